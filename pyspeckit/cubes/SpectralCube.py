@@ -18,18 +18,21 @@ The 'grunt work' is performed by the :py:mod:`cubes` module
 import pyspeckit
 from pyspeckit import spectrum
 from ..spectrum.units import generate_xarr,SpectroscopicAxis
+from ..spectrum.moments import moments_array
 # import local things
 import mapplot
 import readers
 import time
 import numpy as np
-from pyspeckit.parallel_map import parallel_map
+from pyspeckit.parallel_map import parallel_imap, parallel_foreach, shared_array
 import types
 import copy
 import itertools
+import traceback
 from pyspeckit.spectrum import history
 from astropy.io import fits
 import cubes
+from checkpoint import FitCheckpoint
 from astropy import log
 from astropy import wcs
 from astropy import units
@@ -396,17 +399,8 @@ class Cube(spectrum.Spectrum):
         Returns a SpectroscopicAxis instance
         """
 
-        ct = 'CTYPE{0}'.format(self._first_cel_axis_num)
-        header = cubes.speccen_header(fits.Header(cards=[(k,v) for k,v in
-                                                         self.header.iteritems()
-                                                         if k != 'HISTORY']),
-                                      lon=x, lat=y, system=self.system,
-                                      proj=(self.header[ct][-3:]
-                                            if ct in self.header else
-                                            'CAR'))
-
         sp = pyspeckit.Spectrum(xarr=self.xarr.copy(), data=self.cube[:,y,x],
-                                header=header,
+                                header=self._spectrum_header(x,y),
                                 error=(self.errorcube[:,y,x] if self.errorcube
                                        is not None else None))
 
@@ -435,6 +429,34 @@ class Cube(spectrum.Spectrum):
 
         return sp
 
+    def _spectrum_header(self, x, y, template=None):
+        """
+        The header of the spectrum at pixel x,y.  If a ``template`` (a header
+        made by this method for another pixel) is given, it is copied and
+        only the position is updated, which is much faster.
+        """
+        if template is not None:
+            header = template.copy()
+            # these are the position keywords set by cubes.speccen_header
+            header['CRVAL2'] = x
+            header['CRVAL3'] = y
+            return header
+        ct = 'CTYPE{0}'.format(self._first_cel_axis_num)
+        return cubes.speccen_header(fits.Header(cards=[(k,v) for k,v in
+                                                       self.header.iteritems()
+                                                       if k != 'HISTORY']),
+                                    lon=x, lat=y, system=self.system,
+                                    proj=(self.header[ct][-3:]
+                                          if ct in self.header else
+                                          'CAR'))
+
+    def _get_spectrum_view(self, x, y, header_template=None):
+        """
+        A lightweight version of `get_spectrum` for the per-pixel loops: see
+        `PixelSpectrum`
+        """
+        return PixelSpectrum(self, x, y, header_template=header_template)
+
     def get_apspec(self, aperture, coordsys=None, method='mean', **kwargs):
         """
         Extract an aperture using cubes.extract_aperture
@@ -528,7 +550,9 @@ class Cube(spectrum.Spectrum):
                 blank_value=0, integral=True, direct=False, absorption=False,
                 use_nearest_as_guess=False, use_neighbor_as_guess=False,
                 start_from_point=(0,0), multicore=1, position_order = None,
-                continuum_map=None, **fitkwargs):
+                continuum_map=None, checkpoint=None, checkpoint_interval=60,
+                resume=False, engine='specfit', batch_size=1024,
+                **fitkwargs):
         """
         Fit a spectrum to each valid pixel in the cube
 
@@ -572,14 +596,54 @@ class Cube(spectrum.Spectrum):
             3 - print out messages when fitting pixels
             4 - specfit will be verbose 
         multicore: int
-            if >1, try to use multiprocessing via parallel_map to run on multiple cores
+            if >1, fit on multiple cores using a pool of worker processes
+            (see `pyspeckit.parallel_map.parallel_imap`).  Pixels are handed
+            out in dynamically sized chunks, and the workers write their
+            results straight into ``parcube``/``errcube``/``has_fit``, which
+            are held in shared memory for the duration of the fit.
         continuum_map: np.ndarray
             Same shape as error map.  Subtract this from data before estimating noise.
+        checkpoint: str or None
+            If set, periodically save the fit results to this ``.npz`` file
+            (plus an append-only ``.log`` of the pixels finished since the
+            last save) so that a crashed run can be resumed.  See
+            `pyspeckit.cubes.checkpoint.FitCheckpoint`.
+        checkpoint_interval: float
+            Minimum number of seconds between checkpoint snapshots
+        resume: bool
+            Load the results stored in ``checkpoint`` and only fit the
+            pixels that have not been done yet
+        engine: 'specfit' or 'batched'
+            'specfit' fits each pixel with its own `Specfit` call.  'batched'
+            fits blocks of ``batch_size`` pixels at once with the vectorized
+            `~pyspeckit.spectrum.models.model.SpectralModel.batch_fitter`,
+            which is much faster for simple models (gaussian, lorentzian,
+            voigt).  It supports neither tied parameters nor
+            ``use_nearest_as_guess``/``use_neighbor_as_guess``, and
+            ignores ``multicore``.  Its integral map is the integral of the
+            best-fit model.
+        batch_size: int
+            Number of spectra fitted together when ``engine='batched'``
+
+        Notes
+        -----
+        A pixel whose fit raises an exception does not abort the run: its
+        parameters are set to ``blank_value``, ``has_fit`` is False, and the
+        traceback is stored in ``self.fit_errors[(x,y)]``.
 
         """
         if 'multifit' in fitkwargs:
             log.warn("The multifit keyword is no longer required.  All fits "
                      "allow for multiple components.", DeprecationWarning)
+        if resume and checkpoint is None:
+            raise ValueError("A checkpoint file is required to resume a fit.")
+        if engine not in ('specfit', 'batched'):
+            raise ValueError("engine must be 'specfit' or 'batched'")
+        if engine == 'batched' and (use_nearest_as_guess or
+                                    use_neighbor_as_guess):
+            raise ValueError("The batched engine fits many pixels at "
+                             "once, so it cannot use neighboring fits "
+                             "as guesses.")
 
         if not hasattr(self.mapplot,'plane'):
             self.mapplot.makeplane()
@@ -628,24 +692,58 @@ class Cube(spectrum.Spectrum):
             if npars == 0:
                 raise ValueError("Parameter guesses are required.")
 
-        self.parcube = np.zeros((npars,)+self.mapplot.plane.shape)
-        self.errcube = np.zeros((npars,)+self.mapplot.plane.shape) 
-        if integral: self.integralmap = np.zeros((2,)+self.mapplot.plane.shape)
+        # In the multicore case, the output planes live in shared memory so
+        # that the workers write their fits into them directly
+        zeros = shared_array if multicore > 1 else np.zeros
+        self.parcube = zeros((npars,)+self.mapplot.plane.shape)
+        self.errcube = zeros((npars,)+self.mapplot.plane.shape)
+        if integral: self.integralmap = zeros((2,)+self.mapplot.plane.shape)
 
         # newly needed as of March 27, 2012.  Don't know why.
         if 'fittype' in fitkwargs: self.specfit.fittype = fitkwargs['fittype']
         self.specfit.fitter = self.specfit.Registry.multifitters[self.specfit.fittype]
 
         # array to store whether pixels have fits
-        self.has_fit = np.zeros(self.mapplot.plane.shape, dtype='bool')
+        self.has_fit = zeros(self.mapplot.plane.shape, dtype='bool')
+        # tracebacks of pixels whose fits raised, keyed by (x,y)
+        self.fit_errors = {}
+
+        if checkpoint is not None:
+            self._checkpoint = FitCheckpoint(checkpoint, self,
+                                             interval=checkpoint_interval)
+            if resume:
+                self._checkpoint.load()
+                valid_pixels = [(x,y) for (x,y) in valid_pixels
+                                if not self._checkpoint.done[y,x]]
+                if len(valid_pixels) == 0:
+                    log.info("All pixels in the checkpoint have been fitted.")
+                    self._checkpoint.close()
+                    return
+            else:
+                # start a fresh snapshot and log
+                self._checkpoint.save()
+
+        if engine == 'batched':
+            self._fiteach_batched(valid_pixels, guesses=guesses,
+                                  errspec=errspec, errmap=errmap,
+                                  signal_cut=signal_cut,
+                                  continuum_map=continuum_map,
+                                  absorption=absorption,
+                                  usemomentcube=usemomentcube,
+                                  blank_value=blank_value, integral=integral,
+                                  batch_size=batch_size, verbose=verbose,
+                                  checkpoint=checkpoint, **fitkwargs)
+            return
 
         self._counter = 0
 
         t0 = time.time()
 
+        header_template = self._spectrum_header(0, 0)
+
         def fit_a_pixel(iixy):
             ii,x,y = iixy
-            sp = self.get_spectrum(x,y)
+            sp = self._get_spectrum_view(x, y, header_template)
 
             # very annoying - cannot use min/max without checking type
             # maybe can use np.asarray here?
@@ -689,6 +787,10 @@ class Cube(spectrum.Spectrum):
             # Do some homework for local fits
             xpatch = np.array([1,1,1,0,0,0,-1,-1,-1],dtype=np.int)
             ypatch = np.array([1,0,-1,1,0,-1,1,0,-1],dtype=np.int)
+            # neighbors that fall off the edge of the map are ignored
+            inmap = ((xpatch+x >= 0) & (xpatch+x < self.has_fit.shape[1]) &
+                     (ypatch+y >= 0) & (ypatch+y < self.has_fit.shape[0]))
+            xpatch, ypatch = xpatch[inmap], ypatch[inmap]
             local_fits = self.has_fit[ypatch+y,xpatch+x]
 
             
@@ -739,11 +841,6 @@ class Cube(spectrum.Spectrum):
                 self.errcube[:,y,x] = blank_value
                 if integral: self.integralmap[:,y,x] = blank_value
 
-        
-            if blank_value != 0:
-                self.parcube[self.parcube == 0] = blank_value
-                self.errcube[self.parcube == 0] = blank_value
-
             self._counter += 1
             if verbose:
                 if ii % (min(10**(3-verbose_level),1)) == 0:
@@ -785,7 +882,7 @@ class Cube(spectrum.Spectrum):
         # replicates what's inside the fit_a_pixel code and so should be a
         # useful sanity check
         x,y = valid_pixels[0]
-        sp = self.get_spectrum(x,y)
+        sp = self._get_spectrum_view(x,y)
         sp.specfit.Registry = self.Registry # copy over fitter registry
         # this reproduced code is needed because the functional wrapping
         # required for the multicore case prevents gg from being set earlier
@@ -802,66 +899,57 @@ class Cube(spectrum.Spectrum):
         #### END TEST BLOCK ####
 
 
+        def store_error(x, y, error):
+            log.warn("Fit at %i,%i failed:\n%s" % (x, y, error))
+            self.fit_errors[(x,y)] = error
+            self.parcube[:,y,x] = blank_value
+            self.errcube[:,y,x] = blank_value
+            self.has_fit[y,x] = False
+            if integral: self.integralmap[:,y,x] = blank_value
+
         if multicore > 1:
-            sequence = [(ii,x,y) for ii,(x,y) in tuple(enumerate(valid_pixels))]
-            result = parallel_map(fit_a_pixel, sequence, numcores=multicore)
-            self._result = result # backup - don't want to lose data in the case of a failure
-            # a lot of ugly hacking to deal with the way parallel_map returns
-            # its results needs TWO levels of None-filtering, because any
-            # individual result can be None (I guess?) but apparently (and this
-            # part I don't believe) any individual *fit* result can be None as
-            # well (apparently the x,y pairs can also be None?)
-            merged_result = [core_result for core_result in result if
-                             core_result is not None]
-            # for some reason, every other time I run this code, merged_result
-            # ends up with a different intrinsic shape.  This is an attempt to
-            # force it to maintain a sensible shape.
-            try:
-                if integral:
-                    ((x,y), m1, m2, intgl) = merged_result[0]
-                else:
-                    ((x,y), m1, m2) = merged_result[0]
-            except ValueError:
-                if verbose > 1:
-                    log.exception("ERROR: merged_result[0] is {0} which has the"
-                                  " wrong shape".format(merged_result[0]))
-                merged_result = itertools.chain.from_iterable(merged_result)
-            for TEMP in merged_result:
-                if TEMP is None:
-                    # this shouldn't be possible, but it appears to happen
-                    # anyway.  parallel_map is great, up to a limit that was
-                    # reached long before this level of complexity
-                    log.debug("Skipped a None entry: {0}".format(str(TEMP)))
-                    continue
-                try:
-                    if integral:
-                        ((x,y), modelpars, modelerrs, intgl) = TEMP
-                    else:
-                        ((x,y), modelpars, modelerrs) = TEMP
-                except TypeError:
-                    # implies that TEMP does not have the shape ((a,b),c,d)
-                    # as above, shouldn't be possible, but it happens...
-                    log.debug("Skipped a misshapen entry: {0}".format(str(TEMP)))
-                    continue
-                if ((len(modelpars) != len(modelerrs)) or
-                    (len(modelpars) != len(self.parcube))):
-                    raise ValueError("There was a serious problem; modelpar and"
-                                     " error shape don't match that of the "
-                                     "parameter cubes")
-                if np.any(np.isnan(modelpars)) or np.any(np.isnan(modelerrs)):
-                    self.parcube[:,y,x] = np.nan
-                    self.errcube[:,y,x] = np.nan
-                    self.has_fit[y,x] = False
-                else:
-                    self.parcube[:,y,x] = modelpars
-                    self.errcube[:,y,x] = modelerrs
-                    self.has_fit[y,x] = max(modelpars) > 0
-                if integral:
-                    self.integralmap[:,y,x] = intgl
+            # the workers write into the shared planes; only a completion
+            # flag (or a traceback) comes back through the queue
+            sequence = [(ii,x,y) for ii,(x,y) in enumerate(valid_pixels)]
+            fit_in_place = lambda iixy: fit_a_pixel(iixy) and None
+            for ii, result, error in parallel_imap(fit_in_place, sequence,
+                                                   numcores=multicore):
+                if error is not None:
+                    store_error(valid_pixels[ii][0], valid_pixels[ii][1],
+                                error)
+                elif checkpoint is not None:
+                    self._checkpoint.record(*valid_pixels[ii])
+
+            # detach the results from the shared buffers
+            self.parcube = np.array(self.parcube)
+            self.errcube = np.array(self.errcube)
+            self.has_fit = np.array(self.has_fit)
+            if integral: self.integralmap = np.array(self.integralmap)
         else:
             for ii,(x,y) in enumerate(valid_pixels):
-                fit_a_pixel((ii,x,y))
+                try:
+                    fit_a_pixel((ii,x,y))
+                except KeyboardInterrupt:
+                    raise
+                except Exception:
+                    store_error(x, y, traceback.format_exc())
+                else:
+                    if checkpoint is not None:
+                        self._checkpoint.record(x, y)
+
+        # blank the unfitted parameters once all of the workers are done
+        # (doing it in the workers would race with the other pixels' writes)
+        if blank_value != 0:
+            blank = self.parcube == 0
+            self.parcube[blank] = blank_value
+            self.errcube[blank] = blank_value
 
+        if checkpoint is not None:
+            self._checkpoint.close()
+
+        if self.fit_errors:
+            log.warn("%i of %i fits failed; see the fit_errors attribute." %
+                     (len(self.fit_errors), len(valid_pixels)))
 
         # March 27, 2014: This is EXTREMELY confusing.  This isn't in a loop...
         # make sure the fitter / fittype are set for the cube
@@ -873,17 +961,268 @@ class Cube(spectrum.Spectrum):
 
         if verbose:
             log.info("Finished final fit %i.  "
-                     "Elapsed time was %0.1f seconds" % (ii+1, time.time()-t0))
+                     "Elapsed time was %0.1f seconds" % (len(valid_pixels), time.time()-t0))
+
+
+    def _fiteach_batched(self, valid_pixels, guesses=(), errspec=None,
+                         errmap=None, signal_cut=3, continuum_map=None,
+                         absorption=False, usemomentcube=False, blank_value=0,
+                         integral=True, batch_size=1024, verbose=True,
+                         checkpoint=None, **fitkwargs):
+        """
+        The ``engine='batched'`` implementation of `fiteach`: gather blocks of
+        valid spectra into (nspec, nchan) arrays and fit each block with
+        `~pyspeckit.spectrum.models.model.SpectralModel.batch_fitter`.
+
+        ``parcube``, ``errcube``, ``has_fit`` and ``integralmap`` must already
+        be allocated.
+        """
+        fitter = self.specfit.fitter
+        fitkwargs.pop('fittype', None)
+        for kw in ('quiet', 'verbose', 'veryverbose'):
+            fitkwargs.pop(kw, None)
+
+        xarr = self.xarr
+        # channels excluded from the fit region get zero weight
+        if (self.specfit.includemask is not None and
+            self.specfit.includemask.shape == xarr.shape):
+            excluded = ~self.specfit.includemask
+        else:
+            excluded = np.zeros(xarr.shape, dtype='bool')
+        if integral:
+            # as for the per-pixel engine, the model is evaluated on the axis
+            # that it was fitted on, and integrated over the cube's axis
+            dx = np.abs(xarr.cdelt(approx=True))
+            if fitter.fitunits is not None:
+                modelxarr = xarr.as_unit(fitter.fitunits)
+            else:
+                modelxarr = xarr
+
+        t0 = time.time()
+        npix = len(valid_pixels)
+        for start in xrange(0, npix, batch_size):
+            xs, ys = [np.array(v) for v in zip(*valid_pixels[start:start+batch_size])]
+
+            data = np.array(self.cube[:,ys,xs].T, dtype='float64')
+            if np.ma.isMaskedArray(data):
+                data = data.filled(np.nan)
+            if errspec is not None:
+                error = np.repeat(np.asarray(errspec, dtype='float64')[np.newaxis,:],
+                                  len(xs), axis=0)
+            elif errmap is not None:
+                error = np.repeat(errmap[ys,xs][:,np.newaxis], xarr.size,
+                                  axis=1).astype('float64')
+            else:
+                # same as the per-pixel default: the std of the finite data
+                error = np.repeat(np.array([row[np.isfinite(row)].std()
+                                            for row in data])[:,np.newaxis],
+                                  xarr.size, axis=1)
+
+            keep = np.ones(len(xs), dtype='bool')
+            if signal_cut > 0:
+                if continuum_map is not None:
+                    snr = (data - continuum_map[ys,xs][:,np.newaxis]) / error
+                else:
+                    snr = data / error
+                max_sn = np.nanmax(-snr if absorption else snr, axis=1)
+                keep = max_sn >= signal_cut
+
+            if usemomentcube:
+                gg = self.momentcube[:,ys,xs].T
+            elif hasattr(guesses,'shape') and guesses.shape[1:] == self.cube.shape[1:]:
+                gg = guesses[:,ys,xs].T
+            elif isinstance(guesses, dict):
+                gg = np.array([guesses[(y,x)] for x,y in zip(xs,ys)])
+            else:
+                gg = np.repeat(np.array(guesses, dtype='float64', ndmin=2),
+                               len(xs), axis=0)
+            keep &= np.all(np.isfinite(gg), axis=1)
+            self.parcube[:,ys[~keep],xs[~keep]] = blank_value
+            self.errcube[:,ys[~keep],xs[~keep]] = blank_value
+            if integral: self.integralmap[:,ys[~keep],xs[~keep]] = blank_value
+
+            if np.any(keep):
+                error[:,excluded] = np.inf
+                pars, errs, chi2, status = fitter.batch_fitter(xarr,
+                                                               data[keep],
+                                                               err=error[keep],
+                                                               guesses=gg[keep],
+                                                               **fitkwargs)
+                kx, ky = xs[keep], ys[keep]
+                good = np.all(np.isfinite(pars), axis=1)
+                self.parcube[:,ky,kx] = pars.T
+                self.errcube[:,ky,kx] = errs.T
+                self.has_fit[ky,kx] = good
+                if integral:
+                    model = fitter.batch_modelfunc(modelxarr, pars,
+                                                   **fitter.modelfunc_kwargs)
+                    significant = np.abs(model) > 0.01*np.abs(model).max(axis=1)[:,np.newaxis]
+                    self.integralmap[0,ky,kx] = model.sum(axis=1) * dx
+                    significant &= np.isfinite(error[keep])
+                    self.integralmap[1,ky,kx] = (np.sqrt((np.where(significant, error[keep], 0)**2).sum(axis=1)) * dx)
+
+            if checkpoint is not None:
+                for x,y in zip(xs,ys):
+                    self._checkpoint.record(x, y)
+
+            if verbose:
+                log.info("Finished fit %6i of %6i.  Elapsed time is %0.1f "
+                         "seconds" % (min(start+batch_size, npix), npix,
+                                      time.time()-t0))
 
+        if checkpoint is not None:
+            self._checkpoint.close()
 
-    def momenteach(self, verbose=True, verbose_level=1, multicore=1, **kwargs):
+        # make sure the fitter / fittype are set for the cube, as for the
+        # per-pixel engine
+        self.specfit.parinfo = fitter.parinfo
+        self.specfit.npeaks = fitter.npeaks
+
+    def mcmceach(self, nsteps=500, burn=100, nwalkers=None, errspec=None,
+                 errmap=None, multicore=1, verbose=True, **kwargs):
+        """
+        Sample the posterior of the model of each fitted pixel with an
+        independent emcee ensemble, started around the `fiteach` results
+
+        The log probability of all of the walkers of an ensemble is computed
+        at once (see
+        `~pyspeckit.spectrum.models.model.SpectralModel.logp_batch`).  The
+        mean and standard deviation of each parameter over the samples after
+        ``burn`` steps are stored in ``mcmc_parcube`` and ``mcmc_errcube``,
+        and the mean acceptance fraction of each ensemble in
+        ``mcmc_acceptance``.
+
+        Parameters
+        ----------
+        nsteps : int
+            Number of steps of each ensemble
+        burn : int
+            Number of initial steps discarded
+        nwalkers : int or None
+            Number of walkers; defaults to twice the number of parameters
+        errspec : np.ndarray or None
+            The error spectrum, the same for every pixel
+        errmap : np.ndarray or None
+            The error of each pixel.  If neither ``errspec`` nor ``errmap`` is
+            given, the std() of each spectrum is used, as in `fiteach`.
+        multicore : int
+            if >1, run the ensembles of different pixels in that many
+            processes, which write into shared-memory output cubes
+        kwargs : dict
+            Passed to ``emcee.EnsembleSampler``
+        """
+        if not hasattr(self, 'parcube'):
+            raise ValueError("mcmceach starts from the results of fiteach, "
+                             "which must be run first.")
+        if burn >= nsteps:
+            raise ValueError("burn must be smaller than nsteps")
+
+        try:
+            import emcee
+        except ImportError:
+            raise ImportError("mcmceach requires emcee")
+
+        fitter = self.specfit.fitter
+        npars = self.parcube.shape[0]
+        if nwalkers is None:
+            nwalkers = 2*npars
+
+        xarr = self.xarr
+        if (self.specfit.includemask is not None and
+            self.specfit.includemask.shape == xarr.shape):
+            excluded = ~self.specfit.includemask
+        else:
+            excluded = np.zeros(xarr.shape, dtype='bool')
+
+        ys, xs = np.where(self.has_fit)
+        zeros = shared_array if multicore > 1 else np.zeros
+        self.mcmc_parcube = zeros((npars,)+self.parcube.shape[1:])
+        self.mcmc_errcube = zeros((npars,)+self.parcube.shape[1:])
+        self.mcmc_acceptance = zeros(self.parcube.shape[1:])
+
+        t0 = time.time()
+
+        def mcmc_a_pixel(iixy):
+            ii,x,y = iixy
+            data = np.ma.filled(np.ma.asarray(self.cube[:,y,x],
+                                              dtype='float64'), np.nan)
+            if errspec is not None:
+                error = np.array(errspec, dtype='float64')
+            elif errmap is not None:
+                error = np.ones(data.shape) * errmap[y,x]
+            else:
+                error = np.ones(data.shape) * data[np.isfinite(data)].std()
+            # bad and excluded channels do not contribute
+            bad = excluded | ~np.isfinite(data)
+            data[bad] = 0
+            error[bad] = np.inf
+
+            sampler = fitter.get_emcee_ensemblesampler(xarr, data, error,
+                                                       nwalkers, **kwargs)
+
+            # scatter the walkers by the fit errors (or by 10% where there
+            # are none), keeping them within the parameter limits.  An
+            # ensemble without spread in a parameter never moves in it, so a
+            # parameter of 0 without an error is scattered by 1e-3.
+            pars = np.asarray(self.parcube[:,y,x])
+            scatter = np.asarray(self.errcube[:,y,x])
+            noerr = ~(np.isfinite(scatter) & (scatter > 0))
+            scatter = np.where(noerr, np.abs(pars)/10., scatter)
+            scatter[scatter == 0] = 1e-3
+            # (a fresh generator, so forked workers do not share a seed)
+            random = np.random.RandomState()
+            p0 = pars + random.randn(nwalkers, npars) * scatter
+            outside = ~fitter.parinfo.in_limits(p0)
+            p0[outside] = pars
+
+            sampler.run_mcmc(p0, nsteps)
+            samples = np.asarray(sampler.chain)[:,burn:,:].reshape(-1, npars)
+            self.mcmc_parcube[:,y,x] = samples.mean(axis=0)
+            self.mcmc_errcube[:,y,x] = samples.std(axis=0)
+            self.mcmc_acceptance[y,x] = np.mean(sampler.acceptance_fraction)
+
+            if verbose:
+                log.info("Finished MCMC %6i of %6i at (%4i,%4i).  Elapsed "
+                         "time is %0.1f seconds" % (ii+1, len(xs), x, y,
+                                                    time.time()-t0))
+
+        sequence = [(ii,x,y) for ii,(x,y) in enumerate(zip(xs,ys))]
+        if multicore > 1:
+            parallel_foreach(mcmc_a_pixel, sequence, numcores=multicore)
+            self.mcmc_parcube = np.array(self.mcmc_parcube)
+            self.mcmc_errcube = np.array(self.mcmc_errcube)
+            self.mcmc_acceptance = np.array(self.mcmc_acceptance)
+        else:
+            for iixy in sequence:
+                mcmc_a_pixel(iixy)
+
+    def momenteach(self, verbose=True, verbose_level=1, multicore=1,
+                   tilesize=4096, unit='km/s', **kwargs):
         """
         Return a cube of the moments of each pixel
 
+        The moments of all of the valid pixels are computed at once, as
+        reductions along the spectral axis (see
+        `~pyspeckit.spectrum.moments.moments_array`), ``tilesize`` pixels at
+        a time.  Only the pixels that are finite in the map plane and in
+        ``maskmap`` are computed; the others are left at 0.  No pixel raises
+        ``ValueError("something is nan")`` as
+        `~pyspeckit.spectrum.moments.moments` does: non-finite channels are
+        ignored, and constant spectra get moments of 0.
+
         Parameters
         ----------
         multicore: int
-            if >1, try to use multiprocessing via parallel_map to run on multiple cores
+            if >1, compute the moments of the tiles on multiple cores; the
+            workers write into a shared-memory moment cube
+        tilesize : int
+            Number of pixels whose moments are computed at a time
+        unit : str or None
+            The unit of the spectral axis in which the moments are computed,
+            as in `~pyspeckit.Spectrum.moments`.  If None or False, use the
+            current unit.
+        kwargs : dict
+            Passed to `~pyspeckit.spectrum.moments.moments_array`
         """
 
         if not hasattr(self.mapplot,'plane'):
@@ -891,46 +1230,49 @@ class Cube(spectrum.Spectrum):
 
         yy,xx = np.indices(self.mapplot.plane.shape)
         if isinstance(self.mapplot.plane, np.ma.core.MaskedArray): 
-            OK = (True-self.mapplot.plane.mask) * self.maskmap
+            OK = ~self.mapplot.plane.mask * self.maskmap
         else:
             OK = np.isfinite(self.mapplot.plane) * self.maskmap
-        valid_pixels = zip(xx[OK],yy[OK])
+        ys, xs = yy[OK], xx[OK]
 
-        # run the moment process to find out how many elements are in a moment
-        _temp_moment = self.get_spectrum(yy[OK][0],xx[OK][0]).moments(**kwargs)
+        if unit is False or unit is None:
+            xarr = self.xarr
+        else:
+            xarr = self.xarr.as_unit(unit)
+        # the spectra are sorted along the spectral axis, as they are in a
+        # Spectrum
+        xorder = np.argsort(np.asarray(xarr))
+        Xax = np.asarray(xarr)[xorder]
 
-        self.momentcube = np.zeros((len(_temp_moment),)+self.mapplot.plane.shape)
+        nmoments = 3 + kwargs.get('vheight', True)
+        zeros = shared_array if multicore > 1 else np.zeros
+        self.momentcube = zeros((nmoments,)+self.mapplot.plane.shape)
 
         t0 = time.time()
 
-        def moment_a_pixel(iixy):
-            ii,x,y = iixy
-            sp = self.get_spectrum(x,y)
-            self.momentcube[:,y,x] = sp.moments(**kwargs)
+        def moment_a_tile(start):
+            tile = slice(start, min(start+tilesize, len(xs)))
+            data = self.cube[:,ys[tile],xs[tile]][xorder]
+            self.momentcube[:,ys[tile],xs[tile]] = moments_array(Xax, data,
+                                                                 **kwargs)
             if verbose:
-                if ii % 10**(3-verbose_level) == 0:
-                    log.info("Finished moment %i.  "
-                             "Elapsed time is %0.1f seconds" % (ii, time.time()-t0))
-
-            return ((x,y), self.momentcube[:,y,x])
+                log.info("Finished moments of pixels %i-%i.  "
+                         "Elapsed time is %0.1f seconds" % (tile.start,
+                                                            tile.stop,
+                                                            time.time()-t0))
 
+        starts = range(0, len(xs), tilesize)
         if multicore > 1:
-            sequence = [(ii,x,y) for ii,(x,y) in tuple(enumerate(valid_pixels))]
-            result = parallel_map(moment_a_pixel, sequence, numcores=multicore)
-            merged_result = [core_result
-                             for core_result in result
-                             if core_result is not None]
-            for mr in merged_result:
-                for TEMP in mr:
-                    ((x,y), moments) = TEMP
-                    self.momentcube[:,y,x] = moments
+            # workers write straight into the shared moment cube
+            parallel_foreach(moment_a_tile, starts, numcores=multicore)
+            self.momentcube = np.array(self.momentcube)
         else:
-            for ii,(x,y) in enumerate(valid_pixels):
-                moment_a_pixel((ii,x,y))
+            for start in starts:
+                moment_a_tile(start)
 
         if verbose:
             log.info("Finished final moment %i.  "
-                     "Elapsed time was %0.1f seconds" % (ii+1, time.time()-t0))
+                     "Elapsed time was %0.1f seconds" % (len(xs), time.time()-t0))
 
     def show_moment(self, momentnumber, **kwargs):
         """
@@ -1117,6 +1459,101 @@ class Cube(spectrum.Spectrum):
         raise NotImplementedError
 
 
+class PixelSpectrum(spectrum.Spectrum):
+    """
+    A lightweight `~pyspeckit.Spectrum` of one pixel of a `Cube`, used by the
+    per-pixel loops (`Cube.fiteach`, `Cube.momenteach`).
+
+    The spectral axis and the fitter registry are shared with the cube, and
+    the header, plotter, baseline and fitter are only built when they are
+    first used.  The fitter starts from the cube's fitter settings but not
+    from its fitted parameters.  Use `to_spectrum` (or `Cube.get_spectrum`)
+    to get a full, independent Spectrum.
+    """
+
+    def __init__(self, cube, x, y, header_template=None):
+        self._cube = cube
+        self._pixel = (x, y)
+        self._header_template = header_template
+        self._header = None
+        self._plotter = None
+        self._baseline = None
+        self._specfit = None
+
+        self.xarr = cube.xarr
+        self.data = cube.cube[:,y,x]
+        if cube.errorcube is not None:
+            self.error = cube.errorcube[:,y,x]
+        else:
+            self.error = self.data * 0
+        self._maskdata()
+        self._sort()
+        self.parse_header(cube.header)
+
+        self.Registry = cube.Registry
+        self.speclines = spectrum.speclines
+        self.plot_special = None
+        self.plot_special_kwargs = {}
+
+    def to_spectrum(self):
+        """
+        Materialize the full `~pyspeckit.Spectrum` of this pixel
+        """
+        return self._cube.get_spectrum(*self._pixel)
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = self._cube._spectrum_header(*self._pixel,
+                                                       template=self._header_template)
+        return self._header
+
+    @header.setter
+    def header(self, value):
+        self._header = value
+
+    @property
+    def plotter(self):
+        if self._plotter is None:
+            self._plotter = spectrum.plotters.Plotter(self)
+        return self._plotter
+
+    @plotter.setter
+    def plotter(self, value):
+        self._plotter = value
+
+    @property
+    def baseline(self):
+        if self._baseline is None:
+            self._baseline = spectrum.baseline.Baseline(self)
+        return self._baseline
+
+    @baseline.setter
+    def baseline(self, value):
+        self._baseline = value
+
+    @property
+    def specfit(self):
+        if self._specfit is None:
+            cubefit = self._cube.specfit
+            specfit = spectrum.fitters.Specfit(self, Registry=self.Registry)
+            specfit.parinfo = copy.deepcopy(cubefit.parinfo)
+            if specfit.parinfo is not None:
+                specfit.modelpars = specfit.parinfo.values
+                specfit.modelerrs = specfit.parinfo.errors
+            specfit.includemask = cubefit.includemask.copy()
+            specfit.npeaks = cubefit.npeaks
+            if hasattr(cubefit, 'fitter'):
+                # shared with the cube, as the registry's fitters are
+                specfit.fitter = cubefit.fitter
+            self._specfit = specfit
+        return self._specfit
+
+    @specfit.setter
+    def specfit(self, value):
+        self._specfit = value
+
+
 class CubeStack(Cube):
     """
     The Cube equivalent of Spectra: for stitching multiple cubes with the same
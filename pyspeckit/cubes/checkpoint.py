@@ -0,0 +1,149 @@
+"""
+Checkpointing for long `~pyspeckit.cubes.SpectralCube.Cube.fiteach` runs.
+
+A checkpoint consists of two files:
+
+   * ``<filename>``, a ``.npz`` snapshot of ``parcube``, ``errcube``,
+     ``has_fit``, ``integralmap`` and a map of the pixels that have been
+     processed, rewritten atomically every ``interval`` seconds
+   * ``<filename>.log``, an append-only text log with one line per pixel
+     finished since the last snapshot, flushed after every line, so that
+     little work is lost if the process dies between snapshots
+
+Resuming loads the snapshot and replays the log on top of it.
+"""
+import os
+import time
+import numpy as np
+from astropy import log
+
+
+class FitCheckpoint(object):
+    """
+    Periodically persist the fit results of a cube
+
+    Parameters
+    ----------
+    filename : str
+        The snapshot file name.  The progress log is ``filename + '.log'``.
+    cube : `~pyspeckit.cubes.SpectralCube.Cube`
+        The cube being fitted; its ``parcube``, ``errcube``, ``has_fit`` and
+        (optionally) ``integralmap`` attributes must already exist.
+    interval : float
+        Minimum number of seconds between snapshots.  The log is flushed
+        after every pixel; the snapshot is synced to disk before the log is
+        truncated.  Snapshots cost roughly one write of the parameter cubes,
+        so this should be long compared to that.
+    """
+    def __init__(self, filename, cube, interval=60):
+        if not filename.endswith('.npz'):
+            # np.savez would append it anyway
+            filename = filename + '.npz'
+        self.filename = filename
+        self.logfilename = filename + '.log'
+        self.cube = cube
+        self.interval = interval
+        self.done = np.zeros(cube.has_fit.shape, dtype='bool')
+        self._logfile = None
+        self._last_save = time.time()
+
+    @property
+    def _planes(self):
+        planes = {'parcube': self.cube.parcube,
+                  'errcube': self.cube.errcube,
+                  'has_fit': self.cube.has_fit,
+                  'done': self.done}
+        if hasattr(self.cube, 'integralmap'):
+            planes['integralmap'] = self.cube.integralmap
+        return planes
+
+    def load(self):
+        """
+        Restore the snapshot and replay the progress log into the cube's
+        arrays (in place).  Returns the number of pixels already done.
+        """
+        if not os.path.exists(self.filename):
+            log.info("No checkpoint found at {0}; starting from "
+                     "scratch.".format(self.filename))
+            return 0
+
+        planes = self._planes
+        snapshot = np.load(self.filename)
+        for name in planes:
+            if name not in snapshot.files:
+                continue
+            if snapshot[name].shape != planes[name].shape:
+                raise ValueError("Checkpoint {0} has {1} with shape {2}, but "
+                                 "the fit expects {3}.  Was it made with a "
+                                 "different model or cube?"
+                                 .format(self.filename, name,
+                                         snapshot[name].shape,
+                                         planes[name].shape))
+            planes[name][:] = snapshot[name]
+
+        if os.path.exists(self.logfilename):
+            npars = self.cube.parcube.shape[0]
+            with open(self.logfilename) as fh:
+                for line in fh:
+                    if not line.endswith('\n'):
+                        # the process died mid-write
+                        break
+                    values = line.split()
+                    x, y, has_fit = int(values[0]), int(values[1]), int(values[2])
+                    values = np.array(values[3:], dtype='float')
+                    self.cube.parcube[:,y,x] = values[:npars]
+                    self.cube.errcube[:,y,x] = values[npars:2*npars]
+                    if len(values) > 2*npars and 'integralmap' in planes:
+                        self.cube.integralmap[:,y,x] = values[2*npars:]
+                    self.cube.has_fit[y,x] = bool(has_fit)
+                    self.done[y,x] = True
+
+        ndone = self.done.sum()
+        log.info("Resuming from checkpoint {0}: {1} pixels already "
+                 "done.".format(self.filename, ndone))
+        return ndone
+
+    def record(self, x, y):
+        """
+        Mark pixel x,y as done, log its results and snapshot if the interval
+        has elapsed
+        """
+        self.done[y,x] = True
+        if self._logfile is None:
+            self._logfile = open(self.logfilename, 'a')
+        values = [self.cube.parcube[:,y,x], self.cube.errcube[:,y,x]]
+        if hasattr(self.cube, 'integralmap'):
+            values.append(self.cube.integralmap[:,y,x])
+        self._logfile.write("%i %i %i %s\n" %
+                            (x, y, self.cube.has_fit[y,x],
+                             " ".join(repr(float(v))
+                                      for v in np.concatenate(values))))
+        # the log is only useful if it survives the process being killed
+        self._logfile.flush()
+
+        if time.time() - self._last_save > self.interval:
+            self.save()
+
+    def save(self):
+        """
+        Write a snapshot (atomically) and start a fresh progress log
+        """
+        tmpname = self.filename + '.tmp.npz'
+        with open(tmpname, 'wb') as fh:
+            np.savez(fh, **self._planes)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmpname, self.filename)
+        # the snapshot supersedes everything in the log
+        if self._logfile is not None:
+            self._logfile.close()
+        self._logfile = open(self.logfilename, 'w')
+        self._last_save = time.time()
+
+    def close(self):
+        """
+        Write a final snapshot and close the progress log
+        """
+        self.save()
+        self._logfile.close()
+        self._logfile = None
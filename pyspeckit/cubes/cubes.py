@@ -23,7 +23,8 @@ import pyspeckit
 from astropy import coordinates
 from astropy import log
 from pyspeckit.specwarnings import warn
-from pyspeckit.parallel_map import parallel_map
+from pyspeckit.parallel_map import parallel_map, parallel_foreach, shared_array
+from pyspeckit.spectrum.baseline import _poly_lstsq, _spline_baselines
 try:
     from AG_fft_tools import smooth
     smoothOK = True
@@ -59,7 +60,7 @@ def blfunc_generator(x=None, polyorder=None, splineorder=None,
     def blfunc(args, x=x):
         yfit,yreal = args
         if hasattr(yfit,'mask'):
-            mask = True-yfit.mask
+            mask = ~yfit.mask
         else:
             mask = np.isfinite(yfit)
 
@@ -78,7 +79,7 @@ def blfunc_generator(x=None, polyorder=None, splineorder=None,
                                       y, polyorder)
                 return yreal-np.polyval(polypars, x).astype(yreal.dtype)
 
-        elif splineorder is not None and scipyOK:
+        elif splineorder is not None:
             if splineorder < 1 or splineorder > 4:
                 raise ValueError("Spline order must be in {1,2,3,4}")
             elif ngood <= splineorder:
@@ -86,17 +87,10 @@ def blfunc_generator(x=None, polyorder=None, splineorder=None,
             else:
                 log.debug("splinesampling: {0}  "
                           "splineorder: {1}".format(sampling, splineorder))
-                endpoint = ngood - (ngood % sampling)
-                y = np.mean([yfit[mask][ii:endpoint:sampling]
-                             for ii in range(sampling)], axis=0)
-                if len(y) <= splineorder:
-                    raise ValueError("Sampling is too sparse.  Use finer sampling or "
-                                     "decrease the spline order.")
-                spl = UnivariateSpline(x[mask][sampling/2:endpoint:sampling],
-                                       y,
-                                       k=splineorder,
-                                       s=0)
-                return yreal-spl(x)
+                return yreal-_spline_baselines(x, yfit[:,None], mask,
+                                               order=splineorder,
+                                               sampling=sampling,
+                                               downsampler=np.mean)[:,0]
         else:
             raise ValueError("Must provide polyorder or splineorder")
 
@@ -104,9 +98,9 @@ def blfunc_generator(x=None, polyorder=None, splineorder=None,
 
 
 def baseline_cube(cube, polyorder=None, cubemask=None, splineorder=None,
-                  numcores=None, sampling=1):
+                  numcores=None, sampling=1, scratchfile=None, tilesize=4096):
     """
-    Given a cube, fit a polynomial to each spectrum
+    Given a cube, fit a polynomial or spline to each spectrum and subtract it
 
     Parameters
     ----------
@@ -117,39 +111,113 @@ def baseline_cube(cube, polyorder=None, cubemask=None, splineorder=None,
     cubemask: boolean ndarray
         Mask to apply to cube.  Values that are True will be ignored when
         fitting.
+    splineorder: int
+        Order of the spline to fit and subtract, if ``polyorder`` is not given
+    sampling : int
+        Average the fitted channels in groups of ``sampling`` before fitting
+        (see `blfunc_generator`)
     numcores : None or int
         Number of cores to use for parallelization.  If None, will be set to
         the number of available cores.
+    scratchfile : None or str
+        The workers write the baselined spectra directly into a shared output
+        array.  By default this is anonymous shared memory; give a filename
+        to use a memory-mapped scratch file instead.
+    tilesize : int
+        The baselines are fitted ``tilesize`` spectra at a time (see
+        `_baseline_tile`); this bounds the memory used per worker.
     """
-    x = np.arange(cube.shape[0], dtype=cube.dtype)
-    #polyfitfunc = lambda y: np.polyfit(x, y, polyorder)
-    blfunc = blfunc_generator(x=x,
-                              splineorder=splineorder,
-                              polyorder=polyorder,
-                              sampling=sampling)
-
-    reshaped_cube = cube.reshape(cube.shape[0], cube.shape[1]*cube.shape[2]).T
-
-    if cubemask is None:
-        log.debug("No mask defined.")
-        fit_cube = reshaped_cube
-    else:
+    if cubemask is not None:
         if cubemask.dtype != 'bool':
             raise TypeError("Cube mask *must* be a boolean array.")
         if cubemask.shape != cube.shape:
             raise ValueError("Mask shape does not match cube shape")
         log.debug("Masking cube with shape {0} "
                   "with mask of shape {1}".format(cube.shape, cubemask.shape))
-        masked_cube = cube.copy()
-        masked_cube[cubemask] = np.nan
-        fit_cube = masked_cube.reshape(cube.shape[0], cube.shape[1]*cube.shape[2]).T
 
+    if polyorder is None and splineorder is None:
+        raise ValueError("Must provide polyorder or splineorder")
+    if polyorder is None and (splineorder < 1 or splineorder > 4):
+        raise ValueError("Spline order must be in {1,2,3,4}")
+
+    npix = cube.shape[1]*cube.shape[2]
+    blcube = shared_array(cube.shape, dtype='float32', filename=scratchfile)
+    flat_cube = cube.reshape(cube.shape[0], npix)
+    flat_mask = (cubemask.reshape(cube.shape[0], npix)
+                 if cubemask is not None else None)
+    flat_blcube = blcube.reshape(cube.shape[0], npix)
+    x = np.arange(cube.shape[0], dtype='float64')
+
+    def baseline_a_tile(start):
+        tile = slice(start, min(start+tilesize, npix))
+        flat_blcube[:,tile] = _baseline_tile(x, flat_cube[:,tile],
+                                             (flat_mask[:,tile] if
+                                              flat_mask is not None
+                                              else None),
+                                             polyorder=polyorder,
+                                             splineorder=splineorder,
+                                             sampling=sampling)
+
+    parallel_foreach(baseline_a_tile, range(0, npix, tilesize),
+                     numcores=numcores)
 
-    baselined = np.array(parallel_map(blfunc, zip(fit_cube,reshaped_cube), numcores=numcores))
-    blcube = baselined.T.reshape(cube.shape)
     return blcube
 
+def _mask_groups(mask):
+    """
+    Group the columns of a 2D boolean array by their pattern
 
+    Returns a list of (pattern, column indices) pairs
+    """
+    packed = np.ascontiguousarray(np.packbits(mask, axis=0).T)
+    keys = packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(inverse, kind='mergesort')
+    splits = np.cumsum(np.bincount(inverse))[:-1]
+    return [(mask[:,first[ii]], columns)
+            for ii, columns in enumerate(np.split(order, splits))]
+
+def _baseline_tile(x, data, mask=None, polyorder=None, splineorder=None,
+                   sampling=1):
+    """
+    Subtract polynomial (``polyorder``) or spline (``splineorder``) baselines
+    from the (nchan, nspec) spectra ``data``, as `blfunc_generator` does one
+    spectrum at a time.
+
+    The spectra are grouped by their pattern of good (finite and not
+    ``mask``-ed) channels; each group shares one design matrix (or spline
+    knot vector) and is fitted with a single multi-spectrum least-squares
+    solve.
+    """
+    data = np.asarray(data)
+    good = np.isfinite(data)
+    if mask is not None:
+        good &= ~mask
+    result = np.array(data, dtype='float32')
+
+    for pattern, columns in _mask_groups(good):
+        ngood = np.count_nonzero(pattern)
+        endpoint = ngood - (ngood % sampling)
+        if polyorder is not None:
+            if ngood < polyorder or endpoint == 0:
+                continue
+            # mean of each run of `sampling` good channels, at the middle one
+            rows = np.flatnonzero(pattern)[:endpoint]
+            y = data[np.ix_(rows, columns)].astype('float64')
+            y = y.reshape(endpoint//sampling, sampling, len(columns)).mean(axis=1)
+            xfit = x[pattern][sampling//2:endpoint:sampling]
+            polypars = _poly_lstsq(xfit, y, order=polyorder)
+            baselines = np.dot(np.vander(x, polyorder+1), polypars)
+        else:
+            if ngood <= splineorder:
+                continue
+            baselines = _spline_baselines(x, data[:,columns], pattern,
+                                          order=splineorder,
+                                          sampling=sampling,
+                                          downsampler=np.mean)
+        result[:,columns] -= baselines.astype('float32')
+
+    return result
 
 def flatten_header(header,delete=False):
     """
@@ -674,12 +742,15 @@ def coords_in_image(fitsfile,lon,lat,system='galactic'):
         return False
 
 def spectral_smooth(cube, smooth_factor, downsample=True, parallel=True,
-                    numcores=None, **kwargs):
+                    numcores=None, scratchfile=None, tilesize=4096, **kwargs):
     """
     Smooth the cube along the spectral direction
-    """
 
-    yy,xx = numpy.indices(cube.shape[1:])
+    The spectra are smoothed ``tilesize`` at a time (see
+    `pyspeckit.spectrum.smooth.smooth_array`), and the smoothed tiles are
+    written in place into a shared output array (anonymous shared memory, or
+    a memory-mapped ``scratchfile`` if given).
+    """
 
     if downsample:
         newshape = cube[::smooth_factor,:,:].shape
@@ -688,17 +759,20 @@ def spectral_smooth(cube, smooth_factor, downsample=True, parallel=True,
     
     # need to make the cube "flat" along dims 1&2 for iteration in the "map"
     flatshape = (cube.shape[0],cube.shape[1]*cube.shape[2])
+    flatcube = cube.reshape(flatshape)
 
-    Ssmooth = lambda x: pyspeckit.smooth.smooth(x, smooth_factor, downsample=downsample, **kwargs)
-    if parallel:
-        newcube = numpy.array(parallel_map(Ssmooth, cube.reshape(flatshape).T, numcores=numcores)).T.reshape(newshape)
-    else:
-        newcube = numpy.array(map(Ssmooth, cube.reshape(flatshape).T)).T.reshape(newshape)
+    newcube = shared_array(newshape, dtype=cube.dtype, filename=scratchfile)
+    flat_newcube = newcube.reshape((newshape[0],flatshape[1]))
+
+    def smooth_a_tile(start):
+        tile = slice(start, min(start+tilesize, flatshape[1]))
+        flat_newcube[:,tile] = pyspeckit.smooth.smooth_array(flatcube[:,tile],
+                                                             smooth_factor,
+                                                             downsample=downsample,
+                                                             **kwargs)
 
-    #naive, non-optimal version
-    # for (x,y) in zip(xx.flat,yy.flat):
-    #     newcube[:,y,x] = pyspeckit.smooth.smooth(cube[:,y,x], smooth_factor,
-    #             downsample=downsample, **kwargs)
+    parallel_foreach(smooth_a_tile, range(0, flatshape[1], tilesize),
+                     numcores=numcores if parallel else 1)
 
     return newcube
 
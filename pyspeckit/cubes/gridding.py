@@ -0,0 +1,212 @@
+"""
+Convolutional gridding of irregularly sampled (e.g., on-the-fly) spectra onto
+a regular pixel grid.
+
+Each spectrum is assigned to the cell of the output grid it falls in; it only
+contributes to the pixels within ``support`` of it, which are found by
+offsetting that cell rather than by searching the whole grid.  The kernels
+follow `Mangum, Emerson & Greisen (2007)
+<http://adsabs.harvard.edu/abs/2007A%26A...474..679M>`_.
+
+The output rows are split into bands that are gridded independently (each
+band only reads the spectra near it and only writes its own rows), so the
+bands can be handed to a thread or process pool, and the spectra are read
+``chunksize`` at a time so that memory use does not grow with their number.
+"""
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from pyspeckit.parallel_map import parallel_foreach, shared_array
+from pyspeckit.parallel_map.parallel_map import guided_chunks
+try:
+    import scipy.special
+    scipyOK = True
+except ImportError:
+    scipyOK = False
+
+kernels = ('gaussian', 'besselgauss')
+
+def kernel_weights(r, beam_fwhm, kernel='gaussian'):
+    """
+    The gridding kernel at distances ``r`` (same units as ``beam_fwhm``)
+
+    Parameters
+    ----------
+    r : np.ndarray
+        Distances from the spectrum
+    beam_fwhm : float
+        The FWHM of the telescope beam
+    kernel : 'gaussian' or 'besselgauss'
+        ``exp(-(r/b)**2)`` with ``b = beam_fwhm/3``, or
+        ``2 J1(pi r/a)/(pi r/a) exp(-(r/b)**2)`` with ``a = 1.55 beam_fwhm/3``
+        and ``b = 2.52 beam_fwhm/3``
+    """
+    r = np.asarray(r, dtype='float64')
+    if kernel == 'gaussian':
+        return np.exp(-(r/(beam_fwhm/3.))**2)
+    elif kernel == 'besselgauss':
+        if not scipyOK:
+            raise ImportError("Couldn't import scipy, therefore cannot use "
+                              "the Bessel x Gaussian kernel")
+        x = np.pi*r/(1.55*beam_fwhm/3.)
+        bessel = np.ones_like(x)
+        nonzero = x != 0
+        bessel[nonzero] = 2*scipy.special.j1(x[nonzero])/x[nonzero]
+        return bessel*np.exp(-(r/(2.52*beam_fwhm/3.))**2)
+    else:
+        raise ValueError("kernel must be one of {0}".format(kernels))
+
+def grid_spectra(spectra, xoff, yoff, xaxis, yaxis, beam_fwhm,
+                 kernel='gaussian', support=None, noise=None,
+                 weight_by_noise=True, chunksize=4096, numcores=1,
+                 parallel='thread'):
+    """
+    Grid spectra onto a regular pixel grid
+
+    Parameters
+    ----------
+    spectra : np.ndarray
+        ``(nspec, nchan)`` array of spectra, e.g. from
+        `~pyspeckit.spectrum.readers.read_class.ClassObject.get_spectra_array`.
+        It may be a memmap or a view of one: it is only read ``chunksize``
+        rows at a time.
+    xoff, yoff : np.ndarray
+        The positions of the spectra
+    xaxis, yaxis : np.ndarray
+        The (regularly spaced) positions of the centers of the output pixels
+        along each axis, in the same units as ``xoff`` and ``yoff``.  Each
+        must have at least two pixels.
+    beam_fwhm : float
+        The beam FWHM that sets the kernel width (see `kernel_weights`)
+    kernel : 'gaussian' or 'besselgauss'
+        The gridding kernel
+    support : float or None
+        The radius beyond which a spectrum does not contribute to a pixel.
+        Defaults to ``beam_fwhm``.
+    noise : np.ndarray or None
+        The noise of each spectrum.  If not given, it is estimated from the
+        channel-to-channel differences of each spectrum.
+    weight_by_noise : bool
+        Multiply the kernel weights by ``1/noise**2``
+    chunksize : int
+        Number of spectra read at a time
+    numcores : int
+        Number of bands of rows gridded at the same time
+    parallel : 'thread' or 'process'
+        Grid the bands in a thread pool or in forked processes writing to
+        shared memory (see `~pyspeckit.parallel_map.shared_array`)
+
+    Returns
+    -------
+    cube : np.ndarray
+        The gridded ``(nchan, ny, nx)`` cube, NaN where no spectrum
+        contributes
+    weights : np.ndarray
+        The ``(ny, nx)`` sum of the weights of each pixel
+    errors : np.ndarray
+        The ``(ny, nx)`` noise of each pixel, propagated from the noise of the
+        spectra; it is the same for every channel
+    """
+    nspec, nchan = spectra.shape
+    xoff = np.asarray(xoff, dtype='float64')
+    yoff = np.asarray(yoff, dtype='float64')
+    if len(xoff) != nspec or len(yoff) != nspec:
+        raise ValueError("There must be one x and one y offset per spectrum.")
+    if noise is not None:
+        noise = np.asarray(noise, dtype='float64')
+    if support is None:
+        support = beam_fwhm
+    if parallel not in ('thread', 'process'):
+        raise ValueError("parallel must be 'thread' or 'process'")
+    # fail early on an unknown kernel (or missing scipy)
+    kernel_weights(np.zeros(1), beam_fwhm, kernel=kernel)
+
+    nx, ny = len(xaxis), len(yaxis)
+    dx, dy = xaxis[1]-xaxis[0], yaxis[1]-yaxis[0]
+    xpix = (xoff - xaxis[0]) / dx
+    ypix = (yoff - yaxis[0]) / dy
+    # the cell offsets reaching every pixel within the support
+    rx = int(np.ceil(support/abs(dx)))
+    ry = int(np.ceil(support/abs(dy)))
+    stencil = [(sx, sy) for sx in range(-rx, rx+1) for sy in range(-ry, ry+1)]
+
+    # spectra sorted by row, so each band finds its own with searchsorted
+    order = np.argsort(ypix, kind='mergesort')
+    ysorted = ypix[order]
+
+    if parallel == 'process' and numcores > 1:
+        make_array = shared_array
+    else:
+        make_array = np.zeros
+    datasum = make_array((ny, nx, nchan), dtype='float32')
+    weightsum = make_array((ny, nx), dtype='float64')
+    varsum = make_array((ny, nx), dtype='float64')
+    datasum_flat = datasum.reshape(ny*nx, nchan)
+    weightsum_flat = weightsum.reshape(ny*nx)
+    varsum_flat = varsum.reshape(ny*nx)
+
+    def grid_band(band):
+        ystart, ystop = band
+        lo = np.searchsorted(ysorted, ystart - ry - 0.5, side='left')
+        hi = np.searchsorted(ysorted, ystop - 1 + ry + 0.5, side='right')
+        # the chunks are aligned on multiples of chunksize, so each pixel
+        # adds up the same partial sums in the same order (and gets the same
+        # result) however the rows are split into bands
+        for start in range(lo - lo % chunksize, hi, chunksize):
+            # read in file order, which is friendlier to a memmap
+            idx = np.sort(order[max(start, lo):min(start+chunksize, hi)])
+            chunk = np.asarray(spectra[idx], dtype='float32')
+            if noise is None:
+                sigma = np.std(np.diff(chunk, axis=1), axis=1)/np.sqrt(2)
+            else:
+                sigma = noise[idx]
+            variance = sigma**2
+            if weight_by_noise:
+                scale = np.zeros_like(variance)
+                scale[variance > 0] = 1./variance[variance > 0]
+            else:
+                scale = np.ones_like(variance)
+
+            cx = np.round(xpix[idx]).astype('int64')
+            cy = np.round(ypix[idx]).astype('int64')
+            for sx, sy in stencil:
+                px, py = cx+sx, cy+sy
+                r = np.hypot((px - xpix[idx])*dx, (py - ypix[idx])*dy)
+                valid = ((px >= 0) & (px < nx) & (py >= ystart) &
+                         (py < ystop) & (r <= support))
+                if not valid.any():
+                    continue
+                rows = np.flatnonzero(valid)
+                w = kernel_weights(r[rows], beam_fwhm, kernel=kernel)*scale[rows]
+                pix = py[rows]*nx + px[rows]
+                pixorder = np.argsort(pix, kind='mergesort')
+                pix, rows, w = pix[pixorder], rows[pixorder], w[pixorder]
+                first = np.flatnonzero(np.concatenate([[True],
+                                                       pix[1:] != pix[:-1]]))
+                upix = pix[first]
+                datasum_flat[upix] += np.add.reduceat(chunk[rows]*w[:,None],
+                                                      first, axis=0)
+                weightsum_flat[upix] += np.add.reduceat(w, first)
+                varsum_flat[upix] += np.add.reduceat(w**2*variance[rows],
+                                                     first)
+
+    if numcores > 1:
+        bands = guided_chunks(ny, numcores)
+        if parallel == 'process':
+            parallel_foreach(grid_band, bands, numcores=numcores)
+        else:
+            pool = ThreadPool(numcores)
+            try:
+                pool.map(grid_band, bands)
+            finally:
+                pool.close()
+    else:
+        grid_band((0, ny))
+
+    empty = weightsum == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        datasum /= weightsum[:,:,None]
+        errors = np.sqrt(varsum)/np.abs(weightsum)
+    datasum[empty] = np.nan
+    errors[empty] = np.nan
+
+    return datasum.transpose(2,0,1), np.array(weightsum), errors
@@ -0,0 +1,82 @@
+"""
+Tests of the tiled, mask-grouped cube baselines against per-spectrum fits
+"""
+
+import numpy as np
+import pytest
+from pyspeckit.cubes import cubes
+
+
+def make_cube(nchan=40, ny=3, nx=5):
+    rng = np.random.RandomState(4)
+    x = np.arange(nchan, dtype='float64')
+    coeffs = rng.normal(size=(3, ny, nx))
+    cube = (coeffs[0] + coeffs[1]*x[:,None,None]/nchan +
+            coeffs[2]*(x[:,None,None]/nchan)**2)
+    cube += 3*np.exp(-(x[:,None,None]-20)**2/8.)
+    cube += rng.normal(0, 0.1, cube.shape)
+    cube = cube.astype('float32')
+    # mask the line in most (but not all) of the spectra, over two ranges
+    cubemask = np.zeros(cube.shape, dtype='bool')
+    cubemask[15:26, :, :3] = True
+    cubemask[17:23, :, 3] = True
+    # NaNs in a few channels of some spectra, and a spectrum with no data
+    cube[[2, 3, 30], 1, 1] = np.nan
+    cube[0, 2, 4] = np.nan
+    cube[:, 0, 4] = np.nan
+    return cube, cubemask
+
+def per_spectrum(cube, cubemask, **kwargs):
+    """ The per-spectrum fits baseline_cube used to run """
+    blfunc = cubes.blfunc_generator(x=np.arange(cube.shape[0], dtype='float64'),
+                                    **kwargs)
+    masked = cube.copy()
+    if cubemask is not None:
+        masked[cubemask] = np.nan
+    result = np.empty_like(cube)
+    for jj in range(cube.shape[1]):
+        for ii in range(cube.shape[2]):
+            result[:,jj,ii] = blfunc((masked[:,jj,ii], cube[:,jj,ii]))
+    return result
+
+@pytest.mark.parametrize('kwargs', [dict(polyorder=1),
+                                    dict(polyorder=2, sampling=3),
+                                    dict(splineorder=2, sampling=4),
+                                    dict(splineorder=3, sampling=3)])
+@pytest.mark.parametrize('masked', [False, True])
+def test_baseline_cube_matches_per_spectrum(kwargs, masked):
+    cube, cubemask = make_cube()
+    if not masked:
+        cubemask = None
+    expected = per_spectrum(cube, cubemask, **kwargs)
+    # tiles smaller than the cube, so groups are split across tiles
+    for numcores in (1, 2):
+        result = cubes.baseline_cube(cube, cubemask=cubemask, numcores=numcores,
+                                     tilesize=4, **kwargs)
+        assert result.shape == cube.shape
+        assert result.dtype == np.float32
+        np.testing.assert_array_equal(np.isnan(result), np.isnan(cube))
+        np.testing.assert_allclose(result, expected, rtol=1e-4, atol=2e-5)
+    # the masked line is left in the baselined spectra
+    if masked:
+        assert np.nanmin(result[20, :, :4]) > 2
+
+def test_mask_groups():
+    mask = np.array([[1, 0, 1, 1, 0],
+                     [0, 0, 0, 0, 0],
+                     [1, 1, 1, 1, 1]], dtype='bool')
+    groups = cubes._mask_groups(mask)
+    assert sorted(sorted(columns.tolist()) for _, columns in groups) == \
+            [[0, 2, 3], [1, 4]]
+    for pattern, columns in groups:
+        for column in columns:
+            np.testing.assert_array_equal(mask[:,column], pattern)
+
+def test_baseline_tile_all_masked():
+    cube, cubemask = make_cube()
+    data = cube.reshape(cube.shape[0], -1)
+    mask = np.ones(data.shape, dtype='bool')
+    # no channels to fit: the spectra are returned unchanged
+    np.testing.assert_array_equal(cubes._baseline_tile(np.arange(40.), data,
+                                                       mask, polyorder=1),
+                                  data)
@@ -0,0 +1,60 @@
+"""
+Tests for fiteach checkpoints
+"""
+
+import numpy as np
+from pyspeckit.cubes.checkpoint import FitCheckpoint
+
+
+class FakeCube(object):
+    def __init__(self, npars=3, ny=4, nx=5):
+        self.parcube = np.zeros((npars, ny, nx))
+        self.errcube = np.zeros((npars, ny, nx))
+        self.has_fit = np.zeros((ny, nx), dtype='bool')
+
+
+def fit_pixel(cube, x, y):
+    cube.parcube[:,y,x] = [x, y, x*y+0.1]
+    cube.errcube[:,y,x] = [0.5, 0.25, x+y]
+    cube.has_fit[y,x] = True
+
+
+def test_log_is_flushed(tmpdir):
+    filename = str(tmpdir.join('fit.npz'))
+    cube = FakeCube()
+    checkpoint = FitCheckpoint(filename, cube, interval=1e6)
+    checkpoint.save()
+    for x, y in [(0,0), (1,2), (4,3)]:
+        fit_pixel(cube, x, y)
+        checkpoint.record(x, y)
+
+    # the log can be read back before it is closed, as after a crash
+    with open(checkpoint.logfilename) as fh:
+        lines = fh.readlines()
+    assert len(lines) == 3
+    assert all(line.endswith('\n') for line in lines)
+
+    resumed = FakeCube()
+    assert FitCheckpoint(filename, resumed).load() == 3
+    np.testing.assert_array_equal(resumed.parcube, cube.parcube)
+    np.testing.assert_array_equal(resumed.errcube, cube.errcube)
+    np.testing.assert_array_equal(resumed.has_fit, cube.has_fit)
+
+
+def test_snapshot_supersedes_log(tmpdir):
+    filename = str(tmpdir.join('fit'))
+    cube = FakeCube()
+    checkpoint = FitCheckpoint(filename, cube, interval=1e6)
+    checkpoint.save()
+    fit_pixel(cube, 2, 1)
+    checkpoint.record(2, 1)
+    checkpoint.close()
+    assert checkpoint.filename.endswith('.npz')
+    with open(checkpoint.logfilename) as fh:
+        assert fh.read() == ''
+
+    resumed = FakeCube()
+    reader = FitCheckpoint(filename, resumed)
+    assert reader.load() == 1
+    assert reader.done[1,2]
+    np.testing.assert_array_equal(resumed.parcube, cube.parcube)
@@ -0,0 +1,234 @@
+"""
+Tests for fitting every pixel of a cube
+"""
+
+import sys
+import types
+import numpy as np
+import pytest
+from astropy.io import fits
+import pyspeckit
+from pyspeckit.spectrum.units import SpectroscopicAxis
+
+
+def make_cube(ny=3, nx=4, nchan=100, seed=0):
+    """
+    A small cube of gaussians with a celestial header; pixel (x=3,y=2) has
+    no signal
+    """
+    np.random.seed(seed)
+    x = np.linspace(-10, 10, nchan)
+    amp = np.random.uniform(1, 2, (ny,nx))
+    amp[2,3] = 0
+    data = (amp[None] * np.exp(-x[:,None,None]**2/2.) +
+            np.random.randn(nchan,ny,nx)*0.05)
+    header = fits.Header()
+    header['NAXIS'] = 3
+    header['NAXIS1'] = nx
+    header['NAXIS2'] = ny
+    header['NAXIS3'] = nchan
+    header['CTYPE1'] = 'RA---TAN'
+    header['CRVAL1'] = 10.
+    header['CRPIX1'] = 1
+    header['CDELT1'] = -1/3600.
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL2'] = 10.
+    header['CRPIX2'] = 1
+    header['CDELT2'] = 1/3600.
+    header['CTYPE3'] = 'VRAD'
+    header['CRVAL3'] = x[0]*1e3
+    header['CRPIX3'] = 1
+    header['CDELT3'] = (x[1]-x[0])*1e3
+    header['CUNIT3'] = 'm/s'
+    header['RESTFRQ'] = 1e9
+    header['BUNIT'] = 'K'
+    xarr = SpectroscopicAxis(x, unit='km/s', refX=1e9, refX_unit='Hz',
+                             velocity_convention='radio')
+    return pyspeckit.Cube(cube=data, xarr=xarr, header=header)
+
+
+@pytest.mark.parametrize('blank_value', [0, np.nan, -99])
+def test_fiteach_blank_value(blank_value):
+    results = []
+    for multicore in (1, 2):
+        cube = make_cube()
+        cube.fiteach(fittype='gaussian', guesses=[1,0,1], multicore=multicore,
+                     blank_value=blank_value, signal_cut=5,
+                     errmap=np.ones(cube.cube.shape[1:])*0.05, verbose=False)
+        results.append((cube.parcube, cube.errcube))
+
+    for parcube, errcube in results:
+        # the pixel without signal is blanked in both planes...
+        np.testing.assert_array_equal(parcube[:,2,3], blank_value)
+        np.testing.assert_array_equal(errcube[:,2,3], blank_value)
+        # ...and none of the fitted ones are
+        fitted = np.ones(parcube.shape[1:], dtype='bool')
+        fitted[2,3] = False
+        assert np.all(np.isfinite(parcube[:,fitted]))
+        assert np.all(parcube[:,fitted] != blank_value)
+        assert np.all(errcube[:,fitted] != blank_value)
+
+    # the workers' results are the same as the serial ones
+    np.testing.assert_allclose(results[0][0], results[1][0])
+    np.testing.assert_allclose(results[0][1], results[1][1])
+
+def test_momenteach_matches_moments():
+    from pyspeckit.spectrum.moments import moments
+    cube = make_cube()
+    # a constant pixel, for which moments are 0, and one left out of the map
+    cube.cube[:,0,1] = 1.
+    cube.maskmap[1,2] = False
+    cube.momenteach(verbose=False, tilesize=5)
+    x = np.asarray(cube.xarr.as_unit('km/s'))
+    for yy in range(cube.cube.shape[1]):
+        for xx in range(cube.cube.shape[2]):
+            if (yy, xx) == (1, 2):
+                np.testing.assert_array_equal(cube.momentcube[:,yy,xx], 0)
+                continue
+            np.testing.assert_allclose(cube.momentcube[:,yy,xx],
+                                       moments(x, cube.cube[:,yy,xx]),
+                                       rtol=1e-6, atol=1e-12)
+
+def fit_both_engines(cube_factory, **kwargs):
+    results = []
+    for engine in ('specfit', 'batched'):
+        cube = cube_factory()
+        cube.fiteach(engine=engine, signal_cut=5,
+                     errmap=np.ones(cube.cube.shape[1:])*0.05, verbose=False,
+                     **kwargs)
+        results.append(cube)
+    return results
+
+def test_fiteach_batched_matches_specfit():
+    specfit, batched = fit_both_engines(make_cube, fittype='gaussian',
+                                        guesses=[1,0,1])
+    np.testing.assert_array_equal(batched.has_fit, specfit.has_fit)
+    assert not batched.has_fit[2,3]
+    fitted = specfit.has_fit
+    np.testing.assert_allclose(batched.parcube[:,fitted],
+                               specfit.parcube[:,fitted], rtol=1e-6)
+    np.testing.assert_allclose(batched.errcube[:,fitted],
+                               specfit.errcube[:,fitted], rtol=1e-4)
+    # the integral of a gaussian: amplitude * width * sqrt(2 pi)
+    np.testing.assert_allclose(batched.integralmap[0,fitted],
+                               (batched.parcube[0]*batched.parcube[2] *
+                                (2*np.pi)**0.5)[fitted], rtol=1e-3)
+    np.testing.assert_allclose(batched.integralmap[0,fitted],
+                               specfit.integralmap[0,fitted], rtol=1e-2)
+
+def test_fiteach_batched_fitunits():
+    # a model fitted in GHz on a cube in km/s: the integral is computed from
+    # the model on the GHz axis, over the km/s channels, as by the per-pixel
+    # engine
+    from pyspeckit.spectrum.models import model, inherited_gaussfitter
+    def ghz_cube():
+        cube = make_cube()
+        # the Cube does not keep the reference frequency of its axis
+        cube.xarr.refX = 1e9
+        cube.xarr.refX_unit = 'Hz'
+        cube.xarr.velocity_convention = 'radio'
+        fitter = model.SpectralModel(inherited_gaussfitter.gaussian, 3,
+                                     parnames=['amplitude','shift','width'],
+                                     parlimited=[(False,False),(False,False),
+                                                 (True,False)],
+                                     parlimits=[(0,0), (0,0), (0,0)],
+                                     fitunits='GHz')
+        fitter.batchable = True
+        cube.specfit.Registry.add_fitter('gaussian_ghz', fitter, 3)
+        return cube
+    # 1 km/s at 1 GHz (radio convention) is 1/c GHz
+    kms = 1/299792.458
+    specfit, batched = fit_both_engines(ghz_cube, fittype='gaussian_ghz',
+                                        guesses=[1, 1, kms])
+    fitted = specfit.has_fit
+    assert fitted.sum() == 11
+    np.testing.assert_array_equal(batched.has_fit, fitted)
+    np.testing.assert_allclose(batched.parcube[:,fitted],
+                               specfit.parcube[:,fitted], rtol=1e-6)
+    np.testing.assert_allclose(batched.parcube[1,fitted], 1, rtol=1e-6)
+    np.testing.assert_allclose(batched.parcube[2,fitted], kms, rtol=0.1)
+    # in K km/s
+    np.testing.assert_allclose(batched.integralmap[0,fitted],
+                               (batched.parcube[0] * batched.parcube[2]/kms *
+                                (2*np.pi)**0.5)[fitted], rtol=1e-3)
+    np.testing.assert_allclose(batched.integralmap[0,fitted],
+                               specfit.integralmap[0,fitted], rtol=1e-2)
+
+def test_fiteach_bad_engine(tmpdir):
+    cube = make_cube()
+    checkpoint = str(tmpdir.join('fits.h5'))
+    for kwargs in (dict(engine='wrong'),
+                   dict(engine='batched', use_nearest_as_guess=True)):
+        with pytest.raises(ValueError):
+            cube.fiteach(fittype='gaussian', guesses=[1,0,1], verbose=False,
+                         checkpoint=checkpoint, **kwargs)
+        # nothing was done before the arguments were checked
+        assert not tmpdir.listdir()
+        assert not hasattr(cube, 'parcube')
+
+class EnsembleSampler(object):
+    """
+    A stand-in for the EnsembleSampler of emcee 3, whose chain is its
+    starting walkers, after ``burn`` steps far away from them
+    """
+    samplers = []
+
+    def __init__(self, nwalkers, ndim, log_prob_fn, vectorize=False,
+                 **kwargs):
+        self.nwalkers, self.ndim = nwalkers, ndim
+        self.log_prob_fn = log_prob_fn
+        self.vectorize = vectorize
+        self.samplers.append(self)
+
+    def run_mcmc(self, p0, nsteps):
+        self.p0 = np.array(p0)
+        self.logprob = self.log_prob_fn(self.p0)
+        self.chain = np.repeat(self.p0[:,None,:], nsteps, axis=1)
+        self.chain[:,:10,:] = 1e10
+        self.acceptance_fraction = np.ones(self.nwalkers) * len(self.samplers)
+
+def test_mcmceach(monkeypatch):
+    emcee = types.ModuleType('emcee')
+    emcee.EnsembleSampler = EnsembleSampler
+    monkeypatch.setitem(sys.modules, 'emcee', emcee)
+    monkeypatch.setattr(EnsembleSampler, 'samplers', [])
+
+    cube = make_cube()
+    errmap = np.ones(cube.cube.shape[1:])*0.05
+    with pytest.raises(ValueError):
+        cube.mcmceach(verbose=False)
+    cube.fiteach(fittype='gaussian', guesses=[1,0,1], signal_cut=5,
+                 errmap=errmap, verbose=False)
+    # a parameter of 0 without an error
+    cube.parcube[1,0,0] = 0
+    cube.errcube[1,0,0] = 0
+    cube.mcmceach(nsteps=30, burn=10, nwalkers=40, errmap=errmap,
+                  verbose=False)
+
+    ys, xs = np.where(cube.has_fit)
+    assert len(EnsembleSampler.samplers) == len(ys) == 11
+    fitter = cube.specfit.fitter
+    for ii, (sampler, y, x) in enumerate(zip(EnsembleSampler.samplers, ys,
+                                             xs)):
+        assert sampler.vectorize
+        assert sampler.p0.shape == (40, 3)
+        # the walkers start around the fit of their pixel, and the log
+        # probability of all of them at once is that of the pixel's data
+        pars, errors = cube.parcube[:,y,x], cube.errcube[:,y,x]
+        if (y, x) != (0, 0):
+            assert np.all(np.abs(sampler.p0 - pars) <= 7*errors)
+        np.testing.assert_allclose(sampler.logprob,
+                                   fitter.logp_batch(cube.xarr,
+                                                     cube.cube[:,y,x],
+                                                     np.ones(100)*0.05,
+                                                     sampler.p0),
+                                   rtol=1e-10)
+        # the samples after the burn-in are summarized in the pixel
+        np.testing.assert_allclose(cube.mcmc_parcube[:,y,x],
+                                   sampler.p0.mean(axis=0), rtol=1e-10)
+        np.testing.assert_allclose(cube.mcmc_errcube[:,y,x],
+                                   sampler.p0.std(axis=0), rtol=1e-10)
+        assert cube.mcmc_acceptance[y,x] == ii+1
+    assert EnsembleSampler.samplers[0].p0[:,1].std() > 0
+    assert np.all(cube.mcmc_parcube[:,2,3] == 0)
+    assert cube.mcmc_acceptance[2,3] == 0
@@ -0,0 +1,121 @@
+"""
+Tests of the convolutional gridding of on-the-fly spectra
+"""
+
+import numpy as np
+import pytest
+from pyspeckit.cubes import gridding
+from pyspeckit.spectrum.readers import read_class
+from pyspeckit.spectrum.readers.tests.test_read_class import (make_entries,
+                                                              write_class_file)
+
+
+def brute_force_grid(spectra, xoff, yoff, xaxis, yaxis, beam_fwhm, support,
+                     kernel='gaussian'):
+    """ Every pixel against every spectrum, without noise weighting """
+    ny, nx = len(yaxis), len(xaxis)
+    cube = np.empty((spectra.shape[1], ny, nx))
+    weights = np.zeros((ny, nx))
+    for jj in range(ny):
+        for ii in range(nx):
+            r = np.hypot(xaxis[ii]-xoff, yaxis[jj]-yoff)
+            w = gridding.kernel_weights(r, beam_fwhm, kernel=kernel)*(r <= support)
+            weights[jj, ii] = w.sum()
+            cube[:, jj, ii] = (w[:,None]*spectra).sum(axis=0)/w.sum()
+    return cube, weights
+
+def test_point_source():
+    xaxis = np.arange(8)*2.
+    yaxis = np.arange(6)*2. - 4
+    spectrum = np.arange(5, dtype='float32')[None,:] + 1
+    cube, weights, errors = gridding.grid_spectra(spectrum, [6.], [0.], xaxis,
+                                                  yaxis, beam_fwhm=5.,
+                                                  support=5.,
+                                                  noise=np.ones(1),
+                                                  weight_by_noise=False)
+    assert cube.shape == (5, 6, 8)
+    # (6, 0) is the center of pixel x=3, y=2
+    np.testing.assert_allclose(weights[2,3], 1)
+    np.testing.assert_array_equal(cube[:,2,3], spectrum[0])
+    yy, xx = np.meshgrid(yaxis, xaxis, indexing='ij')
+    r = np.hypot(xx-6, yy)
+    inside = r <= 5
+    np.testing.assert_allclose(weights[inside], np.exp(-(r[inside]/(5/3.))**2))
+    assert np.all(weights[~inside] == 0)
+    assert np.all(np.isnan(cube[:, ~inside]))
+    assert np.all(np.isnan(errors[~inside]))
+    np.testing.assert_allclose(cube[:, inside],
+                               np.repeat(spectrum.T, inside.sum(), axis=1),
+                               rtol=1e-6)
+    # the error of a single spectrum is its noise at any weight
+    np.testing.assert_allclose(errors[inside], 1)
+
+@pytest.mark.parametrize('kernel', gridding.kernels)
+def test_matches_brute_force(kernel):
+    rng = np.random.RandomState(1)
+    nspec = 200
+    spectra = rng.normal(size=(nspec, 7)).astype('float32')
+    xoff = rng.uniform(-3, 13, nspec)
+    yoff = rng.uniform(-2, 9, nspec)
+    xaxis = 12 - np.arange(12)*1.
+    yaxis = np.arange(8)*1.
+    cube, weights, errors = gridding.grid_spectra(spectra, xoff, yoff, xaxis,
+                                                  yaxis, beam_fwhm=2.5,
+                                                  kernel=kernel,
+                                                  noise=np.ones(nspec),
+                                                  weight_by_noise=False,
+                                                  chunksize=17)
+    expected, expected_weights = brute_force_grid(spectra, xoff, yoff, xaxis,
+                                                  yaxis, 2.5, 2.5, kernel=kernel)
+    np.testing.assert_allclose(weights, expected_weights, rtol=1e-10)
+    np.testing.assert_allclose(cube, expected, rtol=1e-4, atol=1e-5)
+
+def test_parallel_modes_agree():
+    rng = np.random.RandomState(2)
+    nspec = 500
+    spectra = rng.normal(size=(nspec, 16)).astype('float32')
+    xoff = rng.uniform(0, 20, nspec)
+    yoff = rng.uniform(0, 30, nspec)
+    args = (spectra, xoff, yoff, np.arange(21)*1., np.arange(31)*1., 3.)
+    serial = gridding.grid_spectra(*args, chunksize=64)
+    for parallel in ('thread', 'process'):
+        result = gridding.grid_spectra(*args, chunksize=64, numcores=3,
+                                       parallel=parallel)
+        for expected, actual in zip(serial, result):
+            np.testing.assert_array_equal(actual, expected)
+
+def test_class_to_cube_header(tmpdir):
+    pixsize = 10.
+    entries = [entry for entry in make_entries() if entry['line'] == 'CO(2-1)'
+               and entry['ver'] > 0]
+    # spectra on a grid of pixels, each one only reaching its own pixel
+    positions = [(x, y) for x in (-20, -10, 0, 10) for y in (0, 10)]
+    arcsec = np.pi/180/3600
+    for entry, (x, y) in zip(entries, positions):
+        entry['off1'] = x*arcsec
+        entry['off2'] = y*arcsec
+    entries = entries[:len(positions)]
+    filename = write_class_file(str(tmpdir.join('otf.cls')), entries)
+
+    cube = read_class.class_to_cube(filename, pixsize, beam_fwhm=9.,
+                                    support=4.)
+    header = cube.header
+    assert cube.cube.shape[0] == 64
+    assert cube.cube.shape[1:] == (header['NAXIS2'], header['NAXIS1'])
+    assert header['CRVAL1'] == entries[0]['lam']*180/np.pi
+    assert header['CRVAL2'] == entries[0]['bet']*180/np.pi
+    assert header['CDELT1'] == -pixsize/3600.
+    assert header['CDELT2'] == pixsize/3600.
+    for entry, (x, y) in zip(entries, positions):
+        ii = header['CRPIX1'] - 1 + x/(header['CDELT1']*3600)
+        jj = header['CRPIX2'] - 1 + y/(header['CDELT2']*3600)
+        assert ii == int(ii) and jj == int(jj)
+        np.testing.assert_allclose(cube.cube[:, int(jj), int(ii)],
+                                   entry['data'], rtol=1e-6)
+    # the spectral axis
+    assert header['CRPIX3'] == entries[0]['rchan']
+    assert header['CRVAL3'] == entries[0]['restf']*1e6
+    assert header['CDELT3'] == entries[0]['fres']*1e6
+    xarr = np.asarray(cube.xarr.as_unit('Hz'))
+    np.testing.assert_allclose(xarr, header['CRVAL3'] + header['CDELT3'] *
+                               (np.arange(1, 65) - header['CRPIX3']))
@@ -0,0 +1,49 @@
+"""
+Tests for the lightweight per-pixel spectra used by the cube loops
+"""
+
+import numpy as np
+from pyspeckit.cubes.SpectralCube import PixelSpectrum
+from pyspeckit.cubes.tests.test_fiteach import make_cube
+
+
+def test_pixel_spectrum_matches_get_spectrum():
+    cube = make_cube()
+    template = cube._spectrum_header(0, 0)
+    for x, y in [(0,0), (3,1), (1,2)]:
+        full = cube.get_spectrum(x, y)
+        for view in (cube._get_spectrum_view(x, y),
+                     PixelSpectrum(cube, x, y, header_template=template)):
+            np.testing.assert_array_equal(view.data, full.data)
+            np.testing.assert_array_equal(np.asarray(view.xarr),
+                                          np.asarray(full.xarr))
+            assert view.header['CRVAL2'] == full.header['CRVAL2'] == x
+            assert view.header['CRVAL3'] == full.header['CRVAL3'] == y
+            assert set(view.header.keys()) == set(full.header.keys())
+            for key in full.header:
+                assert view.header[key] == full.header[key], key
+
+
+def test_pixel_fit_leaves_cube_untouched():
+    cube = make_cube()
+    cube.specfit(fittype='gaussian', guesses=[1,0,1])
+    parinfo = cube.specfit.parinfo
+    values = np.array(parinfo.values)
+    errors = np.array(parinfo.errors)
+    modelpars = np.array(cube.specfit.modelpars)
+    data = cube.cube.copy()
+
+    sp = cube._get_spectrum_view(3, 1)
+    # the pixel starts from the cube's fitter settings...
+    np.testing.assert_array_equal(sp.specfit.parinfo.values, values)
+    assert sp.specfit.parinfo is not parinfo
+    sp.specfit(fittype='gaussian', guesses=[1.5,0.5,2])
+    assert np.any(np.array(sp.specfit.modelpars) != modelpars)
+
+    # ...but fitting it does not change the cube's fit, or the other pixels
+    assert cube.specfit.parinfo is parinfo
+    np.testing.assert_array_equal(cube.specfit.parinfo.values, values)
+    np.testing.assert_array_equal(cube.specfit.parinfo.errors, errors)
+    np.testing.assert_array_equal(cube.specfit.modelpars, modelpars)
+    np.testing.assert_array_equal(cube.cube, data)
+    assert cube._get_spectrum_view(0, 2).specfit.parinfo.values == list(values)
@@ -0,0 +1,337 @@
+"""
+Vectorized Levenberg-Marquardt least-squares minimization of many
+independent problems at once.
+
+`mpfit` solves one problem at a time and spends most of its time in Python
+bookkeeping when the model is cheap (e.g., a few Gaussians).  `batch_lm`
+instead fits ``nspec`` spectra that share an X-axis and a model simultaneously:
+each iteration evaluates the model for every spectrum as one ``(nspec,
+nchan)`` array operation, builds all of the normal equations with a single
+``einsum`` and solves them with stacked `numpy.linalg.solve` calls.  The
+step control (scaled trust region, Levenberg-Marquardt parameter and
+convergence tests) follows MINPACK's lmdif, like `mpfit`.  Spectra drop out
+of the active set as they converge.
+
+Parameter constraints follow the `mpfit` ``parinfo`` conventions for
+``fixed``, ``limited`` and ``limits`` (the same constraints apply to every
+spectrum).  Limits are enforced by projecting each trial step back onto the
+allowed box; as in `mpfit`, parameters pegged at a limit that chi^2 would
+push them past are held there.  ``tied`` parameters are not supported.
+"""
+import numpy
+
+__all__ = ['batch_lm', 'BatchLMResult']
+
+# status codes, chosen to agree with the mpfit codes of the same meaning
+STATUS_FTOL = 1
+STATUS_XTOL = 2
+STATUS_BOTH = 3
+STATUS_MAXITER = 5
+
+
+class BatchLMResult(object):
+    """
+    The output of `batch_lm`.  The attribute names match those of `mpfit`,
+    but each is an array with a leading ``nspec`` axis.
+
+    Attributes
+    ----------
+    params : ndarray, shape (nspec, npars)
+        Best-fit parameters
+    perror : ndarray, shape (nspec, npars)
+        1-sigma parameter errors from the diagonal of the covariance matrix
+        (zero for fixed parameters; NaN where the covariance is singular)
+    covar : ndarray, shape (nspec, npars, npars)
+        Parameter covariance matrices
+    fnorm : ndarray, shape (nspec,)
+        Final chi^2 of each fit
+    status : ndarray, shape (nspec,)
+        1 (chi^2 converged to ftol), 2 (parameters converged to xtol),
+        3 (both) or 5 (maxiter reached)
+    niter : ndarray, shape (nspec,)
+        Number of iterations used by each fit
+    """
+    def __init__(self, params, perror, covar, fnorm, status, niter):
+        self.params = params
+        self.perror = perror
+        self.covar = covar
+        self.fnorm = fnorm
+        self.status = status
+        self.niter = niter
+
+
+def _clip(params, limited, limits):
+    lower = numpy.where(limited[:,0], limits[:,0], -numpy.inf)
+    upper = numpy.where(limited[:,1], limits[:,1], numpy.inf)
+    return numpy.clip(params, lower, upper)
+
+
+def _solve(matrix, rhs):
+    """
+    Stacked linear solve that degrades gracefully to a least-squares solve
+    for the (rare) singular systems
+    """
+    try:
+        return numpy.linalg.solve(matrix, rhs[...,numpy.newaxis])[...,0]
+    except numpy.linalg.LinAlgError:
+        return numpy.array([numpy.linalg.lstsq(mm, rr, rcond=-1)[0]
+                            for mm, rr in zip(matrix, rhs)])
+
+
+def _inverse(matrix):
+    try:
+        return numpy.linalg.inv(matrix)
+    except numpy.linalg.LinAlgError:
+        return numpy.array([numpy.linalg.pinv(mm) for mm in matrix])
+
+
+def _lmstep(alpha, beta, scale, lamb):
+    """ Solve (alpha + lamb * scale**2) step = beta for every spectrum """
+    damped = alpha.copy()
+    diag = numpy.arange(alpha.shape[-1])
+    damped[:,diag,diag] += lamb[:,numpy.newaxis] * scale**2
+    return _solve(damped, beta)
+
+
+def fdjac(func, params, model, free, limited, limits, epsfcn=None):
+    """
+    Forward-difference Jacobian of ``func`` with respect to the free
+    parameters, for all spectra at once.  The step sizes follow `mpfit`
+    (``sqrt(epsfcn) * |p|``), stepping backwards when a forward step would
+    cross an upper limit.
+
+    Returns an array of shape (nspec, nchan, nfree).
+    """
+    machep = numpy.finfo(numpy.float64).eps
+    eps = numpy.sqrt(max(epsfcn if epsfcn is not None else machep, machep))
+    jac = numpy.empty(model.shape + (len(free),))
+    for jj, kk in enumerate(free):
+        hh = eps * numpy.abs(params[:,kk])
+        hh[hh == 0] = eps
+        if limited[kk,1]:
+            hh = numpy.where(params[:,kk] + hh > limits[kk,1], -hh, hh)
+        stepped = params.copy()
+        stepped[:,kk] += hh
+        jac[:,:,jj] = (func(stepped) - model) / hh[:,numpy.newaxis]
+    return jac
+
+
+def batch_lm(func, p0, data, err=None, fixed=None, limited=None, limits=None,
+             jacobian=None, maxiter=200, ftol=1e-10, xtol=1e-10,
+             factor=100., epsfcn=None):
+    """
+    Fit ``nspec`` independent least-squares problems at once
+
+    Parameters
+    ----------
+    func : function
+        ``func(params)`` must return the model for every spectrum, an array of
+        shape (nspec, nchan), given ``params`` of shape (nspec, npars).  It is
+        called with subsets of the spectra as they converge, so it must not
+        assume a fixed ``nspec``.
+    p0 : ndarray, shape (nspec, npars)
+        Initial guesses
+    data : ndarray, shape (nspec, nchan)
+        The data to fit
+    err : ndarray, shape (nspec, nchan) or (nchan,), optional
+        1-sigma errors.  Infinite errors (or non-finite data) give a point zero
+        weight.
+    fixed : sequence of bool, length npars
+    limited : sequence of (bool, bool) pairs, length npars
+    limits : sequence of (float, float) pairs, length npars
+        Parameter constraints in the `mpfit` ``parinfo`` sense
+    jacobian : function, optional
+        ``jacobian(params)`` returning d(model)/d(params), an array of shape
+        (nspec, nchan, npars).  Finite differences are used otherwise.
+    maxiter : int
+    ftol : float
+        Convergence criterion on the relative reduction of chi^2
+    xtol : float
+        Convergence criterion on the relative size of the parameter step
+    factor : float
+        Sets the initial trust region radius, ``factor`` times the scaled
+        norm of the guesses (as in `mpfit`)
+    epsfcn : float, optional
+        Relative precision of the model, used to pick finite difference steps
+
+    Returns
+    -------
+    result : `BatchLMResult`
+    """
+    params = numpy.array(p0, dtype='float64', ndmin=2)
+    data = numpy.array(data, dtype='float64', ndmin=2)
+    nspec, npars = params.shape
+    if data.shape[0] != nspec:
+        raise ValueError("data and p0 must have the same number of spectra")
+
+    fixed = (numpy.zeros(npars, dtype='bool') if fixed is None
+             else numpy.array(fixed, dtype='bool'))
+    limited = (numpy.zeros([npars,2], dtype='bool') if limited is None
+               else numpy.array(limited, dtype='bool'))
+    limits = (numpy.zeros([npars,2]) if limits is None
+              else numpy.array(limits, dtype='float64'))
+    free = numpy.flatnonzero(~fixed)
+
+    if err is None:
+        weights = numpy.ones(data.shape)
+    else:
+        weights = 1. / numpy.broadcast_to(numpy.asarray(err, dtype='float64'),
+                                          data.shape)
+    bad = ~(numpy.isfinite(data) & numpy.isfinite(weights))
+    weights = numpy.where(bad, 0, weights)
+    data = numpy.where(bad, 0, data)
+
+    params = _clip(params, limited, limits)
+
+    def model_jacobian(pars, model):
+        if jacobian is not None:
+            return jacobian(pars)[:,:,free]
+        return fdjac(func, pars, model, free, limited,
+                     limits, epsfcn=epsfcn)
+
+    machep = numpy.finfo(numpy.float64).eps
+    nfree = free.size
+    # the model and weighted Jacobian at the current parameters; they are
+    # only recomputed for the spectra whose parameters changed
+    models = func(params)
+    chi2 = (((data - models) * weights)**2).sum(axis=1)
+    jacs = numpy.empty(data.shape + (nfree,))
+    stale = numpy.ones(nspec, dtype='bool')
+    # Levenberg-Marquardt parameter, scaling and trust region radius
+    # (as in MINPACK lmdif, which mpfit follows)
+    lam = numpy.zeros(nspec)
+    scale = numpy.zeros([nspec, nfree])
+    delta = numpy.zeros(nspec)
+    status = numpy.repeat(STATUS_MAXITER, nspec)
+    niter = numpy.zeros(nspec, dtype='int')
+    active = numpy.ones(nspec, dtype='bool')
+
+    for iteration in range(maxiter):
+        inds = numpy.flatnonzero(active)
+        if inds.size == 0:
+            break
+        niter[inds] += 1
+        pars = params[inds]
+        update = inds[stale[inds]]
+        if update.size:
+            jacs[update] = (model_jacobian(params[update], models[update]) *
+                            weights[update][:,:,numpy.newaxis])
+            stale[update] = False
+        resid = (data[inds] - models[inds]) * weights[inds]
+        fnorm = numpy.sqrt(chi2[inds])
+        # Jacobian of the weighted model; the Gauss-Newton step solves
+        # (J^T J) step = J^T resid
+        jac = jacs[inds]
+        beta = numpy.einsum('sci,sc->si', jac, resid)
+
+        # as in mpfit, parameters pegged at a limit that chi^2 would push
+        # beyond it are held there by zeroing their derivatives
+        pegged = ((limited[free,0] & (pars[:,free] == limits[free,0]) & (beta < 0)) |
+                  (limited[free,1] & (pars[:,free] == limits[free,1]) & (beta > 0)))
+        if numpy.any(pegged):
+            jac = jac * ~pegged[:,numpy.newaxis,:]
+            beta = numpy.where(pegged, 0, beta)
+
+        alpha = numpy.einsum('sci,scj->sij', jac, jac)
+        colnorm = numpy.sqrt(numpy.einsum('sii->si', alpha))
+        colnorm[colnorm == 0] = 1.
+        # keep the normal equations of pegged parameters regular
+        pegrow, pegcol = numpy.nonzero(pegged)
+        alpha[pegrow,pegcol,pegcol] = 1.
+        scale[inds] = numpy.maximum(scale[inds], colnorm)
+        dd = scale[inds]
+        xnorm = numpy.sqrt(((dd*pars[:,free])**2).sum(axis=1))
+        if iteration == 0:
+            delta[inds] = numpy.where(xnorm > 0, factor*xnorm, factor)
+        dlt = delta[inds]
+
+        # Find the LM parameter for which the scaled step fits in the trust
+        # region: try the Gauss-Newton step first, then iterate on lambda
+        # (the scaled step length is roughly inversely proportional to it)
+        lmstep = lambda lamb: _lmstep(alpha, beta, dd, lamb)
+        lamb = numpy.zeros(inds.size)
+        step = lmstep(lamb)
+        dxnorm = numpy.sqrt(((dd*step)**2).sum(axis=1))
+        too_long = ~(dxnorm <= 1.1*dlt)
+        if numpy.any(too_long):
+            lamb = numpy.where(too_long,
+                               numpy.maximum(lam[inds],
+                                             numpy.sqrt(((beta/dd)**2).sum(axis=1))/dlt),
+                               0)
+            for ii in range(10):
+                step = numpy.where(too_long[:,numpy.newaxis], lmstep(lamb), step)
+                dxnorm = numpy.sqrt(((dd*step)**2).sum(axis=1))
+                too_long = ~(dxnorm <= 1.1*dlt)
+                if not numpy.any(too_long):
+                    break
+                lamb = numpy.where(too_long, lamb*numpy.where(numpy.isfinite(dxnorm), dxnorm/dlt, 10), lamb)
+            # give up on refining lambda and truncate the step
+            shrink = numpy.where(too_long & (dxnorm > 0), dlt/dxnorm, 1)
+            step = step * shrink[:,numpy.newaxis]
+        lam[inds] = lamb
+
+        fullstep = numpy.zeros_like(pars)
+        fullstep[:,free] = step
+        trial = _clip(pars + fullstep, limited, limits)
+        step = (trial - pars)[:,free]
+        pnorm = numpy.sqrt(((dd*step)**2).sum(axis=1))
+        if iteration == 0:
+            delta[inds] = dlt = numpy.minimum(dlt, pnorm)
+
+        trial_model = func(trial)
+        trial_chi2 = (((data[inds] - trial_model) * weights[inds])**2).sum(axis=1)
+        fnorm1 = numpy.sqrt(trial_chi2)
+
+        # ratio of the actual to the predicted reduction
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            actred = numpy.where(numpy.isfinite(fnorm1) & (0.1*fnorm1 < fnorm),
+                                 1 - (fnorm1/fnorm)**2, -1)
+            temp1 = numpy.sqrt((numpy.einsum('sci,si->sc', jac, step)**2).sum(axis=1))/fnorm
+            temp2 = numpy.sqrt(lamb)*pnorm/fnorm
+            prered = temp1**2 + temp2**2/0.5
+            dirder = -(temp1**2 + temp2**2)
+            ratio = numpy.where(prered != 0, actred/prered, 0)
+
+            # update the trust region radius
+            shrink = ratio <= 0.25
+            temp = numpy.where(actred >= 0, 0.5,
+                               0.5*dirder/(dirder + 0.5*actred))
+            temp = numpy.where(((0.1*fnorm1 >= fnorm) | ~numpy.isfinite(fnorm1)
+                                | (temp < 0.1)), 0.1, temp)
+            grow = ~shrink & ((lamb == 0) | (ratio >= 0.75))
+            dlt = numpy.where(shrink, temp*numpy.minimum(dlt, pnorm/0.1), dlt)
+            dlt = numpy.where(grow, pnorm/0.5, dlt)
+            lam[inds] = numpy.where(shrink, lamb/temp,
+                                    numpy.where(grow, 0.5*lamb, lamb))
+        delta[inds] = dlt
+
+        better = numpy.isfinite(trial_chi2) & (ratio >= 1e-4)
+        params[inds[better]] = trial[better]
+        chi2[inds[better]] = trial_chi2[better]
+        models[inds[better]] = trial_model[better]
+        stale[inds[better]] = True
+        xnorm = numpy.where(better,
+                            numpy.sqrt(((dd*trial[:,free])**2).sum(axis=1)),
+                            xnorm)
+
+        f_converged = ((numpy.abs(actred) <= ftol) & (prered <= ftol) &
+                       (0.5*ratio <= 1))
+        x_converged = (dlt <= xtol*xnorm) | (dlt <= machep*xnorm)
+
+        status[inds[x_converged]] = STATUS_XTOL
+        status[inds[f_converged]] = STATUS_FTOL
+        status[inds[f_converged & x_converged]] = STATUS_BOTH
+        active[inds[f_converged | x_converged]] = False
+
+    # covariance from the curvature matrix at the solution
+    update = numpy.flatnonzero(stale)
+    if update.size:
+        jacs[update] = (model_jacobian(params[update], models[update]) *
+                        weights[update][:,:,numpy.newaxis])
+    alpha = numpy.einsum('sci,scj->sij', jacs, jacs)
+    covar = numpy.zeros([nspec, npars, npars])
+    covar[:,free[:,numpy.newaxis],free] = _inverse(alpha)
+    variance = numpy.einsum('sii->si', covar)
+    perror = numpy.sqrt(numpy.where(variance >= 0, variance, numpy.nan))
+
+    return BatchLMResult(params, perror, covar, chi2, status, niter)
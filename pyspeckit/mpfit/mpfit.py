@@ -408,9 +408,15 @@ Perform Levenberg-Marquardt least-squares minimization, based on MINPACK-1.
    Converted from Numeric to numpy (Sergey Koposov, July 2008)
 """
 
+import ast
 import numpy
 import types
 from pyspeckit.spectrum.parinfo import ParinfoList,Parinfo
+try:
+    import scipy.linalg
+    scipyOK = True
+except ImportError:
+    scipyOK = False
 
 #    Original FORTRAN documentation
 #    **********
@@ -602,7 +608,7 @@ class mpfit:
             xtol=1.e-10, gtol=1.e-10, damp=0., maxiter=200, factor=100.,
             nprint=1, iterfunct='default', iterkw={}, nocovar=0, rescale=0,
             autoderivative=1, quiet=0, diag=None, epsfcn=None, debug=False,
-            **kwargs):
+            vectorized=0, **kwargs):
         """
   Inputs:
     fcn:
@@ -739,6 +745,15 @@ class mpfit:
 
         Note: DAMP doesn't work with autoderivative=0
 
+     vectorized:
+        If set, the QR factorization, the least-squares solutions in the
+        Levenberg-Marquardt parameter search and the covariance matrix are
+        computed with LAPACK-backed numpy/scipy routines rather than the
+        line-by-line translation of MINPACK.  This is much faster for
+        problems with many parameters and data points; the results agree
+        with the default to within rounding.
+           Default: 0
+
      xtol:
         A nonnegative input variable. Termination occurs when the relative error
         between two consecutive iterates is at most xtol (and status is
@@ -848,6 +863,7 @@ class mpfit:
         self.nfev = 0
         self.damp = damp
         self.dof=0
+        self.vectorized = vectorized
 
         if fcn==None:
             self.errmsg = "Usage: parms = mpfit('myfunt', ... )"
@@ -1098,7 +1114,10 @@ class mpfit:
                             fjac[:,whupeg[i]] = 0
 
             # Compute the QR factorization of the jacobian
-            [fjac, ipvt, wa1, wa2] = self.qrfac(fjac, pivot=1)
+            if vectorized:
+                [qfac, fjac, ipvt, wa1, wa2] = self.qrfac_vectorized(fjac)
+            else:
+                [fjac, ipvt, wa1, wa2] = self.qrfac(fjac, pivot=1)
 
             if debug:
                 print("outer loop; wa1={0}".format(wa1))
@@ -1122,25 +1141,29 @@ class mpfit:
 
             # Form (q transpose)*fvec and store the first n components in qtf
             catch_msg = 'forming (q transpose)*fvec'
-            wa4 = fvec.copy()
-            for j in range(n):
-                lj = ipvt[j]
-                temp3 = fjac[j,lj]
-                if temp3 != 0:
-                    fj = fjac[j:,lj]
-                    wj = wa4[j:]
-                    # *** optimization wa4(j:*)
-                    wa4[j:] = wj - fj * sum(fj*wj) / temp3
-                fjac[j,lj] = wa1[j]
-                qtf[j] = wa4[j]
-            # From this point on, only the square matrix, consisting of the
-            # triangle of R, is needed.
-            fjac = fjac[0:n, 0:n]
-            fjac.shape = [n, n]
-            temp = fjac.copy()
-            for i in range(n):
-                temp[:,i] = fjac[:, ipvt[i]]
-            fjac = temp.copy()
+            if vectorized:
+                # qrfac_vectorized returns R itself, already in pivot order
+                qtf = numpy.dot(qfac.T, fvec)
+            else:
+                wa4 = fvec.copy()
+                for j in range(n):
+                    lj = ipvt[j]
+                    temp3 = fjac[j,lj]
+                    if temp3 != 0:
+                        fj = fjac[j:,lj]
+                        wj = wa4[j:]
+                        # *** optimization wa4(j:*)
+                        wa4[j:] = wj - fj * sum(fj*wj) / temp3
+                    fjac[j,lj] = wa1[j]
+                    qtf[j] = wa4[j]
+                # From this point on, only the square matrix, consisting of the
+                # triangle of R, is needed.
+                fjac = fjac[0:n, 0:n]
+                fjac.shape = [n, n]
+                temp = fjac.copy()
+                for i in range(n):
+                    temp[:,i] = fjac[:, ipvt[i]]
+                fjac = temp.copy()
 
             # Check for overflow.  This should be a cheap test here since FJAC
             # has been reduced to a (small) square matrix, and the test is
@@ -1151,7 +1174,12 @@ class mpfit:
             # Compute the norm of the scaled gradient
             catch_msg = 'computing the scaled gradient'
             gnorm = 0.
-            if self.fnorm != 0:
+            if self.fnorm != 0 and vectorized:
+                sum0 = numpy.dot(qtf, numpy.triu(fjac))/self.fnorm
+                wh = wa2[ipvt] != 0
+                if numpy.any(wh):
+                    gnorm = numpy.max(numpy.abs(sum0[wh]/wa2[ipvt][wh]))
+            elif self.fnorm != 0:
                 for j in range(n):
                     l = ipvt[j]
                     if wa2[l] != 0:
@@ -1175,8 +1203,13 @@ class mpfit:
 
                 # Determine the levenberg-marquardt parameter
                 catch_msg = 'calculating LM parameter (MPFIT_)'
-                [fjac, par, wa1, wa2] = self.lmpar(fjac, ipvt, diag, qtf,
-                                                     delta, wa1, wa2, par=par)
+                if vectorized:
+                    [fjac, par, wa1, wa2] = self.lmpar_vectorized(fjac, ipvt, diag,
+                                                                  qtf, delta, wa1,
+                                                                  wa2, par=par)
+                else:
+                    [fjac, par, wa1, wa2] = self.lmpar(fjac, ipvt, diag, qtf,
+                                                         delta, wa1, wa2, par=par)
                 # Store the direction p and x+p. Calculate the norm of p
                 wa1 = -wa1
                 if debug:
@@ -1282,9 +1315,12 @@ class mpfit:
 
                 # Compute the scaled predicted reduction and the scaled directional
                 # derivative
-                for j in range(n):
-                    wa3[j] = 0
-                    wa3[0:j+1] = wa3[0:j+1] + fjac[0:j+1,j]*wa1[ipvt[j]]
+                if vectorized:
+                    wa3 = numpy.dot(numpy.triu(fjac), wa1[ipvt])
+                else:
+                    for j in range(n):
+                        wa3[j] = 0
+                        wa3[0:j+1] = wa3[0:j+1] + fjac[0:j+1,j]*wa1[ipvt[j]]
 
                 # Remember, alpha is the fraction of the full LM step actually
                 # taken
@@ -1397,7 +1433,10 @@ class mpfit:
                 and (len(ipvt) >= n):
 
                 catch_msg = 'computing the covariance matrix'
-                cv = self.calc_covar(fjac[0:n,0:n], ipvt[0:n])
+                if vectorized:
+                    cv = self.calc_covar_vectorized(fjac[0:n,0:n], ipvt[0:n])
+                else:
+                    cv = self.calc_covar(fjac[0:n,0:n], ipvt[0:n])
                 cv.shape = [n, n]
                 nn = len(xall)
 
@@ -1564,9 +1603,12 @@ class mpfit:
             mperr = 0
             fjac = numpy.zeros(nall, dtype=float)
             fjac[ifree] = 1.0  # Specify which parameters need derivatives
-            [status, fp] = self.call(fcn, xall, functkw, fjac=fjac)
+            [status, fp, pderiv] = self.call(fcn, xall, functkw, fjac=fjac)
+            if status < 0:
+                return None
 
-            if len(fjac) != m*nall:
+            fjac = numpy.array(pderiv, dtype=float)
+            if fjac.size != m*nall:
                 print 'ERROR: Derivative matrix was not computed properly.'
                 return None
 
@@ -1579,7 +1621,7 @@ class mpfit:
             if len(ifree) < nall:
                 fjac = fjac[:,ifree]
                 fjac.shape = [m, n]
-                return fjac
+            return fjac
 
         fjac = numpy.zeros([m, n], dtype=float)
 
@@ -2222,13 +2264,46 @@ class mpfit:
             print 'Entering tie...'
         if ptied is None:
             return
-        for i in range(len(ptied)):
-            if ptied[i] == '':
-                continue
-            cmd = 'p[' + str(i) + '] = ' + ptied[i]
-            exec(cmd)
+        ties = self.compile_ties(ptied)
+        if ties['affine']:
+            # all ties are linear in untied parameters: evaluate them at once
+            values = ties['const'] + numpy.bincount(ties['term_target'],
+                                                    weights=ties['term_coef']*p[ties['term_source']],
+                                                    minlength=len(ties['targets']))
+            p[ties['targets']] = values
+        else:
+            # evaluate in order, so that ties may refer to tied parameters
+            for i, code in ties['code']:
+                p[i] = eval(code, globals(), {'p': p})
         return p
 
+    # Compile the tied expressions, once per set of expressions
+    def compile_ties(self, ptied):
+        key = tuple(ptied)
+        if getattr(self, '_compiled_ties', (None,))[0] == key:
+            return self._compiled_ties[1]
+
+        targets = [i for i in range(len(ptied)) if ptied[i] != '']
+        code = [(i, compile(ptied[i], '<tied parameter %i>' % i, 'eval'))
+                for i in targets]
+        affine = [affine_tie(ptied[i]) for i in targets]
+        ties = {'code': code,
+                'affine': all(a is not None for a in affine)}
+        if ties['affine']:
+            term_target = [k for k,(coefs,const) in enumerate(affine) for j in coefs]
+            term_source = [j for coefs,const in affine for j in coefs]
+            term_coef = [coefs[j] for coefs,const in affine for j in coefs]
+            # a tie referring to another tied parameter depends on the order
+            # of evaluation
+            ties['affine'] = not any(j in targets for j in term_source)
+            ties['targets'] = numpy.array(targets, dtype='int')
+            ties['const'] = numpy.array([const for coefs,const in affine], dtype=float)
+            ties['term_target'] = numpy.array(term_target, dtype='int')
+            ties['term_source'] = numpy.array(term_source, dtype='int')
+            ties['term_coef'] = numpy.array(term_coef, dtype=float)
+        self._compiled_ties = (key, ties)
+        return ties
+
     
     #    Original FORTRAN documentation
     #    **********
@@ -2361,6 +2436,243 @@ class mpfit:
 
         return r
 
+    # Vectorized counterparts of qrfac, qrsolv, lmpar and calc_covar, used
+    # when mpfit is called with vectorized=1.  They replace the loops over
+    # the parameters with (LAPACK) factorizations and triangular solves, but
+    # otherwise follow the MINPACK algorithms step by step.
+
+    def qrfac_vectorized(self, a):
+        """
+        QR factorization of a with column pivoting, a[:,ipvt] = q*r.
+        Returns [q, r, ipvt, rdiag, acnorm], with r the n by n upper
+        triangle (not the householder form returned by qrfac), rdiag its
+        diagonal and acnorm the norms of the columns of a.
+        """
+        if self.debug: print 'Entering qrfac_vectorized...'
+        acnorm = numpy.sqrt((a*a).sum(axis=0))
+        if scipyOK:
+            q, r, ipvt = scipy.linalg.qr(a, mode='economic', pivoting=True)
+        else:
+            # pivot on the initial column norms only
+            ipvt = numpy.argsort(-acnorm, kind='mergesort')
+            q, r = numpy.linalg.qr(a[:,ipvt])
+        return [q, r, ipvt, numpy.diagonal(r).copy(), acnorm]
+
+    def solve_triangular(self, r, b, lower=False, trans=False):
+        """ Solve r*x = b (or r^T*x = b) for triangular r """
+        if scipyOK:
+            return scipy.linalg.solve_triangular(r, b, lower=lower,
+                                                 trans='T' if trans else 'N',
+                                                 check_finite=False)
+        r = numpy.tril(r) if lower else numpy.triu(r)
+        return numpy.linalg.solve(r.T if trans else r, b)
+
+    def qrsolv_vectorized(self, r, ipvt, diag, qtb, sdiag):
+        """
+        As qrsolv: solve r*z = qtb, (p^T*d*p)*z = 0 in the least-squares
+        sense by QR factorization of the stacked system.  On output the
+        strict lower triangle of r holds the strict upper triangle of s
+        (transposed) and sdiag its diagonal.
+        """
+        if self.debug:
+            print 'Entering qrsolv_vectorized...'
+        n = r.shape[1]
+        stacked = numpy.vstack([numpy.triu(r), numpy.diag(diag[ipvt])])
+        q, s = numpy.linalg.qr(stacked)
+        wa = numpy.dot(q[0:n].T, qtb)
+        sdiag = numpy.diagonal(s).copy()
+
+        # Solve the triangular system for z.  If the system is singular
+        # then obtain a least squares solution
+        nsing = n
+        wh = (numpy.nonzero(sdiag == 0))[0]
+        if len(wh) > 0:
+            nsing = wh[0]
+            wa[nsing:] = 0
+        if nsing >= 1:
+            wa[0:nsing] = self.solve_triangular(s[0:nsing,0:nsing], wa[0:nsing])
+
+        lower = numpy.tril_indices(n, -1)
+        r[lower] = s.T[lower]
+        x = numpy.zeros(n, dtype=float)
+        x[ipvt] = wa
+        return (r, x, sdiag)
+
+    def lmpar_vectorized(self, r, ipvt, diag, qtb, delta, x, sdiag, par=None):
+        """
+        As lmpar, using qrsolv_vectorized and triangular solves
+        """
+        if self.debug:
+            print 'Entering lmpar_vectorized...'
+        dwarf = self.machar.minnum
+        machep = self.machar.machep
+        n = r.shape[1]
+        rdiag = numpy.diagonal(r)
+
+        # Compute and store in x the gauss-newton direction.  If the
+        # jacobian is rank-deficient, obtain a least-squares solution
+        nsing = n
+        wa1 = qtb.copy()
+        rthresh = numpy.max(numpy.abs(rdiag)) * machep
+        wh = (numpy.nonzero(numpy.abs(rdiag) < rthresh))[0]
+        if len(wh) > 0:
+            nsing = wh[0]
+            wa1[wh[0]:] = 0
+        if nsing >= 1:
+            wa1[0:nsing] = self.solve_triangular(r[0:nsing,0:nsing], wa1[0:nsing])
+        x[ipvt] = wa1
+
+        # Evaluate the function at the origin, and test for acceptance of
+        # the gauss-newton direction
+        iter = 0
+        wa2 = diag * x
+        dxnorm = self.enorm(wa2)
+        fp = dxnorm - delta
+        if fp <= 0.1*delta:
+            return [r, 0., x, sdiag]
+
+        # Lower bound, parl, from the newton step (unless rank deficient)
+        parl = 0.
+        if nsing >= n:
+            wa1 = self.solve_triangular(r, diag[ipvt] * wa2[ipvt] / dxnorm,
+                                        trans=True)
+            temp = self.enorm(wa1)
+            parl = ((fp/delta)/temp)/temp
+
+        # Upper bound, paru
+        wa1 = numpy.dot(qtb, numpy.triu(r)) / diag[ipvt]
+        gnorm = self.enorm(wa1)
+        paru = gnorm/delta
+        if paru == 0:
+            paru = dwarf/numpy.min([delta,0.1])
+
+        par = numpy.max([par,parl])
+        par = numpy.min([par,paru])
+        if par == 0:
+            par = gnorm/dxnorm
+
+        while(1):
+            iter = iter + 1
+
+            # Evaluate the function at the current value of par
+            if par == 0:
+                par = numpy.max([dwarf, paru*0.001])
+            temp = numpy.sqrt(par)
+            wa1 = temp * diag
+            [r, x, sdiag] = self.qrsolv_vectorized(r, ipvt, wa1, qtb, sdiag)
+            wa2 = diag*x
+            dxnorm = self.enorm(wa2)
+            temp = fp
+            fp = dxnorm - delta
+
+            if (numpy.abs(fp) <= 0.1*delta) or \
+               ((parl == 0) and (fp <= temp) and (temp < 0)) or \
+               (iter == 10):
+               break;
+
+            # Compute the newton correction, solving s^T*wa1 = p^T*d*x/dxnorm
+            # (s^T is stored in the strict lower triangle of r and sdiag)
+            smat = numpy.tril(r, -1) + numpy.diag(sdiag)
+            wa1 = self.solve_triangular(smat, diag[ipvt] * wa2[ipvt] / dxnorm,
+                                        lower=True)
+
+            temp = self.enorm(wa1)
+            parc = ((fp/delta)/temp)/temp
+
+            # Depending on the sign of the function, update parl or paru
+            if fp > 0:
+                parl = numpy.max([parl,par])
+            if fp < 0:
+                paru = numpy.min([paru,par])
+
+            # Compute an improved estimate for par
+            par = numpy.max([parl, par+parc])
+
+        return [r, par, x, sdiag]
+
+    def calc_covar_vectorized(self, rr, ipvt=None, tol=1.e-14):
+        """
+        As calc_covar: p*inverse(r^T*r)*p^T, restricted to the leading
+        columns of r whose diagonal elements exceed tol*abs(r[0,0])
+        """
+        if self.debug:
+            print 'Entering calc_covar_vectorized...'
+        if numpy.ndim(rr) != 2:
+            print 'ERROR: r must be a two-dimensional matrix'
+            return -1
+        s = rr.shape
+        n = s[0]
+        if s[0] != s[1]:
+            print 'ERROR: r must be a square matrix'
+            return -1
+
+        if ipvt is None:
+            ipvt = numpy.arange(n)
+        r = numpy.triu(rr)
+
+        # the covariance is computed for the first nsing columns only
+        tolr = tol * numpy.abs(r[0,0])
+        wh = (numpy.nonzero(numpy.abs(numpy.diagonal(r)) <= tolr))[0]
+        nsing = wh[0] if len(wh) > 0 else n
+
+        covar = numpy.zeros([n,n], dtype=float)
+        if nsing > 0:
+            rinv = self.solve_triangular(r[0:nsing,0:nsing], numpy.eye(nsing))
+            covar[0:nsing,0:nsing] = numpy.dot(rinv, rinv.T)
+        result = numpy.zeros([n,n], dtype=float)
+        result[numpy.ix_(ipvt, ipvt)] = covar
+        return result
+
+def affine_tie(expr):
+    """
+    If the tied expression ``expr`` is a linear function of the parameters
+    (e.g., ``'p[3]'``, ``'2*p[1] + 0.5'`` or ``'(p[0]+p[3])/2.'``), return
+    ``(coefs, const)`` such that it equals ``sum(coefs[j]*p[j]) + const``;
+    otherwise return None
+    """
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError:
+        return None
+
+    def linear(node):
+        if isinstance(node, ast.Num) and not isinstance(node.n, complex):
+            return {}, float(node.n)
+        if (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name)
+                and node.value.id == 'p' and isinstance(node.slice, ast.Index)
+                and isinstance(node.slice.value, ast.Num)
+                and isinstance(node.slice.value.n, (int, long))
+                and node.slice.value.n >= 0):
+            return {node.slice.value.n: 1.}, 0.
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+            operand = linear(node.operand)
+            if operand is None or isinstance(node.op, ast.UAdd):
+                return operand
+            return dict((j,-c) for j,c in operand[0].items()), -operand[1]
+        if isinstance(node, ast.BinOp):
+            left, right = linear(node.left), linear(node.right)
+            if left is None or right is None:
+                return None
+            if isinstance(node.op, (ast.Add, ast.Sub)):
+                sign = 1. if isinstance(node.op, ast.Add) else -1.
+                coefs = dict(left[0])
+                for j,c in right[0].items():
+                    coefs[j] = coefs.get(j, 0.) + sign*c
+                return coefs, left[1] + sign*right[1]
+            if isinstance(node.op, ast.Mult):
+                if not left[0]:
+                    left, right = right, left
+                if right[0]:
+                    return None
+                return dict((j,c*right[1]) for j,c in left[0].items()), left[1]*right[1]
+            # (constant / constant may be integer division; leave it to eval)
+            if (isinstance(node.op, ast.Div) and left[0] and not right[0]
+                    and right[1] != 0):
+                return dict((j,c/right[1]) for j,c in left[0].items()), left[1]/right[1]
+        return None
+
+    return linear(tree.body)
+
 class machar:
     def __init__(self, double=1):
         if double == 0:
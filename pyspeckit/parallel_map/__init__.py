@@ -1 +1,2 @@
-from parallel_map import parallel_map
+from parallel_map import (parallel_map, parallel_imap, parallel_foreach,
+                          shared_array)
@@ -4,8 +4,14 @@ Parellel Map snippet by Brian Refsdal
 http://www.astropython.org/snippet/2010/3/Parallel-map-using-multiprocessing
 """
 import numpy
+import mmap
 import warnings
+import traceback
 from astropy import log
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 _multi=False
 _ncpus=1
 
@@ -21,7 +27,7 @@ except Exception as ex:
     _multi=False
 
 
-__all__ = ('parallel_map',)
+__all__ = ('parallel_map', 'parallel_imap', 'parallel_foreach', 'shared_array')
 
 
 def worker(f, ii, chunk, out_q, err_q, lock):
@@ -159,6 +165,183 @@ def parallel_map(function, sequence, numcores=None):
   return run_tasks(procs, err_q, out_q, numcores)
 
 
+def guided_chunks(size, numcores, minchunk=1, factor=2):
+  """
+  Split ``range(size)`` into (start, stop) work units whose size shrinks as
+  the remaining work shrinks ("guided" scheduling).  Early units are large
+  to keep the queue overhead low; the last ones are small so that no single
+  slow unit holds up the end of the job.
+
+  :param size: number of items
+  :param numcores: number of workers sharing the units
+  :param minchunk: smallest allowed unit
+  :param factor: number of units per worker to aim for at each step
+  """
+  bounds = []
+  start = 0
+  while start < size:
+    remaining = size - start
+    nn = max(minchunk, int(numpy.ceil(remaining / float(factor*numcores))))
+    bounds.append((start, min(start+nn, size)))
+    start += nn
+  return bounds
+
+
+def imap_worker(f, sequence, task_q, out_q):
+  """
+  A persistent worker: pull (start, stop) units from the task queue until a
+  ``None`` sentinel arrives, and put one list of (index, result, error)
+  triplets on the output queue per unit.  Exceptions are caught per item and
+  returned as formatted tracebacks so that one bad item does not cost the
+  rest of the unit.
+  """
+  while True:
+    task = task_q.get()
+    if task is None:
+      break
+    start, stop = task
+    vals = []
+    for ii in range(start, stop):
+      try:
+        vals.append((ii, f(sequence[ii]), None))
+      except KeyboardInterrupt:
+        raise
+      except Exception:
+        vals.append((ii, None, traceback.format_exc()))
+    out_q.put(vals)
+
+
+def parallel_imap(function, sequence, numcores=None, minchunk=1, poll=1.0):
+  """
+  A streaming, load-balanced relative of `parallel_map`.
+
+  A pool of ``numcores`` persistent processes pulls dynamically sized work
+  units (see `guided_chunks`) from a shared queue, so fast workers keep
+  taking work while slow ones are busy.  Results are yielded as
+  ``(index, result, error)`` triplets in completion order as soon as each
+  unit finishes; ``error`` is ``None`` on success and a traceback string if
+  ``function`` raised for that item.  If a worker dies (e.g., is killed
+  for running out of memory), the items it never reported are yielded with
+  an error rather than being silently lost.
+
+  The function is inherited by the workers via ``fork``, so closures are
+  allowed, as for `parallel_map`.
+
+  :param function: callable function that accepts argument from iterable
+  :param sequence: indexable sequence
+  :param numcores: number of cores to use
+  :param minchunk: smallest work unit handed to a worker
+  :param poll: seconds to wait on the result queue before checking that
+      the workers are still alive
+  """
+  if not callable(function):
+    raise TypeError("input function '%s' is not callable" %
+              repr(function))
+
+  if not numpy.iterable(sequence):
+    raise TypeError("input '%s' is not iterable" %
+              repr(sequence))
+
+  size = len(sequence)
+
+  if not _multi or size == 1 or numcores == 1:
+    for ii in range(size):
+      try:
+        yield ii, function(sequence[ii]), None
+      except KeyboardInterrupt:
+        raise
+      except Exception:
+        yield ii, None, traceback.format_exc()
+    return
+
+  if numcores is not None and numcores > _ncpus:
+      warnings.warn("Number of requested cores is greated than the "
+                    "number of available CPUs.")
+  elif numcores is None:
+    numcores = _ncpus
+
+  if size < numcores:
+    log.info("Reduced number of cores to {0}".format(size))
+    numcores = size
+
+  task_q = multiprocessing.Queue()
+  out_q = multiprocessing.Queue()
+  for bounds in guided_chunks(size, numcores, minchunk=minchunk):
+    task_q.put(bounds)
+  for ii in range(numcores):
+    task_q.put(None)
+
+  procs = [multiprocessing.Process(target=imap_worker,
+           args=(function, sequence, task_q, out_q))
+         for ii in range(numcores)]
+
+  received = numpy.zeros(size, dtype='bool')
+  try:
+    for proc in procs:
+      proc.start()
+
+    while not received.all():
+      try:
+        vals = out_q.get(timeout=poll)
+      except queue.Empty:
+        if any(proc.is_alive() for proc in procs):
+          continue
+        # every worker has exited; drain whatever is left, then give up
+        try:
+          vals = out_q.get(timeout=poll)
+        except queue.Empty:
+          break
+      for val in vals:
+        received[val[0]] = True
+        yield val
+
+    for ii in numpy.flatnonzero(~received):
+      yield ii, None, "Worker process exited before returning this item."
+
+  finally:
+    for proc in procs:
+      if proc.is_alive():
+        proc.terminate()
+      proc.join()
+
+
+def parallel_foreach(function, sequence, numcores=None, **kwargs):
+  """
+  Call ``function`` on every item of ``sequence`` purely for its side
+  effects, using `parallel_imap`.  Nothing but a completion flag travels
+  back through the queues, so ``function`` should write its output into
+  arrays created with `shared_array`.  The first error is re-raised as a
+  `RuntimeError` carrying the worker's traceback.
+  """
+  for ii, result, error in parallel_imap(function, sequence,
+                                         numcores=numcores, **kwargs):
+    if error is not None:
+      raise RuntimeError("Item %i of the parallel job failed:\n%s" %
+                         (ii, error))
+
+
+def shared_array(shape, dtype='float64', filename=None):
+  """
+  Create a zero-filled array whose memory is shared with forked worker
+  processes, so that workers can write their results into it in place.
+
+  :param shape: shape of the array
+  :param dtype: numpy dtype of the array
+  :param filename: if given, back the array with a memory-mapped scratch
+      file instead of anonymous shared memory (useful when the output does
+      not fit in RAM)
+  """
+  if filename is not None:
+    return numpy.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+
+  dtype = numpy.dtype(dtype)
+  nbytes = int(numpy.prod(shape)) * dtype.itemsize
+  # an anonymous mmap is MAP_SHARED and zero-filled
+  buf = mmap.mmap(-1, max(nbytes, 1))
+  return numpy.frombuffer(buf, dtype=dtype,
+                          count=int(numpy.prod(shape))).reshape(shape)
+
+
 if __name__ == "__main__":
   """
   Unit test of parallel_map()
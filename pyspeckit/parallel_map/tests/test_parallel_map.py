@@ -0,0 +1,100 @@
+"""
+Tests for the multiprocessing helpers
+"""
+
+import os
+import numpy as np
+import pytest
+from pyspeckit.parallel_map import (parallel_map, parallel_imap,
+                                    parallel_foreach, shared_array)
+from pyspeckit.parallel_map.parallel_map import guided_chunks
+
+
+def test_guided_chunks():
+    chunks = guided_chunks(1000, 4, minchunk=3)
+    # the units tile the range in order
+    assert chunks[0][0] == 0
+    assert chunks[-1][1] == 1000
+    assert all(a[1] == b[0] for a, b in zip(chunks[:-1], chunks[1:]))
+    sizes = [stop-start for start, stop in chunks]
+    # they shrink, but not below minchunk (except for the remainder)
+    assert sizes == sorted(sizes, reverse=True)
+    assert min(sizes[:-1]) >= 3
+
+
+@pytest.mark.parametrize('numcores', [1, 3])
+def test_imap_ordering(numcores):
+    sequence = np.arange(57)
+    results = list(parallel_imap(lambda x: x**2, sequence, numcores=numcores))
+    assert sorted(ii for ii, result, error in results) == list(range(57))
+    for ii, result, error in results:
+        assert error is None
+        assert result == sequence[ii]**2
+    assert parallel_map(lambda x: x**2, sequence, numcores=numcores) == list(sequence**2)
+
+
+def _fail_on_odd(x):
+    if x % 2:
+        raise ValueError("odd item %i" % x)
+    return x
+
+
+@pytest.mark.parametrize('numcores', [1, 2])
+def test_imap_item_errors(numcores):
+    results = dict((ii, (result, error)) for ii, result, error in
+                   parallel_imap(_fail_on_odd, range(20), numcores=numcores))
+    assert len(results) == 20
+    for ii in range(20):
+        result, error = results[ii]
+        if ii % 2:
+            # the failure of one item does not cost the rest of its unit
+            assert result is None
+            assert "odd item %i" % ii in error
+        else:
+            assert result == ii
+            assert error is None
+
+
+def test_imap_worker_dies():
+    def die_on_five(x):
+        if x == 5:
+            os._exit(1)
+        return x
+
+    results = dict((ii, (result, error)) for ii, result, error in
+                   parallel_imap(die_on_five, range(12), numcores=2,
+                                 poll=0.1))
+    # every item is reported, and the one that killed its worker is an error
+    assert sorted(results) == list(range(12))
+    assert "exited" in results[5][1]
+    for ii, (result, error) in results.items():
+        if error is None:
+            assert result == ii
+
+
+def test_foreach_raises():
+    with pytest.raises(RuntimeError) as exc:
+        parallel_foreach(_fail_on_odd, range(10), numcores=2)
+    assert "odd item" in str(exc.value)
+
+
+def test_shared_array_writes():
+    out = shared_array((4, 5), dtype='float32')
+    assert out.dtype == np.float32
+    assert np.all(out == 0)
+
+    def fill(ii):
+        out[ii] = ii + np.arange(5)
+
+    parallel_foreach(fill, range(4), numcores=2)
+    np.testing.assert_array_equal(out, np.arange(4)[:,None] + np.arange(5))
+
+
+def test_shared_array_file(tmpdir):
+    out = shared_array((3, 2), filename=str(tmpdir.join('scratch.dat')))
+
+    def fill(ii):
+        out[ii] = ii
+
+    parallel_foreach(fill, range(3), numcores=2)
+    np.testing.assert_array_equal(out, np.arange(3)[:,None]*np.ones(2))
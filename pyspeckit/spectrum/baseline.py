@@ -485,7 +485,10 @@ class Baseline(interactive.Interactive):
             import pdb; pdb.set_trace()
 
         #xarrconv = xarr[xmin:xmax].as_unit(xarr_fit_units)
-        OK = True-masktoexclude
+        if masktoexclude is None:
+            OK = np.ones(spectrum.shape, dtype='bool')
+        else:
+            OK = ~masktoexclude
         xarrconv = xarr.as_unit(xarr_fit_units)
         if powerlaw:
             # for powerlaw fitting, only consider positive data
@@ -503,12 +506,18 @@ class Baseline(interactive.Interactive):
                     return [0, np.ravel( (data - self.get_model(xarr=xarrconv[OK],baselinepars=p)) / (err/data) )]
                 return f
         else:
-            pguess = [0]*(order+1)
-            if LoudDebug: print "_baseline Guesses: ",pguess
+            # a polynomial baseline is a linear least-squares problem: solve
+            # it directly rather than iterating with mpfit
+            xfit = getattr(xarrconv, 'value', xarrconv)
+            if not np.any(OK):
+                OK = np.ones(spectrum.shape, dtype='bool')
+            fitp = _poly_lstsq(np.asarray(xfit)[OK], spectrum[OK],
+                               weights=1./err[OK], order=order)
+            if np.any(np.isnan(fitp)):
+                raise ValueError("chi^2 is NAN in baseline fitting")
+            bestfit = np.poly1d(fitp)(xarrconv).squeeze()
+            return bestfit,fitp
 
-            def mpfitfun(data,err):
-                def f(p,fjac=None): return [0,np.ravel((np.poly1d(p)(xarrconv[OK])-data)/err)]
-                return f
         #scalefactor = 1.0
         #if renormalize in ('auto',True):
         #    datarange = spectrum.max() - spectrum.min()
@@ -523,11 +532,8 @@ class Baseline(interactive.Interactive):
         if np.isnan(mp.fnorm):
             raise ValueError("chi^2 is NAN in baseline fitting")
         fitp = mp.params
-        if powerlaw:
-            #bestfit = (fitp[0]*(xarrconv)**(-fitp[1])).squeeze()
-            bestfit = (fitp[0]*(xarrconv)**(-fitp[1])).squeeze()
-        else:
-            bestfit = np.poly1d(fitp)(xarrconv).squeeze()
+        #bestfit = (fitp[0]*(xarrconv)**(-fitp[1])).squeeze()
+        bestfit = (fitp[0]*(xarrconv)**(-fitp[1])).squeeze()
 
         return bestfit,fitp
 
@@ -569,17 +575,202 @@ class Baseline(interactive.Interactive):
 
         return newbaseline
 
+def _poly_lstsq(x, data, weights=None, order=1):
+    """
+    Weighted linear least-squares polynomial fit
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The (npts,) x values
+    data : np.ndarray
+        The (npts,) data, or (npts, nspec) to fit nspec spectra sharing ``x``
+        and ``weights`` at once
+    weights : np.ndarray or None
+        (npts,) weights of each point (1/error)
+    order : int
+        The polynomial order
+
+    Returns
+    -------
+    coefficients : np.ndarray
+        (order+1,) or (order+1, nspec) coefficients, highest power first as
+        for `numpy.poly1d`
+    """
+    design = np.vander(np.asarray(x, dtype='float64'), order+1)
+    data = np.asarray(data, dtype='float64')
+    if weights is not None:
+        weights = np.asarray(weights, dtype='float64')
+        design = design * weights[:,None]
+        data = data * (weights[:,None] if data.ndim == 2 else weights)
+    # scale the columns to unit norm so that high powers of large x values
+    # don't make the system ill-conditioned (as numpy.polyfit does)
+    scale = np.sqrt((design**2).sum(axis=0))
+    scale[scale == 0] = 1
+    coefficients = np.linalg.lstsq(design/scale, data, rcond=-1)[0]
+    return (coefficients.T/scale).T
+
+def _bspline_basis(x, knots, order):
+    """
+    The B-spline basis functions of degree ``order`` for the knot vector
+    ``knots`` (de Boor's recursion), evaluated at ``x``
+
+    Only the ``order+1`` basis functions that are nonzero at each x are
+    computed, so the cost is linear in ``len(x)``.  The last knot interval is
+    closed on the right.
+
+    Returns
+    -------
+    first : np.ndarray
+        The (len(x),) index of the first nonzero basis function at each x
+    values : np.ndarray
+        The (len(x), order+1) values of basis functions ``first`` to
+        ``first+order``
+    """
+    x = np.asarray(x, dtype='float64')
+    t = np.asarray(knots, dtype='float64')
+    # the (nonempty) knot interval t[i] <= x < t[i+1] of each x
+    last = np.flatnonzero(t[:-1] < t[1:])[-1]
+    interval = np.clip(np.searchsorted(t, x, side='right') - 1, order, last)
+    values = np.zeros((len(x), order+1))
+    values[:,0] = 1
+    left = np.empty((len(x), order+1))
+    right = np.empty((len(x), order+1))
+    for j in range(1, order+1):
+        left[:,j] = x - t[interval+1-j]
+        right[:,j] = t[interval+j] - x
+        saved = np.zeros(len(x))
+        for r in range(j):
+            temp = values[:,r] / (right[:,r+1] + left[:,j-r])
+            values[:,r] = saved + right[:,r+1]*temp
+            saved = left[:,j-r]*temp
+        values[:,j] = saved
+    return interval - order, values
+
+def _interpolation_knots(xfit, order, lo, hi):
+    """
+    The knot vector of the spline of degree ``order`` interpolating at the
+    (sorted) ``xfit``, with the "not-a-knot" choice of interior knots used by
+    FITPACK (and so `scipy.interpolate.UnivariateSpline` with ``s=0``) and
+    boundary knots at ``lo`` and ``hi``
+    """
+    m = len(xfit)
+    if order % 2:
+        interior = xfit[(order+1)//2:m-(order+1)//2]
+    else:
+        interior = (xfit[order//2:m-order//2-1] + xfit[order//2+1:m-order//2])/2.
+    return np.concatenate([[lo]*(order+1), interior, [hi]*(order+1)])
+
+def _banded_lstsq(first, values, data, ncoef):
+    """
+    Least-squares solution of ``design . coefficients = data`` for a B-spline
+    design matrix given by its nonzero values (see `_bspline_basis`) and one
+    or many (columns of) ``data``, through the banded normal equations
+
+    The normal matrix is accumulated directly in banded form, without
+    building the dense design matrix.
+    """
+    bandwidth = values.shape[1] - 1
+    data = np.asarray(data, dtype='float64')
+    shape = data.shape
+    data = data.reshape(len(data), -1)
+    # sum the rows that share their first basis function
+    inds = np.argsort(first, kind='mergesort')
+    first, values, data = first[inds], values[inds], data[inds]
+    starts = np.flatnonzero(np.concatenate([[True], first[1:] != first[:-1]]))
+    ufirst = first[starts]
+
+    banded = np.zeros((bandwidth+1, ncoef))
+    rhs = np.zeros((ncoef, data.shape[1]))
+    for p in range(bandwidth+1):
+        rhs[ufirst+p] += np.add.reduceat(values[:,p,None]*data, starts, axis=0)
+        for q in range(p, bandwidth+1):
+            banded[bandwidth-(q-p), ufirst+q] += np.add.reduceat(values[:,p]*values[:,q],
+                                                                 starts)
+    try:
+        from scipy.linalg import solveh_banded
+        coefficients = solveh_banded(banded, rhs)
+    except (ImportError, np.linalg.LinAlgError):
+        # no scipy, or not positive definite (some basis function has no
+        # data): fall back to a dense solve
+        design = np.zeros((len(first), ncoef))
+        for p in range(bandwidth+1):
+            design[np.arange(len(first)), first+p] = values[:,p]
+        coefficients = np.linalg.lstsq(design, data, rcond=-1)[0]
+    return coefficients.reshape((ncoef,) + shape[1:])
+
+def _bspline_evaluate(first, values, coefficients):
+    """
+    The spline(s) with B-spline ``coefficients`` at the points whose nonzero
+    basis functions are ``first`` and ``values`` (see `_bspline_basis`)
+    """
+    coefficients = np.asarray(coefficients)
+    shape = coefficients.shape
+    coefficients = coefficients.reshape(len(coefficients), -1)
+    result = np.zeros((len(first), coefficients.shape[1]))
+    for p in range(values.shape[1]):
+        result += values[:,p,None] * coefficients[first+p]
+    return result.reshape((len(first),) + shape[1:])
+
+def _spline_baselines(x, data, good, order=3, sampling=10,
+                      downsampler=np.median, append_endpoints=False):
+    """
+    Spline baselines for many spectra sharing an X-axis and a mask
+
+    The ``good`` channels of each spectrum are downsampled by ``sampling``
+    with ``downsampler`` and interpolated with a spline of degree ``order``,
+    as `_spline` does one spectrum at a time.  All the spectra share the
+    knot vector, so their coefficients come from a single banded
+    least-squares solve.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The (nchan,) X-axis
+    data : np.ndarray
+        The (nchan, nspec) spectra
+    good : np.ndarray
+        The (nchan,) boolean mask of the channels to fit
+
+    Returns
+    -------
+    baselines : np.ndarray
+        The (nchan, nspec) baselines
+    """
+    x = np.asarray(getattr(x, 'value', x), dtype='float64')
+    ngood = np.count_nonzero(good)
+    endpoint = ngood - (ngood % sampling)
+    nspec = data.shape[1]
+    y = np.asarray(data[np.flatnonzero(good)[:endpoint]], dtype='float64')
+    yfit = downsampler(y.reshape(endpoint//sampling, sampling, nspec), axis=1)
+    xfit = x[good][sampling//2:endpoint:sampling]
+    if append_endpoints:
+        dx = x[1]-x[0]
+        xfit = np.concatenate([[x[0]-dx], xfit, [x[-1]+dx]])
+        yfit = np.concatenate([yfit[:1], yfit, yfit[-1:]])
+    if len(xfit) <= order:
+        raise ValueError("Sampling is too sparse.  Use finer sampling or "
+                         "decrease the spline order.")
+    inds = np.argsort(xfit)
+    xfit, yfit = xfit[inds], yfit[inds]
+
+    knots = _interpolation_knots(xfit, order, min(xfit[0], x.min()),
+                                 max(xfit[-1], x.max()))
+    first, values = _bspline_basis(xfit, knots, order)
+    coefficients = _banded_lstsq(first, values, yfit, len(knots)-order-1)
+    first, values = _bspline_basis(x, knots, order)
+    return _bspline_evaluate(first, values, coefficients)
+
 def _spline(data, xarr=None, masktofit=None, order=3, sampling=10,
             downsampler=np.median, append_endpoints=True):
-    from scipy.interpolate import UnivariateSpline
-
-    assert masktofit.shape == data.shape
 
     if masktofit is None:
         masktofit = np.isfinite(data)
         if not any(masktofit):
             log.warn("All data was infinite or NaN")
 
+    assert masktofit.shape == data.shape
+
     if xarr is None:
         xarr = np.arange(data.size, dtype=data.dtype)
 
@@ -588,22 +779,12 @@ def _spline(data, xarr=None, masktofit=None, order=3, sampling=10,
         if ngood == 0:
             log.warn("Fitting all data with spline")
             masktofit[:] = True
-            ngood = masktofit.size
-        endpoint = ngood - (ngood % sampling)
-        yfit = downsampler([data[masktofit][ii:endpoint:sampling]
-                            for ii in range(sampling)], axis=0)
-        xfit = xarr[masktofit][sampling/2:endpoint:sampling]
-        if append_endpoints:
-            xfit = np.array([xarr[0]-(xarr[1]-xarr[0])] +
-                            xfit.tolist() +
-                            [xarr[-1]+(xarr[1]-xarr[0])])
-            yfit = np.array([yfit[0]] + yfit.tolist() + [yfit[-1]])
-        inds = np.argsort(xfit)
-        spl = UnivariateSpline(xfit[inds],
-                               yfit[inds],
-                               k=order,
-                               s=0)
+        baseline_fitted = _spline_baselines(xarr, data[:,None], masktofit,
+                                            order=order, sampling=sampling,
+                                            downsampler=downsampler,
+                                            append_endpoints=append_endpoints)[:,0]
     else:
+        from scipy.interpolate import UnivariateSpline
         xfit = xarr[masktofit]
         yfit = data[masktofit]
         inds = np.argsort(xfit)
@@ -611,10 +792,9 @@ def _spline(data, xarr=None, masktofit=None, order=3, sampling=10,
                                yfit[inds],
                                k=order,
                                s=sampling)
+        baseline_fitted = spl(xarr)
 
-    baseline_fitted = spl(xarr)
     if np.any(np.isnan(baseline_fitted)):
         log.error("NaNs in baseline.")
         import ipdb; ipdb.set_trace()
     return baseline_fitted
-
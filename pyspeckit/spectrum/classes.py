@@ -171,13 +171,7 @@ class Spectrum(object):
             self.parse_header(self.header)
 
         if maskdata:
-            if hasattr(self.data,'mask'):
-                self.data.mask += np.isnan(self.data) + np.isinf(self.data)
-                if hasattr(self.error,'mask'):
-                    self.error.mask += np.isnan(self.data) + np.isinf(self.data)
-            else:
-                self.data = np.ma.masked_where(np.isnan(self.data) + np.isinf(self.data), self.data)
-                self.error = np.ma.masked_where(np.isnan(self.data) + np.isinf(self.data), self.error)
+            self._maskdata()
 
         # it is very important that this be done BEFORE the spectofit is set!
         self._sort()
@@ -252,6 +246,18 @@ class Spectrum(object):
             self.Registry.add_fitter(modelname, model,
                     registry.npars[modelname], key=registry.associated_keys.get(modelname))
 
+    def _maskdata(self):
+        """
+        Mask the nan and inf values of the data and error
+        """
+        if hasattr(self.data,'mask'):
+            self.data.mask += np.isnan(self.data) + np.isinf(self.data)
+            if hasattr(self.error,'mask'):
+                self.error.mask += np.isnan(self.data) + np.isinf(self.data)
+        else:
+            self.data = np.ma.masked_where(np.isnan(self.data) + np.isinf(self.data), self.data)
+            self.error = np.ma.masked_where(np.isnan(self.data) + np.isinf(self.data), self.error)
+
     def _sort(self):
         """
         Make sure X axis is monotonic.  
@@ -617,10 +617,11 @@ class Specfit(interactive.Interactive):
                     np.sum(self.parinfo.fixed))
 
         # rescale any scaleable parameters
-        for par in self.parinfo:
-            if par.scaleable:
-                par.value = par.value * scalefactor
-                par.error = par.error * scalefactor
+        scale = np.array([scalefactor if par.scaleable else 1
+                          for par in self.parinfo])
+        if np.any(scale != 1):
+            self.parinfo.set_values(self.parinfo.column('value') * scale,
+                                    errors=self.parinfo.column('error') * scale)
 
         self.modelpars = self.parinfo.values
         self.modelerrs = self.parinfo.errors
@@ -808,10 +809,11 @@ class Specfit(interactive.Interactive):
         self.modelerrs = mpperr
         
         # rescale any scaleable parameters
-        for par in self.parinfo:
-            if par.scaleable:
-                par.value = par.value * scalefactor
-                par.error = par.error * scalefactor
+        scale = np.array([scalefactor if par.scaleable else 1
+                          for par in self.parinfo])
+        if np.any(scale != 1):
+            self.parinfo.set_values(self.parinfo.column('value') * scale,
+                                    errors=self.parinfo.column('error') * scale)
 
         if self.Spectrum.plotter.axis is not None and plot:
             if color is not None:
@@ -1685,7 +1687,7 @@ class Specfit(interactive.Interactive):
         else:
             raise AttributeError("Fitter %r does not have pymc implemented." % self.fitter)
 
-    def get_emcee(self, nwalkers=None, **kwargs):
+    def get_emcee(self, nwalkers=None, vectorize=None, **kwargs):
         """
         Get an emcee walker ensemble for the data & model using the current model type
 
@@ -1695,6 +1697,11 @@ class Specfit(interactive.Interactive):
         error : np.ndarray
         nwalkers : int
             Number of walkers to use.  Defaults to 2 * self.fitters.npars
+        vectorize : bool or None
+            Evaluate all of the walkers at once (see
+            `~pyspeckit.spectrum.models.model.SpectralModel.get_emcee_ensemblesampler`)
+        kwargs : dict
+            Passed to ``emcee.EnsembleSampler``
 
         Examples
         --------
@@ -1710,10 +1717,13 @@ class Specfit(interactive.Interactive):
         >>> pos,logprob,state = emcee_ensemble.run_mcmc(p0,100)
         """
         if hasattr(self.fitter,'get_emcee_ensemblesampler'):
-            nwalkers = (self.fitter.npars * self.fitter.npeaks + self.fitter.vheight) * 2
+            if nwalkers is None:
+                nwalkers = (self.fitter.npars * self.fitter.npeaks + self.fitter.vheight) * 2
             emc = self.fitter.get_emcee_ensemblesampler(self.Spectrum.xarr,
                                                         self.spectofit,
-                                                        self.errspec, nwalkers)
+                                                        self.errspec, nwalkers,
+                                                        vectorize=vectorize,
+                                                        **kwargs)
             emc.nwalkers = nwalkers
             emc.p0 = np.array([self.parinfo.values] * emc.nwalkers)
             return emc
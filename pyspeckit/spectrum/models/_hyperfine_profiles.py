@@ -0,0 +1,69 @@
+"""
+Helpers for evaluating sums of many narrow Gaussian (hyperfine) components
+on a wide spectral axis.
+
+Each component is only evaluated on the window of channels within `nsigma`
+widths of its centre.
+"""
+import numpy as np
+
+# components are evaluated out to this many widths from their centres;
+# beyond that exp(-x**2/2) < 3e-18, negligible relative to the peak
+nsigma = 9
+
+def axis_values(xarr, unit):
+    """
+    Convert a spectroscopic axis (or a Quantity) to ``unit``
+
+    Repeated conversions of an unchanged `SpectroscopicAxis` come from its
+    own `~pyspeckit.spectrum.units.SpectroscopicAxis.as_unit` cache.
+
+    Returns
+    -------
+    values : `numpy.ndarray`
+        The axis in ``unit``
+    sortkey : `numpy.ndarray` or None
+        ``values`` if they increase monotonically, ``-values`` if they
+        decrease, or None otherwise.  Used by `component_windows`.
+    """
+    try:
+        values = xarr.as_unit(unit).value
+    except AttributeError:
+        values = xarr.to(unit).value
+    values = np.asarray(values, dtype='float64')
+
+    steps = np.diff(values)
+    if np.all(steps > 0):
+        sortkey = values
+    elif np.all(steps < 0):
+        sortkey = -values
+    else:
+        sortkey = None
+
+    return values, sortkey
+
+def component_windows(values, sortkey, centers, widths):
+    """
+    The slices of ``values`` within `nsigma` ``widths`` of each of the
+    ``centers``.  If the axis is not monotonic or a width is not positive,
+    the full axis is used.
+    """
+    centers = np.asarray(centers, dtype='float64')
+    widths = np.abs(np.asarray(widths, dtype='float64'))
+    full = [slice(None)] * centers.size
+    if sortkey is None or not np.all(np.isfinite(centers)):
+        return full
+    ok = np.isfinite(widths) & (widths > 0)
+    sign = 1 if sortkey is values else -1
+    lo = np.searchsorted(sortkey, sign*centers - nsigma*widths, side='left')
+    hi = np.searchsorted(sortkey, sign*centers + nsigma*widths, side='right')
+    return [slice(l, h) if good else slice(None)
+            for l, h, good in zip(lo, hi, ok)]
+
+def window_span(windows, size):
+    """ The smallest slice containing all of the ``windows`` """
+    starts = [w.indices(size)[0] for w in windows]
+    stops = [w.indices(size)[1] for w in windows]
+    if not starts:
+        return slice(0, 0)
+    return slice(min(starts), max(stops))
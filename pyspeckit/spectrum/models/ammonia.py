@@ -25,73 +25,33 @@ from . import mpfit_messages
 
 from ammonia_constants import (line_names, freq_dict, aval_dict, ortho_dict,
                                voff_lines_dict, tau_wts_dict)
-
-def ammonia(xarr, tkin=20, tex=None, ntot=1e14, width=1, xoff_v=0.0,
-            fortho=0.0, tau=None, fillingfraction=None, return_tau=False,
-            background_tb=2.7315,
-            thin=False, verbose=False, return_components=False, debug=False):
+from _hyperfine_profiles import axis_values, component_windows, window_span
+
+# rest frequencies (GHz) and normalized relative optical depths of the
+# hyperfine components of each line
+_ckms = 2.99792458e5
+line_freqs_dict = dict((linename,
+                        (1-np.array(voff_lines_dict[linename])/_ckms)*
+                        freq_dict[linename]/1e9)
+                       for linename in line_names)
+line_weights_dict = dict((linename,
+                          np.array(tau_wts_dict[linename]) /
+                          np.array(tau_wts_dict[linename]).sum())
+                         for linename in line_names)
+
+def _line_optical_depths(tkin=20, tex=None, ntot=1e14, width=1, fortho=0.0,
+                         tau=None, thin=False):
     """
-    Generate a model Ammonia spectrum based on input temperatures, column, and
-    gaussian parameters
-
-    Parameters
-    ----------
-    xarr: `pyspeckit.spectrum.units.SpectroscopicAxis`
-        Array of wavelength/frequency values
-    ntot: float
-        can be specified as a column density (e.g., 10^15) or a
-        log-column-density (e.g., 15)
-    tex: float or None
-        Excitation temperature. Assumed LTE if unspecified (``None``), if
-        tex>tkin, or if ``thin`` is specified.
-    ntot: float
-        Total column density of NH3.  Can be specified as a float in the range
-        5-25 or an exponential (1e5-1e25)
-    width: float
-        Line width in km/s
-    xoff_v: float
-        Line offset in km/s
-    fortho: float
-        Fraction of NH3 molecules in ortho state.  Default assumes all para
-        (fortho=0).
-    tau: None or float
-        If tau (optical depth in the 1-1 line) is specified, ntot is NOT fit
-        but is set to a fixed value.  The optical depths of the other lines are
-        fixed relative to tau_oneone
-    fillingfraction: None or float
-        fillingfraction is an arbitrary scaling factor to apply to the model
-    return_tau: bool
-        Return a dictionary of the optical depths in each line instead of a
-        synthetic spectrum
-    thin: bool
-        uses a different parametetrization and requires only the optical depth,
-        width, offset, and tkin to be specified.  In the 'thin' approximation,
-        tex is not used in computation of the partition function - LTE is
-        implicitly assumed
-    return_components: bool
-        Return a list of arrays, one for each hyperfine component, instead of
-        just one array
-    background_tb : float
-        The background brightness temperature.  Defaults to TCMB.
-    verbose: bool
-        More messages
-    debug: bool
-        For debugging.
+    Compute the peak optical depth of each of the ammonia inversion lines.
+    The parameters are as for `ammonia`.
 
     Returns
     -------
-    spectrum: `numpy.ndarray`
-        Synthetic spectrum with same shape as ``xarr``
-    component_list: list
-        List of `numpy.ndarray`'s, one for each hyperfine component
-    tau_dict: dict
-        Dictionary of optical depth values for the various lines
-        (if ``return_tau`` is set)
+    tau_dict : dict or None
+        The optical depth of each line (None if ``ntot`` is invalid)
+    tex : float
+        The excitation temperature actually used
     """
-
-    # Convert X-units to frequency in GHz
-    xarr = xarr.as_unit('GHz')
-
     if tex is not None:
         # Yes, you certainly can have nonthermal excitation, tex>tkin.
         #if tex > tkin: # cannot have Tex > Tkin
@@ -110,12 +70,7 @@ def ammonia(xarr, tkin=20, tex=None, ntot=1e14, width=1, xoff_v=0.0,
         ntot = 10**ntot
     elif (25 < ntot < 1e5) or (ntot < 5):
         # these are totally invalid for log/non-log
-        return 0
-
-    # fillingfraction is an arbitrary scaling for the data
-    # The model will be (normal model) * fillingfraction
-    if fillingfraction is None:
-        fillingfraction = 1.0
+        return None, tex
 
     ckms = 2.99792458e5
     ccms = ckms*1e5
@@ -129,14 +84,12 @@ def ammonia(xarr, tkin=20, tex=None, ntot=1e14, width=1, xoff_v=0.0,
     nlevs = 51
     jv=np.arange(nlevs)
     ortho = jv % 3 == 0
-    para = True-ortho
+    para = ~ortho
     Jpara = jv[para]
     Jortho = jv[ortho]
     Brot = 298117.06e6
     Crot = 186726.36e6
 
-    runspec = np.zeros(len(xarr))
-    
     tau_dict = {}
     para_count = 0
     ortho_count = 1 # ignore 0-0
@@ -213,52 +166,246 @@ def ammonia(xarr, tkin=20, tex=None, ntot=1e14, width=1, xoff_v=0.0,
         for linename,t in tau_dict.iteritems():
             tau_dict[linename] = t * tau/tau11_temp
 
+    return tau_dict, tex
+
+def ammonia(xarr, tkin=20, tex=None, ntot=1e14, width=1, xoff_v=0.0,
+            fortho=0.0, tau=None, fillingfraction=None, return_tau=False,
+            background_tb=2.7315,
+            thin=False, verbose=False, return_components=False, debug=False):
+    """
+    Generate a model Ammonia spectrum based on input temperatures, column, and
+    gaussian parameters
+
+    Parameters
+    ----------
+    xarr: `pyspeckit.spectrum.units.SpectroscopicAxis`
+        Array of wavelength/frequency values
+    ntot: float
+        can be specified as a column density (e.g., 10^15) or a
+        log-column-density (e.g., 15)
+    tex: float or None
+        Excitation temperature. Assumed LTE if unspecified (``None``), if
+        tex>tkin, or if ``thin`` is specified.
+    ntot: float
+        Total column density of NH3.  Can be specified as a float in the range
+        5-25 or an exponential (1e5-1e25)
+    width: float
+        Line width in km/s
+    xoff_v: float
+        Line offset in km/s
+    fortho: float
+        Fraction of NH3 molecules in ortho state.  Default assumes all para
+        (fortho=0).
+    tau: None or float
+        If tau (optical depth in the 1-1 line) is specified, ntot is NOT fit
+        but is set to a fixed value.  The optical depths of the other lines are
+        fixed relative to tau_oneone
+    fillingfraction: None or float
+        fillingfraction is an arbitrary scaling factor to apply to the model
+    return_tau: bool
+        Return a dictionary of the optical depths in each line instead of a
+        synthetic spectrum
+    thin: bool
+        uses a different parametetrization and requires only the optical depth,
+        width, offset, and tkin to be specified.  In the 'thin' approximation,
+        tex is not used in computation of the partition function - LTE is
+        implicitly assumed
+    return_components: bool
+        Return a list of arrays, one for each hyperfine component, instead of
+        just one array
+    background_tb : float
+        The background brightness temperature.  Defaults to TCMB.
+    verbose: bool
+        More messages
+    debug: bool
+        For debugging.
+
+    Returns
+    -------
+    spectrum: `numpy.ndarray`
+        Synthetic spectrum with same shape as ``xarr``
+    component_list: list
+        List of `numpy.ndarray`'s, one for each hyperfine component
+    tau_dict: dict
+        Dictionary of optical depth values for the various lines
+        (if ``return_tau`` is set)
+    """
+
+    # Convert X-units to frequency in GHz
+    x, sortkey = axis_values(xarr, 'GHz')
+
+    tau_dict, tex = _line_optical_depths(tkin=tkin, tex=tex, ntot=ntot,
+                                         width=width, fortho=fortho, tau=tau,
+                                         thin=thin)
+    if tau_dict is None:
+        # ntot is invalid
+        return 0
+
+    # fillingfraction is an arbitrary scaling for the data
+    # The model will be (normal model) * fillingfraction
+    if fillingfraction is None:
+        fillingfraction = 1.0
+
+    ckms = 2.99792458e5
+    h = 6.6260693e-27     
+    kb = 1.3806505e-16     
+
+    runspec = np.zeros(len(x))
+
+    T0 = (h*x*1e9/kb) # "temperature" of wavelength
+    # is there ever a case where you want to ignore the optical depth function? I think no
+    source = T0/(np.exp(T0/tex)-1)-T0/(np.exp(T0/background_tb)-1)
+
     components =[]
     for linename in line_names:
-        voff_lines = np.array(voff_lines_dict[linename])
-        tau_wts = np.array(tau_wts_dict[linename])
-  
-        lines = (1-voff_lines/ckms)*freq_dict[linename]/1e9
-        tau_wts = tau_wts / (tau_wts).sum()
+        lines = line_freqs_dict[linename]
+        tau_wts = line_weights_dict[linename]
         nuwidth = np.abs(width/ckms*lines)
         nuoff = xoff_v/ckms*lines
-  
-        # tau array
-        tauprof = np.zeros(len(xarr))
+
+        # tau array: each hyperfine component is only evaluated near its
+        # center, where it is non-negligible
+        windows = component_windows(x, sortkey, lines-nuoff, nuwidth)
+        tauprof = np.zeros(len(x))
         for kk,nuo in enumerate(nuoff):
-            tauprof += (tau_dict[linename] * tau_wts[kk] *
-                    np.exp(-(xarr.value+nuo-lines[kk])**2 / (2.0*nuwidth[kk]**2)) *
-                    fillingfraction)
-            components.append( tauprof )
-  
-        T0 = (h*xarr.value*1e9/kb) # "temperature" of wavelength
-        if tau is not None and thin:
-            #runspec = tauprof+runspec
-            # is there ever a case where you want to ignore the optical depth function? I think no
-            runspec = (T0/(np.exp(T0/tex)-1)-T0/(np.exp(T0/background_tb)-1))*(1-np.exp(-tauprof))+runspec
-        else:
-            runspec = (T0/(np.exp(T0/tex)-1)-T0/(np.exp(T0/background_tb)-1))*(1-np.exp(-tauprof))+runspec
-        if runspec.min() < 0 and background_tb == 2.7315:
-            raise ValueError("Model dropped below zero.  That is not possible normally.  Here are the input values: "+
-                    ("tex: %f " % tex) + 
-                    ("tkin: %f " % tkin) + 
-                    ("ntot: %f " % ntot) + 
-                    ("width: %f " % width) + 
-                    ("xoff_v: %f " % xoff_v) + 
-                    ("fortho: %f " % fortho)
-                    )
+            sl = windows[kk]
+            tauprof[sl] += (tau_dict[linename] * tau_wts[kk] *
+                            np.exp(-(x[sl]+nuo-lines[kk])**2 / (2.0*nuwidth[kk]**2)) *
+                            fillingfraction)
+        components.extend([tauprof]*len(nuoff))
+
+        span = window_span(windows, len(x))
+        runspec[span] += source[span]*(1-np.exp(-tauprof[span]))
+
+    # all lines share the sign of the source function, so the spectrum only
+    # needs to be checked once
+    if runspec.min() < 0 and background_tb == 2.7315:
+        raise ValueError("Model dropped below zero.  That is not possible normally.  Here are the input values: "+
+                ("tex: %f " % tex) + 
+                ("tkin: %f " % tkin) + 
+                ("ntot: %f " % ntot) + 
+                ("width: %f " % width) + 
+                ("xoff_v: %f " % xoff_v) + 
+                ("fortho: %f " % fortho)
+                )
 
     if verbose or debug:
         log.info("tkin: %g  tex: %g  ntot: %g  width: %g  xoff_v: %g  fortho: %g  fillingfraction: %g" % (tkin,tex,ntot,width,xoff_v,fortho,fillingfraction))
 
     if return_components:
-        return (T0/(np.exp(T0/tex)-1)-T0/(np.exp(T0/background_tb)-1))*(1-np.exp(-1*np.array(components)))
+        return source*(1-np.exp(-1*np.array(components)))
 
     if return_tau:
         return tau_dict
   
     return runspec
 
+# parameters ammonia_jacobian can differentiate with respect to
+jacobian_parnames = ('tkin', 'tex', 'ntot', 'width', 'xoff_v', 'fortho', 'tau',
+                     'fillingfraction')
+
+def ammonia_jacobian(xarr, tkin=20, tex=None, ntot=1e14, width=1, xoff_v=0.0,
+                     fortho=0.0, tau=None, fillingfraction=None,
+                     background_tb=2.7315, thin=False,
+                     parnames=('tkin','tex','ntot','width','xoff_v','fortho'),
+                     **kwargs):
+    """
+    Partial derivatives of the `ammonia` spectrum with respect to the
+    parameters named in ``parnames`` (any of `jacobian_parnames`).  The other
+    parameters are as for `ammonia`.
+
+    The derivatives with respect to the line profile parameters, the
+    excitation temperature and the line optical depths are analytic.  The
+    line optical depths are scalar functions of the physical parameters
+    (through the partition function), so their derivatives are found by
+    central differences of `_line_optical_depths`, which does not involve
+    the spectrum.
+
+    Returns
+    -------
+    jacobian : `numpy.ndarray`
+        Array of shape (len(parnames), len(xarr))
+    """
+    x, sortkey = axis_values(xarr, 'GHz')
+
+    taupars = dict(tkin=tkin, tex=tex, ntot=ntot, width=width, fortho=fortho,
+                   tau=tau, thin=thin)
+    tau_dict, tex_used = _line_optical_depths(**taupars)
+    derivs = dict((name, np.zeros(len(x))) for name in parnames)
+    if tau_dict is None:
+        return np.array([derivs[name] for name in parnames])
+
+    if fillingfraction is None:
+        fillingfraction = 1.0
+
+    ckms = 2.99792458e5
+    h = 6.6260693e-27
+    kb = 1.3806505e-16
+
+    # Source function term and its derivative
+    T0 = (h*x*1e9/kb)
+    source = T0/(np.exp(T0/tex_used)-1)-T0/(np.exp(T0/background_tb)-1)
+    dsource_dtex = (T0/tex_used)**2*np.exp(T0/tex_used)/(np.exp(T0/tex_used)-1)**2
+
+    # d(tau_line)/d(par) for the parameters that the optical depths depend on
+    dtau_dict = {}
+    for name in ('tkin', 'tex', 'ntot', 'width', 'fortho', 'tau'):
+        if name not in parnames or taupars[name] is None:
+            continue
+        step = 1e-5*max(np.abs(taupars[name]), 1e-3)
+        lo, hi = dict(taupars), dict(taupars)
+        lo[name] = taupars[name] - step
+        hi[name] = taupars[name] + step
+        tau_lo = _line_optical_depths(**lo)[0]
+        tau_hi = _line_optical_depths(**hi)[0]
+        if tau_lo is None or tau_hi is None:
+            continue
+        dtau_dict[name] = dict((linename, (tau_hi[linename]-tau_lo[linename])/(2*step))
+                               for linename in line_names)
+
+    opacity = np.zeros(len(x))
+    for linename in line_names:
+        lines = line_freqs_dict[linename]
+        tau_wts = line_weights_dict[linename]
+        nuwidth = np.abs(width/ckms*lines)
+        nuoff = xoff_v/ckms*lines
+
+        # the line profile (tau / tau_line) and its derivatives
+        windows = component_windows(x, sortkey, lines-nuoff, nuwidth)
+        profile = np.zeros(len(x))
+        dprofile_dv = np.zeros(len(x))
+        dprofile_dw = np.zeros(len(x))
+        for kk,nuo in enumerate(nuoff):
+            sl = windows[kk]
+            dnu = x[sl]+nuo-lines[kk]
+            gauss = tau_wts[kk] * np.exp(-dnu**2 / (2.0*nuwidth[kk]**2)) * fillingfraction
+            profile[sl] += gauss
+            dprofile_dv[sl] += -gauss*dnu/nuwidth[kk]**2 * lines[kk]/ckms
+            dprofile_dw[sl] += gauss*dnu**2/nuwidth[kk]**3 * np.abs(lines[kk])/ckms * np.sign(width)
+
+        tauprof = tau_dict[linename] * profile
+        opacity += 1-np.exp(-tauprof)
+        # derivative of this line's contribution to the spectrum w.r.t. tauprof
+        dspec_dtauprof = source*np.exp(-tauprof)
+
+        if 'xoff_v' in derivs:
+            derivs['xoff_v'] += dspec_dtauprof * tau_dict[linename] * dprofile_dv
+        if 'width' in derivs:
+            derivs['width'] += dspec_dtauprof * tau_dict[linename] * dprofile_dw
+        if 'fillingfraction' in derivs:
+            derivs['fillingfraction'] += dspec_dtauprof * tauprof / fillingfraction
+        for name in dtau_dict:
+            derivs[name] += dspec_dtauprof * dtau_dict[name][linename] * profile
+
+    # tex enters the source function; it is tkin's if tex was not given
+    if tex is None or thin:
+        if 'tkin' in derivs:
+            derivs['tkin'] += dsource_dtex * opacity
+    elif 'tex' in derivs:
+        derivs['tex'] += dsource_dtex * opacity
+
+    return np.array([derivs[name] for name in parnames])
+
 
 class ammonia_model(model.SpectralModel):
 
@@ -368,6 +515,40 @@ class ammonia_model(model.SpectralModel):
             return v
         return L
 
+    def n_ammonia_jacobian(self, pars=None, parnames=None, **kwargs):
+        """
+        Returns a function that computes the derivatives of the `n_ammonia`
+        model with respect to each of the parameters, an array of shape
+        (len(x), len(pars)).  The parameters are interpreted as for
+        `n_ammonia`.
+        """
+        if hasattr(pars,'values'):
+            parnames,parvals = zip(*pars.items())
+            parnames = [p.lower() for p in parnames]
+            parvals = [p.value for p in parvals]
+        elif parnames is None:
+            parvals = pars
+            parnames = self.parnames
+        else:
+            parvals = pars
+        if len(parvals) != len(parnames):
+            if len(parvals) % len(parnames) == 0:
+                parnames = [p for ii in range(len(parvals)/len(parnames)) for p in parnames]
+            else:
+                raise ValueError("Wrong array lengths passed to n_ammonia_jacobian!")
+        npars = len(parvals) / self.npeaks
+
+        def L(x):
+            derivs = []
+            for jj in xrange(self.npeaks):
+                modelkwargs = kwargs.copy()
+                names = [parnames[ii+jj*npars].strip('0123456789').lower()
+                         for ii in xrange(npars)]
+                modelkwargs.update(dict(zip(names, parvals[jj*npars:(jj+1)*npars])))
+                derivs.append(ammonia_jacobian(x, parnames=names, **modelkwargs))
+            return np.concatenate(derivs).T
+        return L
+
     def components(self, xarr, pars, hyperfine=False, **kwargs):
         """
         Ammonia components don't follow the default, since in Galactic astronomy the hyperfine components should be well-separated.
@@ -450,15 +631,26 @@ class ammonia_model(model.SpectralModel):
 
         def mpfitfun(x,y,err):
             if err is None:
-                def f(p,fjac=None): return [0,(y-self.n_ammonia(pars=p,
-                                                                parnames=parinfo.parnames,
-                                                                **fitfun_kwargs)(x))]
-            else:
-                def f(p,fjac=None): return [0,(y-self.n_ammonia(pars=p,
-                                                                parnames=parinfo.parnames,
-                                                                **fitfun_kwargs)(x))/err]
+                err = 1.0
+            def f(p,fjac=None):
+                residuals = (y-self.n_ammonia(pars=p,
+                                              parnames=parinfo.parnames,
+                                              **fitfun_kwargs)(x))/err
+                if fjac is None:
+                    return [0,residuals]
+                jac = self.n_ammonia_jacobian(pars=p,
+                                              parnames=parinfo.parnames,
+                                              **fitfun_kwargs)(x)
+                return [0,residuals,jac/np.reshape(err, (-1,1))]
             return f
 
+        # use analytic derivatives unless they cannot account for the
+        # parameters (or their ties)
+        autoderivative = int(any(p['tied'] for p in parinfo) or
+                             any(name.strip('0123456789').lower()
+                                 not in jacobian_parnames
+                                 for name in parinfo.parnames))
+
         if veryverbose:
             log.info("GUESSES: ")
             log.info(str(parinfo))
@@ -474,7 +666,8 @@ class ammonia_model(model.SpectralModel):
                        parinfo=parinfo,
                        maxiter=maxiter,
                        quiet=quiet,
-                       debug=debug)
+                       debug=debug,
+                       autoderivative=autoderivative)
             mpp = mp.params
             if mp.perror is not None: mpperr = mp.perror
             else: mpperr = mpp*0
@@ -483,9 +676,7 @@ class ammonia_model(model.SpectralModel):
         if mp.status == 0:
             raise Exception(mp.errmsg)
 
-        for i,p in enumerate(mpp):
-            parinfo[i]['value'] = p
-            parinfo[i]['error'] = mpperr[i]
+        parinfo.set_values(mpp, errors=mpperr)
 
         if not shh:
             log.info("Fit status: {0}".format(mp.status))
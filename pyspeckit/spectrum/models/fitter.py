@@ -36,3 +36,20 @@ def vheightmodel(zeroheightmodel):
             return zeroheightmodel(xax, *pars[1:],**kwargs)
     vhm.__doc__ += zeroheightmodel.__doc__
     return vhm
+
+def vheightjacobian(zeroheightjacobian):
+    """
+    The derivatives of a `vheightmodel`, given the derivatives
+    (``jacobian_func``) of the zero-height model
+    """
+    def vhj(xax, *pars,**kwargs):
+        vheight=True
+        if 'vheight' in kwargs:
+            vheight = kwargs.pop('vheight')
+        derivs = zeroheightjacobian(xax, *pars[1:],**kwargs)
+        if derivs is None:
+            return None
+        derivs = list(derivs)
+        dheight = numpy.ones_like(derivs[0]) if vheight else numpy.zeros_like(derivs[0])
+        return [dheight] + derivs
+    return vhj
@@ -10,7 +10,7 @@ models
 import numpy as np
 from pyspeckit.mpfit import mpfit
 from .. import units
-from . import fitter,model,modelgrid
+from . import fitter,model,modelgrid,radex_modelgrid
 import matplotlib.cbook as mpcb
 import copy
 import hyperfine
@@ -169,6 +169,9 @@ def formaldehyde_radex(xarr, density=4, column=13, xoff_v=0.0, width=1.0,
     OR they can be passed as arrays.  If as arrays, the form should be:
     texgrid = ((minfreq1,maxfreq1,texgrid1),(minfreq2,maxfreq2,texgrid2))
 
+    The grids are only read and indexed on the first call with them (see
+    `radex_modelgrid.radex_model`).
+
     xarr must be a SpectroscopicAxis instance
     xoff_v, width are both in km/s
 
@@ -178,57 +181,24 @@ def formaldehyde_radex(xarr, density=4, column=13, xoff_v=0.0, width=1.0,
     grid_vwidth_scale is True or False: False for LVG, True for Sphere
     """
 
-    if texgrid is None and taugrid is None:
-        if path_to_texgrid == '' or path_to_taugrid=='':
-            raise IOError("Must specify model grids to use.")
-        else:
-            taugrid = [pyfits.getdata(path_to_taugrid)]
-            texgrid = [pyfits.getdata(path_to_texgrid)]
-            hdr = pyfits.getheader(path_to_taugrid)
-            yinds,xinds = np.indices(taugrid[0].shape[1:])
-            densityarr = (xinds+hdr['CRPIX1']-1)*hdr['CD1_1']+hdr['CRVAL1'] # log density
-            columnarr  = (yinds+hdr['CRPIX2']-1)*hdr['CD2_2']+hdr['CRVAL2'] # log column
-            minfreq = (4.8,)
-            maxfreq = (5.0,)
-    elif len(taugrid)==len(texgrid) and hdr is not None:
-        minfreq,maxfreq,texgrid = zip(*texgrid)
-        minfreq,maxfreq,taugrid = zip(*taugrid)
-        yinds,xinds = np.indices(taugrid[0].shape[1:])
-        densityarr = (xinds+hdr['CRPIX1']-1)*hdr['CD1_1']+hdr['CRVAL1'] # log density
-        columnarr  = (yinds+hdr['CRPIX2']-1)*hdr['CD2_2']+hdr['CRVAL2'] # log column
-    else:
-        raise Exception
-    
-    # Convert X-units to frequency in GHz
-    xarr = xarr.as_unit('Hz', quiet=True)
-
-    tau_nu_cumul = np.zeros(len(xarr))
-
-    gridval1 = np.interp(density, densityarr[0,:], xinds[0,:])
-    gridval2 = np.interp(column, columnarr[:,0], yinds[:,0])
-    if np.isnan(gridval1) or np.isnan(gridval2):
-        raise ValueError("Invalid column/density")
+    grid = radex_modelgrid.cached_radex_model(formaldehyde_vtau,
+                                              texgrid=texgrid, taugrid=taugrid,
+                                              hdr=hdr,
+                                              path_to_texgrid=path_to_texgrid,
+                                              path_to_taugrid=path_to_taugrid,
+                                              freqrange=((4.8,5.0),),
+                                              gridaxes=('density','column','temperature'),
+                                              fixed_gridindices={'temperature':temperature_gridnumber})
 
-    if scipyOK:
-        slices = [temperature_gridnumber] + [slice(np.floor(gv),np.floor(gv)+2) for gv in (gridval2,gridval1)]
-        tau = [scipy.ndimage.map_coordinates(tg[slices],np.array([[gridval2%1],[gridval1%1]]),order=1) for tg in taugrid]
-        tex = [scipy.ndimage.map_coordinates(tg[slices],np.array([[gridval2%1],[gridval1%1]]),order=1) for tg in texgrid]
-    else:
-        raise ImportError("Couldn't import scipy, therefore cannot interpolate")
-    #tau = modelgrid.line_params_2D(gridval1,gridval2,densityarr,columnarr,taugrid[temperature_gridnumber,:,:])
-    #tex = modelgrid.line_params_2D(gridval1,gridval2,densityarr,columnarr,texgrid[temperature_gridnumber,:,:])
+    tau,tex = grid.lookup(density, column)
 
     if verbose:
-        print "density %20.12g column %20.12g: tau %20.12g tex %20.12g" % (density, column, tau, tex)
+        print "density %20.12g column %20.12g: tau %20.12g tex %20.12g" % (density, column, tau[0], tex[0])
 
     if debug:
         import pdb; pdb.set_trace()
 
-    spec = np.sum([(formaldehyde_vtau(xarr,Tex=float(tex[ii]),tau=float(tau[ii]),xoff_v=xoff_v,width=width, **kwargs)
-                * (xarr.as_unit('GHz')>minfreq[ii]) * (xarr.as_unit('GHz')<maxfreq[ii])) for ii in xrange(len(tex))],
-                axis=0)
-  
-    return spec
+    return grid(xarr, density, column, xoff_v, width, **kwargs)
 
 def formaldehyde_radex_orthopara_temp(xarr, density=4, column=13,
                                       orthopara=1.0, temperature=15.0,
@@ -248,6 +218,9 @@ def formaldehyde_radex_orthopara_temp(xarr, density=4, column=13,
     OR they can be passed as arrays.  If as arrays, the form should be:
     texgrid = ((minfreq1,maxfreq1,texgrid1),(minfreq2,maxfreq2,texgrid2))
 
+    The grids are only read and indexed on the first call with them (see
+    `radex_modelgrid.radex_model`).
+
     xarr must be a SpectroscopicAxis instance
     xoff_v, width are both in km/s
 
@@ -257,62 +230,24 @@ def formaldehyde_radex_orthopara_temp(xarr, density=4, column=13,
     grid_vwidth_scale is True or False: False for LVG, True for Sphere
     """
 
-    if texgrid is None and taugrid is None:
-        if path_to_texgrid == '' or path_to_taugrid=='':
-            raise IOError("Must specify model grids to use.")
-        else:
-            taugrid = [pyfits.getdata(path_to_taugrid)]
-            texgrid = [pyfits.getdata(path_to_texgrid)]
-            hdr = pyfits.getheader(path_to_taugrid)
-            minfreq = (4.8,)
-            maxfreq = (5.0,)
-    elif len(taugrid)==len(texgrid) and hdr is not None:
-        minfreq,maxfreq,texgrid = zip(*texgrid)
-        minfreq,maxfreq,taugrid = zip(*taugrid)
-    else:
-        raise Exception
-
-    densityarr = (np.arange(taugrid[0].shape[3])+hdr['CRPIX1']-1)*hdr['CD1_1']+hdr['CRVAL1'] # log density
-    columnarr  = (np.arange(taugrid[0].shape[2])+hdr['CRPIX2']-1)*hdr['CD2_2']+hdr['CRVAL2'] # log column
-    temparr    = (np.arange(taugrid[0].shape[1])+hdr['CRPIX3']-1)*hdr['CDELT3']+hdr['CRVAL3'] # temperature
-    oprarr     = (np.arange(taugrid[0].shape[0])+hdr['CRPIX4']-1)*hdr['CDELT4']+hdr['CRVAL4'] # log ortho/para ratio
-    
-    gridval1 = np.interp(density,     densityarr,  np.arange(len(densityarr)))
-    gridval2 = np.interp(column,      columnarr,   np.arange(len(columnarr)))
-    gridval3 = np.interp(temperature, temparr,     np.arange(len(temparr)))
-    gridval4 = np.interp(orthopara,   oprarr,      np.arange(len(oprarr)))
-    if np.isnan(gridval1) or np.isnan(gridval2):
-        raise ValueError("Invalid column/density")
-
-    if scipyOK:
-        slices = [slice(int(np.floor(gv)),int(np.floor(gv)+2))
-                  for gv in (gridval4,gridval3,gridval2,gridval1)]
-        tau = [scipy.ndimage.map_coordinates(tg[slices],
-                                             np.array([[gridval4 % 1],
-                                                       [gridval3 % 1],
-                                                       [gridval2 % 1],
-                                                       [gridval1 % 1]]),
-                                             order=1, prefilter=False)
-               for tg in taugrid]
-        tex = [scipy.ndimage.map_coordinates(tg[slices],
-                                             np.array([[gridval4 % 1],
-                                                       [gridval3 % 1],
-                                                       [gridval2 % 1],
-                                                       [gridval1 % 1]]),
-                                             order=1,prefilter=False)
-               for tg in texgrid]
-    else:
-        raise ImportError("Couldn't import scipy, therefore cannot interpolate")
-    #tau = modelgrid.line_params_2D(gridval1,gridval2,densityarr,columnarr,taugrid[temperature_gridnumber,:,:])
-    #tex = modelgrid.line_params_2D(gridval1,gridval2,densityarr,columnarr,texgrid[temperature_gridnumber,:,:])
-
     # there can be different background temperatures at each frequency
     tbg = [Tbackground1,Tbackground2]
 
+    grid = radex_modelgrid.cached_radex_model(formaldehyde_vtau,
+                                              texgrid=texgrid, taugrid=taugrid,
+                                              hdr=hdr,
+                                              path_to_texgrid=path_to_texgrid,
+                                              path_to_taugrid=path_to_taugrid,
+                                              freqrange=((4.8,5.0),),
+                                              gridaxes=('density','column','temperature','orthopara'),
+                                              parnames=('density','column','orthopara','temperature'))
+
+    tau,tex = grid.lookup(density, column, orthopara, temperature)
+
     if verbose:
         print "density %20.12g   column: %20.12g   temperature: %20.12g   opr: %20.12g   xoff_v: %20.12g   width: %20.12g" % (density, column, temperature, orthopara, xoff_v, width)
         print "tau: ",tau," tex: ",tex
-        print "minfreq: ",minfreq," maxfreq: ",maxfreq
+        print "freqrange: ",grid.freqrange
         print "tbg: ",tbg
 
     if debug > 1:
@@ -321,16 +256,8 @@ def formaldehyde_radex_orthopara_temp(xarr, density=4, column=13,
     if getpars:
         return tau,tex
 
-    spec = np.sum([(formaldehyde_vtau(xarr.as_unit('Hz', quiet=True),
-                                      Tex=float(tex[ii]), tau=float(tau[ii]),
-                                      Tbackground=tbg[ii], xoff_v=xoff_v,
-                                      width=width, **kwargs)
-                    * (xarr.as_unit('GHz')>minfreq[ii])
-                    * (xarr.as_unit('GHz')<maxfreq[ii]))
-                   for ii in xrange(len(tex))],
-                  axis=0)
-  
-    return spec
+    return grid(xarr, density, column, orthopara, temperature, xoff_v, width,
+                Tbackground=tbg, **kwargs)
 
 
 def formaldehyde(xarr, amp=1.0, xoff_v=0.0, width=1.0,
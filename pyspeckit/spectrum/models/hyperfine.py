@@ -8,6 +8,7 @@ import numpy as np
 import model
 import fitter
 from astropy import units as u
+from _hyperfine_profiles import axis_values, component_windows
 
 # should be imported in the future
 ckms = 2.99792458e5
@@ -46,13 +47,23 @@ class hyperfinemodel(object):
         self.line_strength_dict = line_strength_dict
         self.relative_strength_total_degeneracy = relative_strength_total_degeneracy
 
+        # rest frequencies, frequencies corresponding to the velocity offsets
+        # and relative strengths of the components, in line_names order
+        self._freqs = np.array([freq_dict[k] for k in line_names], dtype='float')
+        self._lines = np.array([(1-np.array(voff_lines_dict[k])/ckms)*freq_dict[k]
+                                for k in line_names], dtype='float')
+        self._strengths = np.array([np.array(line_strength_dict[k]) /
+                                    np.array(relative_strength_total_degeneracy[k])
+                                    for k in line_names], dtype='float')
+
         self.fitter = model.SpectralModel(self,4,
             parnames=['Tex','tau','center','width'],
             parlimited=[(False,False), (True,False), (False,False), (True,False)],
             parlimits=[(0,0), (0,0), (0,0), (0,0)],
             # specify the parameter names (LaTeX is OK)
             shortvarnames=("T_{ex}","\\tau","v","\\sigma"),
-            fitunits='Hz' )
+            fitunits='Hz',
+            jacobian_func=self.hyperfine_jacobian)
 
         self.nlines = len(line_names)
 
@@ -88,7 +99,8 @@ class hyperfinemodel(object):
             parlimited=[(False,False), (False,False), (True,False), (False,False), (True,False)], 
             parlimits=[(0,0), (0,0), (0,0), (0,0), (0,0)],
             shortvarnames=("H","T_{ex}","\\tau","v","\\sigma"), # specify the parameter names (TeX is OK)
-            fitunits='Hz' )
+            fitunits='Hz',
+            jacobian_func=fitter.vheightjacobian(self.hyperfine_jacobian))
 
         self.background_fitter = model.SpectralModel(self.hyperfine_addbackground,5,
             parnames=['Tbackground','Tex','tau','center','width'],
@@ -212,6 +224,52 @@ class hyperfinemodel(object):
                               xoff_v=xoff_v, width=width, return_tau=False,
                               **kwargs)
 
+    def hyperfine_jacobian(self, xarr, Tex=5.0, tau=0.1, xoff_v=0.0, width=1.0,
+                           return_hyperfine_components=False, Tbackground=2.73,
+                           amp=None, return_tau=False, tau_total=None,
+                           vary_hyperfine_tau=False,
+                           vary_hyperfine_width=False):
+        """
+        Partial derivatives of the `hyperfine` spectrum with respect to Tex,
+        tau, xoff_v and width.  Only the default parametrization (a single
+        total optical depth shared according to ``line_strength_dict``) is
+        supported: for any of the other options of `hyperfine`, None is
+        returned, and the fitters use numerical derivatives instead.
+        """
+        if (return_hyperfine_components or amp is not None or return_tau or
+                tau_total is not None or vary_hyperfine_tau or
+                vary_hyperfine_width):
+            return None
+
+        xarr, sortkey = axis_values(xarr, 'Hz')
+
+        tau_nu_cumul = np.zeros(len(xarr))
+        dtau_dtau = np.zeros(len(xarr))
+        dtau_dv = np.zeros(len(xarr))
+        dtau_dw = np.zeros(len(xarr))
+        if width != 0:
+            nuwidths = np.abs(width/ckms*self._lines)
+            nuoffs = xoff_v/ckms*self._lines
+            windows = component_windows(xarr, sortkey, self._freqs-nuoffs,
+                                        nuwidths)
+            for ii in range(len(self._lines)):
+                sl = windows[ii]
+                lines, nuwidth, nuoff = self._lines[ii], nuwidths[ii], nuoffs[ii]
+                dnu = xarr[sl]+nuoff-self._freqs[ii]
+                profile = self._strengths[ii]*np.exp(-dnu**2 / (2.0*nuwidth**2))
+                tau_nu = tau*profile
+                tau_nu_cumul[sl] += tau_nu
+                dtau_dtau[sl] += profile
+                dtau_dv[sl] += -tau_nu*dnu/nuwidth**2 * lines/ckms
+                dtau_dw[sl] += tau_nu*dnu**2/nuwidth**3 * np.abs(lines)/ckms * np.sign(width)
+
+        # spec = (1-exp(-tau_nu))*(Tex-Tbackground)
+        dspec_dtau = np.exp(-tau_nu_cumul)*(Tex-Tbackground)
+        return [1.0-np.exp(-tau_nu_cumul),
+                dspec_dtau*dtau_dtau,
+                dspec_dtau*dtau_dv,
+                dspec_dtau*dtau_dw]
+
     def hyperfine(self, xarr, Tex=5.0, tau=0.1, xoff_v=0.0, width=1.0,
                   return_hyperfine_components=False, Tbackground=2.73, amp=None,
                   return_tau=False, tau_total=None, vary_hyperfine_tau=False,
@@ -233,10 +291,7 @@ class hyperfinemodel(object):
         """
 
         # Convert X-units to frequency in Hz
-        try:
-            xarr = xarr.as_unit('Hz').value
-        except AttributeError:
-            xarr = xarr.to('Hz').value
+        xarr, sortkey = axis_values(xarr, 'Hz')
 
         # Ensure parameters are scalar / have no extra dims
         if not np.isscalar(Tex): Tex = Tex.squeeze()
@@ -266,29 +321,31 @@ class hyperfinemodel(object):
         if tau_total is not None:
             tau = 1
 
+        if vary_hyperfine_width:
+            widths = np.array([width[linename] for linename in self.line_names],
+                              dtype='float')
+        else:
+            widths = width
+        nuwidths = np.abs(widths/ckms*self._lines)
+        nuoffs = xoff_v/ckms*self._lines
+        # each component is only evaluated near its center, where it is
+        # non-negligible
+        windows = component_windows(xarr, sortkey, self._freqs-nuoffs, nuwidths)
+
         components =[]
-        for linename in self.line_names:
-            voff_lines = np.array(self.voff_lines_dict[linename])
-      
-            lines = (1-voff_lines/ckms)*self.freq_dict[linename]
-            if not vary_hyperfine_width and width == 0:
-                tau_nu = xarr*0
-            else:
-                if vary_hyperfine_width:
-                    nuwidth = np.abs(width[linename]/ckms*lines)
-                else:
-                    nuwidth = np.abs(width/ckms*lines)
-                nuoff = xoff_v/ckms*lines
+        for ii,linename in enumerate(self.line_names):
+            tau_nu = np.zeros(len(xarr))
+            if vary_hyperfine_width or width != 0:
                 if vary_hyperfine_tau:
                     tau_line = tau[linename]
                 else:
                     # the total optical depth, which is being fitted, should be the sum of the components
-                    tau_line = (tau * np.array(self.line_strength_dict[linename])/
-                                np.array(self.relative_strength_total_degeneracy[linename]))
-          
-                tau_nu = np.array(tau_line * 
-                                  np.exp(-(xarr+nuoff-self.freq_dict[linename])**2 /
-                                          (2.0*nuwidth**2)))
+                    tau_line = tau * self._strengths[ii]
+
+                sl = windows[ii]
+                tau_nu[sl] = (tau_line *
+                              np.exp(-(xarr[sl]+nuoffs[ii]-self._freqs[ii])**2 /
+                                     (2.0*nuwidths[ii]**2)))
                 tau_nu[tau_nu!=tau_nu] = 0 # avoid nans
             components.append(tau_nu)
             tau_nu_cumul += tau_nu
@@ -52,6 +52,24 @@ def gaussian(x,A,dx,w, return_components=False, normalized=False,
     else:
         return G
 
+def gaussian_jacobian(x, A, dx, w, normalized=False, **kwargs):
+    """
+    Partial derivatives of `gaussian` with respect to A, dx and w
+
+    Returns a list of three arrays with the shape of x
+    """
+    x = numpy.array(x)
+    E = numpy.exp(-(x-dx)**2/(2.0*w**2))
+    G = A*E
+    dG_dA = E
+    dG_ddx = G*(x-dx)/w**2
+    dG_dw = G*(x-dx)**2/w**3
+    if normalized:
+        norm = numpy.sqrt(2*numpy.pi) * w**2
+        return [dG_dA/norm, dG_ddx/norm, dG_dw/norm - 2*G/(norm*w)]
+    else:
+        return [dG_dA, dG_ddx, dG_dw]
+
 def gaussian_fwhm(sigma):
     return numpy.sqrt(8*numpy.log(2)) * sigma
 
@@ -79,8 +97,10 @@ def gaussian_fitter():
             fwhm_func=gaussian_fwhm,
             fwhm_pars=['width'],
             integral_func=_integral_modelpars,
+            jacobian_func=gaussian_jacobian,
             )
     myclass.__name__ = "gaussian"
+    myclass.batchable = True
     
     return myclass
 
@@ -90,6 +110,7 @@ def gaussian_vheight_fitter():
     """
 
     vhg = fitter.vheightmodel(gaussian)
+    vhgj = fitter.vheightjacobian(gaussian_jacobian)
     myclass =  model.SpectralModel(vhg, 4,
             parnames=['height','amplitude','shift','width'], 
             parlimited=[(False,False),(False,False),(False,False),(True,False)], 
@@ -98,7 +119,9 @@ def gaussian_vheight_fitter():
             centroid_par='shift',
             fwhm_func=gaussian_fwhm,
             fwhm_pars=['width'],
+            jacobian_func=vhgj,
             )
     myclass.__name__ = "vheightgaussian"
+    myclass.batchable = True
     
     return myclass
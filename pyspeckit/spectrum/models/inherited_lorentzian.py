@@ -26,6 +26,16 @@ def lorentzian(x,A,dx,w, return_components=False):
     x = numpy.array(x) # make sure xarr is no longer a spectroscopic axis
     return A/(2.0*numpy.pi)*w/((x-dx)**2 + (w/2.0)**2)
 
+def lorentzian_jacobian(x,A,dx,w, return_components=False):
+    """
+    Partial derivatives of `lorentzian` with respect to A, dx and w
+    """
+    x = numpy.array(x)
+    D = (x-dx)**2 + (w/2.0)**2
+    return [w/(2.0*numpy.pi*D),
+            A/(2.0*numpy.pi)*w*2*(x-dx)/D**2,
+            A/(2.0*numpy.pi)*(D - w**2/2.0)/D**2]
+
 def lorentzian_fitter():
     """
     Generator for lorentzian fitter class
@@ -36,8 +46,10 @@ def lorentzian_fitter():
             parlimited=[(False,False),(False,False),(True,False)], 
             parlimits=[(0,0), (0,0), (0,0)],
             shortvarnames=('A',r'\Delta x',r'\sigma'),
+            jacobian_func=lorentzian_jacobian,
             )
     myclass.__name__ = "lorentzian"
+    myclass.batchable = True
     
     return myclass
 
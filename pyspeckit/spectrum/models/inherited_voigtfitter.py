@@ -51,7 +51,9 @@ def voigt(xarr,amp,xcen,sigma,gamma,normalized=False):
     """
 
     if scipyOK:
-        z = ((xarr.value-xcen) + 1j*gamma) / (sigma * np.sqrt(2))
+        # xarr may be a SpectroscopicAxis or (in the batched fitter) a
+        # plain array
+        z = ((getattr(xarr, 'value', xarr)-xcen) + 1j*gamma) / (sigma * np.sqrt(2))
         V = amp * np.real(scipy.special.wofz(z)) 
         if normalized:
             return V / (sigma*np.sqrt(2*np.pi))
@@ -66,6 +68,29 @@ def voigt(xarr,amp,xcen,sigma,gamma,normalized=False):
     else:
         raise ImportError("Couldn't import scipy, therefore cannot do voigt profile stuff")
 
+def voigt_jacobian(xarr,amp,xcen,sigma,gamma,normalized=False):
+    """
+    Partial derivatives of `voigt` with respect to amp, xcen, sigma and gamma
+
+    Uses the derivative of the Faddeeva function, w'(z) = -2 z w(z) +
+    2i/sqrt(pi), so it costs a single `scipy.special.wofz` evaluation.
+    """
+    if not scipyOK:
+        raise ImportError("Couldn't import scipy, therefore cannot do voigt profile stuff")
+
+    z = ((getattr(xarr, 'value', xarr)-xcen) + 1j*gamma) / (sigma * np.sqrt(2))
+    w = scipy.special.wofz(z)
+    dw_dz = -2*z*w + 2j/np.sqrt(np.pi)
+    derivs = [np.real(w),
+              amp * np.real(dw_dz) * -1 / (sigma*np.sqrt(2)),
+              amp * np.real(dw_dz * -z / sigma),
+              amp * -np.imag(dw_dz) / (sigma*np.sqrt(2))]
+    if normalized:
+        norm = sigma*np.sqrt(2*np.pi)
+        derivs[2] = derivs[2] - amp * np.real(w) / sigma
+        derivs = [d / norm for d in derivs]
+    return derivs
+
 def voigt_fwhm(sigma, gamma):
     """
     Approximation to the Voigt FWHM from wikipedia
@@ -102,8 +127,10 @@ def voigt_fitter():
             centroid_par='shift',
             fwhm_func=voigt_fwhm,
             fwhm_pars=['gwidth','lwidth'],
+            jacobian_func=voigt_jacobian,
             )
     myclass.__name__ = "voigt"
+    myclass.batchable = True
     myclass.moments = types.MethodType(voigt_moments, myclass,
                                        myclass.__class__)
     
@@ -4,8 +4,10 @@ Generic SpectralModel wrapper
 =============================
 .. moduleauthor:: Adam Ginsburg <adam.g.ginsburg@gmail.com>
 """
+import inspect
 import numpy as np
 from pyspeckit.mpfit import mpfit,mpfitException
+from pyspeckit.mpfit.batch_lm import batch_lm
 from pyspeckit.spectrum.parinfo import ParinfoList,Parinfo
 import copy
 from astropy import log
@@ -30,6 +32,15 @@ class SpectralModel(fitter.SimpleFitter):
     of the hyperfine codes (hcn, n2hp) for examples.
     """
 
+    # Can modelfunc be evaluated for many parameter sets at once by
+    # broadcasting (x of shape (1,nchan), parameters of shape (nspec,1))?
+    # Models that can are supported by `batch_fitter`.
+    batchable = False
+
+    # Analytic derivatives of modelfunc with respect to its parameters, if
+    # available (see `__init__`)
+    jacobian_func = None
+
     def __init__(self, modelfunc, npars, 
                  shortvarnames=("A","\\Delta x","\\sigma"),
                  fitunits=None,
@@ -37,6 +48,7 @@ class SpectralModel(fitter.SimpleFitter):
                  fwhm_func=None,
                  fwhm_pars=None,
                  integral_func=None,
+                 jacobian_func=None,
                  use_lmfit=False, **kwargs):
         """
         Spectral Model Initialization
@@ -73,6 +85,13 @@ class SpectralModel(fitter.SimpleFitter):
             default number of peaks to assume when fitting (can be overridden)
         shortvarnames : list (optional)
             TeX names of the variables to use when annotating
+        jacobian_func : function (optional)
+            the analytic derivatives of ``modelfunc``.  Takes the same
+            arguments as ``modelfunc`` and returns a sequence of ``npars``
+            arrays, the partial derivatives of the model with respect to each
+            parameter.  If given, the fitter will use them instead of finite
+            differences.  It may return None for model keyword arguments that
+            it does not support, in which case finite differences are used.
 
         Returns
         -------
@@ -110,6 +129,9 @@ class SpectralModel(fitter.SimpleFitter):
         # analytic integral function
         self.integral_func = integral_func
 
+        # analytic derivatives
+        self.jacobian_func = jacobian_func
+
     def __call__(self, *args, **kwargs):
         
         use_lmfit = kwargs.pop('use_lmfit') if 'use_lmfit' in kwargs else self.use_lmfit
@@ -280,10 +302,11 @@ class SpectralModel(fitter.SimpleFitter):
                     if debug > 1:
                         import pdb; pdb.set_trace()
                 pass
-        if hasattr(pars,'values'):
+        if isinstance(pars, ParinfoList):
+            parvals = pars.column('value').tolist()
+        elif hasattr(pars,'values'):
             # important to treat as Dictionary, since lmfit params & parinfo both have .items
             parnames,parvals = zip(*pars.items())
-            parnames = [p.lower() for p in parnames]
             parvals = [p.value for p in parvals]
         else:
             parvals = list(pars)
@@ -302,18 +325,64 @@ class SpectralModel(fitter.SimpleFitter):
             return v
         return L
 
+    def n_modeljacobian(self, pars=None, **kwargs):
+        """
+        Wrapper to compute the derivatives of the N-peak model with respect to
+        each of its parameters using ``jacobian_func``.  The returned function
+        gives an array of shape (len(x), len(pars)).
+        """
+        if pars is None:
+            pars = self.parinfo
+        if isinstance(pars, ParinfoList):
+            parvals = pars.column('value').tolist()
+        elif hasattr(pars,'values'):
+            parvals = [p.value for p in zip(*pars.items())[1]]
+        else:
+            parvals = list(pars)
+        def L(x):
+            derivs = []
+            if self.vheight:
+                derivs.append(np.ones(len(x)))
+            for jj in xrange((len(parvals)-self.vheight)/self.npars):
+                lower_parind = jj*self.npars+self.vheight
+                upper_parind = (jj+1)*self.npars+self.vheight
+                derivs.extend(self.jacobian_func(x, *parvals[lower_parind:upper_parind], **kwargs))
+            return np.array(derivs).T
+        return L
+
+    def _analytic_jacobian(self, xax, parvals, **kwargs):
+        """
+        Whether ``jacobian_func`` gives the derivatives of the model for the
+        model keyword arguments ``kwargs`` (it returns None for those it does
+        not support), tried on the first component of ``parvals``
+        """
+        if self.jacobian_func is None:
+            return False
+        pars = list(parvals)[self.vheight:self.vheight+self.npars]
+        return self.jacobian_func(xax, *pars, **kwargs) is not None
+
     def mpfitfun(self,x,y,err=None):
         """
         Wrapper function to compute the fit residuals in an mpfit-friendly format
+
+        If mpfit requests derivatives (``fjac`` is not None, which requires
+        ``jacobian_func``), they are returned too.
         """
         if err is None:
             def f(p,fjac=None):
                 residuals = (y-self.n_modelfunc(p, **self.modelfunc_kwargs)(x))
-                return [0,residuals]
+                if fjac is None:
+                    return [0,residuals]
+                return [0,residuals,
+                        self.n_modeljacobian(p, **self.modelfunc_kwargs)(x)]
         else:
             def f(p,fjac=None):
                 residuals = (y-self.n_modelfunc(p, **self.modelfunc_kwargs)(x))/err
-                return [0,residuals]
+                if fjac is None:
+                    return [0,residuals]
+                return [0,residuals,
+                        self.n_modeljacobian(p, **self.modelfunc_kwargs)(x) /
+                        np.reshape(err, (-1,1))]
         return f
 
     def lmfitfun(self,x,y,err=None,debug=False):
@@ -425,7 +494,7 @@ class SpectralModel(fitter.SimpleFitter):
         return self.mpp,self.model,self.mpperr,chi2
 
     def fitter(self, xax, data, err=None, quiet=True, veryverbose=False,
-               debug=False, parinfo=None, **kwargs):
+               debug=False, parinfo=None, vectorized=False, **kwargs):
         """
         Run the fitter using mpfit.
         
@@ -449,6 +518,10 @@ class SpectralModel(fitter.SimpleFitter):
             print out a variety of mpfit output parameters
         debug : bool
             raise an exception (rather than a warning) if chi^2 is nan
+        vectorized : bool
+            Use mpfit's vectorized (LAPACK) linear algebra instead of the
+            MINPACK loops.  Faster for fits with many parameters; the results
+            agree to within rounding.
         """
 
         if parinfo is None:
@@ -463,8 +536,8 @@ class SpectralModel(fitter.SimpleFitter):
             # some models will depend on the input units.  For these, pass in an X-axis in those units
             # (gaussian, voigt, lorentz profiles should not depend on units.  Ammonia, formaldehyde,
             # H-alpha, etc. should)
-            xax = copy.copy(xax)
-            # xax.convert_to_unit(self.fitunits, quiet=quiet)
+            # as_unit returns a new axis; the conversion is cached on xax, so
+            # repeated fits (e.g. fiteach) on the same axis only convert once
             xax = xax.as_unit(self.fitunits, quiet=quiet, **kwargs)
         elif self.fitunits is not None:
             raise TypeError("X axis does not have a convert method")
@@ -488,7 +561,16 @@ class SpectralModel(fitter.SimpleFitter):
             for p in parinfo: log.debug( p )
             log.debug( "\n".join(["%s %i: tied: %s value: %s" % (p['parname'],p['n'],p['tied'],p['value']) for p in parinfo]) )
 
-        mp = mpfit(self.mpfitfun(xax,data,err),parinfo=parinfo,quiet=quiet,**kwargs)
+        # analytic derivatives cannot account for tied parameters, and mpfit
+        # does not support them with damping
+        if ('autoderivative' not in kwargs and not kwargs.get('damp') and
+                not any(p['tied'] for p in parinfo) and
+                self._analytic_jacobian(xax, parinfo.values,
+                                        **self.modelfunc_kwargs)):
+            kwargs['autoderivative'] = 0
+
+        mp = mpfit(self.mpfitfun(xax,data,err),parinfo=parinfo,quiet=quiet,
+                   vectorized=vectorized,**kwargs)
         mpp = mp.params
         if mp.perror is not None: mpperr = mp.perror
         else: mpperr = mpp*0
@@ -499,9 +581,7 @@ class SpectralModel(fitter.SimpleFitter):
                 log.warn( parinfo )
             raise mpfitException(mp.errmsg)
 
-        for i,(p,e) in enumerate(zip(mpp,mpperr)):
-            self.parinfo[i]['value'] = p
-            self.parinfo[i]['error'] = e
+        self.parinfo.set_values(mpp, errors=mpperr)
 
         if veryverbose:
             log.info("Fit status: {0}".format(mp.status))
@@ -528,6 +608,134 @@ class SpectralModel(fitter.SimpleFitter):
                 log.warn("Warning: chi^2 is nan")
         return mpp,self.model,mpperr,chi2
 
+    def batch_modelfunc(self, xax, pars, **kwargs):
+        """
+        Evaluate the multi-component model for many parameter sets at once
+
+        Parameters
+        ----------
+        xax : np.ndarray
+            The X-axis, shape (nchan,)
+        pars : np.ndarray
+            The parameters, shape (nspec, npars*npeaks [+1 if vheight])
+
+        Returns
+        -------
+        An array of shape (nspec, nchan)
+        """
+        x = np.asarray(xax)[np.newaxis,:]
+        model = np.zeros([pars.shape[0], x.size])
+        if self.vheight:
+            model += pars[:,0:1]
+        for jj in xrange((pars.shape[1]-self.vheight)/self.npars):
+            lower_parind = jj*self.npars+self.vheight
+            model += self.modelfunc(x, *[pars[:,kk,np.newaxis] for kk in
+                                         xrange(lower_parind,
+                                                lower_parind+self.npars)],
+                                    **kwargs)
+        return model
+
+    def batch_modeljacobian(self, xax, pars, **kwargs):
+        """
+        Evaluate the derivatives of the multi-component model (from
+        ``jacobian_func``) for many parameter sets at once
+
+        Parameters
+        ----------
+        xax : np.ndarray
+            The X-axis, shape (nchan,)
+        pars : np.ndarray
+            The parameters, shape (nspec, npars*npeaks [+1 if vheight])
+
+        Returns
+        -------
+        An array of shape (nspec, nchan, npars*npeaks [+1 if vheight])
+        """
+        x = np.asarray(xax)[np.newaxis,:]
+        jac = np.zeros([pars.shape[0], x.size, pars.shape[1]])
+        if self.vheight:
+            jac[:,:,0] = 1
+        for jj in xrange((pars.shape[1]-self.vheight)/self.npars):
+            lower_parind = jj*self.npars+self.vheight
+            derivs = self.jacobian_func(x, *[pars[:,kk,np.newaxis] for kk in
+                                             xrange(lower_parind,
+                                                    lower_parind+self.npars)],
+                                        **kwargs)
+            for kk,deriv in enumerate(derivs):
+                jac[:,:,lower_parind+kk] = deriv
+        return jac
+
+    def batch_fitter(self, xax, data, err=None, guesses=None, parinfo=None,
+                     maxiter=200, ftol=1e-10, xtol=1e-10, **kwargs):
+        """
+        Fit many spectra sharing one X-axis simultaneously with the vectorized
+        Levenberg-Marquardt solver `pyspeckit.mpfit.batch_lm.batch_lm`.
+
+        Only available for models whose ``batchable`` attribute is set, i.e.
+        whose model function broadcasts over arrays of parameters.  The same
+        limits and fixed parameters (from ``parinfo`` or the ``kwargs``
+        accepted by `_make_parinfo`) apply to all spectra; tied parameters
+        are not supported.  The model's ``jacobian_func``, if any, is used
+        for the derivatives and must broadcast in the same way.
+
+        Parameters
+        ----------
+        xax : SpectroscopicAxis
+            The X-axis shared by all spectra
+        data : ndarray
+            The data, shape (nspec, nchan)
+        err : ndarray (optional)
+            The errors, shape (nspec, nchan) or (nchan,)
+        guesses : ndarray
+            The guesses, shape (nspec, npars*npeaks) or (npars*npeaks,)
+        parinfo : ParinfoList
+            Limits and fixed parameters.  Generated from the first row of
+            ``guesses`` if not given.
+
+        Returns
+        -------
+        A tuple of (best-fit parameters, parameter errors, chi^2, status)
+        arrays with a leading nspec dimension.  Status codes are those of
+        `batch_lm`.
+        """
+        if not self.batchable:
+            raise NotImplementedError("The model {0} cannot be evaluated for "
+                                      "many spectra at once, so it cannot "
+                                      "use the batched fitter."
+                                      .format(getattr(self, '__name__',
+                                                      self)))
+
+        data = np.array(data, dtype='float64', ndmin=2)
+        guesses = np.array(guesses, dtype='float64', ndmin=2)
+        if guesses.shape[0] == 1:
+            guesses = np.repeat(guesses, data.shape[0], axis=0)
+
+        if parinfo is None:
+            parinfo, kwargs = self._make_parinfo(params=list(guesses[0]),
+                                                 npeaks=guesses.shape[1]/self.npars,
+                                                 **kwargs)
+        if any(parinfo.tied):
+            raise NotImplementedError("Tied parameters are not supported by "
+                                      "the batched fitter.")
+
+        if hasattr(xax,'as_unit') and self.fitunits is not None:
+            xax = xax.as_unit(self.fitunits)
+        x = np.asarray(xax)
+
+        modelkwargs = {}
+        modelkwargs.update(self.modelfunc_kwargs)
+        if self._analytic_jacobian(x, guesses[0], **modelkwargs):
+            jacobian = lambda p: self.batch_modeljacobian(x, p, **modelkwargs)
+        else:
+            jacobian = None
+        result = batch_lm(lambda p: self.batch_modelfunc(x, p, **modelkwargs),
+                          guesses, data, err=err, jacobian=jacobian,
+                          fixed=parinfo.fixed,
+                          limited=parinfo.limited, limits=parinfo.limits,
+                          maxiter=maxiter, ftol=ftol, xtol=xtol)
+
+        return result.params, result.perror, result.fnorm, result.status
+
     def slope(self, xinp):
         """
         Find the local slope of the model at location x
@@ -721,13 +929,8 @@ class SpectralModel(fitter.SimpleFitter):
         """
         if pars is None:
             pars = self.parinfo
-        else:
-            parinfo = copy.copy(self.parinfo)
-            for value,parameter in zip(pars,parinfo):
-                try:
-                    parameter.value = value
-                except ValueError:
-                    return -np.inf
+        elif not self.parinfo.in_limits(np.asarray(pars, dtype='float64')):
+            return -np.inf
         model = self.n_modelfunc(pars, **self.modelfunc_kwargs)(xarr)
 
         difference = np.abs(data-model)
@@ -741,6 +944,44 @@ class SpectralModel(fitter.SimpleFitter):
 
         return totallogprob
 
+    def logp_batch(self, xarr, data, error, pars):
+        """
+        The log probability of the model (as in `logp`) for many parameter
+        sets at once
+
+        Parameters
+        ----------
+        xarr : np.ndarray
+            The X-axis, shape (nchan,)
+        data, error : np.ndarray
+            The data and its errors, shape (nchan,)
+        pars : np.ndarray
+            The parameters, shape (nsets, npars*npeaks [+1 if vheight]), e.g.
+            the positions of all of the walkers of an emcee ensemble
+
+        Returns
+        -------
+        An array of shape (nsets,): -inf for the parameter sets that are out
+        of range
+        """
+        pars = np.atleast_2d(np.asarray(pars, dtype='float64'))
+        data = np.asarray(data)
+        error = np.asarray(error)
+
+        logprob = np.empty(pars.shape[0])
+        logprob.fill(-np.inf)
+        OK = self.parinfo.in_limits(pars)
+        if np.any(OK):
+            if self.batchable:
+                model = self.batch_modelfunc(xarr, pars[OK],
+                                             **self.modelfunc_kwargs)
+            else:
+                model = np.array([self.n_modelfunc(p, **self.modelfunc_kwargs)(xarr)
+                                  for p in pars[OK]])
+            logprob[OK] = np.sum(-(data-model)**2/(2.*error**2), axis=1)
+
+        return logprob
+
     def get_emcee_sampler(self, xarr, data, error, **kwargs):
         """
         Get an emcee walker for the data & model
@@ -777,7 +1018,8 @@ class SpectralModel(fitter.SimpleFitter):
 
         return sampler
 
-    def get_emcee_ensemblesampler(self, xarr, data, error, nwalkers, **kwargs):
+    def get_emcee_ensemblesampler(self, xarr, data, error, nwalkers,
+                                  vectorize=None, **kwargs):
         """
         Get an emcee walker ensemble for the data & model
 
@@ -787,6 +1029,11 @@ class SpectralModel(fitter.SimpleFitter):
         error : np.ndarray
         nwalkers : int
             Number of walkers to use
+        vectorize : bool or None
+            Evaluate the log probability of all of the walkers at once with
+            `logp_batch`, using emcee's ``vectorize`` mode (emcee >= 3).  By
+            default, this is done if the installed emcee supports it; if
+            True, an older emcee raises a ValueError.
 
         Examples
         --------
@@ -808,12 +1055,25 @@ class SpectralModel(fitter.SimpleFitter):
         except ImportError:
             return
 
+        ndim = self.npars*self.npeaks+self.vheight
+
+        if vectorize is None:
+            vectorize = _emcee_can_vectorize(emcee)
+        elif vectorize and not _emcee_can_vectorize(emcee):
+            raise ValueError("emcee %s has no vectorize mode; emcee >= 3 is "
+                             "required" % getattr(emcee, '__version__', ''))
+
+        if vectorize:
+            def batch_probfunc(pars):
+                return self.logp_batch(xarr, data, error, pars)
+
+            return emcee.EnsembleSampler(nwalkers, ndim, batch_probfunc,
+                                         vectorize=True, **kwargs)
+
         def probfunc(pars):
             return self.logp(xarr, data, error, pars=pars)
 
-        sampler = emcee.EnsembleSampler(nwalkers,
-                                        self.npars*self.npeaks+self.vheight,
-                                        probfunc, **kwargs)
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, probfunc, **kwargs)
 
         return sampler
 
@@ -1010,3 +1270,12 @@ class AstropyModel(SpectralModel):
         except AttributeError:
             self.modelfunc.parameters = pars
         return self.modelfunc
+
+
+def _emcee_can_vectorize(emcee):
+    """ Does emcee's EnsembleSampler take a ``vectorize`` argument? """
+    try:
+        argnames = inspect.getargspec(emcee.EnsembleSampler.__init__).args
+    except TypeError:
+        return False
+    return 'vectorize' in argnames
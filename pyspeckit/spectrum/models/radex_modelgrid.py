@@ -2,49 +2,74 @@
 Fit a line based on parameters output from a grid of RADEX models
 """
 import numpy as np
-from pyspeckit.mpfit import mpfit
-from .. import units
-from . import fitter,model
-import matplotlib.cbook as mpcb
-import copy
+from . import model
 try:
     import astropy.io.fits as pyfits
 except ImportError:
     import pyfits
 
 class radex_model(object):
-    def __init__(self, xarr,  
-            grid_vwidth=1.0,
-            grid_vwidth_scale=False,
-            texgrid=None,
-            taugrid=None,
-            hdr=None,
-            path_to_texgrid='',
-            path_to_taugrid='',
-            temperature_gridnumber=3,
-            debug=False,
-            verbose=False,
-            modelfunc=None,
-            **kwargs):
+    def __init__(self, modelfunc, texgrid=None, taugrid=None, hdr=None,
+                 path_to_texgrid='', path_to_taugrid='', freqrange=None,
+                 gridaxes=('density','column'), fixed_gridindices={},
+                 parnames=None, shortvarnames=None, Tbackground=None,
+                 memmap=False, **kwargs):
         """
         Use a grid of RADEX-computed models to make a model line spectrum
 
+        The grids are read (or memory-mapped) once, and the excitation
+        temperature and optical depth of all of the lines are interpolated
+        together from them on each call.  The last interpolation is reused if
+        the grid parameters have not changed, e.g. while the fitter steps the
+        velocity offset or width.
+
         The RADEX models have to be available somewhere.
         OR they can be passed as arrays.  If as arrays, the form should be:
         texgrid = ((minfreq1,maxfreq1,texgrid1),(minfreq2,maxfreq2,texgrid2))
 
-        xarr must be a SpectroscopicAxis instance
-        xoff_v, width are both in km/s.  With is 'sigma'
-
-        grid_vwidth is the velocity assumed when computing the grid in km/s
-            this is important because tau = modeltau / width (see, e.g., 
-            Draine 2011 textbook pgs 219-230)
-        grid_vwidth_scale is True or False: False for LVG, True for Sphere
-
+        Parameters
+        ----------
+        modelfunc : function
+            The line model.  It should take an xarr (in Hz) and the keyword
+            arguments Tex, tau, xoff_v, and width (gaussian sigma, not FWHM,
+            in km/s), e.g. `pyspeckit.spectrum.models.formaldehyde.formaldehyde_vtau`
+        texgrid, taugrid : tuple
+            The grids, in the form above.  ``hdr`` must then be given.
+        hdr : header
+            The FITS header describing the grid axes (CRVALn, CRPIXn and CDn_n
+            or CDELTn for each of the axes that are interpolated)
+        path_to_texgrid, path_to_taugrid : str
+            Instead of ``texgrid`` and ``taugrid``, the FITS files holding the
+            grids of a single line; the header is read from the tau grid
+        freqrange : sequence of (minfreq,maxfreq) or None
+            The frequency range (in GHz) of the lines of grids read from the
+            files.  By default, the line covers the whole spectrum.
+        gridaxes : sequence of str
+            The names of the grid axes, in FITS order (the first name is the
+            last array axis)
+        fixed_gridindices : dict
+            The grid axes that are not interpolated, and the index used on
+            each of them, e.g. ``{'temperature':3}``
+        parnames : sequence of str or None
+            The order in which the interpolated grid parameters are passed to
+            the model.  Defaults to the axes in ``gridaxes`` that are not fixed.
+        shortvarnames : sequence of str or None
+            TeX names of the grid parameters, used for the annotations of the
+            fitter
+        Tbackground : sequence or None
+            The background temperature of each line, passed to ``modelfunc``
+        memmap : bool
+            Memory-map the grids read from files instead of reading them into
+            memory
+        kwargs : dict
+            Passed to ``modelfunc``
 
-        A modelfunc must be specified.  Model functions should take an xarr and
-        a series of keyword arguments corresponding to the line parameters
-        (Tex, tau, xoff_v, and width (gaussian sigma, not FWHM))
+        Attributes
+        ----------
+        fitter : `~pyspeckit.spectrum.models.model.SpectralModel`
+            A fitter of the grid parameters followed by the velocity offset
+            and width, limited to the extent of the grid; it can be registered
+            with ``Registry.add_fitter(name, grid.fitter, grid.npars)``
         """
 
         self.modelfunc = modelfunc
@@ -55,49 +80,189 @@ class radex_model(object):
             if path_to_texgrid == '' or path_to_taugrid=='':
                 raise IOError("Must specify model grids to use.")
             else:
-                self.taugrid = [pyfits.getdata(path_to_taugrid)]
-                self.texgrid = [pyfits.getdata(path_to_texgrid)]
+                taugrid = [pyfits.getdata(path_to_taugrid, memmap=memmap)]
+                texgrid = [pyfits.getdata(path_to_texgrid, memmap=memmap)]
                 hdr = pyfits.getheader(path_to_taugrid)
-                self.yinds,self.xinds = np.indices(self.taugrid[0].shape[1:])
-                self.densityarr = (xinds+hdr['CRPIX1']-1)*hdr['CD1_1']+hdr['CRVAL1'] # log density
-                self.columnarr  = (yinds+hdr['CRPIX2']-1)*hdr['CD2_2']+hdr['CRVAL2'] # log column
-                self.minfreq = (4.8,)
-                self.maxfreq = (5.0,)
-        elif len(taugrid)==len(texgrid) and hdr is not None:
-            self.minfreq,self.maxfreq,self.texgrid = zip(*texgrid)
-            self.minfreq,self.maxfreq,self.taugrid = zip(*taugrid)
-            self.yinds,self.xinds = np.indices(self.taugrid[0].shape[1:])
-            self.densityarr = (xinds+hdr['CRPIX1']-1)*hdr['CD1_1']+hdr['CRVAL1'] # log density
-            self.columnarr  = (yinds+hdr['CRPIX2']-1)*hdr['CD2_2']+hdr['CRVAL2'] # log column
+        elif (texgrid is not None and taugrid is not None and
+              len(taugrid)==len(texgrid) and hdr is not None):
+            minfreq,maxfreq,texgrid = zip(*texgrid)
+            minfreq,maxfreq,taugrid = zip(*taugrid)
+            freqrange = zip(minfreq,maxfreq)
         else:
-            raise Exception
-        
-        # Convert X-units to frequency in GHz
-        self.xarr = copy.copy(xarr)
-        self.xarr.convert_to_unit('Hz', quiet=True)
-
-        #tau = modelgrid.line_params_2D(gridval1,gridval2,densityarr,columnarr,taugrid[temperature_gridnumber,:,:])
-        #tex = modelgrid.line_params_2D(gridval1,gridval2,densityarr,columnarr,texgrid[temperature_gridnumber,:,:])
-
-        if debug:
-            import pdb; pdb.set_trace()
-
-    def __call__(self, density=4, column=13, xoff_v=0.0, width=1.0,):
-        self.gridval1 = np.interp(density, self.densityarr[0,:], xinds[0,:])
-        self.gridval2 = np.interp(column, self.columnarr[:,0], yinds[:,0])
-        if np.isnan(gridval1) or np.isnan(gridval2):
-            raise ValueError("Invalid column/density")
-
-        if scipyOK:
-            tau = [scipy.ndimage.map_coordinates(tg[temperature_gridnumber,:,:],np.array([[self.gridval2],[self.gridval1]]),order=1) for tg in self.taugrid]
-            tex = [scipy.ndimage.map_coordinates(tg[temperature_gridnumber,:,:],np.array([[self.gridval2],[self.gridval1]]),order=1) for tg in self.texgrid]
+            raise ValueError("Must specify texgrid, taugrid and hdr, or the "
+                             "paths to the grids.")
+
+        self.nlines = len(taugrid)
+        # the tau grids followed by the tex grids, interpolated together
+        self.grids = list(taugrid) + list(texgrid)
+        self.freqrange = freqrange
+        self.Tbackground = Tbackground
+        self.modelfunc_kwargs = kwargs
+
+        shape = self.grids[0].shape
+        if len(gridaxes) != len(shape):
+            raise ValueError("There must be one name in gridaxes for each of "
+                             "the %i grid axes" % len(shape))
+        self.gridaxes = tuple(gridaxes)
+        self.fixed_gridindices = dict(fixed_gridindices)
+        if parnames is None:
+            parnames = [name for name in self.gridaxes
+                        if name not in self.fixed_gridindices]
+        self.parnames = list(parnames)
+        self.npars = len(self.parnames) + 2
+
+        # the values along each interpolated axis are
+        # (index + CRPIX - 1) * CDELT + CRVAL
+        self.axes = {}
+        self.axis_values = {}
+        for naxis,name in enumerate(self.gridaxes):
+            if name in self.fixed_gridindices:
+                continue
+            ii = naxis+1
+            cdelt = (hdr['CD%i_%i' % (ii,ii)] if 'CD%i_%i' % (ii,ii) in hdr
+                     else hdr['CDELT%i' % ii])
+            npix = shape[len(shape)-1-naxis]
+            self.axes[name] = (hdr['CRVAL%i' % ii], cdelt, hdr['CRPIX%i' % ii],
+                               npix)
+            self.axis_values[name] = ((np.arange(npix)+hdr['CRPIX%i' % ii]-1)
+                                      * cdelt + hdr['CRVAL%i' % ii])
+
+        self._last_pars = None
+        self._last_lookup = None
+
+        limits = [(self.axis_values[name].min(), self.axis_values[name].max())
+                  for name in self.parnames]
+        if shortvarnames is None:
+            shortvarnames = self.parnames
+        self.fitter = model.SpectralModel(self, self.npars,
+                                          parnames=self.parnames+['center','width'],
+                                          parvalues=[np.mean(lim) for lim in limits]+[0,1],
+                                          parlimited=[(True,True)]*len(limits)+[(False,False),(True,False)],
+                                          parlimits=limits+[(0,0),(0,0)],
+                                          shortvarnames=tuple(shortvarnames)+("v","\\sigma"),
+                                          fitunits='Hz')
+
+    def lookup(self, *gridpars):
+        """
+        Interpolate the optical depth and excitation temperature of each line
+        at the grid parameters (in the order of ``parnames``)
+
+        Returns
+        -------
+        tau, tex : np.ndarray
+            One value per line
+        """
+        gridpars = tuple(float(p) for p in gridpars)
+        if gridpars == self._last_pars:
+            return self._last_lookup
+        if len(gridpars) != len(self.parnames):
+            raise ValueError("Expected %i grid parameters (%s)" %
+                             (len(self.parnames), ", ".join(self.parnames)))
+        values = dict(zip(self.parnames, gridpars))
+
+        # the 2x2x... block of grid points around the parameters, and the
+        # weight of each point
+        slices, weights = [], []
+        for name in self.gridaxes[::-1]:
+            if name in self.fixed_gridindices:
+                index = self.fixed_gridindices[name]
+                slices.append(slice(index, index+1))
+                weights.append(np.ones(1))
+                continue
+            crval, cdelt, crpix, npix = self.axes[name]
+            gridval = (values[name]-crval)/cdelt - crpix + 1
+            if np.isnan(gridval):
+                raise ValueError("Invalid %s" % name)
+            gridval = min(max(gridval, 0), npix-1)
+            lower = max(min(int(np.floor(gridval)), npix-2), 0)
+            frac = gridval - lower
+            if npix == 1:
+                slices.append(slice(0, 1))
+                weights.append(np.ones(1))
+            else:
+                slices.append(slice(lower, lower+2))
+                weights.append(np.array([1-frac, frac]))
+
+        weight = weights[0]
+        for w in weights[1:]:
+            weight = np.multiply.outer(weight, w)
+        slices = tuple(slices)
+        block = np.array([grid[slices] for grid in self.grids], dtype='float64')
+        interpolated = (block*weight).reshape(len(self.grids), -1).sum(axis=1)
+
+        tau, tex = interpolated[:self.nlines], interpolated[self.nlines:]
+        self._last_pars = gridpars
+        self._last_lookup = (tau, tex)
+        return tau, tex
+
+    def __call__(self, xarr, *pars, **kwargs):
+        """
+        The model spectrum: ``pars`` are the grid parameters (in the order of
+        ``parnames``) followed by xoff_v and width, which can also be given
+        as keywords.  ``Tbackground`` (one value, or one per line) overrides
+        the background temperature given when the model was made.
+
+        xarr must be a SpectroscopicAxis instance
+        """
+        ngrid = len(self.parnames)
+        tau, tex = self.lookup(*pars[:ngrid])
+        xoff_v = pars[ngrid] if len(pars) > ngrid else kwargs.pop('xoff_v', 0.0)
+        width = pars[ngrid+1] if len(pars) > ngrid+1 else kwargs.pop('width', 1.0)
+
+        # as_unit caches the conversion for as long as the axis (including
+        # its reference frequency and velocity convention) is unchanged
+        xarr_hz = xarr.as_unit('Hz', quiet=True)
+        if self.freqrange is None:
+            inrange = [True]*self.nlines
         else:
-            raise ImportError("Couldn't import scipy, therefore cannot interpolate")
+            xghz = np.asarray(xarr_hz)/1e9
+            inrange = [(xghz > minfreq) & (xghz < maxfreq)
+                       for minfreq,maxfreq in self.freqrange]
+
+        # a background temperature for all of the lines or one for each
+        tbg = kwargs.pop('Tbackground', self.Tbackground)
+        if tbg is not None and not np.iterable(tbg):
+            tbg = [tbg]*self.nlines
+
+        linekwargs = dict(self.modelfunc_kwargs)
+        linekwargs.update(kwargs)
+        spec = np.zeros(len(xarr))
+        for ii in xrange(self.nlines):
+            if tbg is not None:
+                linekwargs['Tbackground'] = tbg[ii]
+            spec += (self.modelfunc(xarr_hz, Tex=float(tex[ii]),
+                                    tau=float(tau[ii]), xoff_v=xoff_v,
+                                    width=width, **linekwargs)
+                     * inrange[ii])
+
+        return spec
+
+def _same(a, b):
+    """ Are a and b the same grid argument? """
+    if a is b:
+        return True
+    try:
+        return bool(a == b)
+    except (ValueError, TypeError):
+        return False
 
-        if verbose:
-            print "density %20.12g column %20.12g: tau %20.12g tex %20.12g" % (density, column, tau, tex)
-        if debug:
-            import pdb; pdb.set_trace()
+# the radex_models made by `cached_radex_model`, most recent last
+_cached_models = []
 
-        return self.modelfunc(self.xarr,Tex=self.tex,tau=tau,xoff_v=xoff_v,width=width,**kwargs)
+def cached_radex_model(modelfunc, maxcache=8, **kwargs):
+    """
+    A `radex_model` of ``modelfunc`` and the grid arguments ``kwargs``,
+    reused by later calls with the same arguments (the same grid objects, or
+    the same paths), so that model functions that are given the grids on
+    each call only read them once
+    """
+    for func, cachekwargs, grid in _cached_models:
+        if (func is modelfunc and set(cachekwargs) == set(kwargs) and
+                all(_same(cachekwargs[k], kwargs[k]) for k in kwargs)):
+            return grid
 
+    grid = radex_model(modelfunc, **kwargs)
+    _cached_models.append((modelfunc, kwargs, grid))
+    if len(_cached_models) > maxcache:
+        _cached_models.pop(0)
+    return grid
@@ -0,0 +1,94 @@
+"""
+Tests for the vectorized (batched) fitter
+"""
+
+import numpy as np
+from pyspeckit.spectrum.units import SpectroscopicAxis
+from pyspeckit.spectrum.models import inherited_gaussfitter
+
+
+def make_spectra(nspec=20, nchan=100):
+    np.random.seed(0)
+    x = np.linspace(-10, 10, nchan)
+    amp = np.random.uniform(1, 3, nspec)
+    cen = np.random.uniform(-2, 2, nspec)
+    wid = np.random.uniform(0.8, 2, nspec)
+    data = (amp[:,None] * np.exp(-(x-cen[:,None])**2/(2*wid[:,None]**2)) +
+            np.random.randn(nspec, nchan)*0.05)
+    return SpectroscopicAxis(x, unit='km/s'), data
+
+
+def test_batch_matches_mpfit():
+    xarr, data = make_spectra()
+    err = np.ones(data.shape[1]) * 0.05
+    guesses = [1.5, 0, 1]
+
+    fitter = inherited_gaussfitter.gaussian_fitter()
+    pars, errs, chi2, status = fitter.batch_fitter(xarr, data, err=err,
+                                                   guesses=guesses)
+    assert np.all(status > 0)
+
+    for ii in range(data.shape[0]):
+        mpp, model, mpperr, mpchi2 = fitter.fitter(xarr, data[ii], err=err.copy(),
+                                                   params=guesses)
+        np.testing.assert_allclose(pars[ii], mpp, rtol=1e-5)
+        np.testing.assert_allclose(errs[ii], mpperr, rtol=1e-4)
+        np.testing.assert_allclose(chi2[ii], mpchi2, rtol=1e-6)
+
+
+def test_batch_limits_and_fixed():
+    xarr, data = make_spectra(nspec=5)
+    fitter = inherited_gaussfitter.gaussian_fitter()
+    pars, errs, chi2, status = fitter.batch_fitter(xarr, data,
+                                                   err=np.ones(data.shape)*0.05,
+                                                   guesses=[1.5, 0, 1],
+                                                   fixed=[False, True, False],
+                                                   limitedmax=[True, False, False],
+                                                   maxpars=[1.2, 0, 0])
+    assert np.all(pars[:,1] == 0)
+    assert np.all(errs[:,1] == 0)
+    assert np.all(pars[:,0] <= 1.2)
+
+
+def test_batch_pegged_matches_mpfit():
+    # the guessed amplitude sits on its upper limit and chi^2 pushes it
+    # beyond; it must stay pegged without stopping the other parameters
+    xarr, data = make_spectra()
+    data *= 2
+    err = np.ones(data.shape[1]) * 0.05
+    kwargs = dict(limitedmax=[True, False, False], maxpars=[1.2, 0, 0],
+                  limitedmin=[False, False, True], minpars=[0, 0, 0])
+    guesses = [1.2, 0, 1]
+
+    fitter = inherited_gaussfitter.gaussian_fitter()
+    pars, errs, chi2, status = fitter.batch_fitter(xarr, data, err=err,
+                                                   guesses=guesses, **kwargs)
+    for ii in range(data.shape[0]):
+        mpp, model, mpperr, mpchi2 = fitter.fitter(xarr, data[ii],
+                                                   err=err.copy(),
+                                                   params=guesses, **kwargs)
+        np.testing.assert_allclose(pars[ii], mpp, rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(chi2[ii], mpchi2, rtol=1e-6)
+
+
+def test_batch_lm_reuses_rejected_jacobians():
+    from pyspeckit.mpfit.batch_lm import batch_lm
+    xarr, data = make_spectra()
+    x = np.asarray(xarr)
+
+    def gauss(p):
+        return p[:,0:1]*np.exp(-(x-p[:,1:2])**2/(2*p[:,2:3]**2))
+
+    nrows = []
+    def jacobian(p):
+        nrows.append(len(p))
+        amp, cen, wid = p[:,0:1], p[:,1:2], p[:,2:3]
+        g = np.exp(-(x-cen)**2/(2*wid**2))
+        return np.dstack([g, amp*g*(x-cen)/wid**2, amp*g*(x-cen)**2/wid**3])
+
+    result = batch_lm(gauss, np.tile([1.5, 0.5, 1.5], (len(data), 1)), data,
+                      err=0.05, jacobian=jacobian)
+    assert np.all(result.status > 0) and np.all(result.status < 5)
+    # a Jacobian is only computed after a step is accepted (plus once at
+    # the start), not for every active spectrum on every iteration
+    assert sum(nrows) < result.niter.sum() + len(data)
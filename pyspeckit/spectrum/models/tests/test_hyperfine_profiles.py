@@ -0,0 +1,40 @@
+"""
+Windowed evaluation of the hyperfine models
+"""
+
+import numpy as np
+from pyspeckit.spectrum.units import SpectroscopicAxis
+from pyspeckit.spectrum.models import ammonia, n2hp
+
+
+def test_windowed_matches_unsorted_axis():
+    # a shuffled axis cannot be windowed, so every component is evaluated
+    # on every channel
+    np.random.seed(0)
+    x = np.linspace(23.65, 24.2, 5000)
+    order = np.random.permutation(x.size)
+    pars = dict(tkin=20, tex=8, ntot=14.8, width=0.8, xoff_v=3.)
+    sorted_spec = ammonia.ammonia(SpectroscopicAxis(x, unit='GHz'), **pars)
+    shuffled_spec = ammonia.ammonia(SpectroscopicAxis(x[order], unit='GHz'),
+                                    **pars)
+    np.testing.assert_allclose(sorted_spec[order], shuffled_spec,
+                               rtol=1e-12, atol=1e-15)
+
+    x = np.linspace(93.16e9, 93.19e9, 3000)[::-1]
+    order = np.random.permutation(x.size)
+    pars = dict(Tex=8, tau=2, xoff_v=1, width=0.5)
+    sorted_spec = n2hp.n2hp_vtau.hyperfine(SpectroscopicAxis(x, unit='Hz'),
+                                           **pars)
+    shuffled_spec = n2hp.n2hp_vtau.hyperfine(SpectroscopicAxis(x[order],
+                                                               unit='Hz'),
+                                             **pars)
+    np.testing.assert_allclose(sorted_spec[order], shuffled_spec,
+                               rtol=1e-12, atol=1e-15)
+
+
+def test_axis_cache_follows_changes():
+    xarr = SpectroscopicAxis(np.linspace(93.16, 93.19, 1000), unit='GHz')
+    spec1 = n2hp.n2hp_vtau.hyperfine(xarr, Tex=8, tau=2, xoff_v=1, width=0.5)
+    xarr[:] = xarr[::-1]
+    spec2 = n2hp.n2hp_vtau.hyperfine(xarr, Tex=8, tau=2, xoff_v=1, width=0.5)
+    np.testing.assert_allclose(spec2, spec1[::-1], rtol=1e-12)
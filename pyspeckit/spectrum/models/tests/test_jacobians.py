@@ -0,0 +1,145 @@
+"""
+Check the analytic derivatives of the line profile models against finite
+differences
+"""
+
+import numpy as np
+import pytest
+from pyspeckit.spectrum.units import SpectroscopicAxis
+from pyspeckit.spectrum.models import (inherited_gaussfitter,
+                                       inherited_lorentzian,
+                                       inherited_voigtfitter, fitter, n2hp,
+                                       ammonia, model)
+
+
+def numerical_jacobian(func, xarr, pars, **kwargs):
+    derivs = []
+    for ii in range(len(pars)):
+        step = 1e-5*max(abs(pars[ii]), 1e-2)
+        hi, lo = list(pars), list(pars)
+        hi[ii] += step
+        lo[ii] -= step
+        derivs.append((func(xarr, *hi, **kwargs) -
+                       func(xarr, *lo, **kwargs)) / (2*step))
+    return np.array(derivs)
+
+
+def check_jacobian(func, jacfunc, xarr, pars, **kwargs):
+    analytic = np.array(jacfunc(xarr, *pars, **kwargs))
+    numerical = numerical_jacobian(func, xarr, pars, **kwargs)
+    for ana, num in zip(analytic, numerical):
+        np.testing.assert_allclose(ana, num, rtol=1e-5,
+                                   atol=1e-6*np.abs(num).max())
+
+
+def test_profile_jacobians():
+    xarr = np.linspace(-10, 10, 201)
+    check_jacobian(inherited_gaussfitter.gaussian,
+                   inherited_gaussfitter.gaussian_jacobian,
+                   xarr, [2., 0.5, 1.5])
+    check_jacobian(inherited_gaussfitter.gaussian,
+                   inherited_gaussfitter.gaussian_jacobian,
+                   xarr, [2., 0.5, 1.5], normalized=True)
+    check_jacobian(fitter.vheightmodel(inherited_gaussfitter.gaussian),
+                   fitter.vheightjacobian(inherited_gaussfitter.gaussian_jacobian),
+                   xarr, [0.3, 2., 0.5, 1.5])
+    check_jacobian(inherited_lorentzian.lorentzian,
+                   inherited_lorentzian.lorentzian_jacobian,
+                   xarr, [2., 0.5, 1.5])
+    check_jacobian(inherited_voigtfitter.voigt,
+                   inherited_voigtfitter.voigt_jacobian,
+                   xarr, [2., 0.5, 1.5, 0.7])
+    check_jacobian(inherited_voigtfitter.voigt,
+                   inherited_voigtfitter.voigt_jacobian,
+                   xarr, [2., 0.5, 1.5, 0.7], normalized=True)
+
+
+def n2hp_axis():
+    """ -15 to 15 km/s around the N2H+ 1-0 line, in Hz """
+    restfreq = 93.176261e9
+    return SpectroscopicAxis(restfreq*(1-np.linspace(-15, 15, 300)/299792.458),
+                             unit='Hz', refX=restfreq, refX_unit='Hz',
+                             velocity_convention='radio')
+
+
+def test_hyperfine_jacobian():
+    xarr = n2hp_axis()
+    assert n2hp.n2hp_vtau.hyperfine(xarr, 8., 2., 1.0, 0.8).max() > 1
+    check_jacobian(n2hp.n2hp_vtau.hyperfine,
+                   n2hp.n2hp_vtau.hyperfine_jacobian,
+                   xarr, [8., 2., 1.0, 0.8])
+
+
+def test_ammonia_jacobian():
+    xarr = SpectroscopicAxis(np.linspace(-30, 30, 300), unit='km/s',
+                             refX=23.6944955e9, refX_unit='Hz',
+                             velocity_convention='radio')
+    xarr = xarr.as_unit('GHz')
+    parnames = ['tkin', 'tex', 'ntot', 'width', 'xoff_v', 'fortho']
+    pars = [15., 7., 14.5, 1.2, 0.5, 0.1]
+    func = lambda x, *p: ammonia.ammonia(x, **dict(zip(parnames, p)))
+    jacfunc = lambda x, *p: ammonia.ammonia_jacobian(x, parnames=parnames,
+                                                     **dict(zip(parnames, p)))
+    check_jacobian(func, jacfunc, xarr, pars)
+
+
+def test_analytic_fit_matches_numerical():
+    np.random.seed(0)
+    xarr = SpectroscopicAxis(np.linspace(-10, 10, 200), unit='km/s')
+    data = (inherited_voigtfitter.voigt(xarr.value, 2., 0.5, 1.5, 0.7) +
+            np.random.randn(200)*0.05)
+    fitter = inherited_voigtfitter.voigt_fitter()
+    analytic = fitter.fitter(xarr, data.copy(), err=np.ones(200)*0.05,
+                             params=[1.5, 0, 1, 1])
+    numerical = fitter.fitter(xarr, data.copy(), err=np.ones(200)*0.05,
+                              params=[1.5, 0, 1, 1], autoderivative=1)
+    assert fitter.mp.nfev < 40
+    np.testing.assert_allclose(analytic[0], numerical[0], rtol=1e-5)
+    np.testing.assert_allclose(analytic[2], numerical[2], rtol=1e-4)
+
+
+def test_hyperfine_jacobian_unsupported_options():
+    # for the options that change the parametrization, there are no analytic
+    # derivatives and the fitters must use numerical ones
+    xarr = n2hp_axis()
+    hf = n2hp.n2hp_vtau
+    pars = [8., 2., 1.0, 0.8]
+    for option in (dict(tau_total=2.), dict(amp=3.), dict(return_tau=True),
+                   dict(return_hyperfine_components=True),
+                   dict(vary_hyperfine_tau=True),
+                   dict(vary_hyperfine_width=True)):
+        assert hf.hyperfine_jacobian(xarr, *pars, **option) is None
+        assert hf.vheight_fitter.jacobian_func(xarr, 0.5, *pars,
+                                               **option) is None
+        assert not hf.fitter._analytic_jacobian(xarr, pars, **option)
+    assert hf.fitter._analytic_jacobian(xarr, pars, Tbackground=5.)
+    with pytest.raises(TypeError):
+        hf.hyperfine_jacobian(xarr, *pars, unknown=1)
+
+
+def test_hyperfine_fit_with_unsupported_option():
+    xarr = n2hp_axis()
+    hf = n2hp.n2hp_vtau
+    # a fit of the peak optical depth, with the tau parameter fixed
+    fitter = model.SpectralModel(hf, 4, parnames=['Tex', 'tau', 'center',
+                                                  'width'],
+                                 parlimited=[(False,False), (True,False),
+                                             (False,False), (True,False)],
+                                 parlimits=[(0,0), (0,0), (0,0), (0,0)],
+                                 fitunits='Hz',
+                                 jacobian_func=hf.hyperfine_jacobian,
+                                 tau_total=3.)
+    assert fitter.modelfunc_kwargs == {'tau_total': 3.}
+    rng = np.random.RandomState(2)
+    data = (hf.hyperfine(xarr, 8., 1., 1.0, 0.8, tau_total=3.) +
+            rng.normal(0, 0.05, len(xarr)))
+    err = np.ones(len(xarr))*0.05
+    fit = fitter.fitter(xarr, data.copy(), err=err.copy(),
+                        params=[6., 1., 0.8, 1.], fixed=[False, True, False,
+                                                         False])
+    numerical = fitter.fitter(xarr, data.copy(), err=err.copy(),
+                              params=[6., 1., 0.8, 1.],
+                              fixed=[False, True, False, False],
+                              autoderivative=1)
+    np.testing.assert_allclose(fit[0], numerical[0], rtol=1e-10)
+    np.testing.assert_allclose(fit[0], [8., 1., 1.0, 0.8], rtol=0.02)
@@ -0,0 +1,151 @@
+"""
+Tests of the log probability of models, one parameter set or many at once
+"""
+
+import sys
+import types
+import numpy as np
+import pytest
+from pyspeckit.spectrum.units import SpectroscopicAxis
+from pyspeckit.spectrum.models import inherited_gaussfitter
+
+
+def make_fitter(batchable=True):
+    fitter = inherited_gaussfitter.gaussian_fitter()
+    fitter.parinfo, kwargs = fitter._make_parinfo(params=[2, 0, 1, 1, 3, 0.5],
+                                                  npeaks=2,
+                                                  limitedmax=[True, False,
+                                                              False]*2,
+                                                  maxpars=[5, 0, 0]*2,
+                                                  limitedmin=[False, False,
+                                                              True]*2,
+                                                  minpars=[0, 0, 0]*2)
+    fitter.npeaks = 2
+    if not batchable:
+        fitter.batchable = False
+    return fitter
+
+def make_data():
+    rng = np.random.RandomState(8)
+    xarr = SpectroscopicAxis(np.linspace(-10, 10, 80), unit='km/s')
+    x = np.asarray(xarr)
+    data = (2*np.exp(-x**2/2.) + np.exp(-(x-3)**2/(2*0.5**2)) +
+            rng.normal(0, 0.1, x.size))
+    error = rng.uniform(0.05, 0.2, x.size)
+    return xarr, data, error
+
+def make_pars():
+    rng = np.random.RandomState(9)
+    pars = np.array([2, 0, 1, 1, 3, 0.5]) + rng.normal(0, 0.1, (12, 6))
+    # amplitudes above their upper limit and widths below their lower limit
+    pars[2,0] = 6
+    pars[5,3] = 5.5
+    pars[7,2] = -0.1
+    pars[9,5] = -1
+    return pars
+
+@pytest.mark.parametrize('batchable', [True, False])
+def test_logp_batch_matches_logp(batchable):
+    fitter = make_fitter(batchable=batchable)
+    xarr, data, error = make_data()
+    pars = make_pars()
+    logprob = fitter.logp_batch(xarr, data, error, pars)
+    assert logprob.shape == (len(pars),)
+    expected = [fitter.logp(xarr, data, error, pars=p) for p in pars]
+    outside = [2, 5, 7, 9]
+    assert np.all(np.isneginf(logprob[outside]))
+    assert np.all(np.isneginf(np.array(expected)[outside]))
+    assert np.all(np.isfinite(np.delete(logprob, outside)))
+    np.testing.assert_allclose(logprob, expected, rtol=1e-10)
+    # one parameter set
+    np.testing.assert_allclose(fitter.logp_batch(xarr, data, error, pars[0]),
+                               expected[:1], rtol=1e-10)
+
+def test_logp_leaves_parinfo_alone():
+    fitter = make_fitter()
+    xarr, data, error = make_data()
+    values = fitter.parinfo.values
+    for p in make_pars():
+        fitter.logp(xarr, data, error, pars=p)
+    fitter.logp_batch(xarr, data, error, make_pars())
+    assert fitter.parinfo.values == values
+
+def test_logp_batch_all_outside():
+    fitter = make_fitter()
+    xarr, data, error = make_data()
+    pars = make_pars()[[2, 5, 7, 9]]
+    assert np.all(np.isneginf(fitter.logp_batch(xarr, data, error, pars)))
+
+
+class EnsembleSampler2(object):
+    """ The EnsembleSampler of emcee 2, without a vectorize mode """
+    def __init__(self, nwalkers, dim, lnpostfn, a=2.0, args=[], kwargs={},
+                 postargs=None, threads=1, pool=None, live_dangerously=False,
+                 runtime_sortingfn=None):
+        self.nwalkers, self.dim, self.lnpostfn = nwalkers, dim, lnpostfn
+        self.vectorize = False
+
+class EnsembleSampler3(object):
+    """ The EnsembleSampler of emcee 3 """
+    def __init__(self, nwalkers, ndim, log_prob_fn, pool=None, moves=None,
+                 args=None, kwargs=None, backend=None, vectorize=False,
+                 blobs_dtype=None):
+        self.nwalkers, self.dim, self.lnpostfn = nwalkers, ndim, log_prob_fn
+        self.vectorize = vectorize
+
+def fake_emcee(monkeypatch, sampler):
+    emcee = types.ModuleType('emcee')
+    emcee.__version__ = '2.2.1' if sampler is EnsembleSampler2 else '3.0.2'
+    emcee.EnsembleSampler = sampler
+    monkeypatch.setitem(sys.modules, 'emcee', emcee)
+
+@pytest.mark.parametrize('vectorize', [None, False])
+def test_ensemblesampler_without_vectorize(monkeypatch, vectorize):
+    fake_emcee(monkeypatch, EnsembleSampler2)
+    fitter = make_fitter()
+    xarr, data, error = make_data()
+    sampler = fitter.get_emcee_ensemblesampler(xarr, data, error, 12,
+                                               vectorize=vectorize)
+    assert isinstance(sampler, EnsembleSampler2)
+    assert sampler.dim == 6
+    # one walker at a time
+    p = make_pars()[0]
+    assert sampler.lnpostfn(p) == fitter.logp(xarr, data, error, pars=p)
+
+def test_ensemblesampler_vectorize_needs_emcee3(monkeypatch):
+    fake_emcee(monkeypatch, EnsembleSampler2)
+    fitter = make_fitter()
+    xarr, data, error = make_data()
+    with pytest.raises(ValueError):
+        fitter.get_emcee_ensemblesampler(xarr, data, error, 12, vectorize=True)
+
+@pytest.mark.parametrize('vectorize', [None, True, False])
+def test_ensemblesampler_emcee3(monkeypatch, vectorize):
+    fake_emcee(monkeypatch, EnsembleSampler3)
+    fitter = make_fitter()
+    xarr, data, error = make_data()
+    sampler = fitter.get_emcee_ensemblesampler(xarr, data, error, 12,
+                                               vectorize=vectorize)
+    assert isinstance(sampler, EnsembleSampler3)
+    pars = make_pars()
+    if vectorize is False:
+        assert not sampler.vectorize
+        assert sampler.lnpostfn(pars[0]) == fitter.logp(xarr, data, error,
+                                                        pars=pars[0])
+    else:
+        # all of the walkers at once
+        assert sampler.vectorize
+        np.testing.assert_array_equal(sampler.lnpostfn(pars),
+                                      fitter.logp_batch(xarr, data, error,
+                                                        pars))
+
+def test_ensemblesampler_runs():
+    emcee = pytest.importorskip('emcee')
+    fitter = make_fitter()
+    xarr, data, error = make_data()
+    nwalkers = 14
+    sampler = fitter.get_emcee_ensemblesampler(xarr, data, error, nwalkers)
+    p0 = (np.array([2, 0, 1, 1, 3, 0.5]) +
+          np.random.RandomState(3).normal(0, 0.01, (nwalkers, 6)))
+    sampler.run_mcmc(p0, 20)
+    assert np.asarray(sampler.chain).shape == (nwalkers, 20, 6)
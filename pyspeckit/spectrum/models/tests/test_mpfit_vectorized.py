@@ -0,0 +1,39 @@
+"""
+The vectorized mpfit linear algebra should reproduce the MINPACK loops
+"""
+
+import numpy as np
+from pyspeckit.spectrum.units import SpectroscopicAxis
+from pyspeckit.spectrum.models import inherited_gaussfitter
+
+
+def test_vectorized_matches_minpack():
+    np.random.seed(2)
+    x = np.linspace(-50, 50, 1000)
+    centers = [-30, -10, 12, 35]
+    data = sum(2*np.exp(-(x-c)**2/(2*1.5**2)) for c in centers)
+    data += np.random.randn(x.size)*0.1
+    xarr = SpectroscopicAxis(x, unit='km/s')
+    guesses = [p for c in centers for p in (1.5, c+0.5, 2)]
+
+    fitter = inherited_gaussfitter.gaussian_fitter()
+    for kwargs in ({}, {'fixed': [False]*11+[True]},
+                   {'limitedmax': [True]+[False]*11,
+                    'maxpars': [1.8]+[0]*11}):
+        results = []
+        for vectorized in (False, True):
+            pars, model, errs, chi2 = fitter.fitter(xarr, data.copy(),
+                                                    err=np.ones(x.size)*0.1,
+                                                    params=guesses, npeaks=4,
+                                                    vectorized=vectorized,
+                                                    **kwargs)
+            results.append((pars, errs, chi2, fitter.mp.status,
+                            fitter.mp.covar))
+        (pars0, errs0, chi20, status0, covar0), (pars1, errs1, chi21, status1,
+                                                 covar1) = results
+        assert status0 == status1
+        np.testing.assert_allclose(pars1, pars0, rtol=1e-6)
+        np.testing.assert_allclose(errs1, errs0, rtol=1e-5)
+        np.testing.assert_allclose(chi21, chi20, rtol=1e-8)
+        np.testing.assert_allclose(covar1, covar0, rtol=1e-5,
+                                   atol=1e-8*np.abs(covar0).max())
@@ -0,0 +1,272 @@
+"""
+Tests of the RADEX grid model on small synthetic grids
+"""
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from scipy.ndimage import map_coordinates
+import pyspeckit
+from pyspeckit.spectrum.units import SpectroscopicAxis
+from pyspeckit.spectrum.models import radex_modelgrid
+
+
+def make_grids(nlines=2):
+    """
+    tau and Tex grids of shape (temperature, column, density) = (3, 5, 6),
+    with the lines between 4.8 and 5.0 GHz and between 14.4 and 14.6 GHz
+    """
+    rng = np.random.RandomState(10)
+    header = fits.Header()
+    # log density from 2 to 4.5, log column from 12 to 14, temperature; the
+    # values are (index + CRPIX - 1) * CDELT + CRVAL, as in the RADEX grids
+    for ii, (crval, cdelt, crpix) in enumerate([(2., 0.5, 1), (11., 0.5, 3),
+                                                (10., 10., 1)]):
+        header['CRVAL%i' % (ii+1)] = crval
+        header['CDELT%i' % (ii+1)] = cdelt
+        header['CRPIX%i' % (ii+1)] = crpix
+    ranges = [(4.8, 5.0), (14.4, 14.6)][:nlines]
+    taugrid = [(lo, hi, rng.uniform(0, 2, (3, 5, 6))) for lo, hi in ranges]
+    texgrid = [(lo, hi, rng.uniform(3, 30, (3, 5, 6))) for lo, hi in ranges]
+    return taugrid, texgrid, header
+
+def linemodel(xarr, Tex=10, tau=1, xoff_v=0, width=1, Tbackground=2.73):
+    """ A line at 4.9 GHz whose peak depends on Tex and tau (xarr in Hz) """
+    x = np.asarray(xarr)
+    velocity = (4.9e9-x)/4.9e9*3e5
+    return ((Tex-Tbackground)*(1-np.exp(-tau)) *
+            np.exp(-(velocity-xoff_v)**2/(2*width**2)))
+
+def make_model(**kwargs):
+    taugrid, texgrid, header = make_grids()
+    return radex_modelgrid.radex_model(linemodel, texgrid=texgrid,
+                                       taugrid=taugrid, hdr=header,
+                                       gridaxes=('density', 'column',
+                                                 'temperature'),
+                                       fixed_gridindices={'temperature':1},
+                                       **kwargs)
+
+def map_coordinates_lookup(grid, header, density, column, temperature_index):
+    """ The interpolation of the original grid model, with clamped edges """
+    ncol, ndens = grid.shape[1:]
+    densidx = (density-header['CRVAL1'])/header['CDELT1'] - header['CRPIX1']+1
+    colidx = (column-header['CRVAL2'])/header['CDELT2'] - header['CRPIX2']+1
+    coords = np.array([[np.clip(colidx, 0, ncol-1)],
+                       [np.clip(densidx, 0, ndens-1)]])
+    return map_coordinates(grid[temperature_index], coords, order=1)[0]
+
+def test_axes():
+    model = make_model()
+    np.testing.assert_allclose(model.axis_values['density'],
+                               2 + 0.5*np.arange(6))
+    np.testing.assert_allclose(model.axis_values['column'],
+                               12 + 0.5*np.arange(5))
+    assert model.parnames == ['density', 'column']
+    assert model.npars == 4
+    assert model.fitter.npars == 4
+
+@pytest.mark.parametrize(('density', 'column'),
+                         [(2, 12), (4.5, 14), (3.3, 12.7), (2.25, 13.9),
+                          (3, 13), (4.49, 12.01),
+                          # outside the grid, clamped to its edges
+                          (1, 13.2), (5, 12.6), (3.7, 11), (2.9, 15),
+                          (0, 20), (10, -3)])
+def test_lookup_matches_map_coordinates(density, column):
+    taugrid, texgrid, header = make_grids()
+    model = make_model()
+    tau, tex = model.lookup(density, column)
+    for ii in range(2):
+        np.testing.assert_allclose(tau[ii],
+                                   map_coordinates_lookup(taugrid[ii][2],
+                                                          header, density,
+                                                          column, 1),
+                                   rtol=1e-12)
+        np.testing.assert_allclose(tex[ii],
+                                   map_coordinates_lookup(texgrid[ii][2],
+                                                          header, density,
+                                                          column, 1),
+                                   rtol=1e-12)
+
+def test_lookup_edges():
+    taugrid, texgrid, header = make_grids()
+    model = make_model()
+    grid = taugrid[0][2][1]
+    # on the grid points, and clamped to the corners
+    tau, tex = model.lookup(2.5, 12.5)
+    assert tau[0] == grid[1, 1]
+    assert model.lookup(-100, -100)[0][0] == grid[0, 0]
+    assert model.lookup(100, 100)[0][0] == grid[-1, -1]
+    assert model.lookup(100, -100)[0][0] == grid[0, -1]
+    # along an edge, only the other axis is interpolated
+    np.testing.assert_allclose(model.lookup(100, 12.25)[0][0],
+                               grid[:2, -1].mean(), rtol=1e-12)
+    with pytest.raises(ValueError):
+        model.lookup(np.nan, 13)
+    with pytest.raises(ValueError):
+        model.lookup(3)
+
+def test_lookup_reuses_last():
+    model = make_model()
+    tau, tex = model.lookup(3.3, 12.7)
+    again = model.lookup(3.3, 12.7)
+    assert again[0] is tau and again[1] is tex
+    second = model.lookup(3.4, 12.7)
+    assert second[0] is not tau
+    assert not np.all(second[0] == tau)
+
+def test_call():
+    model = make_model()
+    xarr = SpectroscopicAxis(np.linspace(4.899, 4.901, 100), unit='GHz')
+    spec = model(xarr, 3.3, 12.7, 1.5, 2.)
+    tau, tex = model.lookup(3.3, 12.7)
+    # only the first line is in range
+    np.testing.assert_allclose(spec, linemodel(xarr.as_unit('Hz'),
+                                               Tex=tex[0], tau=tau[0],
+                                               xoff_v=1.5, width=2.),
+                               rtol=1e-12)
+    np.testing.assert_allclose(model(xarr, 3.3, 12.7, xoff_v=1.5, width=2.),
+                               spec, rtol=1e-12)
+    np.testing.assert_allclose(model(xarr, 3.3, 12.7, 1.5, 2.,
+                                     Tbackground=5),
+                               linemodel(xarr.as_unit('Hz'), Tex=tex[0],
+                                         tau=tau[0], xoff_v=1.5, width=2.,
+                                         Tbackground=5),
+                               rtol=1e-12)
+
+def test_call_follows_reference_frequency():
+    # two velocity axes with the same values and unit, but different
+    # reference frequencies (and so different frequencies)
+    model = make_model()
+    velocities = np.linspace(-30, 30, 200)
+    xarr1 = SpectroscopicAxis(velocities, unit='km/s', refX=4.9, refX_unit='GHz',
+                              velocity_convention='radio')
+    xarr2 = SpectroscopicAxis(velocities, unit='km/s', refX=4.9001,
+                              refX_unit='GHz', velocity_convention='radio')
+    xarr3 = SpectroscopicAxis(velocities, unit='km/s', refX=4.9,
+                              refX_unit='GHz', velocity_convention='optical')
+    pars = (3.3, 12.7, 0., 3.)
+    spec1 = model(xarr1, *pars)
+    for xarr in (xarr2, xarr3):
+        spec = model(xarr, *pars)
+        np.testing.assert_allclose(spec, make_model()(xarr, *pars), rtol=1e-12)
+        assert not np.allclose(spec, spec1)
+    np.testing.assert_allclose(model(xarr1, *pars), spec1, rtol=1e-12)
+
+def test_cached_radex_model(monkeypatch):
+    monkeypatch.setattr(radex_modelgrid, '_cached_models', [])
+    taugrid, texgrid, header = make_grids()
+    kwargs = dict(texgrid=texgrid, taugrid=taugrid, hdr=header,
+                  gridaxes=('density', 'column', 'temperature'),
+                  fixed_gridindices={'temperature':1})
+    model = radex_modelgrid.cached_radex_model(linemodel, **kwargs)
+    assert isinstance(model, radex_modelgrid.radex_model)
+    assert radex_modelgrid.cached_radex_model(linemodel, **kwargs) is model
+    # the same grid objects in an equal container
+    assert radex_modelgrid.cached_radex_model(linemodel,
+                                              **dict(kwargs)) is model
+    # a different fixed index, model function or grid is a new model
+    other = radex_modelgrid.cached_radex_model(linemodel,
+                                               **dict(kwargs,
+                                                      fixed_gridindices={'temperature':2}))
+    assert other is not model
+    assert other.fixed_gridindices == {'temperature':2}
+    def othermodel(xarr, **kwargs):
+        return linemodel(xarr, **kwargs)
+    assert radex_modelgrid.cached_radex_model(othermodel, **kwargs) is not model
+    newtau, newtex, header = make_grids()
+    assert radex_modelgrid.cached_radex_model(linemodel,
+                                              **dict(kwargs, taugrid=newtau,
+                                                     texgrid=newtex)) is not model
+    assert len(radex_modelgrid._cached_models) == 4
+    assert radex_modelgrid.cached_radex_model(linemodel, **kwargs) is model
+
+def test_cached_radex_model_maxcache(monkeypatch):
+    monkeypatch.setattr(radex_modelgrid, '_cached_models', [])
+    taugrid, texgrid, header = make_grids()
+    models = [radex_modelgrid.cached_radex_model(linemodel, maxcache=3,
+                                                 texgrid=texgrid,
+                                                 taugrid=taugrid, hdr=header,
+                                                 gridaxes=('density', 'column',
+                                                           'temperature'),
+                                                 fixed_gridindices={'temperature':ii})
+              for ii in range(3)]
+    models.append(radex_modelgrid.cached_radex_model(linemodel, maxcache=3,
+                                                     texgrid=texgrid,
+                                                     taugrid=taugrid,
+                                                     hdr=header,
+                                                     gridaxes=('density',
+                                                               'column',
+                                                               'temperature'),
+                                                     fixed_gridindices={'temperature':1},
+                                                     Tbackground=[3, 3]))
+    assert len(radex_modelgrid._cached_models) == 3
+    # the oldest model was dropped, the others are still cached
+    cached = [grid for func, kwargs, grid in radex_modelgrid._cached_models]
+    assert models[0] not in cached
+    assert models[1:] == cached
+
+def test_cached_radex_model_paths(tmpdir, monkeypatch):
+    monkeypatch.setattr(radex_modelgrid, '_cached_models', [])
+    taugrid, texgrid, header = make_grids(nlines=1)
+    taupath = str(tmpdir.join('tau.fits'))
+    texpath = str(tmpdir.join('tex.fits'))
+    fits.writeto(taupath, taugrid[0][2], header)
+    fits.writeto(texpath, texgrid[0][2], header)
+    kwargs = dict(gridaxes=('density', 'column', 'temperature'),
+                  fixed_gridindices={'temperature':1})
+    model = radex_modelgrid.cached_radex_model(linemodel,
+                                               path_to_taugrid=taupath,
+                                               path_to_texgrid=texpath,
+                                               **kwargs)
+    # equal paths, not only the same string objects
+    again = radex_modelgrid.cached_radex_model(linemodel,
+                                               path_to_taugrid=str(tmpdir) + '/tau.fits',
+                                               path_to_texgrid=str(tmpdir) + '/tex.fits',
+                                               **kwargs)
+    assert again is model
+    np.testing.assert_allclose(model.lookup(3.3, 12.7)[0],
+                               make_model().lookup(3.3, 12.7)[0][:1],
+                               rtol=1e-6)
+
+def twolinemodel(xarr, Tex=10, tau=1, xoff_v=0, width=1, Tbackground=2.73):
+    """ `linemodel`, with a second line at 14.5 GHz """
+    x = np.asarray(xarr)
+    restfreq = np.where(x < 1e10, 4.9e9, 14.5e9)
+    velocity = (restfreq-x)/restfreq*3e5
+    return ((Tex-Tbackground)*(1-np.exp(-tau)) *
+            np.exp(-(velocity-xoff_v)**2/(2*width**2)))
+
+def test_fit_spectrum():
+    # grids on the axes of make_grids in which tau follows the column and
+    # Tex the density, with an optically thin and an optically thick line,
+    # so that the two lines determine both parameters
+    header = make_grids()[2]
+    column, density = np.meshgrid(12 + 0.5*np.arange(5), 2 + 0.5*np.arange(6),
+                                  indexing='ij')
+    taugrid = [(4.8, 5.0, np.resize(0.1*(column-11), (3, 5, 6))),
+               (14.4, 14.6, np.resize(3*(column-11), (3, 5, 6)))]
+    texgrid = [(4.8, 5.0, np.resize(4*density, (3, 5, 6))),
+               (14.4, 14.6, np.resize(2*density+5, (3, 5, 6)))]
+    model = radex_modelgrid.radex_model(twolinemodel, texgrid=texgrid,
+                                        taugrid=taugrid, hdr=header,
+                                        gridaxes=('density', 'column',
+                                                  'temperature'),
+                                        fixed_gridindices={'temperature':1})
+    xarr = SpectroscopicAxis(np.concatenate([np.linspace(4.8995e9, 4.9005e9,
+                                                         100),
+                                             np.linspace(14.4985e9,
+                                                         14.5015e9, 100)]),
+                             unit='Hz')
+    pars = [3.3, 12.7, 1.5, 4.]
+    rng = np.random.RandomState(11)
+    data = model(xarr, *pars) + rng.normal(0, 0.05, 200)
+    sp = pyspeckit.Spectrum(data=data, xarr=xarr, error=np.ones(200)*0.05,
+                            header=fits.Header())
+    sp.specfit.Registry.add_fitter('radex', model.fitter, model.npars)
+    # guessed in other cells of the grid
+    sp.specfit(fittype='radex', guesses=[2.6, 13.4, 0., 3.])
+    assert sp.specfit.parinfo.names[:2] == ['DENSITY0', 'COLUMN0']
+    values = np.array(sp.specfit.parinfo.values)
+    errors = np.array(sp.specfit.parinfo.errors)
+    assert np.all(np.abs(values - pars) < 4*errors)
+    np.testing.assert_allclose(values[:2], pars[:2], atol=0.02)
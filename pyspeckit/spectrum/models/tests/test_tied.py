@@ -0,0 +1,30 @@
+"""
+Tied parameter expressions in mpfit
+"""
+
+import numpy  # used by the exec-ed expressions
+import numpy as np
+from pyspeckit.mpfit.mpfit import mpfit, affine_tie
+
+
+def test_affine_tie():
+    assert affine_tie('p[3]') == ({3: 1.}, 0.)
+    assert affine_tie('2*p[1] + 0.5') == ({1: 2.}, 0.5)
+    assert affine_tie('(p[0]+p[3])/2.') == ({0: 0.5, 3: 0.5}, 0.)
+    assert affine_tie('p[1]**2') is None
+    assert affine_tie('numpy.sqrt(p[1])') is None
+    # integer division is left to python
+    assert affine_tie('(1/2)*p[1]') is None
+
+
+def test_tie_matches_exec():
+    mp = mpfit(None)
+    for ptied in (['', '2*p[0]+1', '', 'p[2]/3.', '', ''],
+                  ['', '2*p[0]+1', '', 'p[1]/3.', '', 'p[0]**2'],
+                  ['', '', 'numpy.sqrt(p[4])', '', '', '(1/2)*p[1]']):
+        expected = np.arange(6.) + 1
+        for i in range(len(ptied)):
+            if ptied[i] != '':
+                exec('expected[%i] = ' % i + ptied[i].replace('p[', 'expected['))
+        result = mp.tie(np.arange(6.) + 1, ptied)
+        np.testing.assert_allclose(result, expected)
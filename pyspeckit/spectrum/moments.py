@@ -107,3 +107,111 @@ def moments(Xax, data, vheight=True, estimator=np.mean, negamp=None,
     if vheight:
         mylist = [height] + mylist
     return mylist
+
+def moments_array(Xax, data, vheight=True, estimator=np.mean, negamp=None,
+                  nsigcut=None, noise_estimate=None, **kwargs):
+    """
+    The same as `moments`, but for many spectra at once: the moments are
+    computed as reductions along the first (spectral) axis of ``data``.
+
+    Non-finite values are ignored, as masked values are in `moments`.
+    Spectra that are constant or entirely non-finite get moments of 0.
+
+    Parameters
+    ----------
+    Xax : np.ndarray
+        The spectral axis, of length ``data.shape[0]``
+    data : np.ndarray
+        ``(nchan, ...)`` array of spectra
+    estimator : function
+        As in `moments`, but it must accept an ``axis`` keyword and a masked
+        array (e.g., ``np.mean`` or ``np.ma.median``)
+    noise_estimate : float, np.ndarray or None
+        Guess for the noise value, either one value for all of the spectra or
+        an array of shape ``data.shape[1:]``.  Only matters if `nsigcut` is
+        specified.
+
+    Other parameters are as in `moments`.
+
+    Returns
+    -------
+    An array of shape ``(3+vheight,) + data.shape[1:]`` holding
+    (height, amplitude, x, width_x) for each spectrum
+    """
+    Xax = np.asarray(Xax, dtype='float64')
+    # masked values are ignored like non-finite ones
+    data = np.ma.filled(np.ma.asarray(data).astype('float64'), np.nan)
+    # infinite values are ignored too (NaN fails every comparison below)
+    data[np.isinf(data)] = np.nan
+    shape = data.shape[1:]
+    data = data.reshape(data.shape[0], -1)
+    X = Xax[:,None]
+
+    valid = np.isfinite(data)
+    nvalid = valid.sum(axis=0)
+    filled = np.where(valid, data, 0)
+    datamin = np.where(valid, data, np.inf).min(axis=0)
+    datamax = np.where(valid, data, -np.inf).max(axis=0)
+
+    dx = np.abs(np.mean(np.diff(Xax))) # assume a regular grid
+    integral = filled.sum(axis=0)*dx
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if estimator in (np.mean, np.ma.mean):
+            height = filled.sum(axis=0) / nvalid
+        else:
+            height = np.ma.filled(estimator(np.ma.masked_array(data,
+                                                               mask=~valid),
+                                            axis=0), np.nan)
+            height = np.asarray(height, dtype='float64')
+
+        if noise_estimate is None:
+            mean = filled.sum(axis=0) / nvalid
+            noise_estimate = np.sqrt((np.where(valid, data-mean, 0)**2).sum(axis=0) /
+                                     nvalid)
+        height_cut_low = height-nsigcut*noise_estimate if nsigcut is not None else height
+        height_cut_high = height+nsigcut*noise_estimate if nsigcut is not None else height
+
+        # comparisons with non-finite (ignored) data are all False
+        data_gt_low = data > height_cut_low
+        data_lt_low = data < height_cut_low
+        Lpeakintegral = (integral - height_cut_low*data_lt_low.sum(axis=0)*dx -
+                         np.where(data_gt_low, data, 0).sum(axis=0)*dx)
+        Lamplitude = datamin-height
+        Lwidth_x = Lpeakintegral / Lamplitude / np.sqrt(2*np.pi)
+
+        data_gt_high = data > height_cut_high
+        data_lt_high = data < height_cut_high
+        Hpeakintegral = (integral - height*data_gt_high.sum(axis=0)*dx -
+                         np.where(data_lt_high, data, 0).sum(axis=0)*dx)
+        Hamplitude = datamax-height
+        Hwidth_x = Hpeakintegral / Hamplitude / np.sqrt(2*np.pi)
+
+        def xstd(sel):
+            nsel = sel.sum(axis=0)
+            xmean = (X*sel).sum(axis=0) / nsel
+            return np.sqrt((sel*(X-xmean)**2).sum(axis=0) / nsel)
+
+        Lstddev = xstd(data < height)
+        Hstddev = xstd(data > height)
+
+    xmin = Xax[np.where(valid, data, np.inf).argmin(axis=0)]
+    xmax = Xax[np.where(valid, data, -np.inf).argmax(axis=0)]
+
+    if negamp:
+        positive = np.zeros(data.shape[1], dtype='bool')
+    elif negamp is None:
+        positive = Hstddev < Lstddev
+    else:
+        positive = np.ones(data.shape[1], dtype='bool')
+
+    result = [np.where(positive, Hamplitude, Lamplitude),
+              np.where(positive, xmax, xmin),
+              np.where(positive, Hwidth_x, Lwidth_x)]
+    if vheight:
+        result = [height] + result
+    result = np.array(result)
+
+    result[:, (nvalid == 0) | (datamin == datamax)] = 0
+
+    return result.reshape((result.shape[0],)+shape)
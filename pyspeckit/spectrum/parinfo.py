@@ -1,7 +1,49 @@
+import weakref
+import numpy as np
+
+# the attributes that a ParinfoList also stores as arrays, one element per
+# parameter (see `ParinfoList.column`)
+column_dtypes = {'value':'float64', 'error':'float64', 'limits':'float64',
+                 'limited':'bool', 'fixed':'bool', 'tied':'object'}
+
+# the ParinfoLists whose columns were built from each Parinfo, by id(Parinfo):
+# {id: (weakref to the Parinfo, [weakrefs to the lists])}.  A Parinfo's
+# attributes are its dict items, so the lists can't be kept on the Parinfo
+# itself.  The entry is dropped when the Parinfo is deleted.
+_column_owners = {}
+
+def _add_column_owner(parinfo, parinfolist):
+    """ Record that ``parinfolist`` has built its columns from ``parinfo`` """
+    key = id(parinfo)
+    if key not in _column_owners:
+        ref = weakref.ref(parinfo, lambda ref, key=key: _column_owners.pop(key, None))
+        _column_owners[key] = (ref, [])
+    owners = _column_owners[key][1]
+    owners[:] = [owner for owner in owners
+                 if owner() is not None and owner() is not parinfolist]
+    owners.append(weakref.ref(parinfolist))
+
+def _drop_columns(parinfo, keep=None):
+    """
+    Make the ParinfoLists built from ``parinfo`` (except ``keep``) rebuild
+    their columns
+    """
+    if id(parinfo) not in _column_owners:
+        return
+    for owner in _column_owners[id(parinfo)][1]:
+        parinfolist = owner()
+        if parinfolist is not None and parinfolist is not keep:
+            parinfolist._columns = None
+
 class ParinfoList(list):
     """
     Store a list of model parameter values and their associated metadata (name,
     error, order, limits, etc.) in a class-friendly manner
+
+    The values, errors, limits, limited, fixed and tied attributes of the
+    parameters are also kept as arrays (see `column`), so reading or setting
+    them all at once (e.g., `values`, `set_values`) does not go through the
+    individual `Parinfo` dicts.
     """
     def __init__(self, *args, **kwargs):
         """
@@ -50,6 +92,168 @@ class ParinfoList(list):
             return [v[attributename] for v in self]
         return getattribute
 
+    def _column_getter(attributename):
+        def getattribute(self):
+            column = self._get_columns()[attributename]
+            if column.ndim == 2:
+                return [tuple(v) for v in column.tolist()]
+            return column.tolist()
+        return getattribute
+
+    def _get_columns(self):
+        """
+        The columns of the parameter attributes, rebuilt from the `Parinfo`
+        dicts if the list or one of its `Parinfo` has been changed since they
+        were last built
+        """
+        columns = self.__dict__.get('_columns')
+        if columns is None or len(columns['value']) != len(self):
+            columns = {}
+            for key, dtype in column_dtypes.iteritems():
+                items = [np.nan if v[key] is None else v[key] for v in self]
+                if key in ('limits', 'limited'):
+                    items = [[np.nan if x is None else x for x in v]
+                             for v in items]
+                try:
+                    columns[key] = np.array(items, dtype=dtype)
+                except (TypeError, ValueError):
+                    columns[key] = np.array(items, dtype='object')
+                if key in ('limits', 'limited') and len(self) == 0:
+                    columns[key] = columns[key].reshape(0, 2)
+            for parinf in self:
+                _add_column_owner(parinf, self)
+            self._columns = columns
+        return columns
+
+    def __getstate__(self):
+        # copies are made of new Parinfos, so they rebuild their columns
+        state = self.__dict__.copy()
+        state.pop('_columns', None)
+        return state
+
+    def column(self, attributename):
+        """
+        A read-only array of one attribute of all of the parameters
+
+        Parameters
+        ----------
+        attributename : 'value', 'error', 'limits', 'limited', 'fixed' or 'tied'
+            The attribute.  The limits and limited arrays have shape
+            ``(npars, 2)``.
+
+        The array is a view of the list's own storage: it follows `set_values`,
+        but not changes made to the list or to the individual parameters
+        afterwards, so get a new one after those.
+        """
+        view = self._get_columns()[attributename].view()
+        view.flags.writeable = False
+        return view
+
+    def limit_violations(self, values):
+        """
+        Find the parameter values that are outside their limits
+
+        Parameters
+        ----------
+        values : np.ndarray
+            An array of parameter values whose last axis runs over the
+            parameters, e.g. ``(nwalkers, npars)``
+
+        Returns
+        -------
+        low, high : np.ndarray
+            Boolean arrays of the same shape as ``values``: True where the
+            value is below its lower or above its upper limit
+        """
+        columns = self._get_columns()
+        values = np.asarray(values)
+        limits, limited = columns['limits'], columns['limited']
+        with np.errstate(invalid='ignore'):
+            low = limited[:,0] & (values < limits[:,0])
+            high = limited[:,1] & (values > limits[:,1])
+        return low, high
+
+    def in_limits(self, values):
+        """
+        Are all of the parameter values within their limits?  ``values`` is
+        as in `limit_violations`; returns a boolean array of shape
+        ``values.shape[:-1]``
+        """
+        low, high = self.limit_violations(values)
+        return ~np.any(low | high, axis=-1)
+
+    def set_values(self, values, errors=None, check=True):
+        """
+        Set the values (and, optionally, the errors) of all of the parameters
+        at once
+
+        Parameters
+        ----------
+        values : sequence
+            One value per parameter
+        errors : sequence or None
+            One error per parameter
+        check : bool
+            Raise a ValueError if any value is outside its limits (as setting
+            a single `Parinfo` value does).  The check is done before any
+            value is changed.
+        """
+        columns = self._get_columns()
+        values = np.asarray(values, dtype='float64').ravel()
+        if len(values) != len(self):
+            raise ValueError("Must have len(new values) = %i (was %i)" % (len(self),len(values)))
+        if check:
+            low, high = self.limit_violations(values)
+            if np.any(low):
+                ii = np.flatnonzero(low)[0]
+                raise ValueError('Set parameter value %r < limit value %r' %
+                                 (values[ii].item(), columns['limits'][ii,0].item()))
+            if np.any(high):
+                ii = np.flatnonzero(high)[0]
+                raise ValueError('Set parameter value %r > limit value %r' %
+                                 (values[ii].item(), columns['limits'][ii,1].item()))
+        self._set_column('value', values)
+        if errors is not None:
+            self._set_column('error', errors)
+
+    def _set_column(self, attributename, values):
+        """
+        Write an (already checked) column and copy it into the `Parinfo`
+        dicts, bypassing their per-item checks
+        """
+        column = self._get_columns()[attributename]
+        values = np.asarray(values, dtype=column.dtype).ravel()
+        if len(values) != len(self):
+            raise ValueError("Must have len(new values) = %i (was %i)" % (len(self),len(values)))
+        column[:] = values
+        for parinf, newval in zip(self, values.tolist()):
+            dict.__setitem__(parinf, attributename, newval)
+            # other lists holding the same Parinfo
+            _drop_columns(parinf, keep=self)
+
+    def _set_errors(self, errors):
+        self._set_column('error', errors)
+
+    def _invalidating(method):
+        """ Wrap a list method that changes the list so it drops the columns """
+        def wrapper(self, *args, **kwargs):
+            self._columns = None
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    extend = _invalidating(list.extend)
+    insert = _invalidating(list.insert)
+    pop = _invalidating(list.pop)
+    remove = _invalidating(list.remove)
+    reverse = _invalidating(list.reverse)
+    sort = _invalidating(list.sort)
+    __delitem__ = _invalidating(list.__delitem__)
+    __iadd__ = _invalidating(list.__iadd__)
+    __setslice__ = _invalidating(list.__setslice__)
+    __delslice__ = _invalidating(list.__delslice__)
+
     def _setter(attributename):
         def setattribute(self, values):
             if len(values) == len(self):
@@ -76,14 +280,14 @@ class ParinfoList(list):
     parnames=names
     shortnames = property(fget=_getter('shortparname'), fset=_setter('shortparname'))
     shortparnames=shortnames
-    values = property(fget=_getter('value'), fset=_setter('value'))
-    errors = property(fget=_getter('error'), fset=_setter('error'))
+    values = property(fget=_column_getter('value'), fset=set_values)
+    errors = property(fget=_column_getter('error'), fset=_set_errors)
     n = property(fget=_getter('n'), fset=_setter('n'))
     order=n
-    fixed = property(fget=_getter('fixed'), fset=_setter('fixed'))
-    limits = property(fget=_getter('limits'), fset=_setter('limits'))
-    limited = property(fget=_getter('limited'), fset=_setter('limited'))
-    tied = property(fget=_getter('tied'), fset=_setter('tied'))
+    fixed = property(fget=_column_getter('fixed'), fset=_setter('fixed'))
+    limits = property(fget=_column_getter('limits'), fset=_setter('limits'))
+    limited = property(fget=_column_getter('limited'), fset=_setter('limited'))
+    tied = property(fget=_column_getter('tied'), fset=_setter('tied'))
 
     def __getitem__(self, key):
         if type(key) is int:
@@ -98,7 +302,7 @@ class ParinfoList(list):
         """
         # if key already exists, use its setter
         if key in self._dict or (type(key) is int and key < len(self)):
-            self[key] = val
+            self[key].value = val
         elif type(key) is int:
             # can't set a new list element this way
             raise IndexError("Index %i out of range" % key)
@@ -140,6 +344,7 @@ class ParinfoList(list):
             # indexed from 0, so len(self) = max(self.n)+1
             value.n = len(self) 
         super(ParinfoList, self).append(value)
+        self._columns = None
         self._check_names()
         self._set_attributes()
 
@@ -348,11 +553,15 @@ class Parinfo(dict):
     def __setattr__(self, key, value):
         # DEBUG print "Setting attribute %s = %s" % (key,value)
         self._check_OK(key,value)
+        if key in column_dtypes:
+            _drop_columns(self)
         return super(Parinfo, self).__setattr__(key, value)
 
     def __setitem__(self, key, value):
         # DEBUG print "Setting item %s = %s" % (key,value)
         self._check_OK(key,value)
+        if key in column_dtypes:
+            _drop_columns(self)
         return super(Parinfo, self).__setitem__(key, value)
 
     def _check_OK(self,key,value):
@@ -13,6 +13,9 @@ except ImportError:
     import pyfits
 import pyspeckit
 import numpy as np
+import astropy.units as u
+from .. import units
+from ..interpolation import _interp
 try:
     import coords
 except ImportError:
@@ -75,7 +78,14 @@ def read_gbt_scan(sdfitsfile, obsnumber=0):
 
     bintable = _get_bintable(sdfitsfile)
 
-    data = bintable.data[obsnumber]['DATA']
+    return _row_to_spectrum(bintable, obsnumber,
+                            bintable.data[obsnumber]['DATA'])
+
+def _row_to_spectrum(bintable, obsnumber, data):
+    """
+    Make a Spectrum with the header and frequency axis of row ``obsnumber`` of
+    the bintable and the given ``data``
+    """
 
     header = pyfits.Header()
 
@@ -87,64 +97,129 @@ def read_gbt_scan(sdfitsfile, obsnumber=0):
                 header[par[:8]] = str(bintable.data[obsnumber][par])
     header['CUNIT1'] = 'Hz'
 
+    # HACK - temporary!
+    # Convert xarr to LSR units by shifting the reference value of the axis
+    #sp.xarr.frame = 'topo' # sp.header.get('VELDEF') #'topo'
+    header['CRVAL1'] = header['CRVAL1'] - _frame_offset(header['OBSFREQ'],
+                                                        header['VFRAME'],
+                                                        header.get('VELDEF'))
+
     HDU = pyfits.PrimaryHDU(data=data,header=header)
 
     sp = pyspeckit.Spectrum(HDU,filetype='pyfits')
-    #sp.xarr.frame = 'topo' # sp.header.get('VELDEF') #'topo'
-
-    # HACK - temporary!
-    # Convert xarr to LSR units
-    #sp.xarr.convert_to_unit('m/s')
-    obsfreq = header['OBSFREQ']
-    centerfreq = pyspeckit.spectrum.units.SpectroscopicAxis(np.float(obsfreq),'Hz',refX=obsfreq,refX_unit='Hz')
-    delta_freq = (centerfreq.as_unit('m/s') + header['VFRAME']).as_unit(centerfreq.units) - centerfreq
-    sp.xarr -= delta_freq
 
     return sp
 
-def read_gbt_target(sdfitsfile, objectname, verbose=False):
+def _frame_offset(obsfreq, vframe, veldef=None):
     """
-    Give an object name, get all observations of that object as an 'obsblock'
+    The frequency offset (Hz) of the frame velocity ``vframe`` (m/s) from
+    ``obsfreq`` (Hz), using the velocity convention of ``veldef`` (radio if
+    it is not given)
+    """
+    if veldef:
+        convention = units.parse_veldef(veldef)[0]
+    else:
+        convention = 'radio'
+    equivalency = units.velocity_conventions[convention](u.Quantity(obsfreq, u.Hz))
+    frequency = u.Quantity(vframe, u.m/u.s).to(u.Hz, equivalencies=equivalency)
+    return frequency.value - obsfreq
+
+def _row_axes(bintable, rows):
     """
+    The frequency axes of the given rows as an (nrows, nchan) array, computed
+    as `read_gbt_scan` computes the axis of a single row
+    """
+    data = bintable.data
+    nchan = len(data['DATA'][rows[0]])
+    crval = np.array([data['CRVAL1'][row] -
+                      _frame_offset(data['OBSFREQ'][row], data['VFRAME'][row],
+                                    data['VELDEF'][row] if 'VELDEF' in data.names
+                                    else None)
+                      for row in rows])
+    crpix = np.asarray(data['CRPIX1'][rows], dtype='float64')
+    cdelt = np.asarray(data['CDELT1'][rows], dtype='float64')
+    return ((np.arange(nchan) - crpix[:,None] + 1) * cdelt[:,None] +
+            crval[:,None])
 
-    bintable = _get_bintable(sdfitsfile)
+def _arithmetic_threshold(xarr):
+    """
+    The X-axis tolerance of arithmetic between the spectra of a target: a
+    fifth of the smallest channel width
+    """
+    return np.abs(np.diff(xarr)).min() / 5.
+
+def _check_axes(xarr1, xarr2):
+    """
+    Raise a ValueError if two frequency axes differ by more than the
+    `_arithmetic_threshold` of the first, as Spectrum arithmetic does
+    """
+    if np.shape(xarr1) != np.shape(xarr2):
+        raise ValueError("Shape mismatch in data")
+    if not np.all(np.abs(np.asarray(xarr1) - np.asarray(xarr2)) <
+                  _arithmetic_threshold(xarr1)):
+        raise ValueError("X-axes do not match.")
+
+def _target_rows(bintable, objectname, verbose=False):
+    """
+    Group the rows of an object by sampler, nod and cal state using boolean
+    masks over the bintable columns
 
-    whobject = bintable.data['OBJECT'] == objectname
+    Returns a dict of row numbers with the keys ``sampler+onoff+str(nod)``
+    (e.g., ``'A10ON1'``) used by `read_gbt_target`.  Groups whose CRVAL1
+    values differ by more than the frequency resolution are skipped.
+    """
+    data = bintable.data
+    whobject = data['OBJECT'] == objectname
     if verbose:
         print "Number of individual scans for Object %s: %i" % (objectname,whobject.sum())
 
-    calON = bintable.data['CAL'] == 'T'
+    calON = data['CAL'] == 'T'
     # HACK: apparently bintable.data can sometimes treat itself as scalar...
     if np.isscalar(calON):
-        calON = np.array([(val in ['T',True]) for val in bintable.data['CAL']])
-
-    n_nods = np.unique(bintable.data['PROCSIZE'])
-
-    blocks = {}
-    for sampler in np.unique(bintable.data[whobject]['SAMPLER']):
-        whsampler = bintable.data['SAMPLER'] == sampler
-        nods = np.unique(bintable.data['PROCSEQN'][whsampler*whobject])
-        for nod in nods:
-            whnod = bintable.data['PROCSEQN'] == nod
+        calON = np.array([(val in ['T',True]) for val in data['CAL']])
+
+    samplers = data['SAMPLER']
+    procseqn = data['PROCSEQN']
+    crval1 = data['CRVAL1']
+    freqres = data['FREQRES']
+
+    groups = {}
+    for sampler in np.unique(samplers[whobject]):
+        whsampler = whobject & (samplers == sampler)
+        for nod in np.unique(procseqn[whsampler]):
+            whnod = whsampler & (procseqn == nod)
             for onoff in ('ON','OFF'):
-                calOK = (calON - (onoff=='OFF'))
-                whOK = (whobject*whsampler*calOK*whnod)
+                whOK = whnod & (calON if onoff == 'ON' else ~calON)
                 if whOK.sum() == 0:
                     continue
                 if verbose:
                     print "Number of spectra for sampler %s, nod %i, cal%s: %i" % (sampler,nod,onoff,whOK.sum())
-                crvals = bintable.data[whOK]['CRVAL1']
+                crvals = crval1[whOK]
                 if len(crvals) > 1:
                     maxdiff = np.diff(crvals).max()
                 else:
                     maxdiff = 0
-                freqres = np.max(bintable.data[whOK]['FREQRES'])
-                if maxdiff < freqres:
-                    splist = [read_gbt_scan(bintable,ii) for ii in np.where(whOK)[0]]
-                    blocks[sampler+onoff+str(nod)] = pyspeckit.ObsBlock(splist,force=True)
-                    blocks[sampler+onoff+str(nod)]._arithmetic_threshold = np.diff(blocks[sampler+onoff+str(nod)].xarr).min() / 5.
+                maxres = np.max(freqres[whOK])
+                if maxdiff < maxres:
+                    groups[sampler+onoff+str(nod)] = np.flatnonzero(whOK)
                 else:
-                    print "Maximum frequency difference > frequency resolution: %f > %f" % (maxdiff, freqres)
+                    print "Maximum frequency difference > frequency resolution: %f > %f" % (maxdiff, maxres)
+
+    return groups
+
+def read_gbt_target(sdfitsfile, objectname, verbose=False):
+    """
+    Give an object name, get all observations of that object as an 'obsblock'
+    """
+
+    bintable = _get_bintable(sdfitsfile)
+
+    blocks = {}
+    for name, rows in _target_rows(bintable, objectname,
+                                   verbose=verbose).items():
+        splist = [read_gbt_scan(bintable,ii) for ii in rows]
+        blocks[name] = pyspeckit.ObsBlock(splist,force=True)
+        blocks[name]._arithmetic_threshold = _arithmetic_threshold(blocks[name].xarr)
 
     return blocks
 
@@ -255,6 +330,124 @@ def reduce_totalpower(blocks, verbose=False, average=True, fdid=1):
 
     return reduced_tps
 
+def reduce_gbt_target_arrays(sdfitsfile, objectname, obstype='nod',
+                             verbose=False, average=True, fdid=(1,2)):
+    """
+    Reduce the nodded or total power observations of an object directly from
+    the bintable ``DATA`` column, without making a Spectrum or ObsBlock for
+    each row.  Returns a dict of reduced Spectra like `reduce_nod` /
+    `reduce_totalpower` applied to `read_gbt_target`.
+
+    The rows of each sampler, nod and cal state (see `_target_rows`) are
+    reduced as ``(nint, nchan)`` arrays.  As in `read_gbt_target`, rows whose
+    frequency axis differs from that of the first row of their group are
+    interpolated onto it, and the calibration uses the Tsys of the averaged
+    integrations.  Each reduced Spectrum has the header and frequency axis of
+    the first row of its signal group, with ``EXPOSURE`` summed over the
+    integrations of that group and ``TSYS`` set to the Tsys used to
+    calibrate it.
+
+    Parameters
+    ----------
+    obstype : 'nod' or 'tp'
+        Nodded or total power observations
+    average : bool
+        Average the integrations of each group before calibrating them (as
+        `reduce_nod` does).  Otherwise, each integration is calibrated and
+        paired with the same integration of the other nod, and the finite
+        values of the calibrated integrations are averaged into the returned
+        Spectrum (`reduce_nod` returns the ``(nchan, nint)`` array of
+        calibrated integrations instead).
+    fdid : 2-tuple
+        The feed numbers of the two nod positions
+    """
+    if obstype not in ('nod', 'tp'):
+        raise NotImplementedError('Obstype {0} not implemented.'.format(obstype))
+
+    bintable = _get_bintable(sdfitsfile)
+    groups = _target_rows(bintable, objectname, verbose=verbose)
+    alldata = bintable.data['DATA']
+    feeds = bintable.data['FEED']
+    tcals = bintable.data['TCAL']
+    exposures = bintable.data['EXPOSURE']
+
+    def block(name):
+        """ The (nint, nchan) data of a group on the axis of its first row """
+        rows = groups[name]
+        data = np.asarray(alldata[rows], dtype='float64')
+        axes = _row_axes(bintable, rows)
+        for ii in np.flatnonzero(np.any(axes != axes[0], axis=1)):
+            data[ii] = _interp(axes[0], axes[ii], data[ii], left=0, right=0)
+        return data, axes[0]
+
+    def calibrate(sampname, nod):
+        """ The total power, Tsys and frequency axis of one nod """
+        on, xarr = block(sampname+"ON"+nod)
+        off, offxarr = block(sampname+"OFF"+nod)
+        _check_axes(xarr, offxarr)
+        onavg, offavg = _nanmean_rows(on), _nanmean_rows(off)
+        tsys = dcmeantsys(onavg, offavg, tcals[groups[sampname+"ON"+nod][0]])
+        if average:
+            tp = totalpower(onavg, offavg, average=False)
+        elif on.shape != off.shape:
+            raise ValueError("Cal states of %s have different numbers of "
+                             "integrations: %i and %i" % (sampname+nod,
+                                                          len(on), len(off)))
+        else:
+            tp = totalpower(on, off, average=False)
+        return tp, tsys, xarr
+
+    ids = uniq([s[:-1].replace("ON","").replace("OFF","") for s in groups])
+
+    reduced = {}
+    for sampname in ids:
+        feednumber = feeds[groups[sampname+"ON1"][0]]
+
+        tp1, tsys1, xarr1 = calibrate(sampname, "1")
+
+        if obstype == 'tp':
+            if verbose:
+                print "TP: %s (feed %i) has tsys1=%f" % (sampname, feednumber, tsys1)
+            result, tsys, signal = tp1, tsys1, "ON1"
+        else:
+            tp2, tsys2, xarr2 = calibrate(sampname, "2")
+            if tp1.shape != tp2.shape:
+                raise ValueError("Nods of %s have different numbers of "
+                                 "integrations: %i and %i" % (sampname,
+                                                              len(tp1), len(tp2)))
+            if verbose:
+                print "Nod Pair %s (feed %i) has tsys1=%f tsys2=%f" % (sampname, feednumber, tsys1, tsys2)
+
+            # then do the signal-reference bit
+            if feednumber == fdid[0]:
+                _check_axes(xarr1, xarr2)
+                result, tsys, signal = sigref(tp1, tp2, tsys2), tsys2, "ON1"
+            elif feednumber == fdid[1]:
+                _check_axes(xarr2, xarr1)
+                result, tsys, signal = sigref(tp2, tp1, tsys1), tsys1, "ON2"
+            else:
+                raise ValueError("Feed number %i is not understood.  Try specifying fd0, fd1 keywords if this is a genuine nodded observation." % feednumber)
+
+        if not average:
+            result = _nanmean_rows(result)
+        rows = groups[sampname+signal]
+        sp = _row_to_spectrum(bintable, rows[0], result)
+        if sp.header.get('EXPOSURE'):
+            sp.header['EXPOSURE'] = np.sum(exposures[rows])
+        sp.header['TSYS'] = tsys
+        sp._arithmetic_threshold = _arithmetic_threshold(sp.xarr)
+        reduced[sampname] = sp
+
+    return reduced
+
+def _nanmean_rows(data):
+    """
+    Average the rows of a (nint, nchan) array, ignoring non-finite values, as
+    `pyspeckit.ObsBlock.average` does
+    """
+    finite = np.isfinite(data)
+    return np.where(finite, data, 0).sum(axis=0) / finite.sum(axis=0)
+
 def _get_bintable(sdfitsfile):
     """
     Private function: given a filename, HDUlist, or bintable, return a bintable
@@ -275,23 +468,37 @@ def dcmeantsys(calon,caloff,tcal,debug=False):
     """
     from GBTIDL's dcmeantsys.py
     ;  mean_tsys = tcal * mean(nocal) / (mean(withcal-nocal)) + tcal/2.0
+
+    ``calon`` and ``caloff`` may be Spectra or arrays.  For ``(nint, nchan)``
+    arrays, one Tsys is returned per integration.
     """
 
     # Use the inner 80% of data to calculate mean Tsys
+    if not hasattr(calon, 'slice'):
+        calon = np.asarray(calon)
+        caloff = np.asarray(caloff)
+        nchans = calon.shape[-1]
+        pct10 = nchans//10
+        pct90 = nchans - pct10
+        meanoff = np.mean(caloff[...,pct10:pct90], axis=-1)
+        meandiff = np.mean(calon[...,pct10:pct90] - caloff[...,pct10:pct90],
+                           axis=-1)
+        return meanoff / meandiff * tcal + tcal/2.0
+
     nchans = calon.data.shape[0]
     pct10 = nchans/10
     pct90 = nchans - pct10
 
-    meanoff = np.mean(caloff.slice(pct10,pct90,units='pixels').data)
-    meandiff = np.mean(calon.slice(pct10,pct90,units='pixels').data - 
-                        caloff.slice(pct10,pct90,units='pixels').data)
+    meanoff = np.mean(caloff.slice(pct10,pct90,unit='pixels').data)
+    meandiff = np.mean(calon.slice(pct10,pct90,unit='pixels').data - 
+                        caloff.slice(pct10,pct90,unit='pixels').data)
 
     meanTsys = ( meanoff / meandiff * tcal + tcal/2.0 )
     if debug:
         print caloff
-        print caloff.slice(pct10,pct90,units='pixels')
+        print caloff.slice(pct10,pct90,unit='pixels')
         print calon
-        print calon.slice(pct10,pct90,units='pixels')
+        print calon.slice(pct10,pct90,unit='pixels')
         print "pct10: %i  pct90: %i mean1: %f mean2: %f tcal: %f tsys: %f" % (pct10,pct90,meanoff,meandiff,tcal,meanTsys)
 
     return meanTsys
@@ -437,8 +644,7 @@ def average_pols(block):
                 raise ValueError("Too few/many matches: %s" % matched_samplers)
 
             if newname not in averaged_pol_dict:
-                average = (block[matched_samplers[0]] + block[matched_samplers[1]]) / 2.
-                averaged_pol_dict[newname] = average
+                averaged_pol_dict[newname] = _average_spectra([block[name] for name in matched_samplers])
 
     return averaged_pol_dict
 
@@ -452,13 +658,35 @@ def average_IF(block, debug=False):
 
     ifdict = find_matched_freqs(block, debug=debug)
 
-    import operator
     for ifnum,ifsamplers in ifdict.iteritems():
         if debug: print "if%i: freq %g" % (ifnum, block[ifsamplers[0]].header['OBSFREQ'])
-        averaged_dict["if%i" % ifnum] = reduce(operator.add,[block[name] for name in ifsamplers]) / len(ifsamplers)
+        averaged_dict["if%i" % ifnum] = _average_spectra([block[name] for name in ifsamplers])
 
     return averaged_dict
 
+def _average_spectra(spectra):
+    """
+    Average Spectra sharing a frequency axis with one array operation, rather
+    than a chain of Spectrum additions that copies a Spectrum at each step
+    """
+    first = spectra[0]
+    for sp in spectra[1:]:
+        # the checks of Spectrum addition
+        if sp.data.shape != first.data.shape:
+            raise ValueError("Shape mismatch in data")
+        if first._arithmetic_threshold == 'exact':
+            xarrcheck = np.all(first.xarr == sp.xarr)
+        else:
+            xunit = first._arithmetic_threshold_units
+            xarrcheck = np.all(np.abs(first.xarr.as_unit(xunit) -
+                                      sp.xarr.as_unit(xunit)) <
+                               first._arithmetic_threshold)
+        if not xarrcheck:
+            raise ValueError("X-axes do not match.")
+    average = first.copy()
+    average.data = np.mean([sp.data for sp in spectra], axis=0)
+    return average
+
 
 polnum_to_pol = {
     1: 'I',
@@ -553,13 +781,21 @@ class GBTTarget(object):
     """
     A collection of ObsBlocks or Spectra
     """
-    def __init__(self, Session, target, **kwargs):
+    def __init__(self, Session, target, columnar=False, **kwargs):
         """
         Container for the individual scans of a target from a GBT session
+
+        If ``columnar`` is set, the individual scans are not read into
+        ObsBlocks; `reduce` then works on the bintable directly (see
+        `reduce_gbt_target_arrays`).
         """
         self.name = target
         self.Session = Session
-        self.blocks = read_gbt_target(Session.bintable, target, **kwargs)
+        self.columnar = columnar
+        if columnar:
+            self.blocks = {}
+        else:
+            self.blocks = read_gbt_target(Session.bintable, target, **kwargs)
         self.spectra = {}
 
     @property
@@ -585,7 +821,13 @@ class GBTTarget(object):
         """
         Reduce nodded observations (they should have been read in __init__)
         """
-        if obstype == 'nod':
+        if self.columnar:
+            self.reduced_scans = reduce_gbt_target_arrays(self.Session.bintable,
+                                                          self.name,
+                                                          obstype=obstype,
+                                                          fdid=self.beams,
+                                                          **kwargs)
+        elif obstype == 'nod':
             self.reduced_scans = reduce_nod(self.blocks, fdid=self.beams, **kwargs)
         elif obstype == 'tp':
             self.reduced_scans = reduce_totalpower(self.blocks, fdid=self.beams, **kwargs)
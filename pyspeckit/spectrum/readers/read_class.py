@@ -353,35 +353,172 @@ index.f90:
   else
 """
 
+# Entry index layouts (see the excerpts above), named after the v2 fields.
+# The v1 (non-clic) index is 32 words long; the v2 index is 'lind' words long,
+# of which the fields below occupy the first 26.
+index_fields_v1 = [('BLOC', 'int32'), ('NUM', 'int32'), ('VER', 'int32'),
+                   ('CSOUR', 'S12'), ('CLINE', 'S12'), ('CTELE', 'S12'),
+                   ('CDOBS', 'int32'), ('DRED', 'int32'), ('OFF1', 'float32'),
+                   ('OFF2', 'float32'), ('TYPE', 'int32'), ('KIND', 'int32'),
+                   ('QUAL', 'int32'), ('SCAN', 'int32'), ('POSA', 'float32'),
+                   ('SUBSCAN', 'int32')]
+index_fields_v2 = [('BLOC', 'int64'), ('WORD', 'int32'), ('NUM', 'int64'),
+                   ('VER', 'int32'), ('CSOUR', 'S12'), ('CLINE', 'S12'),
+                   ('CTELE', 'S12'), ('CDOBS', 'int32'), ('DRED', 'int32'),
+                   ('OFF1', 'float32'), ('OFF2', 'float32'), ('TYPE', 'int32'),
+                   ('KIND', 'int32'), ('QUAL', 'int32'), ('POSA', 'float32'),
+                   ('SCAN', 'int64'), ('SUBSCAN', 'int32')]
+
+# Columns derived from the index: the observation date in years, and the
+# position angle & OTF scan identification of ClassObject
+derived_index_fields = [('DOBS', 'float64'), ('COMPPOSA', 'float64'),
+                        ('SCANPOSA', 'float64'), ('OTFSCAN', 'int64'),
+                        ('FIRSTSCAN', 'int64')]
+
+# The other names _read_index gives to the index columns
+index_aliases = {'XBLOC': 'BLOC', 'XNUM': 'NUM', 'XVER': 'VER',
+                 'SOURC': 'CSOUR', 'XSOURC': 'CSOUR', 'LINE': 'CLINE',
+                 'XLINE': 'CLINE', 'XTEL': 'CTELE', 'XDOBS': 'CDOBS',
+                 'XDRED': 'DRED', 'XOFF1': 'OFF1', 'XOFF2': 'OFF2',
+                 'XTYPE': 'TYPE', 'XKIND': 'KIND', 'XQUAL': 'QUAL',
+                 'XSCAN': 'SCAN', 'XPOSA': 'POSA', 'XSUBSCAN': 'SUBSCAN'}
+
+class ClassIndex(object):
+    """
+    The entry indices of a CLASS file, stored column-wise in a record array
+    (``table``).
+
+    Indexing with a column name (or any of its `index_aliases`) returns the
+    column; indexing with an integer returns that entry's index as a dict
+    with the same keys as `_read_index`, built on demand.
+    ``SCANPOSA`` (NaN) and ``FIRSTSCAN`` (-1) are left out of the dict when
+    they are not set.
+    """
+    def __init__(self, table):
+        self.table = table
+        self._hash_indexes = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    def __repr__(self):
+        return "ClassIndex with {0} entries".format(len(self))
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.table[index_aliases.get(key, key)]
+        elif isinstance(key, slice):
+            return [self[ii] for ii in irange(*key.indices(len(self)))]
+        row = self.table[key]
+        index = dict((name, row[name]) for name in self.table.dtype.names)
+        if np.isnan(index['SCANPOSA']):
+            del index['SCANPOSA']
+        if index['FIRSTSCAN'] < 0:
+            del index['FIRSTSCAN']
+        for alias, name in index_aliases.items():
+            index[alias] = index[name]
+        return index
+
+    def __iter__(self):
+        for ii in irange(len(self)):
+            yield self[ii]
+
+    def hash_index(self, column):
+        """
+        A dict mapping each distinct value of ``column`` to the (sorted)
+        numbers of the entries with that value.  Built on first use.
+        """
+        name = index_aliases.get(column, column)
+        if name not in self._hash_indexes:
+            values, inverse = np.unique(self.table[name], return_inverse=True)
+            order = np.argsort(inverse, kind='mergesort')
+            splits = np.cumsum(np.bincount(inverse))[:-1]
+            self._hash_indexes[name] = dict(zip(values.tolist(),
+                                                np.split(order, splits)))
+        return self._hash_indexes[name]
+
+    def select(self, column, value=None, pattern=None, flags=0):
+        """
+        A boolean mask of the entries whose ``column`` equals ``value`` or
+        matches the regular expression ``pattern`` (`re.search`).  Each
+        distinct value is only compared once, using `hash_index`.
+        """
+        mask = np.zeros(len(self), dtype='bool')
+        groups = self.hash_index(column)
+        if pattern is None:
+            if value in groups:
+                mask[groups[value]] = True
+        else:
+            for key, entries in groups.items():
+                if re.search(pattern, key, flags):
+                    mask[entries] = True
+        return mask
+
 def _read_indices(f, file_description):
-    #if file_description['version'] in (1,2):
-    #    extension_positions = (file_description['aex']-1)*file_description['reclen']*4
-    #    all_indices = {extension:
-    #                   [_read_index(f,
-    #                                filetype=file_description['version'],
-    #                                entry=ii,
-    #                                #position=position,
-    #                               )
-    #                       for ii in range(file_description['lex1'])]
-    #                   for extension,position in enumerate(extension_positions)
-    #                   if position > 0
-    #                  }
-
-    #elif file_description['version'] == 1:
-    extension_positions = ((file_description['aex'].astype('int64')-1)
-                           *file_description['reclen']*4)
-    all_indices = [_read_index(f,
-                               filetype=file_description['version'],
-                               # 1-indexed files
-                               entry_number=ii+1,
-                               file_description=file_description,
-                              )
-                       for ii in range(file_description['xnext']-1)]
-    #else:
-    #    raise ValueError("Invalid file version {0}".format(file_description['version']))
-
-                
-    return all_indices
+    """
+    Read the indices of all entries in a CLASS file into a `ClassIndex`
+
+    The entry indices within each extension are contiguous, so each extension
+    is read with a single `numpy.fromfile` call rather than entry by entry
+    (`_read_index`).
+    """
+    version = file_description['version']
+    itemsize = file_description['lind']*4
+    if version in ('1A  ', 'v1', 1):
+        fields = index_fields_v1
+    elif version in ('2A  ', 'v2', 2):
+        fields = index_fields_v2
+    else:
+        raise NotImplementedError("Filetype {0} not implemented.".format(version))
+    dtype = np.dtype({'names': [x[0] for x in fields],
+                      'formats': [x[1] for x in fields],
+                      'itemsize': itemsize})
+
+    nentries = int(file_description['xnext']) - 1
+    lexn = np.asarray(file_description['lexn'], dtype='int64')
+    aex = np.asarray(file_description['aex'], dtype='int64')
+    blocks, positions = [], []
+    for kex, address in enumerate(aex):
+        first = lexn[kex]
+        if first >= nentries:
+            break
+        last = (min(lexn[kex+1], nentries) if kex+1 < len(lexn)
+                else nentries)
+        position = (address-1)*file_description['reclen']*4
+        f.seek(position)
+        block = np.fromfile(f, dtype=dtype, count=last-first)
+        if len(block) != last-first:
+            raise IOError("Index extension {0} is truncated.".format(kex+1))
+        blocks.append(block)
+        positions.append(position + np.arange(last-first)*itemsize)
+    raw = np.concatenate(blocks) if blocks else np.zeros(0, dtype=dtype)
+    positions = np.concatenate(positions) if positions else np.zeros(0, 'int64')
+
+    # Same validity checks as _read_index, done on the raw name bytes
+    for name in ('CSOUR', 'CLINE', 'CTELE'):
+        chars = raw[name].copy().view('uint8').reshape(len(raw), 12)
+        bad = (chars >= 128).any(axis=1)
+        if version not in ('1A  ', 'v1', 1):
+            bad |= (chars == 0).all(axis=1)
+        if bad.any():
+            raise ValueError("Invalid index read from {0}."
+                             .format(positions[np.argmax(bad)]))
+
+    names = [x[0] for x in fields]
+    table_fields = list(fields) + derived_index_fields
+    if 'WORD' not in names:
+        table_fields.append(('WORD', 'int32'))
+    table = np.zeros(len(raw), dtype=table_fields).view(np.recarray)
+    for name in names:
+        table[name] = raw[name]
+    if 'WORD' not in names:
+        table['WORD'] = 1
+    # from kernel/lib/gsys/date.f90: gag_julda
+    table['DOBS'] = (table['CDOBS'].astype('int64') + 365*2025)/365.2425 + 1
+    table['SCANPOSA'] = np.nan
+    table['FIRSTSCAN'] = -1
+
+    return ClassIndex(table)
 
 
 def _find_index(entry_number, file_description, return_position=False):
@@ -803,6 +940,127 @@ def _read_obshead_v1(f, position=None, verbose=False):
     #return obsnum,seccodes
     return obsnum,hdr,dict(zip(seccodes,secaddr))
 
+# The fixed part of the observation headers read by _read_obshead_v1/v2
+obshead_fields_v1 = [('CODE', 'S4'), ('NBLOCKS', 'int32'), ('NBYTEOB', 'int32'),
+                     ('DATAADDR', 'int32'), ('NHEADERS', 'int32'),
+                     ('DATALEN', 'int32'), ('OBINDEX', 'int32'),
+                     ('NSEC', 'int32'), ('OBSNUM', 'int32')]
+obshead_fields_v2 = [('CODE', 'S4'), ('VERSION', 'int32'), ('NSEC', 'int32'),
+                     ('NWORD', 'int64'), ('ADATA', 'int64'), ('LDATA', 'int64'),
+                     ('XNUM', 'int64')]
+
+def _section_dtype(section):
+    """ The (packed) layout of a header section, from `keys_lengths` """
+    return np.dtype([(x[0], x[2]) for x in keys_lengths[section]])
+
+def _gather(data, positions, dtype):
+    """
+    Read one item of ``dtype`` starting at each of the byte ``positions`` of
+    ``data``, a uint8 array (e.g., a memmap of the whole file)
+    """
+    dtype = np.dtype(dtype)
+    positions = np.asarray(positions, dtype='int64')
+    offsets = positions[..., None] + np.arange(dtype.itemsize)
+    return data[offsets].view(dtype).reshape(positions.shape)
+
+def _read_section_headers(data, file_description, index, entries=None,
+                          sections=('GENERAL', 'POSITION', 'SPECTRO', 'DRIFT'),
+                          chunksize=65536):
+    """
+    Read the observation headers of many entries at once, without reading
+    their spectra
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The whole file as a uint8 array (a memmap)
+    file_description : dict
+        From `_read_first_record`
+    index : ClassIndex
+        From `_read_indices`
+    entries : None or array of int
+        The entries to read (default: all)
+    sections : sequence of str
+        The header sections (names from `keys_lengths`) to read.  Where
+        sections share a field name, the first one listed is kept.
+
+    Returns
+    -------
+    table : np.recarray
+        One row per entry, with HDRSTART and DATASTART (as set by
+        `read_observation`), NSEC, and the fields of ``sections``.  The fields
+        of sections an entry does not have are NaN, 0 or ''.
+    """
+    if entries is None:
+        entries = np.arange(len(index))
+    entries = np.asarray(entries, dtype='int64')
+    if file_description['version'] == 1:
+        head_dtype = np.dtype(obshead_fields_v1)
+        word_dtype = np.dtype('int32')
+    else:
+        head_dtype = np.dtype(obshead_fields_v2)
+        word_dtype = np.dtype('int64')
+
+    fields = [('HDRSTART', 'int64'), ('DATASTART', 'int64'), ('NSEC', 'int32')]
+    owner = {}
+    for section in sections:
+        for name, _, fmt in keys_lengths[section]:
+            if name not in owner and name not in dict(fields):
+                owner[name] = section
+                fields.append((name, fmt))
+    table = np.zeros(len(entries), dtype=fields).view(np.recarray)
+    for name in owner:
+        if table.dtype[name].kind == 'f':
+            table[name] = np.nan
+
+    for start in irange(0, len(entries), chunksize):
+        rows = slice(start, start+chunksize)
+        ii = entries[rows]
+        position = ((index['BLOC'][ii].astype('int64')-1)
+                    *file_description['reclen']*4 +
+                    (index['WORD'][ii].astype('int64')-1)*4)
+        head = _gather(data, position, head_dtype)
+        bad = np.char.strip(head['CODE']) != '2'
+        if bad.any():
+            raise IndexError("Observation Header reading failure at {0}.  "
+                             "Record does not appear to be an observation "
+                             "header.".format(position[np.argmax(bad)]))
+
+        # The section numbers, lengths and addresses follow the fixed part
+        nsec = head['NSEC'].astype('int64')
+        secnum = np.arange(max(nsec.max(), 1))
+        valid = secnum < nsec[:,None]
+        codes_start = position + head_dtype.itemsize
+        codes = _gather(data, codes_start[:,None] + 4*secnum*valid, 'int32')
+        addr_start = codes_start + nsec*(4 + word_dtype.itemsize)
+        addresses = _gather(data, addr_start[:,None] +
+                            word_dtype.itemsize*secnum*valid, word_dtype)
+        sec_position = position[:,None] + (addresses.astype('int64')-1)*4
+
+        datastart = np.zeros(len(ii), dtype='int64')
+        for code, section in header_id_numbers.items():
+            here = valid & (codes == code)
+            if not here.any():
+                continue
+            size = (_section_dtype(section).itemsize
+                    if section in keys_lengths else 0)
+            datastart = np.maximum(datastart,
+                                   np.where(here, sec_position+size, 0).max(axis=1))
+            if section in sections:
+                has = here.any(axis=1)
+                values = _gather(data, sec_position[has, np.argmax(here[has],
+                                                                   axis=1)],
+                                 _section_dtype(section))
+                for name in values.dtype.names:
+                    if owner[name] == section:
+                        table[name][rows][has] = values[name]
+
+        table['HDRSTART'][rows] = position
+        table['DATASTART'][rows] = datastart
+        table['NSEC'][rows] = nsec
+
+    return table
+
 # THIS IS IN READ_OBSHEAD!!!
 # def _read_preheader(f):
 #     """
@@ -952,6 +1210,56 @@ def _spectrum_from_header(fileobj, header, memmap=None):
                           nchan=header['NCHAN'] if 'NCHAN' in hdr else hdr['NPOIN'],
                           my_memmap=memmap)
 
+def _gather_spectra(data, datastart, nchan, copy=False):
+    """
+    Gather many spectra of ``nchan`` channels each from ``data``, a float32
+    memmap of the whole file, into one ``(nspec, nchan)`` array
+
+    ``datastart`` are the DATASTART byte positions of the spectra (see
+    `read_observation`).  If the spectra are evenly spaced in the file, the
+    result is a (read-only) strided view of ``data`` unless ``copy`` is set;
+    otherwise they are copied with a single fancy-indexing operation.
+    """
+    # read_observation reads the spectrum starting at byte DATASTART-1
+    starts = (np.asarray(datastart, dtype='int64') - 1) // 4
+    nchan = int(nchan)
+    if len(starts) == 0:
+        return np.empty((0, nchan), dtype=data.dtype)
+    steps = np.diff(starts)
+    if len(steps) == 0 or (steps[0] > 0 and np.all(steps == steps[0])):
+        step = int(steps[0]) if len(steps) else nchan
+        first = int(starts[0])
+        block = data[first:first + step*(len(starts)-1) + nchan]
+        view = np.lib.stride_tricks.as_strided(block,
+                                               shape=(len(starts), nchan),
+                                               strides=(step*block.itemsize,
+                                                        block.itemsize))
+        return np.array(view) if copy else view
+    return data[starts[:,None] + np.arange(nchan)]
+
+def _downsample_spectra(spectra, factor, estimator=np.mean, weight=None):
+    """
+    `downsample_1d` applied to each row of a ``(nspec, nchan)`` array at once
+    """
+    factor = int(factor)
+    nout = spectra.shape[1] // factor
+    crarr = spectra[:, :nout*factor].reshape(spectra.shape[0], nout, factor)
+    if weight is None:
+        return estimator(crarr, axis=2)
+    weight = np.asarray(weight)[:nout*factor].reshape(nout, factor)
+    return estimator(crarr*weight, axis=2) / estimator(weight, axis=1)
+
+def _downsample_header_table(table, downsample_factor):
+    """ `downsample_header` applied to the columns of a header table """
+    for k in ('NCHAN','NPOIN'):
+        if k in table.dtype.names:
+            table[k] //= downsample_factor
+    scalefactor = 1./downsample_factor
+    table['RCHAN'] = (table['RCHAN']-1)*scalefactor + 0.5 + scalefactor/2.
+    for kw in ['FRES','VRES']:
+        table[kw] *= downsample_factor
+    return table
+
 def clean_header(header):
     newheader = {}
     for k in header:
@@ -968,13 +1276,97 @@ def clean_header(header):
 
     return newheader
 
+# Bump this whenever the contents of the index table or section headers change
+index_cache_version = 1
+
+def _index_cache_filename(filename):
+    return filename + '.pyspeckit_index.npz'
+
+def _read_index_cache(filename, file_description):
+    """
+    Read the `ClassIndex` and section headers table (see
+    `_read_section_headers`) of a CLASS file from its sidecar cache file.
+
+    Returns None if there is no cache or if it is stale: written by another
+    version of this module, or for a file with a different size,
+    modification time or number of entries.
+    """
+    cachename = _index_cache_filename(filename)
+    if not os.path.exists(cachename):
+        return None
+    stat = os.stat(filename)
+    try:
+        cache = np.load(cachename)
+        try:
+            if (cache['version'] != index_cache_version or
+                    cache['size'] != stat.st_size or
+                    cache['mtime'] != stat.st_mtime or
+                    len(cache['index']) != file_description['xnext']-1):
+                log.debug("Index cache {0} is stale.".format(cachename))
+                return None
+            return (ClassIndex(cache['index'].view(np.recarray)),
+                    cache['section_headers'].view(np.recarray))
+        finally:
+            cache.close()
+    except Exception as ex:
+        # a truncated or corrupt cache can fail in many ways (e.g.,
+        # zipfile.BadZipfile, zlib.error); it is rebuilt in all of them
+        log.warning("Could not read index cache {0} ({1}: {2}); rebuilding "
+                    "the index.".format(cachename, type(ex).__name__, ex))
+        return None
+
+def _write_index_cache(filename, index, section_headers):
+    """
+    Write the `ClassIndex` and section headers table of a CLASS file to its
+    sidecar cache file.  Failure (e.g., a read-only directory) is not an
+    error: the cache is just not written.
+    """
+    cachename = _index_cache_filename(filename)
+    stat = os.stat(filename)
+    tmpname = cachename + '.tmp{0}'.format(os.getpid())
+    try:
+        with open(tmpname, 'wb') as f:
+            np.savez(f, version=index_cache_version, size=stat.st_size,
+                     mtime=stat.st_mtime, index=index.table,
+                     section_headers=section_headers)
+        os.rename(tmpname, cachename)
+    except (IOError, OSError) as ex:
+        log.debug("Could not write index cache {0}: {1}".format(cachename, ex))
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
 class ClassObject(object):
-    def __init__(self, filename, verbose=False):
+    def __init__(self, filename, verbose=False, index_cache=True):
+        """
+        Parameters
+        ----------
+        filename : str
+            The CLASS file
+        verbose : bool
+            Report the time spent reading the file
+        index_cache : bool
+            Reuse the entry index, section headers and OTF scan identification
+            stored in a sidecar file (see `_read_index_cache`) if it is up to
+            date, and write one if not
+        """
         t0 = time.time()
+        self.filename = filename
         self._file = open(filename, 'rb')
         self.file_description = _read_first_record(self._file)
-        self.allind = _read_indices(self._file, self.file_description)
         self._data = np.memmap(self._file, dtype='float32', mode='r')
+
+        cached = (_read_index_cache(filename, self.file_description)
+                  if index_cache else None)
+        if cached is not None:
+            self.allind, self._section_headers = cached
+            self._spectra = LazyItem(self)
+            if verbose:
+                log.info("Loaded CLASS object with {0} indices from {1} in {2}s"
+                         .format(len(self.allind), _index_cache_filename(filename),
+                                 time.time()-t0))
+            return
+
+        self.allind = _read_indices(self._file, self.file_description)
         if verbose: log.info("Setting _spectra")
         self._spectra = LazyItem(self)
         t1 = time.time()
@@ -990,6 +1382,8 @@ class ClassObject(object):
                      " {0}s for indices, "
                      "{1}s for posang, and {2}s for OTF scan identification"
                      .format(t1-t0, t2-t1, t3-t2, len(self.allind)))
+        if index_cache:
+            _write_index_cache(filename, self.allind, self.section_headers)
 
 
     def __repr__(self):
@@ -1008,43 +1402,53 @@ class ClassObject(object):
         return info
 
     def set_posang(self):
-        h0 = self.headers[0]
-        for h in self.headers:
-            dx = h['OFF1'] - h0['OFF1']
-            dy = h['OFF2'] - h0['OFF2']
-            h['COMPPOSA'] = np.arctan2(dy,dx)*180/np.pi
-            h0 = h
+        """
+        Set COMPPOSA, the position angle of each entry's offset from the
+        previous entry's
+        """
+        off1 = self.allind['OFF1']
+        off2 = self.allind['OFF2']
+        # the first entry is compared with itself
+        dx = np.concatenate([np.zeros(1, off1.dtype), np.diff(off1)])
+        dy = np.concatenate([np.zeros(1, off2.dtype), np.diff(off2)])
+        self.allind['COMPPOSA'][:] = (np.arctan2(dy, dx).astype('float64')
+                                      *180/np.pi)
 
 
     def _identify_otf_scans(self, verbose=False):
-        h0 = self.allind[0]
-        st = 0
-        otfscan = 0
-        posangs = [h['COMPPOSA'] for h in self.allind]
-        if verbose:
-            pb = ProgressBar(len(self.allind))
-
-        for ii,h in enumerate(self.allind):
-            if (h['SCAN'] != h0['SCAN']
-                or h['SOURC'] != h0['SOURC']):
-
-                h0['FIRSTSCAN'] = st
-                cpa = np.median(posangs[st:ii])
-                for hh in self.allind[st:ii]:
-                    hh['SCANPOSA'] = cpa % 180
-                st = ii
-                if h['SCAN'] == h0['SCAN']:
-                    h0['OTFSCAN'] = otfscan
-                    otfscan += 1
-                    h['OTFSCAN'] = otfscan
-                else:
-                    otfscan = 0
-                    h['OTFSCAN'] = otfscan
-            else:
-                h['OTFSCAN'] = otfscan
+        """
+        Set SCANPOSA, OTFSCAN and FIRSTSCAN
 
-            if verbose:
-                pb.update(ii)
+        The entries are split into segments starting at each entry whose scan
+        or source differs from those of the first entry.  SCANPOSA is the
+        median COMPPOSA of each segment (it is not set for the last segment).
+        OTFSCAN counts the source changes within the first entry's scan.
+        """
+        table = self.allind.table
+        if len(table) == 0:
+            return
+        samescan = table['SCAN'] == table['SCAN'][0]
+        differs = ~samescan | (table['CSOUR'] != table['CSOUR'][0])
+
+        bounds = np.concatenate([[0], np.flatnonzero(differs)])
+        if len(bounds) > 1:
+            lengths = np.diff(bounds)
+            segment = np.repeat(np.arange(len(lengths)), lengths)
+            posangs = table['COMPPOSA'][:bounds[-1]]
+            posangs = posangs[np.lexsort((posangs, segment))]
+            median = (posangs[bounds[:-1] + (lengths-1)//2] +
+                      posangs[bounds[:-1] + lengths//2]) / 2.
+            table['SCANPOSA'][:bounds[-1]] = np.repeat(median % 180, lengths)
+            table['FIRSTSCAN'][0] = bounds[-2]
+
+        # a change of scan resets the count of source changes
+        changes = differs & samescan
+        count = np.cumsum(changes)
+        table['OTFSCAN'] = count - np.maximum.accumulate(np.where(samescan, 0,
+                                                                  count))
+        if count[-1] > 0:
+            # the first entry is given the count before the last change
+            table['OTFSCAN'][0] = table['OTFSCAN'][np.flatnonzero(changes)[-1]] - 1
 
     def listscans(self, source=None, telescope=None, out=sys.stdout):
         minid=0
@@ -1136,7 +1540,7 @@ class ClassObject(object):
         if hasattr(self,'_tels'):
             return self._tels
         else:
-            self._tels = set([h['XTEL'] for h in self.allind])
+            self._tels = set(self.allind.hash_index('XTEL'))
             return self._tels
 
     @property
@@ -1144,7 +1548,7 @@ class ClassObject(object):
         if hasattr(self,'_source'):
             return self._source
         else:
-            self._source = set([h['SOURC'] for h in self.allind])
+            self._source = set(self.allind.hash_index('SOURC'))
             return self._source
 
     @property
@@ -1152,7 +1556,7 @@ class ClassObject(object):
         if hasattr(self,'_scan'):
             return self._scan
         else:
-            self._scan = set([h['SCAN'] for h in self.allind])
+            self._scan = set(self.allind.hash_index('SCAN'))
             return self._scan
 
     @property
@@ -1166,7 +1570,7 @@ class ClassObject(object):
         if hasattr(self,'_lines'):
             return self._lines
         else:
-            self._lines = set([h['LINE'] for h in self.allind])
+            self._lines = set(self.allind.hash_index('LINE'))
             return self._lines
 
     def _load_all_spectra(self, indices=None):
@@ -1190,6 +1594,18 @@ class ClassObject(object):
             self._spectra.load_all()
 
 
+    @property
+    def section_headers(self):
+        """
+        The GENERAL, POSITION, SPECTRO and DRIFT header sections of all
+        entries, read in bulk by `_read_section_headers`
+        """
+        if not hasattr(self, '_section_headers'):
+            self._section_headers = _read_section_headers(self._data.view('uint8'),
+                                                          self.file_description,
+                                                          self.allind)
+        return self._section_headers
+
     @property
     def spectra(self):
         return [x[0] for x in self._spectra]
@@ -1236,45 +1652,55 @@ class ClassObject(object):
         if entry is not None and len(entry)==2:
             return irange(entry[0], entry[1])
 
-        if frequency is not None:
-            self._load_all_spectra()
-
-        sel = [(re.search(re.escape(line), h['LINE'], re.IGNORECASE)
-                if line is not None else True) and
-               (re.search(linere, h['LINE'], linereflags)
-                if linere is not None else True) and
-               (h['SCAN'] == scan if scan is not None else True) and
-               ((h['OFF1'] == offset or
-                 h['OFF2'] == offset) if offset is not None else True) and
-               (re.search(re.escape(source), h['CSOUR'], re.IGNORECASE)
-                if source is not None else True) and
-               (re.search(sourcere, h['CSOUR'], sourcereflags)
-                if sourcere is not None else True) and
-               (h['OFF1']>range[0] and h['OFF1'] < range[1] and
-                h['OFF2']>range[2] and h['OFF2'] < range[3]
-                if range is not None and len(range)==4 else True) and
-               (h['QUAL'] == quality if quality is not None else True) and
-               (re.search(re.escape(telescope), h['CTELE'], re.IGNORECASE)
-                if telescope is not None else True) and
-               (re.search(telescopere, h['CTELE'], telescopereflags)
-                if telescopere is not None else True) and
-               (h['SUBSCAN']==subscan if subscan is not None else True) and
-               (h['NUM'] >= number[0] and h['NUM'] < number[1]
-                if number is not None else True) and
-               ('RESTF' in h and # Need to check that it IS a spectrum: continuum data can't be accessed this way
-                h['RESTF'] > frequency[0] and
-                h['RESTF'] < frequency[1]
-                if frequency is not None and len(frequency)==2
-                else True) and
-               (h['COMPPOSA']%180 > posang[0] and
-                h['COMPPOSA']%180 < posang[1]
-                if posang is not None and len(posang)==2
-                else True) and
-               (h['XVER'] > 0 if not include_old_versions else True)
-               for h in self.headers
-              ]
-
-        return [ii for ii,k in enumerate(sel) if k]
+        index = self.allind
+        sel = np.ones(len(index), dtype='bool')
+
+        # compare offsets as python floats, as the header values would be
+        off1 = index['OFF1'].astype('float64')
+        off2 = index['OFF2'].astype('float64')
+
+        if line is not None:
+            sel &= index.select('LINE', pattern=re.escape(line),
+                                flags=re.IGNORECASE)
+        if linere is not None:
+            sel &= index.select('LINE', pattern=linere, flags=linereflags)
+        if scan is not None:
+            sel &= index.select('SCAN', scan)
+        if offset is not None:
+            sel &= (off1 == offset) | (off2 == offset)
+        if source is not None:
+            sel &= index.select('CSOUR', pattern=re.escape(source),
+                                flags=re.IGNORECASE)
+        if sourcere is not None:
+            sel &= index.select('CSOUR', pattern=sourcere, flags=sourcereflags)
+        if range is not None and len(range)==4:
+            sel &= ((off1 > range[0]) & (off1 < range[1]) &
+                    (off2 > range[2]) & (off2 < range[3]))
+        if quality is not None:
+            sel &= index['QUAL'] == quality
+        if telescope is not None:
+            sel &= index.select('CTELE', pattern=re.escape(telescope),
+                                flags=re.IGNORECASE)
+        if telescopere is not None:
+            sel &= index.select('CTELE', pattern=telescopere,
+                                flags=telescopereflags)
+        if subscan is not None:
+            sel &= index['SUBSCAN'] == subscan
+        if number is not None:
+            sel &= (index['NUM'] >= number[0]) & (index['NUM'] < number[1])
+        if frequency is not None and len(frequency)==2:
+            # RESTF is NaN for entries without a SPECTRO section (continuum
+            # data), so they are never selected
+            restf = self.section_headers['RESTF']
+            with np.errstate(invalid='ignore'):
+                sel &= (restf > frequency[0]) & (restf < frequency[1])
+        if posang is not None and len(posang)==2:
+            sel &= ((index['COMPPOSA']%180 > posang[0]) &
+                    (index['COMPPOSA']%180 < posang[1]))
+        if not include_old_versions:
+            sel &= index['XVER'] > 0
+
+        return np.flatnonzero(sel).tolist()
 
     def get_spectra(self, progressbar=True, **kwargs):
         selected_indices = self.select_spectra(**kwargs)
@@ -1297,6 +1723,73 @@ class ClassObject(object):
         return spectra
 
 
+    def get_spectra_array(self, downsample_factor=None, weight=None,
+                          estimator=np.mean, copy=False, **kwargs):
+        """
+        Read the selected spectra into a single ``(nspec, nchan)`` array,
+        without building a header dict or `~pyspeckit.Spectrum` per spectrum.
+
+        Parameters
+        ----------
+        downsample_factor : None or int
+            Factor by which to downsample the spectra (see `downsample_1d`)
+        weight : None or np.ndarray
+            Per-channel weights used when downsampling
+        estimator : function
+            The downsampling estimator
+        copy : bool
+            Always return a copy.  Otherwise, if the selected spectra are
+            evenly spaced in the file, the array is a read-only view of the
+            file's memmap.
+        kwargs : dict
+            Passed to `select_spectra`
+
+        Returns
+        -------
+        data : np.ndarray
+            The spectra, one per row, as float32
+        headers : np.recarray
+            One row per spectrum: RECNUM (the entry number), the columns of
+            the entry index and those of `section_headers`, with NCHAN, RCHAN,
+            FRES and VRES adjusted for downsampling
+        """
+        selected_indices = np.asarray(self.select_spectra(**kwargs),
+                                      dtype='int64')
+        if len(selected_indices) == 0:
+            raise ValueError("Selection yielded empty.")
+
+        index = self.allind.table[selected_indices]
+        sections = self.section_headers[selected_indices]
+        fields = [('RECNUM', 'int64')]
+        fields += [(name, index.dtype[name]) for name in index.dtype.names]
+        fields += [(name, sections.dtype[name]) for name in sections.dtype.names
+                   if name not in index.dtype.names]
+        headers = np.zeros(len(selected_indices), dtype=fields).view(np.recarray)
+        headers['RECNUM'] = selected_indices
+        for name in index.dtype.names:
+            headers[name] = index[name]
+        for name in sections.dtype.names:
+            if name not in index.dtype.names:
+                headers[name] = sections[name]
+
+        # continuum data store their length in NPOIN (see read_observation)
+        nchan = np.where(headers['KIND'] == 1, headers['NPOIN'],
+                         headers['NCHAN'])
+        if np.any(nchan != nchan[0]):
+            raise ValueError("The selected spectra have different numbers of "
+                             "channels ({0}); select a single setup."
+                             .format(sorted(set(nchan.tolist()))))
+
+        data = _gather_spectra(self._data, headers['DATASTART'], nchan[0],
+                               copy=copy and downsample_factor is None)
+        if downsample_factor is not None:
+            data = _downsample_spectra(data, downsample_factor,
+                                       estimator=estimator,
+                                       weight=weight).astype('float32')
+            headers = _downsample_header_table(headers, downsample_factor)
+
+        return data, headers
+
     def read_observations(self, observation_indices, progressbar=True):
         self._spectra.load(observation_indices, progressbar=progressbar)
         return [self._spectra[ii] for ii in observation_indices]
@@ -1399,10 +1892,10 @@ def make_axis(header,imagfreq=False):
 
     if not imagfreq:
         xarr =  rest_frequency + foff + (numpy.arange(1, nchan+1) - refchan) * fres
-        XAxis = units.SpectroscopicAxis(xarr,'MHz',frame='rest',refX=rest_frequency)
+        XAxis = units.SpectroscopicAxis(xarr,'MHz',refX=rest_frequency)
     else:
         xarr = imfreq - (numpy.arange(1, nchan+1) - refchan) * fres
-        XAxis = units.SpectroscopicAxis(xarr,'MHz',frame='rest',refX=imfreq)
+        XAxis = units.SpectroscopicAxis(xarr,'MHz',refX=imfreq)
 
     return XAxis
     
@@ -1476,6 +1969,106 @@ def class_to_obsblocks(filename, telescope, line, datatuple=None, source=None,
 
     return obslist
 
+def class_to_cube(filename, pixsize, beam_fwhm, kernel='gaussian',
+                  support=None, downsample_factor=None, chunksize=4096,
+                  numcores=1, parallel='thread', **kwargs):
+    """
+    Grid the on-the-fly spectra of a CLASS file into a `pyspeckit.Cube`
+
+    The spectra are read with `ClassObject.get_spectra_array` and gridded by
+    `pyspeckit.cubes.gridding.grid_spectra` at their OFF1/OFF2 offsets, on a
+    grid of ``pixsize`` pixels covering all of them with the reference
+    position at a pixel center.
+
+    Parameters
+    ----------
+    filename : str or ClassObject
+        The CLASS file
+    pixsize : float
+        The pixel size in arcseconds
+    beam_fwhm : float
+        The beam FWHM in arcseconds
+    kernel : 'gaussian' or 'besselgauss'
+        The gridding kernel (see `pyspeckit.cubes.gridding.kernel_weights`)
+    support : float or None
+        The kernel support radius in arcseconds (default ``beam_fwhm``)
+    downsample_factor : None or int
+        Factor by which to downsample the spectra before gridding
+    chunksize, numcores, parallel :
+        See `pyspeckit.cubes.gridding.grid_spectra`
+    kwargs : dict
+        Passed to `ClassObject.select_spectra`.  The selected spectra must
+        all have the same setup.
+
+    Returns
+    -------
+    cube : `pyspeckit.Cube`
+        The gridded cube, with the propagated noise as its ``errorcube`` and
+        the sum of the weights of each pixel as its ``weightmap`` attribute
+    """
+    from ...cubes import gridding
+
+    classobj = (filename if isinstance(filename, ClassObject)
+                else ClassObject(filename))
+    data, headers = classobj.get_spectra_array(downsample_factor=downsample_factor,
+                                               **kwargs)
+
+    rad_to_arcsec = 180/np.pi*3600
+    xoff = headers['OFF1'].astype('float64')*rad_to_arcsec
+    yoff = headers['OFF2'].astype('float64')*rad_to_arcsec
+    # pixel i of the x axis is at offset (i0-i)*pixsize, so RA increases to
+    # the left; pixel j of the y axis is at offset (j0+j)*pixsize
+    i0 = int(np.ceil(xoff.max()/pixsize))
+    j0 = int(np.floor(yoff.min()/pixsize))
+    nx = max(i0 - int(np.floor(xoff.min()/pixsize)) + 1, 2)
+    ny = max(int(np.ceil(yoff.max()/pixsize)) - j0 + 1, 2)
+    xaxis = (i0 - np.arange(nx))*pixsize
+    yaxis = (j0 + np.arange(ny))*pixsize
+
+    cube, weights, errors = gridding.grid_spectra(data, xoff, yoff, xaxis,
+                                                  yaxis, beam_fwhm,
+                                                  kernel=kernel,
+                                                  support=support,
+                                                  chunksize=chunksize,
+                                                  numcores=numcores,
+                                                  parallel=parallel)
+
+    hdr = dict((name, headers[name][0]) for name in headers.dtype.names)
+    xarr = make_axis(hdr)
+    galactic = hdr['TYPE'] == 3
+    header = pyfits.Header()
+    header['NAXIS'] = 3
+    header['NAXIS1'] = nx
+    header['NAXIS2'] = ny
+    header['NAXIS3'] = cube.shape[0]
+    header['CTYPE1'] = 'GLON-SFL' if galactic else 'RA---SFL'
+    header['CTYPE2'] = 'GLAT-SFL' if galactic else 'DEC--SFL'
+    header['CRVAL1'] = hdr['LAM']*180/np.pi
+    header['CRVAL2'] = hdr['BET']*180/np.pi
+    header['CRPIX1'] = i0 + 1
+    header['CRPIX2'] = 1 - j0
+    header['CDELT1'] = -pixsize/3600.
+    header['CDELT2'] = pixsize/3600.
+    header['CUNIT1'] = 'deg'
+    header['CUNIT2'] = 'deg'
+    header['CTYPE3'] = 'FREQ'
+    header['CRVAL3'] = (hdr['RESTF'] + hdr['FOFF'])*1e6
+    header['CRPIX3'] = hdr['RCHAN']
+    header['CDELT3'] = hdr['FRES']*1e6
+    header['CUNIT3'] = 'Hz'
+    header['RESTFRQ'] = hdr['RESTF']*1e6
+    header['BUNIT'] = 'K'
+    header['OBJECT'] = hdr['CSOUR'].decode().strip()
+    header['LINE'] = hdr['CLINE'].decode().strip()
+    header['TELESCOP'] = hdr['CTELE'].decode().strip()
+    header['BMAJ'] = beam_fwhm/3600.
+    header['BMIN'] = beam_fwhm/3600.
+
+    pcube = pyspeckit.Cube(cube=cube, xarr=xarr, header=header,
+                           errorcube=np.broadcast_to(errors, cube.shape))
+    pcube.weightmap = weights
+    return pcube
+
 class LazyItem(object):
     """
     Simple lazy spectrum-retriever wrapper
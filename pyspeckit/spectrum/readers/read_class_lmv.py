@@ -7,156 +7,170 @@ r2deg = 180/np.pi
     ignored.  No warning is needed.
 """
 
-def read_lmv(fn):
+# The 508-byte header of a GILDAS image, in file order (the position comments
+# are 4-byte word numbers, as in read_lmv).  Per GILDAS image_def.f90, each
+# axis is described by a (reference pixel, value at reference, increment)
+# triplet; read_lmv reports these as CRPIXi, CROTAi and CRVALi.
+lmv_header_dtype = np.dtype([
+    ('FILETYPE', 'S12'),
+    ('FMT', 'int32'), # 4
+    ('NDB', 'int32'), # 5
+    ('GDF_TYPE', 'int32'), # 6
+    ('RESERVED', 'int32', (4,)), # 7
+    ('GENERAL_LEN', 'int32'), # 11
+    ('NAXIS', 'int32'), # 12
+    ('NAXIS1', 'int32'), ('NAXIS2', 'int32'), ('NAXIS3', 'int32'),
+    ('NAXIS4', 'int32'),
+    ('REF1', 'float64'), ('VAL1', 'float64'), ('INC1', 'float64'), # 17
+    ('REF2', 'float64'), ('VAL2', 'float64'), ('INC2', 'float64'),
+    ('REF3', 'float64'), ('VAL3', 'float64'), ('INC3', 'float64'),
+    ('REF4', 'float64'), ('VAL4', 'float64'), ('INC4', 'float64'),
+    ('BLANK_LEN', 'int32'), # 41
+    ('BLANK', 'float32'), # 42
+    ('TOLERANC', 'int32'), # 43
+    ('EXTREMA_LEN', 'int32'), # 44
+    ('VMIN', 'float32'), ('VMAX', 'float32'), # 45
+    ('XMIN', 'int32'), ('XMAX', 'int32'), ('YMIN', 'int32'), # 47
+    ('YMAX', 'int32'), ('ZMIN', 'int32'), ('ZMAX', 'int32'),
+    ('WMIN', 'int32'), ('WMAX', 'int32'), # 53
+    ('DESCRIPTION_LEN', 'int32'), # 55
+    ('BUNIT', 'S12'), # 56
+    ('CTYPE1', 'S12'), ('CTYPE2', 'S12'), ('CTYPE3', 'S12'), # 59
+    ('CTYPE4', 'S12'), # 68
+    ('COOSYS', 'S12'), # 71
+    ('POSITION_LEN', 'int32'), # 74
+    ('OBJNAME', 'S12'), # 75
+    ('RA', 'float64'), ('DEC', 'float64'), # 78
+    ('GLON', 'float64'), ('GLAT', 'float64'), # 82
+    ('EQUINOX', 'float32'), # 86
+    ('PROJWORD', 'S4'), # 87
+    ('PTYP', 'int32'), # 88
+    ('A0', 'float64'), ('D0', 'float64'), ('PANG', 'float64'), # 89
+    ('XAXI', 'float32'), ('YAXI', 'float32'), # 95
+    ('SPECTROSCOPY_LEN', 'int32'), # 97
+    ('RECVR', 'S12'), # 98
+    ('FRES', 'float64'), # 101
+    ('IMAGFREQ', 'float64'), # 103 "FIMA"
+    ('REFFREQ', 'float64'), # 105
+    ('VRES', 'float32'), ('VOFF', 'float32'), # 107
+    ('FAXI', 'int32'), # 109
+    ('RESOLUTION_LEN', 'int32'), # 110
+    ('BMAJ', 'float32'), ('BMIN', 'float32'), ('BPA', 'float32'), # 111
+    ('NOISE_LEN', 'int32'), # 114
+    ('NOISE', 'float32'), ('RMS', 'float32'), # 115
+    ('ASTROMETRY_LEN', 'int32'), # 117
+    ('MURA', 'float32'), ('MUDEC', 'float32'), ('PARALLAX', 'float32'), # 118
+    ('OTHER', 'float32', (7,)), # 121-end
+])
+
+# The expected lengths of the header sections
+lmv_section_lengths = {'BLANK_LEN': 8, 'EXTREMA_LEN': 40,
+                       'DESCRIPTION_LEN': 72, 'POSITION_LEN': 48,
+                       'SPECTROSCOPY_LEN': 48, 'RESOLUTION_LEN': 12,
+                       'NOISE_LEN': 0, 'ASTROMETRY_LEN': 0}
+
+# GILDAS data formats (gildas_def: fmt_r4, fmt_r8)
+lmv_formats = {-11: 'float32', -12: 'float64'}
+
+def read_lmv_header(fn):
+    """
+    Read the header of an LMV cube file with a single structured read
+
+    Returns
+    -------
+    raw : np.record
+        The header fields, as laid out in `lmv_header_dtype`
+    header : dict
+        The header in the form returned by `read_lmv`
+    """
+    with open(fn,'rb') as lf:
+        # lf for "LMV File"
+        raw = np.fromfile(lf, dtype=lmv_header_dtype, count=1)
+    if len(raw) != 1 or raw['FILETYPE'][0] != b'GILDAS-IMAGE':
+        raise TypeError("File is not a GILDAS Image file")
+    raw = raw[0]
+
+    for name, length in lmv_section_lengths.items():
+        if raw[name] != length:
+            warnings.warn("Invalid section length found for {0} section"
+                          .format(name[:-4].lower()))
+    if not np.all(raw['OTHER'] == 0):
+        warnings.warn("Found additional information in the last 7 bytes")
+
+    header = {}
+    for ii in range(1,5):
+        header['NAXIS{0}'.format(ii)] = raw['NAXIS{0}'.format(ii)]
+    header['NAXIS'] = raw['NAXIS']
+    for ii in range(1,5):
+        header['CRPIX{0}'.format(ii)] = raw['REF{0}'.format(ii)]
+        header['CROTA{0}'.format(ii)] = raw['VAL{0}'.format(ii)]
+        header['CRVAL{0}'.format(ii)] = raw['INC{0}'.format(ii)]
+    header['CRVAL1'] *= r2deg
+    header['CRVAL2'] *= r2deg
+    for name in ('BLANK', 'TOLERANC', 'BUNIT', 'CTYPE1', 'CTYPE2', 'CTYPE3',
+                 'CTYPE4', 'COOSYS', 'OBJNAME', 'EQUINOX', 'PROJWORD', 'PTYP',
+                 'A0', 'D0', 'PANG', 'XAXI', 'YAXI', 'RECVR', 'FRES',
+                 'IMAGFREQ', 'REFFREQ', 'VRES', 'VOFF', 'FAXI', 'BMAJ', 'BMIN',
+                 'BPA', 'NOISE', 'RMS', 'MURA', 'MUDEC', 'PARALLAX'):
+        header[name] = raw[name]
+    for name in ('RA', 'DEC', 'GLON', 'GLAT'):
+        header[name] = raw[name] * r2deg
+    return raw, header
+
+def read_lmv(fn, memmap=False):
     """
     Read an LMV cube file
 
     Specification is primarily in GILDAS image_def.f90
+
+    Parameters
+    ----------
+    fn : str
+        The file name
+    memmap : bool
+        Return the data as a read-only `numpy.memmap` of the file rather than
+        reading it into memory.  Blanked values are then left as they are
+        (they equal ``header['BLANK']``) rather than set to NaN, and the
+        data are not checked against the extrema recorded in the header,
+        since both would read the whole cube.
+
+    Returns
+    -------
+    data : np.ndarray
+        The data, with shape ``[naxis4,naxis3,naxis2,naxis1]``
+    header : dict
     """
+    raw, header = read_lmv_header(fn)
+    shape = [max(raw['NAXIS4'],1), raw['NAXIS3'], raw['NAXIS2'], raw['NAXIS1']]
+    dtype = lmv_formats.get(int(raw['FMT']), 'float32')
+
+    if memmap:
+        return np.memmap(fn, dtype=dtype, mode='r',
+                         offset=lmv_header_dtype.itemsize, shape=tuple(shape)), header
 
-    header = {}
     with open(fn,'rb') as lf:
-        # lf for "LMV File"
-        filetype = lf.read(12)
-        if filetype != 'GILDAS-IMAGE':
-            raise TypeError("File is not a GILDAS Image file")
-
-        # fmt probably matters!  Default is "r4", i.e. float32 data, but could be float64
-        fmt = np.fromfile(lf, dtype='int32', count=1) # 4
-        # number of data blocks
-        ndb = np.fromfile(lf, dtype='int32', count=1) # 5
-        gdf_type = np.fromfile(lf, dtype='int32', count=1) # 6
-        # Reserved Space
-        reserved_fill = np.fromfile(lf, dtype='int32', count=4) # 7
-        general_section_length = np.fromfile(lf, dtype='int32', count=1) # 11
-        #print "Format: ",fmt," ndb: ",ndb, " fill: ",fill," other: ",unknown
-
-        # pos 12
-        naxis,naxis1,naxis2,naxis3,naxis4 = np.fromfile(lf,count=5,dtype='int32')
-        header['NAXIS'] = naxis
-        header['NAXIS1'] = naxis1
-        header['NAXIS2'] = naxis2
-        header['NAXIS3'] = naxis3
-        header['NAXIS4'] = naxis4
-
-        # We are indexing bytes from here; CLASS indices are higher by 12
-        # pos 17
-        header['CRPIX1'] = np.fromfile(lf,count=1,dtype='float64')[0]
-        header['CROTA1'] = np.fromfile(lf,count=1,dtype='float64')[0]
-        header['CRVAL1'] = np.fromfile(lf,count=1,dtype='float64')[0] * r2deg
-        header['CRPIX2'] = np.fromfile(lf,count=1,dtype='float64')[0]
-        header['CROTA2'] = np.fromfile(lf,count=1,dtype='float64')[0]
-        header['CRVAL2'] = np.fromfile(lf,count=1,dtype='float64')[0] * r2deg
-        header['CRPIX3'] = np.fromfile(lf,count=1,dtype='float64')[0]
-        header['CROTA3'] = np.fromfile(lf,count=1,dtype='float64')[0]
-        header['CRVAL3'] = np.fromfile(lf,count=1,dtype='float64')[0]
-        header['CRPIX4'] = np.fromfile(lf,count=1,dtype='float64')[0]
-        header['CROTA4'] = np.fromfile(lf,count=1,dtype='float64')[0]
-        header['CRVAL4'] = np.fromfile(lf,count=1,dtype='float64')[0]
-        # pos 41
-        #print "Post-crval",lf.tell()
-        blank_section_length = np.fromfile(lf,count=1,dtype='int32')
-        if blank_section_length != 8:
-            warnings.warn("Invalid section length found for blanking section")
-        header['BLANK'] = np.fromfile(lf,count=1,dtype='float32')[0] # 42
-        header['TOLERANC'] = np.fromfile(lf,count=1,dtype='int32')[0] # 43 eval = tolerance
-        extrema_section_length = np.fromfile(lf,count=1,dtype='int32')[0] # 44
-        if extrema_section_length != 40:
-            warnings.warn("Invalid section length found for extrema section")
-        vmin,vmax = np.fromfile(lf,count=2,dtype='float32') # 45
-        xmin,xmax,ymin,ymax,zmin,zmax = np.fromfile(lf,count=6,dtype='int32') # 47
-        wmin,wmax = np.fromfile(lf,count=2,dtype='int32') # 53
-        description_section_length = np.fromfile(lf,count=1,dtype='int32')[0] # 55
-        if description_section_length != 72:
-            warnings.warn("Invalid section length found for description section")
-        #strings = lf.read(description_section_length) # 56
-        header['BUNIT'] = lf.read(12) # 56
-        header['CTYPE1'] = lf.read(12) # 59
-        header['CTYPE2'] = lf.read(12) # 62
-        header['CTYPE3'] = lf.read(12) # 65
-        header['CTYPE4'] = lf.read(12) # 68
-        header['COOSYS'] = lf.read(12) # 71
-        position_section_length = np.fromfile(lf,count=1,dtype='int32') # 74
-        if position_section_length != 48:
-            warnings.warn("Invalid section length found for position section")
-        header['OBJNAME'] = lf.read(4*3) # 75
-        header['RA'] = np.fromfile(lf, count=1, dtype='float64')[0] * r2deg # 78
-        header['DEC'] = np.fromfile(lf, count=1, dtype='float64')[0] * r2deg # 80
-        header['GLON'] = np.fromfile(lf, count=1, dtype='float64')[0] * r2deg # 82
-        header['GLAT'] = np.fromfile(lf, count=1, dtype='float64')[0] * r2deg # 84
-        header['EQUINOX'] = np.fromfile(lf,count=1,dtype='float32')[0] # 86
-        header['PROJWORD'] = lf.read(4) # 87
-        header['PTYP'] = np.fromfile(lf,count=1,dtype='int32')[0] # 88
-        header['A0'] = np.fromfile(lf,count=1,dtype='float64')[0] # 89
-        header['D0'] = np.fromfile(lf,count=1,dtype='float64')[0] # 91
-        header['PANG'] = np.fromfile(lf,count=1,dtype='float64')[0] # 93
-        header['XAXI'] = np.fromfile(lf,count=1,dtype='float32')[0] # 95
-        header['YAXI'] = np.fromfile(lf,count=1,dtype='float32')[0] # 96
-        spectroscopy_section_length = np.fromfile(lf,count=1,dtype='int32') # 97
-        if spectroscopy_section_length != 48:
-            warnings.warn("Invalid section length found for spectroscopy section")
-        header['RECVR'] = lf.read(12) # 98
-        header['FRES'] = np.fromfile(lf,count=1,dtype='float64')[0] # 101
-        header['IMAGFREQ'] = np.fromfile(lf,count=1,dtype='float64')[0] # 103 "FIMA"
-        header['REFFREQ'] = np.fromfile(lf,count=1,dtype='float64')[0] # 105
-        header['VRES'] = np.fromfile(lf,count=1,dtype='float32')[0] # 107
-        header['VOFF'] = np.fromfile(lf,count=1,dtype='float32')[0] # 108
-        header['FAXI'] = np.fromfile(lf,count=1,dtype='int32')[0] # 109
-        resolution_section_length = np.fromfile(lf,count=1,dtype='int32')[0] # 110
-        if resolution_section_length != 12:
-            warnings.warn("Invalid section length found for resolution section")
-        #header['DOPP'] = np.fromfile(lf,count=1,dtype='float16')[0] # 110a ???
-        #header['VTYP'] = np.fromfile(lf,count=1,dtype='int16')[0] # 110b
-        # integer, parameter :: vel_unk = 0      ! Unsupported referential :: planetary...)
-        # integer, parameter :: vel_lsr = 1      ! LSR referential
-        # integer, parameter :: vel_hel = 2      ! Heliocentric referential
-        # integer, parameter :: vel_obs = 3      ! Observatory referential
-        # integer, parameter :: vel_ear = 4      ! Earth-Moon barycenter referential
-        # integer, parameter :: vel_aut = -1     ! Take referential from data
-        header['BMAJ'] = np.fromfile(lf,count=1,dtype='float32')[0] # 111
-        header['BMIN'] = np.fromfile(lf,count=1,dtype='float32')[0] # 112
-        header['BPA'] = np.fromfile(lf,count=1,dtype='float32')[0] # 113
-        noise_section_length = np.fromfile(lf,count=1,dtype='int32')
-        if noise_section_length != 0:
-            warnings.warn("Invalid section length found for noise section")
-        header['NOISE'] = np.fromfile(lf,count=1,dtype='float32')[0] # 115
-        header['RMS'] = np.fromfile(lf,count=1,dtype='float32')[0] # 116
-        astrometry_section_length = np.fromfile(lf,count=1,dtype='int32')
-        if astrometry_section_length != 0:
-            warnings.warn("Invalid section length found for astrometry section")
-        header['MURA'] = np.fromfile(lf,count=1,dtype='float32')[0] # 118
-        header['MUDEC'] = np.fromfile(lf,count=1,dtype='float32')[0] # 119
-        header['PARALLAX'] = np.fromfile(lf,count=1,dtype='float32')[0] # 120
-
-        other_info = np.fromfile(lf, count=7, dtype='float32') # 121-end
-        if not np.all(other_info == 0):
-            warnings.warn("Found additional information in the last 7 bytes")
-
-        endpoint = 508
-        if lf.tell() != endpoint:
-            raise ValueError("Header was not parsed correctly")
-
-        data = np.fromfile(lf, count=naxis1*naxis2*naxis3, dtype='float32')
+        lf.seek(lmv_header_dtype.itemsize)
+        data = np.fromfile(lf, count=int(np.prod(shape)), dtype=dtype)
 
     data[data == header['BLANK']] = np.nan
 
     # for no apparent reason, y and z are 1-indexed and x is zero-indexed
-    if (wmin-1,zmin-1,ymin-1,xmin) != np.unravel_index(np.nanargmin(data),
-                                                       [naxis4,naxis3,naxis2,naxis1]):
+    if ((raw['WMIN']-1,raw['ZMIN']-1,raw['YMIN']-1,raw['XMIN']) !=
+            np.unravel_index(np.nanargmin(data), shape)):
         warnings.warn("Data min location does not match that on file.  "
                       "Possible error reading data.")
-    if (wmax-1,zmax-1,ymax-1,xmax) != np.unravel_index(np.nanargmax(data),
-                                                       [naxis4,naxis3,naxis2,naxis1]):
+    if ((raw['WMAX']-1,raw['ZMAX']-1,raw['YMAX']-1,raw['XMAX']) !=
+            np.unravel_index(np.nanargmax(data), shape)):
         warnings.warn("Data max location does not match that on file.  "
                       "Possible error reading data.")
-    if np.nanmax(data) != vmax:
+    if np.nanmax(data) != raw['VMAX']:
         warnings.warn("Data max does not match that on file.  "
                       "Possible error reading data.")
-    if np.nanmin(data) != vmin:
+    if np.nanmin(data) != raw['VMIN']:
         warnings.warn("Data min does not match that on file.  "
                       "Possible error reading data.")
 
-    return data.reshape([naxis4,naxis3,naxis2,naxis1]),header
+    return data.reshape(shape),header
     # debug
     #return data.reshape([naxis3,naxis2,naxis1]), header, hdr_f, hdr_s, hdr_i, hdr_d, hdr_d_2
 
@@ -168,3 +182,87 @@ def read_lmv_tofits(fn):
     Header = fits.Header(cards)
     hdu = fits.PrimaryHDU(data=data, header=Header)
     return hdu
+
+# GILDAS projection codes (gildas_def: p_none, p_gnomonic, ...) and their
+# FITS equivalents
+lmv_projections = {0: 'CAR', 1: 'TAN', 2: 'SIN', 3: 'ARC', 4: 'STG', 5: 'ZEA',
+                   6: 'AIT', 7: 'GLS', 8: 'SFL', 9: 'MOL', 10: 'NCP',
+                   11: 'CAR'}
+
+def lmv_to_cube(fn, **kwargs):
+    """
+    Open an LMV cube file as a `pyspeckit.Cube` whose data are a memmap of
+    the file (see `read_lmv`), so spectra are only read from disk when they
+    are used
+
+    The data are reordered (as a view, without copying) to the
+    ``[spectral, y, x]`` order `~pyspeckit.cubes.SpectralCube.Cube` expects,
+    whichever axis ``FAXI`` says is the spectral one.  Blanked values are not
+    replaced by NaN; pass a ``maskmap`` to exclude blanked positions from
+    fits.
+
+    Parameters
+    ----------
+    fn : str
+        The file name
+    kwargs : dict
+        Passed to `~pyspeckit.cubes.SpectralCube.Cube`
+    """
+    from astropy.io import fits
+    import pyspeckit
+    from ..units import SpectroscopicAxis
+
+    data, _ = read_lmv(fn, memmap=True)
+    raw, _ = read_lmv_header(fn)
+    data = data[0]
+    faxi = int(raw['FAXI']) or 3
+    # numpy axis a holds FITS axis 3-a
+    specaxis = 3 - faxi
+    order = [specaxis] + [a for a in (0,1,2) if a != specaxis]
+    cube = data.transpose(order)
+
+    hdr = fits.Header()
+    proj = lmv_projections.get(int(raw['PTYP']), 'CAR')
+    for newaxis, a in zip((3,2,1), order):
+        ii = 3 - a
+        ref, val, inc = (raw['REF{0}'.format(ii)], raw['VAL{0}'.format(ii)],
+                         raw['INC{0}'.format(ii)])
+        ctype = raw['CTYPE{0}'.format(ii)].decode().strip().upper()
+        n = '{0}'.format(newaxis)
+        if ii == faxi:
+            if ctype.startswith('FREQ'):
+                hdr['CTYPE'+n] = 'FREQ'
+                hdr['CUNIT'+n] = 'MHz'
+                unit = 'MHz'
+            else:
+                hdr['CTYPE'+n] = 'VRAD'
+                hdr['CUNIT'+n] = 'km/s'
+                unit = 'km/s'
+            hdr['CRPIX'+n] = ref
+            hdr['CRVAL'+n] = val
+            hdr['CDELT'+n] = inc
+            xarr = SpectroscopicAxis((np.arange(cube.shape[0])+1-ref)*inc+val,
+                                     unit=unit, refX=raw['REFFREQ'],
+                                     refX_unit='MHz',
+                                     velocity_convention='radio')
+        else:
+            # spatial axes are offsets (val) from the projection center
+            # GILDAS names the galactic axes LII and BII
+            ctype = ctype.split('-')[0]
+            latitude = ctype in ('DEC', 'LAT', 'B', 'BII', 'GLAT')
+            if ctype in ('L', 'B', 'LII', 'BII', 'GLON', 'GLAT'):
+                hdr['CTYPE'+n] = ('GLAT-' if latitude else 'GLON-') + proj
+            else:
+                hdr['CTYPE'+n] = ('DEC--' if latitude else 'RA---') + proj
+            hdr['CRVAL'+n] = (raw['D0'] if latitude else raw['A0']) * r2deg
+            hdr['CRPIX'+n] = ref - val/inc
+            hdr['CDELT'+n] = inc * r2deg
+            hdr['CUNIT'+n] = 'deg'
+    hdr['RESTFRQ'] = raw['REFFREQ']*1e6
+    hdr['BUNIT'] = raw['BUNIT'].decode().strip()
+    hdr['OBJECT'] = raw['OBJNAME'].decode().strip()
+    hdr['BMAJ'] = raw['BMAJ'] * r2deg
+    hdr['BMIN'] = raw['BMIN'] * r2deg
+    hdr['BPA'] = raw['BPA'] * r2deg
+
+    return pyspeckit.Cube(cube=cube, xarr=xarr, header=hdr, **kwargs)
@@ -0,0 +1,215 @@
+"""
+Tests of the GBT SDFITS reductions on a small synthetic session
+"""
+
+import numpy as np
+import pytest
+try:
+    import astropy.io.fits as pyfits
+except ImportError:
+    import pyfits
+from pyspeckit.spectrum.readers import gbt
+
+
+# sampler: (IF center frequency, feed, polarization (CRVAL4))
+samplers = {'A9': (14.488e9, 1, -5), 'A10': (14.488e9, 1, -6),
+            'A11': (14.488e9, 2, -5), 'A12': (14.488e9, 2, -6),
+            'B25': (14.129e9, 1, -5), 'B26': (14.129e9, 1, -6),
+            'B27': (14.129e9, 2, -5), 'B28': (14.129e9, 2, -6)}
+
+def make_sdfits(nchan=64, nint=3, objects=('G33.13', 'OTHER'), vstep=5.,
+                veldef=None):
+    """
+    A nodded session: every sampler observes both nods (PROCSEQN 1 and 2) of
+    each object with ``nint`` integrations, each with the cal on and off.
+    The Doppler tracking (VFRAME) shifts the frequency axes of the
+    integrations by ``vstep`` m/s, a fraction of a channel by default.
+    """
+    rng = np.random.RandomState(3)
+    rows = []
+    channels = np.arange(nchan)
+    for objectname in objects:
+        for sampler in sorted(samplers):
+            freq, feed, pol = samplers[sampler]
+            gain = rng.uniform(0.5, 2)
+            tcal = rng.uniform(1, 2)
+            for nod in (1, 2):
+                # the source is in the beam of feed 1 in nod 1, of feed 2 in
+                # nod 2
+                onsource = (feed == nod)
+                for integration in range(nint):
+                    vframe = 1e3 + vstep*(nod*nint + integration)
+                    for cal in ('T', 'F'):
+                        tsys = 20 + 3*np.sin(channels/10.)
+                        line = (5*np.exp(-(channels-nchan/2.)**2/8.)
+                                if onsource else 0)
+                        counts = gain * (tsys + line + (tcal if cal == 'T'
+                                                        else 0) +
+                                         rng.normal(0, 0.1, nchan))
+                        rows.append((objectname, sampler, nod, cal, freq,
+                                     1e4, nchan/2.+1, freq, 1.5e4, vframe,
+                                     feed, 3-feed, tcal, pol,
+                                     rng.uniform(0.9, 1.1), 1.2, 280.,
+                                     -0.1, 'observer', 7.8e8,
+                                     '2012-01-01T00:00:00', counts))
+    names = ['OBJECT', 'SAMPLER', 'PROCSEQN', 'CAL', 'CRVAL1', 'CDELT1',
+             'CRPIX1', 'OBSFREQ', 'FREQRES', 'VFRAME', 'FEED', 'SRFEED',
+             'TCAL', 'CRVAL4', 'EXPOSURE', 'DURATION', 'TRGTLONG',
+             'TRGTLAT', 'OBSERVER', 'BANDWID', 'DATE-OBS', 'DATA']
+    formats = ['16A', '8A', 'J', '1A', 'D', 'D', 'D', 'D', 'D', 'D', 'I', 'I',
+               'E', 'I', 'D', 'D', 'D', 'D', '16A', 'D', '22A',
+               '%iE' % nchan]
+    columns = [pyfits.Column(name=name, format=fmt,
+                             array=np.array([row[ii] for row in rows]))
+               for ii, (name, fmt) in enumerate(zip(names, formats))]
+    if veldef is not None:
+        columns.append(pyfits.Column(name='VELDEF', format='8A',
+                                     array=np.array([veldef]*len(rows))))
+    bintable = pyfits.BinTableHDU.from_columns(columns)
+    bintable.header['PROJID'] = 'TEST'
+    bintable.header['TELESCOP'] = 'NRAO_GBT'
+    return pyfits.HDUList([pyfits.PrimaryHDU(), bintable])
+
+@pytest.fixture(scope='module')
+def session():
+    return gbt.GBTSession(make_sdfits())
+
+@pytest.fixture(scope='module')
+def obsblock_target(session):
+    """ The target read into ObsBlocks, which is slow, shared by the tests """
+    return gbt.GBTTarget(session, 'G33.13')
+
+def reduce_both(session, obsblock_target, obstype='nod', **kwargs):
+    """ Reduce the target from ObsBlocks and from the bintable columns """
+    obsblock_target.reduce(obstype=obstype, **kwargs)
+    columns = gbt.GBTTarget(session, 'G33.13', columnar=True)
+    columns.reduce(obstype=obstype, **kwargs)
+    return obsblock_target, columns
+
+def assert_spectra_equal(sp1, sp2):
+    np.testing.assert_allclose(sp2.data, sp1.data, rtol=1e-12)
+    np.testing.assert_allclose(sp2.error, sp1.error, rtol=1e-12)
+    np.testing.assert_array_equal(sp2.xarr.value, sp1.xarr.value)
+    for key in ('SAMPLER', 'PROCSEQN', 'CAL', 'FEED', 'OBSFREQ', 'CRVAL4'):
+        assert sp2.header[key] == sp1.header[key]
+    np.testing.assert_allclose(sp2.header['EXPOSURE'], sp1.header['EXPOSURE'],
+                               rtol=1e-12)
+
+@pytest.mark.parametrize('obstype', ['nod', 'tp'])
+def test_columnar_matches_obsblocks(session, obsblock_target, obstype):
+    blocks, columns = reduce_both(session, obsblock_target, obstype=obstype)
+    assert columns.blocks == {}
+    assert sorted(columns.reduced_scans) == sorted(samplers)
+    for name in samplers:
+        assert_spectra_equal(blocks[name], columns[name])
+    for name in ('A9', 'B27'):
+        # the header is that of the first signal row, whose exposure is the
+        # sum of those of the signal integrations
+        feed = samplers[name][1]
+        nod = feed if obstype == 'nod' else 1
+        data = session.bintable.data
+        rows = np.flatnonzero((data['OBJECT'] == 'G33.13') &
+                              (data['SAMPLER'] == name) &
+                              (data['PROCSEQN'] == nod) & (data['CAL'] == 'T'))
+        assert columns[name].header['PROCSEQN'] == nod
+        np.testing.assert_allclose(columns[name].header['EXPOSURE'],
+                                   data['EXPOSURE'][rows].sum(), rtol=1e-12)
+        tsys = gbt.dcmeantsys(blocks.blocks[name+'ON'+str(3-nod)].average(),
+                              blocks.blocks[name+'OFF'+str(3-nod)].average(),
+                              data['TCAL'][rows[0]])
+        if obstype == 'tp':
+            tsys = gbt.dcmeantsys(blocks.blocks[name+'ON1'].average(),
+                                  blocks.blocks[name+'OFF1'].average(),
+                                  data['TCAL'][rows[0]])
+        np.testing.assert_allclose(columns[name].header['TSYS'], tsys,
+                                   rtol=1e-12)
+    if obstype == 'nod':
+        # the source is recovered in the nodded spectra
+        for name in samplers:
+            assert 4.5 < columns[name].data.max() < 5.5
+
+@pytest.mark.parametrize('obstype', ['nod', 'tp'])
+def test_columnar_unaveraged(session, obsblock_target, obstype):
+    # reduce_nod and reduce_totalpower return the (nchan, nint) arrays of
+    # calibrated integrations, the columnar reduction the average of their
+    # finite values (the channels that the interpolation moved off the axis
+    # are zero, and so infinite once divided by the reference)
+    blocks, columns = reduce_both(session, obsblock_target, obstype=obstype,
+                                  average=False)
+    for name in samplers:
+        integrations = blocks.reduced_scans[name]
+        assert integrations.shape == (64, 3)
+        np.testing.assert_allclose(columns[name].data,
+                                   np.ma.masked_invalid(integrations).mean(axis=1),
+                                   rtol=1e-12)
+    if obstype == 'nod':
+        # the ratio of the averages differs from the average of the ratios
+        averaged = gbt.reduce_gbt_target_arrays(session.bintable, 'G33.13')
+        assert not np.allclose(averaged['A9'].data, columns['A9'].data,
+                               rtol=1e-12, atol=0)
+        np.testing.assert_allclose(averaged['A9'].data[1:],
+                                   columns['A9'].data[1:], atol=0.05)
+
+def test_columnar_average_pols_and_IFs(session, obsblock_target):
+    blocks, columns = reduce_both(session, obsblock_target)
+    for target in (blocks, columns):
+        target.average_pols()
+        target.average_IFs()
+    assert sorted(columns.averaged_pols) == ['if0fd1', 'if0fd2', 'if1fd1',
+                                             'if1fd2']
+    assert sorted(columns.averaged_IFs) == ['if0', 'if1']
+    for name in ('if0fd1', 'if0fd2', 'if1fd1', 'if1fd2', 'if0', 'if1'):
+        assert_spectra_equal(blocks[name], columns[name])
+    np.testing.assert_allclose(columns['if0fd2'].data,
+                               (columns['A11'].data + columns['A12'].data)/2.,
+                               rtol=1e-12)
+    np.testing.assert_allclose(columns['if1'].data,
+                               np.mean([columns[name].data for name in
+                                        ('B25', 'B26', 'B27', 'B28')],
+                                       axis=0),
+                               rtol=1e-12)
+
+def test_average_spectra_checks_axes(session):
+    reduced = gbt.reduce_gbt_target_arrays(session.bintable, 'G33.13')
+    # samplers of different IFs
+    with pytest.raises(ValueError) as err:
+        gbt._average_spectra([reduced['A9'], reduced['A10'], reduced['B25']])
+    assert 'X-axes' in str(err.value)
+    shorter = reduced['A10'].copy()
+    shorter.data = shorter.data[:-1]
+    with pytest.raises(ValueError):
+        gbt._average_spectra([reduced['A9'], shorter])
+
+def test_mismatched_nods():
+    # the Doppler tracking moves the nods apart by more than the tolerance
+    # of the arithmetic, a fifth of a channel
+    session = gbt.GBTSession(make_sdfits(vstep=20.))
+    with pytest.raises(ValueError):
+        gbt.GBTTarget(session, 'G33.13').reduce()
+    with pytest.raises(ValueError) as err:
+        gbt.GBTTarget(session, 'G33.13', columnar=True).reduce()
+    assert 'X-axes' in str(err.value)
+
+def test_bad_obstype(session):
+    with pytest.raises(NotImplementedError):
+        gbt.reduce_gbt_target_arrays(session.bintable, 'G33.13',
+                                     obstype='fs')
+
+@pytest.mark.parametrize('veldef', [None, 'RADI-OBS', 'OPTI-LSR',
+                                    'RELA-HEL'])
+def test_row_axes(veldef):
+    hdulist = make_sdfits(nint=2, objects=('G33.13',), veldef=veldef)
+    bintable = hdulist[1]
+    rows = np.arange(0, len(bintable.data), 3)
+    axes = gbt._row_axes(bintable, rows)
+    for row, xarr in zip(rows, axes):
+        np.testing.assert_array_equal(gbt.read_gbt_scan(bintable,
+                                                        row).xarr.value,
+                                      xarr)
+    # the frame velocity moves the axis by about OBSFREQ * VFRAME / c
+    row = rows[-1]
+    data = bintable.data
+    shift = data['OBSFREQ'][row] * data['VFRAME'][row] / 299792458.
+    topocentric = ((np.arange(64) - data['CRPIX1'][row] + 1) *
+                   data['CDELT1'][row] + data['CRVAL1'][row])
+    np.testing.assert_allclose(axes[-1] - topocentric, shift, rtol=1e-4)
@@ -0,0 +1,533 @@
+"""
+Tests of the CLASS reader on small synthetic v1 and v2 files
+"""
+
+import os
+import re
+import numpy as np
+import pytest
+from pyspeckit.spectrum.readers import read_class
+
+
+def make_entries():
+    """
+    Entries covering several scans, sources, lines (with different numbers
+    of channels) and an old version of one entry
+    """
+    rng = np.random.RandomState(42)
+    entries = []
+    layout = [(1, 'ORION'), (1, 'ORION'), (1, 'ORION'), (1, 'SKY-ORION'),
+              (1, 'SKY-ORION'), (1, 'ORION'), (1, 'ORION'), (2, 'ORION'),
+              (2, 'ORION'), (1, 'ORION'), (3, 'W51'), (3, 'W51')]
+    for ii, (scan, source) in enumerate(layout):
+        co = ii < 10
+        nchan = 64 if co else 32
+        entries.append(dict(source=source, line='CO(2-1)' if co else 'HCO+(3-2)',
+                            telescope='SMT-F1M-HU' if ii % 2 else 'SMT-F1M-VU',
+                            scan=scan, subscan=ii % 3 + 1, ver=-1 if ii == 6 else 1,
+                            qual=ii % 2, off1=rng.uniform(-1e-4, 1e-4),
+                            off2=rng.uniform(-1e-4, 1e-4), lam=1.46, bet=-0.09,
+                            restf=230538. if co else 267557.6, nchan=nchan,
+                            rchan=nchan/2., fres=-0.25, vres=0.33,
+                            data=rng.normal(size=nchan).astype('float32')))
+    return entries
+
+def _name(s):
+    return s.ljust(12)[:12]
+
+def write_class_file(filename, entries, version=1, lex1=None, reclen=128,
+                     lind=64):
+    """
+    Write a minimal CLASS file holding spectra with GENERAL, SPECTRO and
+    POSITION sections.  The v1 extensions are all ``lex1`` entries long; the
+    v2 extensions grow exponentially and the observations are not aligned on
+    records.
+    """
+    if lex1 is None:
+        lex1 = 4 if version == 1 else 2
+    if version == 1:
+        reclen, lind, gex = 128, 32, 10
+        first_records = 2
+        fields = read_class.index_fields_v1
+    else:
+        gex = 20
+        first_records = 1
+        fields = read_class.index_fields_v2
+    recbytes = reclen*4
+    nentries = len(entries)
+
+    # the number of entries in each extension
+    sizes = []
+    while sum(sizes) < nentries:
+        sizes.append(lex1 if gex == 10 else lex1*2**len(sizes))
+    aex, record = [], first_records + 1
+    for size in sizes:
+        aex.append(record)
+        record += -(-size*lind // reclen)
+
+    index = np.zeros(nentries, dtype=np.dtype({'names': [x[0] for x in fields],
+                                               'formats': [x[1] for x in fields],
+                                               'itemsize': lind*4}))
+    position = (record-1)*recbytes
+    observations = []
+    for ii, entry in enumerate(entries):
+        if version == 1 and position % recbytes:
+            position += recbytes - position % recbytes
+        general = np.zeros(1, read_class._section_dtype('GENERAL'))
+        general['UT'] = 0.1*ii
+        general['TSYS'] = 200 + ii
+        general['TIME'] = 10.
+        spectro = np.zeros(1, read_class._section_dtype('SPECTRO'))
+        spectro['LINE'] = _name(entry['line'])
+        spectro['RESTF'] = entry['restf']
+        spectro['NCHAN'] = entry['nchan']
+        spectro['RCHAN'] = entry['rchan']
+        spectro['FRES'] = entry['fres']
+        spectro['VRES'] = entry['vres']
+        spectro['IMAGE'] = entry['restf'] - 8000
+        pos = np.zeros(1, read_class._section_dtype('POSITION'))
+        pos['SOURC'] = _name(entry['source'])
+        pos['EPOCH'] = 2000.
+        pos['LAM'] = entry['lam']
+        pos['BET'] = entry['bet']
+        pos['LAMOF'] = entry['off1']
+        pos['BETOF'] = entry['off2']
+        sections = [(-2, general), (-4, spectro), (-3, pos)]
+        nsec = len(sections)
+
+        if version == 1:
+            headsize = 4 + 4*8 + 4*3*nsec
+        else:
+            headsize = 44 + 20*nsec
+        body = b''
+        addresses, lengths = [], []
+        for code, section in sections:
+            addresses.append((headsize + len(body))//4 + 1)
+            lengths.append(section.itemsize//4)
+            body += section.tostring()
+        # read_observation starts reading the spectrum one word before the
+        # end of the last section
+        body = body[:-4] + entry['data'].astype('float32').tostring()
+        nwords = (headsize + len(body))//4
+        codes = [code for code, _ in sections]
+        if version == 1:
+            head = (b'2   ' +
+                    np.array([1, nwords*4, headsize//4 + 1, nsec,
+                              entry['nchan'], ii+1, nsec, ii+1],
+                             'int32').tostring() +
+                    np.array(codes, 'int32').tostring() +
+                    np.array(lengths, 'int32').tostring() +
+                    np.array(addresses, 'int32').tostring())
+        else:
+            head = (b'2   ' + np.array([1, nsec], 'int32').tostring() +
+                    np.array([nwords, headsize//4 + 1, entry['nchan'], ii+1],
+                             'int64').tostring() +
+                    np.array(codes, 'int32').tostring() +
+                    np.array(lengths, 'int64').tostring() +
+                    np.array(addresses, 'int64').tostring())
+        assert len(head) == headsize
+        observations.append((position, head + body))
+
+        row = index[ii]
+        row['BLOC'] = position//recbytes + 1
+        if 'WORD' in index.dtype.names:
+            row['WORD'] = (position % recbytes)//4 + 1
+        row['NUM'] = ii + 1
+        row['VER'] = entry['ver']
+        row['CSOUR'] = _name(entry['source'])
+        row['CLINE'] = _name(entry['line'])
+        row['CTELE'] = _name(entry['telescope'])
+        row['CDOBS'] = -7000 + ii
+        row['DRED'] = -7000
+        row['OFF1'] = entry['off1']
+        row['OFF2'] = entry['off2']
+        row['TYPE'] = 2
+        row['QUAL'] = entry['qual']
+        row['SCAN'] = entry['scan']
+        row['POSA'] = 0.5
+        row['SUBSCAN'] = entry['subscan']
+        position += len(head) + len(body)
+
+    size = position + (-position % recbytes)
+    contents = np.zeros(size, dtype='uint8')
+    if version == 1:
+        first = (b'1A  ' +
+                 np.array([size//recbytes + 1, lex1, len(aex), nentries+1],
+                          'int32').tostring() +
+                 np.array(aex, 'int32').tostring())
+    else:
+        first = (b'2A  ' +
+                 np.array([reclen, 1, 2, lind, 0], 'int32').tostring() +
+                 np.array([nentries+1, size//recbytes + 1], 'int64').tostring() +
+                 np.array([1, lex1, len(aex), gex], 'int32').tostring() +
+                 np.array(aex, 'int64').tostring())
+    contents[:len(first)] = np.fromstring(first, dtype='uint8')
+    start = 0
+    for address, size in zip(aex, sizes):
+        rows = index[start:start+size].tostring()
+        offset = (address-1)*recbytes
+        contents[offset:offset+len(rows)] = np.fromstring(rows, dtype='uint8')
+        start += size
+    for position, observation in observations:
+        contents[position:position+len(observation)] = np.fromstring(observation,
+                                                                     dtype='uint8')
+    contents.tofile(filename)
+    return filename
+
+@pytest.fixture(params=[1, 2])
+def classfile(request, tmpdir):
+    filename = str(tmpdir.join('test_v{0}.cls'.format(request.param)))
+    return write_class_file(filename, make_entries(), version=request.param)
+
+def old_set_posang(headers):
+    """ The per-entry ClassObject.set_posang the table version replaced """
+    h0 = headers[0]
+    for h in headers:
+        dx = h['OFF1'] - h0['OFF1']
+        dy = h['OFF2'] - h0['OFF2']
+        h['COMPPOSA'] = np.arctan2(dy,dx)*180/np.pi
+        h0 = h
+
+def old_identify_otf_scans(headers):
+    """ The per-entry ClassObject._identify_otf_scans """
+    h0 = headers[0]
+    st = 0
+    otfscan = 0
+    posangs = [h['COMPPOSA'] for h in headers]
+    for ii,h in enumerate(headers):
+        if (h['SCAN'] != h0['SCAN']
+            or h['SOURC'] != h0['SOURC']):
+
+            h0['FIRSTSCAN'] = st
+            cpa = np.median(posangs[st:ii])
+            for hh in headers[st:ii]:
+                hh['SCANPOSA'] = cpa % 180
+            st = ii
+            if h['SCAN'] == h0['SCAN']:
+                h0['OTFSCAN'] = otfscan
+                otfscan += 1
+                h['OTFSCAN'] = otfscan
+            else:
+                otfscan = 0
+                h['OTFSCAN'] = otfscan
+        else:
+            h['OTFSCAN'] = otfscan
+
+def test_bulk_index_matches_read_index(classfile):
+    with open(classfile, 'rb') as f:
+        file_description = read_class._read_first_record(f)
+        assert file_description['nex'] == 3
+        allind = read_class._read_indices(f, file_description)
+        old = [read_class._read_index(f, filetype=file_description['version'],
+                                      entry_number=ii+1,
+                                      file_description=file_description)
+               for ii in range(file_description['xnext']-1)]
+
+    assert len(allind) == len(old) == len(make_entries())
+    for ii, index in enumerate(old):
+        bulk = allind[ii]
+        for name in [x[0] for x in read_class.index_fields_v1 +
+                     read_class.index_fields_v2]:
+            if name in index:
+                assert bulk[name] == index[name], (ii, name)
+        for key in index:
+            if key in bulk:
+                assert bulk[key] == index[key], (ii, key)
+        assert bulk['NUM'] == ii+1
+        assert bulk['SOURC'] == index['SOURC']
+        assert bulk['XVER'] == (-1 if ii == 6 else 1)
+
+def test_otf_columns_match_per_entry_loop(classfile):
+    classobj = read_class.ClassObject(classfile, index_cache=False)
+    with open(classfile, 'rb') as f:
+        file_description = read_class._read_first_record(f)
+        old = [read_class._read_index(f, filetype=file_description['version'],
+                                      entry_number=ii+1,
+                                      file_description=file_description)
+               for ii in range(file_description['xnext']-1)]
+    old_set_posang(old)
+    old_identify_otf_scans(old)
+
+    for ii, index in enumerate(old):
+        bulk = classobj.allind[ii]
+        for key in ('COMPPOSA', 'SCANPOSA', 'OTFSCAN', 'FIRSTSCAN'):
+            assert (key in bulk) == (key in index), (ii, key)
+            if key in index:
+                np.testing.assert_allclose(bulk[key], index[key], rtol=1e-6,
+                                           atol=1e-10, err_msg=str((ii, key)))
+    # the layout should exercise several segments and OTF scans
+    assert classobj.allind['OTFSCAN'].max() == 2
+    assert 'FIRSTSCAN' in classobj.allind[0]
+
+def old_select_spectra(headers, line=None, linere=None,
+                       linereflags=re.IGNORECASE, number=None, scan=None,
+                       offset=None, source=None, sourcere=None,
+                       sourcereflags=re.IGNORECASE, range=None, quality=None,
+                       telescope=None, telescopere=None,
+                       telescopereflags=re.IGNORECASE, subscan=None,
+                       posang=None, frequency=None, include_old_versions=False):
+    """ The per-header filter ClassObject.select_spectra used to apply """
+    sel = [(re.search(re.escape(line), h['LINE'], re.IGNORECASE)
+            if line is not None else True) and
+           (re.search(linere, h['LINE'], linereflags)
+            if linere is not None else True) and
+           (h['SCAN'] == scan if scan is not None else True) and
+           ((h['OFF1'] == offset or
+             h['OFF2'] == offset) if offset is not None else True) and
+           (re.search(re.escape(source), h['CSOUR'], re.IGNORECASE)
+            if source is not None else True) and
+           (re.search(sourcere, h['CSOUR'], sourcereflags)
+            if sourcere is not None else True) and
+           (h['OFF1']>range[0] and h['OFF1'] < range[1] and
+            h['OFF2']>range[2] and h['OFF2'] < range[3]
+            if range is not None and len(range)==4 else True) and
+           (h['QUAL'] == quality if quality is not None else True) and
+           (re.search(re.escape(telescope), h['CTELE'], re.IGNORECASE)
+            if telescope is not None else True) and
+           (re.search(telescopere, h['CTELE'], telescopereflags)
+            if telescopere is not None else True) and
+           (h['SUBSCAN']==subscan if subscan is not None else True) and
+           (h['NUM'] >= number[0] and h['NUM'] < number[1]
+            if number is not None else True) and
+           ('RESTF' in h and
+            h['RESTF'] > frequency[0] and
+            h['RESTF'] < frequency[1]
+            if frequency is not None and len(frequency)==2
+            else True) and
+           (h['COMPPOSA']%180 > posang[0] and
+            h['COMPPOSA']%180 < posang[1]
+            if posang is not None and len(posang)==2
+            else True) and
+           (h['XVER'] > 0 if not include_old_versions else True)
+           for h in headers
+          ]
+    return [ii for ii,k in enumerate(sel) if k]
+
+def test_section_headers_match_read_observation(classfile):
+    classobj = read_class.ClassObject(classfile, index_cache=False)
+    table = classobj.section_headers
+    entries = make_entries()
+    assert len(table) == len(entries)
+    for ii, entry in enumerate(entries):
+        spectrum, header = read_class.read_observation(
+            classobj._file, ii, file_description=classobj.file_description,
+            indices=classobj.allind, my_memmap=classobj._data)
+        np.testing.assert_array_equal(spectrum, entry['data'])
+        assert table['DATASTART'][ii] == header['DATASTART']
+        assert table['HDRSTART'][ii] == header['HDRSTART']
+        assert table['NCHAN'][ii] == header['NCHAN'] == entry['nchan']
+        assert table['RESTF'][ii] == header['RESTF'] == entry['restf']
+        for name in table.dtype.names:
+            if (name in header and name not in classobj.allind.table.dtype.names
+                    and name not in read_class.index_aliases):
+                assert table[name][ii] == header[name], (ii, name)
+        # the fields of the missing DRIFT section are blank
+        assert np.isnan(table['FREQ'][ii]) and 'FREQ' not in header
+
+@pytest.mark.parametrize('kwargs', [dict(),
+                                    dict(line='co(2-1)'),
+                                    dict(linere='^HCO'),
+                                    dict(scan=1),
+                                    dict(source='orion'),
+                                    dict(sourcere='^OR'),
+                                    dict(telescope='F1M-HU'),
+                                    dict(telescopere=r'VU\s*$'),
+                                    dict(quality=1, subscan=2),
+                                    dict(number=(3, 9)),
+                                    dict(range=(-5e-5, 1e-4, -1e-4, 5e-5)),
+                                    dict(frequency=(230000, 231000)),
+                                    dict(frequency=(260000, 270000), scan=3),
+                                    dict(posang=(0, 90)),
+                                    dict(line='CO', include_old_versions=True),
+                                    dict(source='NOTTHERE'),
+                                   ])
+def test_select_spectra_matches_old_filter(classfile, kwargs):
+    classobj = read_class.ClassObject(classfile, index_cache=False)
+    selection = classobj.select_spectra(**kwargs)
+    classobj._load_all_spectra()
+    assert selection == old_select_spectra(classobj.headers, **kwargs)
+
+def test_select_spectra_offset(classfile):
+    classobj = read_class.ClassObject(classfile, index_cache=False)
+    offset = float(classobj.allind['OFF2'][4])
+    assert classobj.select_spectra(offset=offset) == [4]
+    classobj._load_all_spectra()
+    assert old_select_spectra(classobj.headers, offset=offset) == [4]
+
+def assert_tables_equal(table1, table2):
+    assert table1.dtype == table2.dtype
+    for name in table1.dtype.names:
+        np.testing.assert_array_equal(table1[name], table2[name], err_msg=name)
+
+def test_index_cache_round_trip(classfile, monkeypatch):
+    cachename = read_class._index_cache_filename(classfile)
+    uncached = read_class.ClassObject(classfile, index_cache=False)
+    uncached.section_headers
+    assert not os.path.exists(cachename)
+
+    cold = read_class.ClassObject(classfile)
+    assert os.path.exists(cachename)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The index should come from the cache")
+    monkeypatch.setattr(read_class, '_read_indices', fail)
+    monkeypatch.setattr(read_class, '_read_section_headers', fail)
+    warm = read_class.ClassObject(classfile)
+    for classobj in (cold, warm):
+        assert_tables_equal(classobj.allind.table, uncached.allind.table)
+        assert_tables_equal(classobj.section_headers, uncached.section_headers)
+    assert warm.select_spectra(line='CO', frequency=(230000, 231000)) == \
+            uncached.select_spectra(line='CO', frequency=(230000, 231000))
+    data, headers = warm.get_spectra_array(line='CO(2-1)')
+    np.testing.assert_array_equal(data,
+                                  uncached.get_spectra_array(line='CO(2-1)')[0])
+
+def count_index_reads(monkeypatch):
+    calls = []
+    read_indices = read_class._read_indices
+    def counted(*args, **kwargs):
+        calls.append(1)
+        return read_indices(*args, **kwargs)
+    monkeypatch.setattr(read_class, '_read_indices', counted)
+    return calls
+
+def test_index_cache_stale_size(classfile, monkeypatch):
+    read_class.ClassObject(classfile)
+    calls = count_index_reads(monkeypatch)
+    read_class.ClassObject(classfile)
+    assert len(calls) == 0
+
+    stat = os.stat(classfile)
+    with open(classfile, 'ab') as f:
+        f.write(b'\x00'*512)
+    os.utime(classfile, (stat.st_atime, stat.st_mtime))
+    rewritten = read_class.ClassObject(classfile)
+    assert len(calls) == 1
+    assert len(rewritten.allind) == len(make_entries())
+    # the rewritten cache is up to date
+    read_class.ClassObject(classfile)
+    assert len(calls) == 1
+
+def test_index_cache_stale_mtime(classfile, monkeypatch):
+    read_class.ClassObject(classfile)
+    calls = count_index_reads(monkeypatch)
+    stat = os.stat(classfile)
+    os.utime(classfile, (stat.st_atime, stat.st_mtime + 10))
+    read_class.ClassObject(classfile)
+    assert len(calls) == 1
+    read_class.ClassObject(classfile)
+    assert len(calls) == 1
+
+def test_index_cache_stale_version(classfile, monkeypatch):
+    read_class.ClassObject(classfile)
+    calls = count_index_reads(monkeypatch)
+    monkeypatch.setattr(read_class, 'index_cache_version',
+                        read_class.index_cache_version + 1)
+    read_class.ClassObject(classfile)
+    assert len(calls) == 1
+
+def test_index_cache_unreadable(classfile, monkeypatch):
+    with open(read_class._index_cache_filename(classfile), 'wb') as f:
+        f.write(b'not a cache')
+    calls = count_index_reads(monkeypatch)
+    classobj = read_class.ClassObject(classfile)
+    assert len(calls) == 1
+    assert len(classobj.allind) == len(make_entries())
+
+@pytest.mark.parametrize('keep', [0.5, 0.9, 40])
+def test_index_cache_truncated(classfile, monkeypatch, keep):
+    reference = read_class.ClassObject(classfile)
+    cachename = read_class._index_cache_filename(classfile)
+    size = os.path.getsize(cachename)
+    with open(cachename, 'rb') as f:
+        contents = f.read()
+    with open(cachename, 'wb') as f:
+        f.write(contents[:int(size*keep) if keep < 1 else keep])
+    calls = count_index_reads(monkeypatch)
+    classobj = read_class.ClassObject(classfile)
+    assert len(calls) == 1
+    assert_tables_equal(classobj.allind.table, reference.allind.table)
+    assert_tables_equal(classobj.section_headers, reference.section_headers)
+    # the cache was rewritten
+    assert os.path.getsize(cachename) == size
+    read_class.ClassObject(classfile)
+    assert len(calls) == 1
+
+def test_get_spectra_array_strided_view(classfile):
+    classobj = read_class.ClassObject(classfile, index_cache=False)
+    # the CO entries are evenly spaced in the file
+    data, headers = classobj.get_spectra_array(line='CO(2-1)',
+                                               include_old_versions=True)
+    entries = make_entries()
+    assert headers['RECNUM'].tolist() == list(range(10))
+    assert np.may_share_memory(data, classobj._data)
+    assert not data.flags.writeable
+    for row, ii in zip(data, headers['RECNUM']):
+        np.testing.assert_array_equal(row, entries[ii]['data'])
+        np.testing.assert_array_equal(row, classobj._spectra[ii][0])
+
+    copied, _ = classobj.get_spectra_array(line='CO(2-1)',
+                                           include_old_versions=True, copy=True)
+    assert not np.may_share_memory(copied, classobj._data)
+    np.testing.assert_array_equal(copied, data)
+
+def test_get_spectra_array_fancy_index(classfile):
+    classobj = read_class.ClassObject(classfile, index_cache=False)
+    # leaving out the old version of entry 6 leaves a gap
+    data, headers = classobj.get_spectra_array(line='CO(2-1)')
+    entries = make_entries()
+    assert headers['RECNUM'].tolist() == [0, 1, 2, 3, 4, 5, 7, 8, 9]
+    assert not np.may_share_memory(data, classobj._data)
+    for row, ii in zip(data, headers['RECNUM']):
+        np.testing.assert_array_equal(row, entries[ii]['data'])
+    recnum = headers['RECNUM']
+    for name in ('NCHAN', 'RESTF', 'DATASTART'):
+        np.testing.assert_array_equal(headers[name],
+                                      classobj.section_headers[name][recnum])
+    for name in ('OFF1', 'CSOUR', 'SCAN'):
+        np.testing.assert_array_equal(headers[name], classobj.allind[name][recnum])
+
+def test_get_spectra_array_mixed_nchan(classfile):
+    classobj = read_class.ClassObject(classfile, index_cache=False)
+    with pytest.raises(ValueError) as ex:
+        classobj.get_spectra_array()
+    assert 'different numbers of channels' in str(ex.value)
+    data, headers = classobj.get_spectra_array(line='HCO+')
+    assert data.shape == (2, 32)
+
+@pytest.mark.parametrize(('factor', 'estimator'), [(2, np.mean), (3, np.mean),
+                                                   (4, np.sum)])
+def test_get_spectra_array_downsample(classfile, factor, estimator):
+    classobj = read_class.ClassObject(classfile, index_cache=False)
+    weight = np.random.RandomState(0).uniform(0.5, 2, size=64)
+    data, headers = classobj.get_spectra_array(line='CO(2-1)',
+                                               downsample_factor=factor,
+                                               weight=weight,
+                                               estimator=estimator)
+    full, fullheaders = classobj.get_spectra_array(line='CO(2-1)')
+    nout = 64 // factor
+    assert data.shape == (len(full), nout)
+    assert data.dtype == np.float32
+    for row, spectrum in zip(data, full):
+        expected = read_class.downsample_1d(spectrum[:nout*factor], factor,
+                                            estimator=estimator,
+                                            weight=weight[:nout*factor])
+        np.testing.assert_allclose(row, expected, rtol=1e-6)
+
+    unweighted, _ = classobj.get_spectra_array(line='CO(2-1)',
+                                               downsample_factor=factor)
+    for row, spectrum in zip(unweighted, full):
+        np.testing.assert_allclose(row,
+                                   read_class.downsample_1d(spectrum[:nout*factor],
+                                                            factor),
+                                   rtol=1e-6)
+
+    hdr = read_class.downsample_header(dict(NCHAN=64,
+                                            RCHAN=fullheaders['RCHAN'][0],
+                                            FRES=fullheaders['FRES'][0],
+                                            VRES=fullheaders['VRES'][0]),
+                                       factor)
+    assert np.all(headers['NCHAN'] == nout)
+    np.testing.assert_allclose(headers['RCHAN'], hdr['RCHAN'])
+    np.testing.assert_allclose(headers['FRES'], hdr['FRES'])
+    np.testing.assert_allclose(headers['VRES'], hdr['VRES'])
@@ -0,0 +1,122 @@
+"""
+Tests of the GILDAS LMV cube reader on small synthetic files
+"""
+
+import warnings
+import numpy as np
+import pytest
+from pyspeckit.spectrum.readers import read_class_lmv
+
+arcsec = np.pi/180/3600
+
+def write_lmv(filename, data, ctypes=('LII', 'BII', 'VELOCITY'), faxi=3):
+    """
+    Write ``data`` (in numpy order, ``[naxis3, naxis2, naxis1]``) as a
+    GILDAS image, with 2 arcsecond pixels offset from the projection center
+    and a 0.5 km/s or 0.25 MHz spectral axis
+    """
+    raw = np.zeros(1, dtype=read_class_lmv.lmv_header_dtype)
+    raw['FILETYPE'] = b'GILDAS-IMAGE'
+    raw['FMT'] = -11
+    for name, length in read_class_lmv.lmv_section_lengths.items():
+        raw[name] = length
+    raw['NAXIS'] = 3
+    for ii, n in enumerate(data.shape[::-1]):
+        raw['NAXIS{0}'.format(ii+1)] = n
+        ctype = ctypes[ii]
+        if ii+1 == faxi:
+            ref, val, inc = (3., 10., 0.5) if ctype == 'VELOCITY' else (3., 110201., 0.25)
+        else:
+            ref, val, inc = (2., 4*arcsec, 2*arcsec*(-1 if ii == 0 else 1))
+        raw['REF{0}'.format(ii+1)] = ref
+        raw['VAL{0}'.format(ii+1)] = val
+        raw['INC{0}'.format(ii+1)] = inc
+        raw['CTYPE{0}'.format(ii+1)] = ctype.ljust(12).encode()
+    raw['BLANK'] = -1000.
+    good = data != -1000
+    values = np.where(good, data, np.nan)
+    # x is 0-indexed and y, z and w are 1-indexed in the extrema
+    for kind, func in (('MIN', np.nanargmin), ('MAX', np.nanargmax)):
+        z, y, x = np.unravel_index(func(values), data.shape)
+        raw['V'+kind] = values[z, y, x]
+        raw['X'+kind], raw['Y'+kind] = x, y+1
+        raw['Z'+kind], raw['W'+kind] = z+1, 1
+    raw['BUNIT'] = b'K'.ljust(12)
+    raw['COOSYS'] = b'GALACTIC'.ljust(12)
+    raw['OBJNAME'] = b'W51'.ljust(12)
+    raw['A0'] = 49.5*np.pi/180
+    raw['D0'] = -0.4*np.pi/180
+    raw['PTYP'] = 1
+    raw['REFFREQ'] = 110201.
+    raw['FAXI'] = faxi
+    raw['BMAJ'] = raw['BMIN'] = 5*arcsec
+    with open(filename, 'wb') as f:
+        raw.tofile(f)
+        data.astype('float32').tofile(f)
+    return filename
+
+def make_data(shape):
+    data = np.arange(np.prod(shape), dtype='float32').reshape(shape) / 7.
+    data.flat[5] = -1000
+    return data
+
+def test_header_is_508_bytes():
+    assert read_class_lmv.lmv_header_dtype.itemsize == 508
+
+@pytest.mark.parametrize('memmap', [False, True])
+def test_read_lmv(tmpdir, memmap):
+    data = make_data((6, 4, 5))
+    filename = write_lmv(str(tmpdir.join('cube.lmv')), data)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        cube, header = read_class_lmv.read_lmv(filename, memmap=memmap)
+    assert cube.shape == (1, 6, 4, 5)
+    assert isinstance(cube, np.memmap) == memmap
+    expected = data.copy()
+    if not memmap:
+        expected[expected == -1000] = np.nan
+    np.testing.assert_array_equal(cube[0], expected)
+    assert (header['NAXIS1'], header['NAXIS2'], header['NAXIS3']) == (5, 4, 6)
+    assert header['CRPIX3'] == 3
+    assert header['CTYPE1'].strip() == b'LII'
+    np.testing.assert_allclose(header['CRVAL1'], -2/3600.)
+
+def test_lmv_to_cube_galactic(tmpdir):
+    data = make_data((6, 4, 5))
+    filename = write_lmv(str(tmpdir.join('cube.lmv')), data)
+    cube = read_class_lmv.lmv_to_cube(filename)
+    assert cube.cube.shape == (6, 4, 5)
+    np.testing.assert_array_equal(cube.cube, data)
+    header = cube.header
+    assert header['CTYPE1'] == 'GLON-TAN'
+    assert header['CTYPE2'] == 'GLAT-TAN'
+    assert header['CTYPE3'] == 'VRAD'
+    np.testing.assert_allclose(header['CRVAL1'], 49.5)
+    np.testing.assert_allclose(header['CRVAL2'], -0.4)
+    # the projection center is 2 pixels away from the reference pixel
+    np.testing.assert_allclose(header['CRPIX1'], 2 + 2)
+    np.testing.assert_allclose(header['CRPIX2'], 2 - 2)
+    np.testing.assert_allclose(header['CDELT1'], -2/3600.)
+    np.testing.assert_allclose(header['CDELT2'], 2/3600.)
+    np.testing.assert_allclose(np.asarray(cube.xarr), 10 + 0.5*(np.arange(6)-2))
+    assert cube.xarr.unit == 'km/s'
+
+def test_lmv_to_cube_spectral_first(tmpdir):
+    # spectral axis first (FITS axis 1), as in GILDAS "VLM" cubes
+    data = make_data((4, 5, 6))
+    filename = write_lmv(str(tmpdir.join('cube.vlm')), data,
+                         ctypes=('FREQUENCY', 'RA', 'DEC'), faxi=1)
+    cube = read_class_lmv.lmv_to_cube(filename)
+    assert cube.cube.shape == (6, 4, 5)
+    np.testing.assert_array_equal(cube.cube, data.transpose(2, 0, 1))
+    header = cube.header
+    assert header['CTYPE1'] == 'RA---TAN'
+    assert header['CTYPE2'] == 'DEC--TAN'
+    assert header['CTYPE3'] == 'FREQ'
+    # FITS axis 2 (RA) becomes axis 1, and axis 3 (DEC) axis 2
+    np.testing.assert_allclose(header['CDELT1'], 2/3600.)
+    np.testing.assert_allclose(header['CRPIX1'], 2 - 2)
+    np.testing.assert_allclose(header['CRVAL1'], 49.5)
+    np.testing.assert_allclose(header['CRVAL2'], -0.4)
+    np.testing.assert_allclose(np.asarray(cube.xarr.as_unit('MHz')),
+                               110201 + 0.25*(np.arange(6)-2))
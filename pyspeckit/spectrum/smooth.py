@@ -1,86 +1,205 @@
 import numpy as np
-import interpolation
+
+smoothtypes = ('gaussian', 'hanning', 'boxcar')
 
 def smoothed(spectrum, **kwargs):
     sp = spectrum.copy()
     sp.smooth(**kwargs)
     return sp
 
-def smooth(data, smooth, smoothtype='gaussian', downsample=True,
-           downsample_factor=None, convmode='same'):
+def smoothing_kernel(smooth, smoothtype='gaussian', nchan=None):
     """
-    Smooth and downsample the data array.  NaN data points will be replaced
-    with interpolated values
+    The normalized smoothing kernel
 
     Parameters
     ----------
-    smooth  :  float 
+    smooth  :  float
         Number of pixels to smooth by
     smoothtype : [ 'gaussian','hanning', or 'boxcar' ]
         type of smoothing kernel to use
-    downsample :  bool 
-        Downsample the data?
-    downsample_factor  :  int 
-        Downsample by the smoothing factor, or something else?
-    convmode : [ 'full','valid','same' ]
-        see :mod:`numpy.convolve`.  'same' returns an array of the same length as
-        'data' (assuming data is larger than the kernel)
+    nchan : int or None
+        The length of the data: a gaussian kernel is trimmed (symmetrically)
+        so that it is no longer than the data
     """
-    
-    roundsmooth = round(smooth) # can only downsample by integers
-
-    if downsample_factor is None and downsample:
-        downsample_factor = int(roundsmooth)
-    elif downsample_factor is None:
-        downsample_factor = 1
-
-    if smooth > len(data) or downsample_factor > len(data):
-        raise ValueError("Error: trying to smooth by more than the spectral length.")
+    roundsmooth = int(round(smooth))
 
     if smoothtype == 'hanning':
         kernel = np.hanning(2+roundsmooth)/np.hanning(2+roundsmooth).sum()
     elif smoothtype == 'gaussian':
-        xkern  = np.linspace(-5*smooth,5*smooth,smooth*11)
+        xkern  = np.linspace(-5*smooth,5*smooth,int(smooth*11))
         kernel = np.exp(-xkern**2/(2*(smooth/np.sqrt(8*np.log(2)))**2))
         kernel /= kernel.sum()
-        if len(kernel) > len(data):
-            lengthdiff = len(kernel)-len(data)
+        if nchan is not None and len(kernel) > nchan:
+            lengthdiff = len(kernel)-nchan
             if lengthdiff % 2 == 0: # make kernel same size as data
-                kernel = kernel[lengthdiff/2:-lengthdiff/2]
+                kernel = kernel[lengthdiff//2:-lengthdiff//2]
             else: # make kernel 1 pixel smaller than data but still symmetric
-                kernel = kernel[lengthdiff/2+1:-lengthdiff/2-1]
+                kernel = kernel[lengthdiff//2+1:-lengthdiff//2-1]
     elif smoothtype == 'boxcar':
         kernel = np.ones(roundsmooth)/float(roundsmooth)
+    else:
+        raise ValueError("smoothtype must be one of {0}".format(smoothtypes))
+
+    return kernel
+
+def _fft_length(n):
+    """
+    The smallest ``2**a * 3**b * 5**c`` that is at least ``n``: FFTs of these
+    lengths are fast
+    """
+    best = 2**int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            length = p35
+            while length < n:
+                length *= 2
+            best = min(best, length)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+def _convolve(data, kernel, convmode='same', step=1, method='auto'):
+    """
+    Convolve ``data`` with ``kernel`` along the first axis, the same way
+    `numpy.convolve` does for 1D data, keeping only every ``step``'th value of
+    the result.
+
+    With ``method='direct'``, only the values that are kept are computed,
+    with one vectorized multiply-add over all of the spectra per kernel
+    element.  With ``method='fft'``, the full convolution is computed with
+    FFTs, which is faster for wide kernels.  ``'auto'`` picks whichever needs
+    fewer operations.
+    """
+    nchan, nkern = data.shape[0], len(kernel)
+    lo, hi = min(nchan, nkern), max(nchan, nkern)
+    # the part of the full convolution that np.convolve returns
+    if convmode == 'full':
+        start, length = 0, nchan+nkern-1
+    elif convmode == 'same':
+        start, length = (lo-1)//2, hi
+    elif convmode == 'valid':
+        start, length = lo-1, hi-lo+1
+    else:
+        raise ValueError("convmode must be one of 'full', 'same', 'valid'")
+    nout = (length+step-1)//step
+    nfft = _fft_length(nchan+nkern-1)
+
+    if method == 'auto':
+        method = 'fft' if nkern*nout > nfft*np.log2(nfft) else 'direct'
+
+    if method == 'fft':
+        # transform along the last (contiguous) axis
+        spectra = np.ascontiguousarray(np.rollaxis(data, 0, data.ndim))
+        full = np.fft.irfft(np.fft.rfft(spectra, nfft, axis=-1) *
+                            np.fft.rfft(kernel, nfft), nfft, axis=-1)
+        return np.rollaxis(full[...,start:start+length:step], -1, 0)
+    elif method == 'direct':
+        padded = np.zeros((nchan+2*(nkern-1),)+data.shape[1:])
+        padded[nkern-1:nkern-1+nchan] = data
+        result = np.zeros((nout,)+data.shape[1:])
+        for k, weight in enumerate(kernel):
+            first = start - k + nkern-1
+            result += weight*padded[first:first+step*(nout-1)+1:step]
+        return result
+    else:
+        raise ValueError("method must be one of 'auto', 'direct', 'fft'")
+
+def smooth_array(data, smooth, smoothtype='gaussian', downsample=True,
+                 downsample_factor=None, convmode='same', method='auto'):
+    """
+    Smooth and downsample many spectra at once along the first axis of
+    ``data`` (e.g., an ``[speclen, nspec]`` ObsBlock or a cube).
+
+    NaN and masked data points are left out of the convolution and the
+    result is renormalized by the part of the kernel that fell on valid
+    data, so isolated bad points are filled in from their neighbors; values
+    where less than 1e-8 of the kernel weight falls on valid data are NaN.
+    Spectra without bad points get the plain convolution.
+
+    Parameters are as in `smooth`, plus
+
+    method : [ 'auto', 'direct', 'fft' ]
+        see `_convolve`.  With ``'direct'`` and ``downsample``, only the
+        values that are kept are ever computed.
+    """
+    data = np.ma.asarray(data)
+
+    roundsmooth = round(smooth) # can only downsample by integers
+
+    if downsample_factor is None and downsample:
+        downsample_factor = int(roundsmooth)
+    elif downsample_factor is None:
+        downsample_factor = 1
+
+    if smooth > data.shape[0] or downsample_factor > data.shape[0]:
+        raise ValueError("Error: trying to smooth by more than the spectral length.")
+
+    kernel = smoothing_kernel(smooth, smoothtype=smoothtype,
+                              nchan=data.shape[0])
+
+    def convolve(arr):
+        return _convolve(arr, kernel, convmode=convmode,
+                         step=downsample_factor, method=method)
 
     # deal with NANs or masked values
-    if hasattr(data,'mask'):
-        if type(data.mask) is np.ndarray:
-            OK = True - data.mask
-            if OK.sum() > 0:
-                data = interpolation._interp(np.arange(len(data)),np.arange(len(data))[OK],data[OK])
-            else:
-                data = OK
-    if np.any(True - np.isfinite(data)):
-        OK = np.isfinite(data)
-        if OK.sum() > 0:
-            data = interpolation._interp(np.arange(len(data)),np.arange(len(data))[OK],data[OK])
-        else:
-            data = OK
-
-    if np.any(True - np.isfinite(data)):
-        raise ValueError("NANs in data array after they have been forcibly removed.")
-
-    smdata = np.convolve(data,kernel,convmode)[::downsample_factor]
+    data = np.ma.filled(data.astype('float64'), np.nan)
+    OK = np.isfinite(data)
+    if OK.all():
+        return convolve(data)
+
+    smdata = convolve(np.where(OK, data, 0))
+    # the kernel weight on valid data, relative to what it would be with no
+    # bad data (which is less than 1 near the edges)
+    coverage = convolve(np.ones(data.shape[0]))
+    coverage = coverage.reshape(coverage.shape + (1,)*(data.ndim-1))
+    weight = convolve(OK.astype('float64'))
+    # an absolute cut: near the ends of a 'full' convolution the coverage
+    # itself is tiny and the FFT round-off would decide
+    good = weight > 1e-8*kernel.sum()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smdata = np.where(good, smdata*coverage/weight, np.nan)
+    if data.ndim > 1:
+        # spectra without bad data are the plain convolution
+        clean = OK.all(axis=0)
+        if clean.any():
+            smdata[:,clean] = convolve(data[:,clean])
 
     return smdata
 
-def smooth_multispec(data,smoothfactor,**kwargs):
-    """
-    Smooth multiple spectra as from an ObsBlock (shape should be [speclen, nspec])
+def smooth(data, smooth, smoothtype='gaussian', downsample=True,
+           downsample_factor=None, convmode='same', method='auto'):
     """
+    Smooth and downsample the data array.  NaN and masked data points are
+    filled in from their neighbors (see `smooth_array`)
 
-    nobs = data.shape[1]
+    Parameters
+    ----------
+    smooth  :  float
+        Number of pixels to smooth by
+    smoothtype : [ 'gaussian','hanning', or 'boxcar' ]
+        type of smoothing kernel to use
+    downsample :  bool
+        Downsample the data?
+    downsample_factor  :  int
+        Downsample by the smoothing factor, or something else?
+    convmode : [ 'full','valid','same' ]
+        see :mod:`numpy.convolve`.  'same' returns an array of the same length as
+        'data' (assuming data is larger than the kernel)
+    method : [ 'auto', 'direct', 'fft' ]
+        Convolve directly or with FFTs; 'auto' picks the faster one for the
+        kernel size
+    """
+    return smooth_array(data, smooth, smoothtype=smoothtype,
+                        downsample=downsample,
+                        downsample_factor=downsample_factor,
+                        convmode=convmode, method=method)
 
-    newdata = np.array( [smooth(D,smoothfactor,**kwargs) for D in data.swapaxes(0,1)]).swapaxes(0,1)
+def smooth_multispec(data,smoothfactor,**kwargs):
+    """
+    Smooth multiple spectra as from an ObsBlock (shape should be [speclen, nspec])
 
-    return newdata
+    All of the spectra are convolved at once: see `smooth_array`
+    """
+    return smooth_array(data, smoothfactor, **kwargs)
@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+from scipy.interpolate import BSpline, UnivariateSpline
+
+from .. import Spectrum
+from ..baseline import (_poly_lstsq, _bspline_basis, _interpolation_knots,
+                        _spline_baselines)
+
+
+def make_spectrum():
+    rng = np.random.RandomState(3)
+    x = np.linspace(-6, 6, 200)
+    y = 2 + 0.3*x - 0.05*x**2 + np.exp(-x**2/2.) + rng.normal(0, 0.05, x.size)
+    error = rng.uniform(0.02, 0.1, x.size)
+    return Spectrum(xarr=x, data=y, error=error, xarrkwargs={'unit':'km/s'})
+
+@pytest.mark.parametrize('order', [0, 1, 2, 5])
+def test_poly_lstsq(order):
+    rng = np.random.RandomState(order)
+    x = np.linspace(100, 200, 50)
+    data = rng.normal(size=(50, 4)) + x[:,None]/50.
+    weights = rng.uniform(0.5, 2, 50)
+    coefficients = _poly_lstsq(x, data, weights=weights, order=order)
+    assert coefficients.shape == (order+1, 4)
+    for ii in range(4):
+        expected = np.polyfit(x, data[:,ii], order, w=weights)
+        np.testing.assert_allclose(coefficients[:,ii], expected, rtol=1e-6,
+                                   atol=1e-10)
+        np.testing.assert_allclose(_poly_lstsq(x, data[:,ii], weights=weights,
+                                               order=order),
+                                   expected, rtol=1e-6, atol=1e-10)
+    np.testing.assert_allclose(_poly_lstsq(x, data[:,0], order=order),
+                               np.polyfit(x, data[:,0], order), rtol=1e-6,
+                               atol=1e-10)
+
+@pytest.mark.parametrize('order', [1, 2, 3])
+def test_baseline_matches_polyfit(order):
+    sp = make_spectrum()
+    x = np.asarray(sp.xarr)
+    sp.baseline(exclude=[-2, 2], order=order, subtract=False)
+    include = sp.baseline.includemask
+    assert not include.all() and include.any()
+    expected = np.polyfit(x[include], sp.data[include], order,
+                          w=1./sp.error[include])
+    np.testing.assert_allclose(sp.baseline.baselinepars, expected, rtol=1e-6,
+                               atol=1e-10)
+    np.testing.assert_allclose(sp.baseline.basespec, np.polyval(expected, x),
+                               rtol=1e-6)
+
+def test_baseline_all_masked_fits_everything():
+    sp = make_spectrum()
+    x = np.asarray(sp.xarr)
+    sp.baseline.set_spectofit()
+    sp.baseline.fit(order=2, includemask=np.zeros(x.size, dtype='bool'))
+    # all of the channels are fit with equal weights
+    expected = np.polyfit(x, sp.data, 2)
+    np.testing.assert_allclose(sp.baseline.baselinepars, expected, rtol=1e-6,
+                               atol=1e-10)
+    np.testing.assert_allclose(sp.baseline.basespec, np.polyval(expected, x),
+                               rtol=1e-6)
+
+def test_baseline_without_mask():
+    sp = make_spectrum()
+    x = np.asarray(sp.xarr)
+    bestfit, pars = sp.baseline._baseline(sp.data, xarr=sp.xarr, err=sp.error,
+                                          order=1, xarr_fit_units='km/s')
+    expected = np.polyfit(x, sp.data, 1, w=1./sp.error)
+    np.testing.assert_allclose(pars, expected, rtol=1e-6)
+    np.testing.assert_allclose(bestfit, np.polyval(expected, x), rtol=1e-6)
+
+@pytest.mark.parametrize('order', [1, 2, 3, 5])
+def test_bspline_basis_matches_dense(order):
+    xfit = np.sort(np.random.RandomState(order).uniform(0, 10, 30))
+    knots = _interpolation_knots(xfit, order, 0., 10.)
+    x = np.concatenate([np.linspace(0, 10, 101), knots])
+    first, values = _bspline_basis(x, knots, order)
+    assert values.shape == (len(x), order+1)
+    ncoef = len(knots) - order - 1
+    dense = np.zeros((len(x), ncoef))
+    for p in range(order+1):
+        dense[np.arange(len(x)), first+p] = values[:,p]
+    expected = np.array([BSpline(knots, np.eye(ncoef)[ii], order)(x)
+                         for ii in range(ncoef)]).T
+    np.testing.assert_allclose(dense, expected, atol=1e-12)
+
+@pytest.mark.parametrize('order', [1, 2, 3, 4, 5])
+@pytest.mark.parametrize('sampling', [1, 4])
+def test_spline_baselines_match_univariatespline(order, sampling):
+    rng = np.random.RandomState(5)
+    x = np.arange(500, dtype='float64')
+    data = np.sin(x/30.)[:,None] + rng.normal(0, 0.1, (500, 3))
+    good = np.ones(500, dtype='bool')
+    good[100:150] = False
+    baselines = _spline_baselines(x, data, good, order=order,
+                                  sampling=sampling, downsampler=np.mean)
+    ngood = good.sum()
+    endpoint = ngood - ngood % sampling
+    xfit = x[good][sampling//2:endpoint:sampling]
+    for ii in range(data.shape[1]):
+        yfit = data[good, ii][:endpoint].reshape(-1, sampling).mean(axis=1)
+        expected = UnivariateSpline(xfit, yfit, k=order, s=0)(x)
+        np.testing.assert_allclose(baselines[:,ii], expected, atol=1e-10)
+
+def test_spline_baselines_scale_linearly(monkeypatch):
+    # at sampling=1 there are as many spline coefficients as channels, so a
+    # dense basis (20000 x 20000) would take gigabytes and minutes: the basis
+    # and the normal matrix must stay banded, their sizes linear in nchan
+    import scipy.linalg
+    from .. import baseline
+    shapes = []
+    bspline_basis = baseline._bspline_basis
+    solveh_banded = scipy.linalg.solveh_banded
+    def basis(x, knots, order):
+        first, values = bspline_basis(x, knots, order)
+        shapes.append(values.shape)
+        return first, values
+    def solve(banded, rhs):
+        shapes.append(banded.shape)
+        return solveh_banded(banded, rhs)
+    def dense(*args, **kwargs):
+        raise AssertionError("dense least-squares solve")
+    monkeypatch.setattr(baseline, '_bspline_basis', basis)
+    monkeypatch.setattr(scipy.linalg, 'solveh_banded', solve)
+    monkeypatch.setattr(np.linalg, 'lstsq', dense)
+
+    rng = np.random.RandomState(6)
+    for nchan in (2000, 20000):
+        x = np.arange(nchan, dtype='float64')
+        data = np.sin(x/300.) + rng.normal(0, 0.1, nchan)
+        good = np.ones(nchan, dtype='bool')
+        good[nchan//3:nchan//2] = False
+        ngood = np.count_nonzero(good)
+        del shapes[:]
+        result = _spline_baselines(x, data[:,None], good, order=3,
+                                   sampling=1, downsampler=np.mean)
+        # order+1 nonzero basis functions per fitted and evaluated channel,
+        # and a normal matrix of order+1 diagonals of the ngood coefficients
+        assert shapes == [(ngood, 4), (4, ngood), (nchan, 4)]
+        expected = UnivariateSpline(x[good], data[good], k=3, s=0)(x)
+        np.testing.assert_allclose(result[:,0], expected, atol=1e-9)
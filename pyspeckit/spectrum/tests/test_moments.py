@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from ..moments import moments, moments_array
+
+
+def make_spectra(nchan=60, nspec=8):
+    """ Emission and absorption lines of several widths on noisy baselines """
+    rng = np.random.RandomState(4)
+    x = np.linspace(-15, 15, nchan)
+    amps = np.array([3, -2, 1.5, -4, 0.8, 5, -1, 2.5])[:nspec]
+    centers = rng.uniform(-5, 5, nspec)
+    widths = rng.uniform(0.8, 3, nspec)
+    data = (amps*np.exp(-(x[:,None]-centers)**2/(2*widths**2)) + 0.5 +
+            rng.normal(0, 0.2, (nchan, nspec)))
+    return x, data
+
+def assert_columns_match(x, data, **kwargs):
+    result = moments_array(x, data, **kwargs)
+    assert result.shape == (3+kwargs.get('vheight', True), data.shape[1])
+    for ii in range(data.shape[1]):
+        expected = moments(x, data[:,ii], **kwargs)
+        np.testing.assert_allclose(result[:,ii], expected, rtol=1e-10,
+                                   atol=1e-12)
+
+@pytest.mark.parametrize('negamp', [None, True, False])
+@pytest.mark.parametrize('nsigcut', [None, 1.5])
+@pytest.mark.parametrize('vheight', [True, False])
+def test_moments_array_matches_moments(negamp, nsigcut, vheight):
+    x, data = make_spectra()
+    assert_columns_match(x, data, negamp=negamp, nsigcut=nsigcut,
+                         vheight=vheight)
+
+@pytest.mark.parametrize('negamp', [None, True, False])
+def test_moments_array_noise_estimate(negamp):
+    x, data = make_spectra()
+    assert_columns_match(x, data, negamp=negamp, nsigcut=2,
+                         noise_estimate=0.3)
+    noise = np.linspace(0.1, 0.5, data.shape[1])
+    result = moments_array(x, data, negamp=negamp, nsigcut=2,
+                           noise_estimate=noise)
+    for ii in range(data.shape[1]):
+        np.testing.assert_allclose(result[:,ii],
+                                   moments(x, data[:,ii], negamp=negamp,
+                                           nsigcut=2,
+                                           noise_estimate=noise[ii]),
+                                   rtol=1e-10, atol=1e-12)
+
+@pytest.mark.parametrize('negamp', [None, True, False])
+@pytest.mark.parametrize('nsigcut', [None, 1.5])
+def test_moments_array_masked_channels(negamp, nsigcut):
+    x, data = make_spectra()
+    mask = np.zeros(data.shape, dtype='bool')
+    mask[:5] = True
+    mask[20:24, ::2] = True
+    mask[40, 1::3] = True
+    result = moments_array(x, np.ma.masked_array(data, mask=mask),
+                           negamp=negamp, nsigcut=nsigcut)
+    # non-finite values are ignored in the same way
+    nans = np.where(mask, np.nan, data)
+    np.testing.assert_array_equal(moments_array(x, nans, negamp=negamp,
+                                                nsigcut=nsigcut),
+                                  result)
+    for ii in range(data.shape[1]):
+        expected = moments(x, np.ma.masked_array(data[:,ii], mask=mask[:,ii]),
+                           estimator=np.ma.mean, negamp=negamp,
+                           nsigcut=nsigcut)
+        np.testing.assert_allclose(result[:,ii], expected, rtol=1e-10,
+                                   atol=1e-12)
+
+def test_moments_array_degenerate_spectra():
+    x, data = make_spectra(nspec=4)
+    data[:,1] = 2.
+    data[:,2] = np.nan
+    result = moments_array(x, data)
+    assert np.all(result[:,1:3] == 0)
+    np.testing.assert_array_equal(moments(x, data[:,1]), result[:,1])
+    np.testing.assert_allclose(result[:,0], moments(x, data[:,0]), rtol=1e-10)
+
+def test_moments_array_shape():
+    x, data = make_spectra()
+    cube = data.reshape(data.shape[0], 2, 4)
+    result = moments_array(x, cube, negamp=False)
+    assert result.shape == (4, 2, 4)
+    np.testing.assert_array_equal(result.reshape(4, -1),
+                                  moments_array(x, data, negamp=False))
+
+def test_moments_array_ignores_infinite_channels():
+    x, data = make_spectra()
+    data[10, 0] = np.inf
+    data[30, 3] = -np.inf
+    data[12, 5] = np.nan
+    result = moments_array(x, data)
+    assert np.all(np.isfinite(result))
+    # the same as the spectra with the non-finite channels masked
+    np.testing.assert_array_equal(result,
+                                  moments_array(x, np.ma.masked_invalid(data)))
+    with pytest.raises(ValueError):
+        moments(x, data[:,0])
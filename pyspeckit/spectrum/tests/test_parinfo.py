@@ -0,0 +1,162 @@
+import copy
+import numpy as np
+import pytest
+
+from ..parinfo import Parinfo, ParinfoList
+
+
+def make_parinfo():
+    return ParinfoList([Parinfo({'parname':'AMPLITUDE', 'value':2.,
+                                 'limits':(0,10), 'limited':(True,False)}),
+                        Parinfo({'parname':'SHIFT', 'value':0.5,
+                                 'limits':(-1,1), 'limited':(True,True)}),
+                        Parinfo({'parname':'WIDTH', 'value':1.,
+                                 'limits':(0.1,0), 'limited':(True,False),
+                                 'fixed':True, 'tied':'p[0]'})])
+
+def test_columns():
+    pl = make_parinfo()
+    np.testing.assert_array_equal(pl.column('value'), [2, 0.5, 1])
+    np.testing.assert_array_equal(pl.column('limits'),
+                                  [[0, 10], [-1, 1], [0.1, 0]])
+    np.testing.assert_array_equal(pl.column('limited'),
+                                  [[True, False], [True, True], [True, False]])
+    np.testing.assert_array_equal(pl.column('fixed'), [False, False, True])
+    assert list(pl.column('tied')) == ['', '', 'p[0]']
+    assert pl.values == [2, 0.5, 1]
+    assert pl.limits == [(0, 10), (-1, 1), (0.1, 0)]
+    assert pl.limited == [(True, False), (True, True), (True, False)]
+
+def test_column_is_read_only_view():
+    pl = make_parinfo()
+    values = pl.column('value')
+    assert not values.flags.writeable
+    with pytest.raises(ValueError):
+        values[0] = 3
+    # set_values writes the storage that the view looks at
+    pl.set_values([3, 0, 2], errors=[0.1, 0.2, 0.3])
+    np.testing.assert_array_equal(values, [3, 0, 2])
+    assert np.shares_memory(values, pl.column('value'))
+    np.testing.assert_array_equal(pl.column('error'), [0.1, 0.2, 0.3])
+    assert [par.value for par in pl] == [3, 0, 2]
+    assert [par.error for par in pl] == [0.1, 0.2, 0.3]
+    assert pl.values == [3, 0, 2]
+    assert pl.errors == [0.1, 0.2, 0.3]
+
+def test_set_values_checks_limits():
+    pl = make_parinfo()
+    with pytest.raises(ValueError) as err:
+        pl.set_values([-1, 0, 2])
+    assert '<' in str(err.value)
+    with pytest.raises(ValueError) as err:
+        pl.set_values([1, 2, 2])
+    assert '>' in str(err.value)
+    with pytest.raises(ValueError):
+        pl.values = [1, 0, 0]
+    # nothing was changed by the failed calls
+    assert pl.values == [2, 0.5, 1]
+    assert [par.value for par in pl] == [2, 0.5, 1]
+    # the same errors as setting the values one by one
+    with pytest.raises(ValueError):
+        pl[0].value = -1
+    with pytest.raises(ValueError):
+        pl.set_values([1, 0])
+    # unchecked, e.g. for the results of a fitter that can leave the limits
+    pl.set_values([-1, 2, 0], check=False)
+    assert pl.values == [-1, 2, 0]
+    # values at the limits are allowed
+    pl.set_values([0, 1, 0.1])
+    assert pl.values == [0, 1, 0.1]
+
+def test_limits_of_parameter_sets():
+    pl = make_parinfo()
+    values = np.array([[[2, 0.5, 1], [-1, 0.5, 1]],
+                       [[2, 1.5, 0], [20, -1, 100]]])
+    low, high = pl.limit_violations(values)
+    assert low.shape == high.shape == values.shape
+    np.testing.assert_array_equal(low[0,1], [True, False, False])
+    np.testing.assert_array_equal(high[1,0], [False, True, False])
+    np.testing.assert_array_equal(low[1,0], [False, False, True])
+    assert not low[1,1].any() and not high[1,1].any()
+    np.testing.assert_array_equal(pl.in_limits(values),
+                                  [[True, False], [False, True]])
+    # (nwalkers, npars), as from an MCMC ensemble
+    walkers = np.random.RandomState(0).uniform(-2, 12, (50, 3))
+    expected = [all(par.limits[0] <= w <= par.limits[1] if all(par.limited)
+                    else par.limits[0] <= w if par.limited[0] else True
+                    for par, w in zip(pl, walker))
+                for walker in walkers]
+    np.testing.assert_array_equal(pl.in_limits(walkers), expected)
+    assert pl.in_limits([2, 0.5, 1]) == True
+
+def test_columns_follow_parinfo_changes():
+    pl = make_parinfo()
+    assert pl.values == [2, 0.5, 1]
+    pl[0].value = 4
+    assert pl.values == [4, 0.5, 1]
+    pl['SHIFT']['value'] = -0.5
+    assert pl.values == [4, -0.5, 1]
+    pl[1].limits = (-2, 2)
+    np.testing.assert_array_equal(pl.column('limits')[1], [-2, 2])
+    pl[2].fixed = False
+    assert pl.fixed == [False, False, False]
+    # setting an item of the list sets the parameter's value
+    pl[1] = 0.25
+    assert pl.values == [4, 0.25, 1]
+    pl['WIDTH'] = 2.
+    assert pl.values == [4, 0.25, 2]
+    assert pl['WIDTH'] is pl[2]
+    with pytest.raises(ValueError):
+        pl[1] = 5.
+
+def test_columns_follow_list_changes():
+    pl = make_parinfo()
+    assert pl.values == [2, 0.5, 1]
+    pl.append(Parinfo({'parname':'OFFSET', 'value':7.}))
+    assert pl.values == [2, 0.5, 1, 7]
+    assert pl.limited[3] == (False, False)
+    pl.pop(1)
+    assert pl.values == [2, 1, 7]
+    pl.insert(0, Parinfo({'parname':'OTHER', 'value':-3.}))
+    assert pl.values == [-3, 2, 1, 7]
+    pl.reverse()
+    assert pl.values == [7, 1, 2, -3]
+    del pl[0]
+    assert pl.values == [1, 2, -3]
+    pl.extend([Parinfo({'parname':'LAST', 'value':9.})])
+    assert pl.values == [1, 2, -3, 9]
+
+def test_columns_are_per_list():
+    pl = make_parinfo()
+    other = make_parinfo()
+    assert pl.values == other.values
+    columns = other.__dict__['_columns']
+    pl[0].value = 5
+    # a change to one list's parameter leaves another list's columns alone
+    assert other.__dict__['_columns'] is columns
+    assert pl.__dict__['_columns'] is None
+    assert pl.values == [5, 0.5, 1]
+    assert other.values == [2, 0.5, 1]
+
+def test_shared_parinfo():
+    pl = make_parinfo()
+    other = ParinfoList(list(pl), preserve_order=True)
+    assert pl.values == other.values == [2, 0.5, 1]
+    pl[0].value = 3
+    assert other.values == [3, 0.5, 1]
+    # set_values bypasses the Parinfo setters, but not the other lists
+    other.set_values([4, 0, 1])
+    assert pl.values == [4, 0, 1]
+    # the columns of a removed parameter don't depend on it any more
+    popped = pl.pop(0)
+    popped.value = 6
+    assert pl.values == [0, 1]
+    assert other.values == [6, 0, 1]
+
+def test_copies_rebuild_their_columns():
+    pl = make_parinfo()
+    assert pl.values == [2, 0.5, 1]
+    plcopy = copy.deepcopy(pl)
+    plcopy[0].value = 3
+    assert plcopy.values == [3, 0.5, 1]
+    assert pl.values == [2, 0.5, 1]
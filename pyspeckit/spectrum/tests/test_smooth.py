@@ -0,0 +1,161 @@
+import numpy as np
+import pytest
+
+from ..smooth import (smooth, smooth_array, smooth_multispec, smoothing_kernel,
+                      smoothtypes, _convolve, _fft_length)
+
+
+def make_data(nchan=50, nspec=3):
+    rng = np.random.RandomState(7)
+    x = np.arange(nchan)
+    return (np.exp(-(x[:,None]-nchan/2.)**2/20.) +
+            rng.normal(0, 0.1, (nchan, nspec)))
+
+def convolve_columns(data, kernel, convmode='same', step=1):
+    return np.array([np.convolve(column, kernel, convmode)[::step]
+                     for column in data.T]).T
+
+def test_fft_length():
+    for n in range(1, 300):
+        length = _fft_length(n)
+        assert length >= n
+        remainder = length
+        for factor in (2, 3, 5):
+            while remainder % factor == 0:
+                remainder //= factor
+        assert remainder == 1
+        # no smaller 5-smooth number fits
+        assert all(_fft_length(m) == length for m in range(n, length+1))
+
+@pytest.mark.parametrize('method', ['direct', 'fft', 'auto'])
+@pytest.mark.parametrize('convmode', ['full', 'same', 'valid'])
+@pytest.mark.parametrize('step', [1, 2, 3, 5])
+@pytest.mark.parametrize(('nchan', 'nkern'), [(50, 7), (50, 8), (20, 20),
+                                              (9, 14)])
+def test_convolve_matches_numpy(method, convmode, step, nchan, nkern):
+    rng = np.random.RandomState(nchan+nkern)
+    data = rng.normal(size=(nchan, 4))
+    kernel = rng.uniform(size=nkern)
+    result = _convolve(data, kernel, convmode=convmode, step=step,
+                       method=method)
+    expected = convolve_columns(data, kernel, convmode, step)
+    assert result.shape == expected.shape
+    np.testing.assert_allclose(result, expected, atol=1e-12)
+    # a single spectrum and a cube of spectra
+    np.testing.assert_allclose(_convolve(data[:,0], kernel, convmode=convmode,
+                                         step=step, method=method),
+                               expected[:,0], atol=1e-12)
+    np.testing.assert_allclose(_convolve(data.reshape(nchan, 2, 2), kernel,
+                                         convmode=convmode, step=step,
+                                         method=method),
+                               expected.reshape(-1, 2, 2), atol=1e-12)
+
+def test_convolve_bad_arguments():
+    with pytest.raises(ValueError):
+        _convolve(np.ones(10), np.ones(3), convmode='wrong')
+    with pytest.raises(ValueError):
+        _convolve(np.ones(10), np.ones(3), method='wrong')
+
+@pytest.mark.parametrize('smoothtype', smoothtypes)
+@pytest.mark.parametrize('smoothfactor', [1, 2.4, 3, 4])
+@pytest.mark.parametrize('downsample_factor', [None, 1, 2, 3])
+@pytest.mark.parametrize('convmode', ['full', 'same', 'valid'])
+@pytest.mark.parametrize('method', ['direct', 'fft', 'auto'])
+def test_smooth_array_matches_numpy(smoothtype, smoothfactor,
+                                    downsample_factor, convmode, method):
+    data = make_data()
+    kernel = smoothing_kernel(smoothfactor, smoothtype=smoothtype,
+                              nchan=data.shape[0])
+    step = (int(round(smoothfactor)) if downsample_factor is None
+            else downsample_factor)
+    expected = convolve_columns(data, kernel, convmode, step)
+    result = smooth_array(data, smoothfactor, smoothtype=smoothtype,
+                          downsample_factor=downsample_factor,
+                          convmode=convmode, method=method)
+    np.testing.assert_allclose(result, expected, atol=1e-12)
+    np.testing.assert_allclose(smooth(data[:,1], smoothfactor,
+                                      smoothtype=smoothtype,
+                                      downsample_factor=downsample_factor,
+                                      convmode=convmode, method=method),
+                               expected[:,1], atol=1e-12)
+    np.testing.assert_allclose(smooth_multispec(data, smoothfactor,
+                                                smoothtype=smoothtype,
+                                                downsample_factor=downsample_factor,
+                                                convmode=convmode,
+                                                method=method),
+                               expected, atol=1e-12)
+
+@pytest.mark.parametrize('smoothtype', smoothtypes)
+def test_smooth_array_no_downsample(smoothtype):
+    data = make_data()
+    kernel = smoothing_kernel(3, smoothtype=smoothtype)
+    np.testing.assert_allclose(smooth_array(data, 3, smoothtype=smoothtype,
+                                            downsample=False),
+                               convolve_columns(data, kernel), atol=1e-12)
+
+def test_smooth_array_long_kernel():
+    # the gaussian kernel is trimmed to the length of the data, the hanning
+    # kernel is longer than the data
+    data = make_data(nchan=9)
+    for smoothtype in ('gaussian', 'hanning'):
+        kernel = smoothing_kernel(8, smoothtype=smoothtype, nchan=9)
+        for convmode in ('full', 'same', 'valid'):
+            np.testing.assert_allclose(smooth_array(data, 8,
+                                                    smoothtype=smoothtype,
+                                                    downsample=False,
+                                                    convmode=convmode),
+                                       convolve_columns(data, kernel,
+                                                        convmode),
+                                       atol=1e-12)
+    with pytest.raises(ValueError):
+        smooth_array(data, 10)
+
+@pytest.mark.parametrize('method', ['direct', 'fft'])
+@pytest.mark.parametrize('convmode', ['full', 'same', 'valid'])
+@pytest.mark.parametrize('step', [1, 2])
+def test_smooth_array_bad_data(method, convmode, step):
+    data = make_data(nspec=4)
+    bad = np.zeros(data.shape, dtype='bool')
+    bad[10, 0] = True
+    bad[30:33, 1] = True
+    bad[:4, 2] = True
+    kernel = smoothing_kernel(3)
+    # the normalized convolution: the kernel weights on the valid data are
+    # renormalized to those of the kernel on the whole spectrum
+    good = (~bad).astype('float64')
+    weight = convolve_columns(good, kernel, convmode, step)
+    coverage = np.convolve(np.ones(data.shape[0]), kernel, convmode)[::step]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = (convolve_columns(np.where(bad, 0, data), kernel, convmode,
+                                     step) * coverage[:,None] / weight)
+    # values where the kernel hardly touches valid data are NaN, and the
+    # spectrum without bad data is the plain convolution
+    expected[weight <= 1e-8] = np.nan
+    expected[:,3] = convolve_columns(data, kernel, convmode, step)[:,3]
+
+    # the FFT round-off is amplified by up to 1e8 where little of the kernel
+    # falls on valid data
+    atol = 1e-7 if method == 'fft' else 1e-12
+
+    nans = np.where(bad, np.nan, data)
+    masked = np.ma.masked_array(np.where(bad, 1e10, data), mask=bad)
+    for arr in (nans, masked):
+        result = smooth_array(arr, 3, downsample_factor=step,
+                              convmode=convmode, method=method)
+        np.testing.assert_allclose(result, expected, rtol=1e-10, atol=atol)
+    np.testing.assert_allclose(smooth(nans[:,0], 3, downsample_factor=step,
+                                      convmode=convmode, method=method),
+                               expected[:,0], rtol=1e-10, atol=atol)
+
+def test_smooth_array_all_bad():
+    data = make_data()
+    data[:,1] = np.nan
+    data[:20,2] = np.nan
+    result = smooth_array(data, 3, downsample=False, method='direct')
+    kernel = smoothing_kernel(3)
+    assert np.all(np.isnan(result[:,1]))
+    # values whose kernel covers no valid data at all are NaN
+    assert np.all(np.isnan(result[:20-len(kernel)//2,2]))
+    assert np.all(np.isfinite(result[20+len(kernel)//2:,2]))
+    np.testing.assert_allclose(result[:,0], np.convolve(data[:,0], kernel,
+                                                        'same'), atol=1e-12)
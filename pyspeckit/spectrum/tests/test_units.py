@@ -101,6 +101,22 @@ def test_convert_back(unit_from, unit_to,convention,ref_unit):
     assert xarr.unit == unit_from
 
 
+def test_as_unit_cache():
+    xarr = units.SpectroscopicAxis(np.linspace(1,10,10),unit='GHz')
+    hz = xarr.as_unit('Hz')
+    # cached result is a copy, not shared
+    hz.value[:] = 0
+    assert np.all(xarr.as_unit('Hz').value == np.linspace(1,10,10)*1e9)
+    # copies share the cache, but in-place changes invalidate it
+    xarr2 = xarr.copy()
+    xarr2.value[:] *= 2
+    assert np.all(xarr2.as_unit('Hz').value == np.linspace(2,20,10)*1e9)
+    assert np.all(xarr.as_unit('Hz').value == np.linspace(1,10,10)*1e9)
+    xarr.convert_to_unit('MHz')
+    assert np.all(xarr.as_unit('Hz').value == np.linspace(1,10,10)*1e9)
+    assert np.all(xarr.as_unit('GHz').value == np.linspace(1,10,10))
+
+
 if __name__=="__main__":
     unit_from='GHz'
     xarr = units.SpectroscopicAxis(np.linspace(1,10,10),unit=unit_from,refX=5,refX_unit='GHz')
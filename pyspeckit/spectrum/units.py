@@ -428,6 +428,11 @@ class SpectroscopicAxis(u.Quantity):
         self.center_frequency = getattr(obj, 'center_frequency', None)
         self.center_frequency_unit = getattr(obj, 'center_frequency_unit', None)
         self._equivalencies = getattr(obj, 'equivalencies', [])
+        # copies of an axis share its cache of unit conversions; the entries
+        # are validated against the axis values before they are used
+        self._as_unit_cache = getattr(obj, '_as_unit_cache', None)
+        if self._as_unit_cache is None:
+            self._as_unit_cache = {}
         # moved from __init__ - needs to be done whenever viewed
         # (this is slow, though - may be better not to do this)
         if self.shape: # check to make sure non-scalar
@@ -576,6 +581,8 @@ class SpectroscopicAxis(u.Quantity):
         new_values = self.as_unit(unit, **kwargs)
         self[:] = new_values.value * self.unit
         self.set_unit(unit)
+        # the values have changed, so any cached conversions are stale
+        self._as_unit_cache = {}
 
         self.flags.writeable=False
         self.make_dxarr()
@@ -606,7 +613,22 @@ class SpectroscopicAxis(u.Quantity):
             need to specify the central frequency around which that velocity is
             calculated.
             I think this can also accept wavelengths....
+
+        Notes
+        -----
+        If no conversion parameters are given, the result is cached (keyed on
+        the target unit) and reused as long as the axis values, unit,
+        reference frequency and velocity convention are unchanged.  Copies
+        of an axis share the cache.
         """
+        cacheable = not (equivalencies or velocity_convention or refX or
+                         refX_unit or center_frequency or center_frequency_unit
+                         or kwargs.get('equivalencies'))
+        if cacheable:
+            cached = self._cached_conversion(unit)
+            if cached is not None:
+                return cached.copy()
+
         if not velocity_convention:
             velocity_convention = self.velocity_convention
         if not equivalencies:
@@ -637,7 +659,40 @@ class SpectroscopicAxis(u.Quantity):
         if isinstance(self.unit, str):
             self._unit = u.Unit(self.unit)
 
-        return self.to(unit, equivalencies=self.equivalencies)
+        result = self.to(unit, equivalencies=self.equivalencies)
+        if cacheable:
+            self._cache_conversion(unit, result)
+        return result
+
+    def _conversion_state(self):
+        """
+        The attributes that determine the result of `as_unit`
+        """
+        return (str(self.unit), self.velocity_convention, repr(self.refX),
+                str(self.refX_unit), repr(self.center_frequency),
+                self._equivalencies)
+
+    def _cached_conversion(self, unit):
+        """
+        Return the cached conversion of this axis to ``unit``, or None if
+        there is none or the axis has changed since it was made
+        """
+        cache = getattr(self, '_as_unit_cache', None)
+        key = (str(unit), self.shape)
+        if not cache or key not in cache:
+            return None
+        state, values, result = cache[key]
+        if (state != self._conversion_state() or
+                not np.array_equal(values, self.value)):
+            return None
+        return result
+
+    def _cache_conversion(self, unit, result):
+        if not self.shape or getattr(self, '_as_unit_cache', None) is None:
+            return
+        self._as_unit_cache[(str(unit), self.shape)] = (self._conversion_state(),
+                                                        self.value.copy(),
+                                                        result.copy())
 
     def make_dxarr(self, coordinate_location='center'):
         """